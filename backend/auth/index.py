@@ -1,21 +1,46 @@
 import json
 import os
-import hashlib
+import sys
 import secrets
 from typing import Dict, Any, Optional
 from datetime import datetime, timedelta
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import passwords
 
-def hash_password(password: str) -> str:
-    return hashlib.sha256(password.encode()).hexdigest()
+# shared: из backend/ при локальном запуске, из каталога функции после bundle_shared.py при деплое
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from shared import adb, db, http_cache, metrics, models, resilience, shards
 
 def generate_token() -> str:
     return secrets.token_urlsafe(32)
 
-def get_db_connection():
-    return psycopg2.connect(os.environ['DATABASE_URL'], cursor_factory=RealDictCursor)
+def get_db_connection(readonly: bool = False, sticky_key: Optional[str] = None,
+                      statement_timeout_ms: Optional[int] = None):
+    return db.connect(readonly=readonly, sticky_key=sticky_key, statement_timeout_ms=statement_timeout_ms)
 
+def sync_doctor_shard(conn, doctor_id: Any) -> None:
+    '''При шардировании назначает врачу узел БД и обновляет на нём копию строки врача (shared/shards.py)'''
+    if not shards.enabled():
+        return
+    with conn.cursor() as cur:
+        route = shards.place_doctor(cur, int(doctor_id))
+        conn.commit()
+        shards.invalidate(route.doctor_id)
+        if shards.is_directory(route.shard):
+            return
+        shard_conn = db.connect(shard=route.shard)
+        try:
+            with shard_conn.cursor() as shard_cur:
+                shards.copy_doctor(cur, shard_cur, route.doctor_id)
+            shard_conn.commit()
+        finally:
+            shard_conn.close()
+
+def fetch_doctor(cur, doctor_id: Any) -> Optional[Dict[str, Any]]:
+    cur.execute(f"SELECT {models.Doctor.COLUMNS} FROM doctors WHERE id = %s", (doctor_id,))
+    return models.serialize_row(models.Doctor, cur.fetchone())
+
+@metrics.instrumented('auth')
+@db.read_your_writes
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     API для авторизации и регистрации врачей
@@ -29,7 +54,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, PUT, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token, x-auth-token',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token, x-auth-token, If-None-Match, X-Last-Write',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
@@ -41,8 +66,16 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         'Content-Type': 'application/json'
     }
     
+    request_headers = event.get('headers', {})
+    auth_token = request_headers.get('x-auth-token') or request_headers.get('X-Auth-Token')
+    client_ip = (event.get('requestContext') or {}).get('identity', {}).get('sourceIp')
+    
+    policy = resilience.READ if method == 'GET' else resilience.WRITE
+    
     try:
-        conn = get_db_connection()
+        slot = resilience.admit(policy)
+        conn = get_db_connection(readonly=(method == 'GET'), sticky_key=auth_token,
+                                 statement_timeout_ms=policy.statement_timeout_ms)
         cur = conn.cursor()
         
         if method == 'POST':
@@ -63,6 +96,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'isBase64Encoded': False
                     }
                 
+                passwords.throttle(client_ip)
                 cur.execute("SELECT id FROM doctors WHERE email = %s", (email,))
                 if cur.fetchone():
                     return {
@@ -72,22 +106,17 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'isBase64Encoded': False
                     }
                 
-                password_hash = hash_password(password)
+                password_hash = passwords.hash_password(password)
                 token = generate_token()
                 
                 cur.execute(
-                    "INSERT INTO doctors (email, password_hash, full_name, specialization) VALUES (%s, %s, %s, %s) RETURNING id",
+                    f"INSERT INTO doctors (email, password_hash, full_name, specialization) VALUES (%s, %s, %s, %s) RETURNING {models.Doctor.COLUMNS}",
                     (email, password_hash, full_name, specialization)
                 )
-                doctor_id = cur.fetchone()['id']
+                doctor = models.serialize_row(models.Doctor, cur.fetchone())
                 conn.commit()
-                
-                cur.execute(
-                    "SELECT id, email, full_name, specialization, signature_url, created_at FROM doctors WHERE id = %s",
-                    (doctor_id,)
-                )
-                doctor = dict(cur.fetchone())
-                doctor['created_at'] = doctor['created_at'].isoformat() if doctor['created_at'] else None
+                if doctor:
+                    sync_doctor_shard(conn, doctor['id'])
                 
                 return {
                     'statusCode': 200,
@@ -111,15 +140,16 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'isBase64Encoded': False
                     }
                 
-                password_hash = hash_password(password)
-                
+                passwords.throttle(client_ip, email)
                 cur.execute(
-                    "SELECT id, email, full_name, specialization, signature_url, created_at FROM doctors WHERE email = %s AND password_hash = %s",
-                    (email, password_hash)
+                    f"SELECT {models.Doctor.COLUMNS}, password_hash FROM doctors WHERE email = %s",
+                    (email,)
                 )
-                doctor = cur.fetchone()
+                row = cur.fetchone()
+                stored_hash = row[-1] if row else None
+                password_ok, needs_rehash = passwords.verify_password(password, stored_hash)
                 
-                if not doctor:
+                if not password_ok:
                     return {
                         'statusCode': 401,
                         'headers': headers,
@@ -127,8 +157,14 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'isBase64Encoded': False
                     }
                 
-                doctor = dict(doctor)
-                doctor['created_at'] = doctor['created_at'].isoformat() if doctor['created_at'] else None
+                doctor = models.serialize_row(models.Doctor, row)
+                if needs_rehash:
+                    # Старый SHA-256 или устаревшие параметры scrypt — перехэшируем, пока известен пароль
+                    cur.execute(
+                        "UPDATE doctors SET password_hash = %s WHERE id = %s AND password_hash = %s",
+                        (passwords.hash_password(password), doctor['id'], stored_hash)
+                    )
+                    conn.commit()
                 token = generate_token()
                 
                 return {
@@ -163,9 +199,10 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'isBase64Encoded': False
                     }
                 
-                old_hash = hash_password(old_password)
-                cur.execute("SELECT id FROM doctors WHERE id = %s AND password_hash = %s", (doctor_id, old_hash))
-                if not cur.fetchone():
+                passwords.throttle(client_ip, f'doctor:{doctor_id}')
+                cur.execute("SELECT password_hash FROM doctors WHERE id = %s", (doctor_id,))
+                existing = cur.fetchone()
+                if not passwords.verify_password(old_password, existing[0] if existing else None)[0]:
                     return {
                         'statusCode': 400,
                         'headers': headers,
@@ -173,7 +210,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'isBase64Encoded': False
                     }
                 
-                new_hash = hash_password(new_password)
+                new_hash = passwords.hash_password(new_password)
                 cur.execute("UPDATE doctors SET password_hash = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s", (new_hash, doctor_id))
                 conn.commit()
                 
@@ -218,17 +255,13 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     }
                 
                 cur.execute(
-                    "UPDATE doctors SET full_name = %s, email = %s, specialization = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
+                    f"UPDATE doctors SET full_name = %s, email = %s, specialization = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s RETURNING {models.Doctor.COLUMNS}",
                     (full_name, email, specialization, doctor_id)
                 )
+                doctor = models.serialize_row(models.Doctor, cur.fetchone())
                 conn.commit()
-                
-                cur.execute(
-                    "SELECT id, email, full_name, specialization, signature_url, created_at FROM doctors WHERE id = %s",
-                    (doctor_id,)
-                )
-                doctor = dict(cur.fetchone())
-                doctor['created_at'] = doctor['created_at'].isoformat() if doctor['created_at'] else None
+                if doctor:
+                    sync_doctor_shard(conn, doctor['id'])
                 
                 return {
                     'statusCode': 200,
@@ -260,17 +293,13 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     }
                 
                 cur.execute(
-                    "UPDATE doctors SET signature_url = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
+                    f"UPDATE doctors SET signature_url = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s RETURNING {models.Doctor.COLUMNS}",
                     (signature_url, doctor_id)
                 )
+                doctor = models.serialize_row(models.Doctor, cur.fetchone())
                 conn.commit()
-                
-                cur.execute(
-                    "SELECT id, email, full_name, specialization, signature_url, created_at FROM doctors WHERE id = %s",
-                    (doctor_id,)
-                )
-                doctor = dict(cur.fetchone())
-                doctor['created_at'] = doctor['created_at'].isoformat() if doctor['created_at'] else None
+                if doctor:
+                    sync_doctor_shard(conn, doctor['id'])
                 
                 return {
                     'statusCode': 200,
@@ -300,13 +329,11 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'isBase64Encoded': False
                 }
             
-            cur.execute(
-                "SELECT id, email, full_name, specialization, signature_url, created_at FROM doctors WHERE id = %s",
-                (doctor_id,)
-            )
-            doctor = cur.fetchone()
+            # Сначала только версия профиля: совпавший ETag — 304 без чтения подписи
+            cur.execute("SELECT updated_at FROM doctors WHERE id = %s", (doctor_id,))
+            version = cur.fetchone()
             
-            if not doctor:
+            if not version:
                 return {
                     'statusCode': 404,
                     'headers': headers,
@@ -314,12 +341,15 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'isBase64Encoded': False
                 }
             
-            doctor = dict(doctor)
-            doctor['created_at'] = doctor['created_at'].isoformat() if doctor['created_at'] else None
+            tag = http_cache.etag(doctor_id, version[0])
+            if http_cache.if_none_match(event, tag):
+                return http_cache.not_modified(headers, tag, http_cache.REVALIDATE)
+            
+            doctor = fetch_doctor(cur, doctor_id)
             
             return {
                 'statusCode': 200,
-                'headers': headers,
+                'headers': http_cache.cache_headers(headers, tag, http_cache.REVALIDATE),
                 'body': json.dumps({'doctor': doctor}),
                 'isBase64Encoded': False
             }
@@ -331,6 +361,10 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
+    except passwords.TooManyAttempts as e:
+        return passwords.too_many_attempts_response(headers, e)
+    except resilience.UNAVAILABLE_ERRORS as e:
+        return resilience.unavailable_response(headers, e)
     except Exception as e:
         return {
             'statusCode': 500,
@@ -342,4 +376,68 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         if 'cur' in locals():
             cur.close()
         if 'conn' in locals():
-            conn.close()
\ No newline at end of file
+            conn.close()
+        if 'slot' in locals():
+            slot.release()
+
+
+@metrics.instrumented('auth')
+@db.read_your_writes
+async def handler_async(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Режим serve.py --async: профиль врача (GET) читается через asyncpg без потока на запрос,
+    остальные запросы и ответы об ошибках параметров — синхронным handler в пуле потоков
+    '''
+    auth_token = (event.get('headers') or {}).get('x-auth-token')
+    doctor_id = (event.get('queryStringParameters') or {}).get('doctor_id') or ''
+    if event.get('httpMethod') != 'GET' or not auth_token or not doctor_id.isdigit():
+        return await adb.run_sync(handler, event, context)
+    
+    headers = {
+        'Access-Control-Allow-Origin': '*',
+        'Content-Type': 'application/json'
+    }
+    
+    try:
+        slot = resilience.admit(resilience.READ)
+        async with adb.connect(readonly=True, sticky_key=auth_token,
+                               statement_timeout_ms=resilience.READ.statement_timeout_ms) as conn:
+            updated_at = await conn.fetchrow(
+                "SELECT updated_at FROM t_p13795046_functional_diagnosti.doctors WHERE id = %s", int(doctor_id)
+            )
+            if not updated_at:
+                return {
+                    'statusCode': 404,
+                    'headers': headers,
+                    'body': json.dumps({'error': 'Врач не найден'}),
+                    'isBase64Encoded': False
+                }
+            
+            tag = http_cache.etag(doctor_id, updated_at[0])
+            if http_cache.if_none_match(event, tag):
+                return http_cache.not_modified(headers, tag, http_cache.REVALIDATE)
+            
+            doctor = models.serialize_row(models.Doctor, await conn.fetchrow(
+                f"SELECT {models.Doctor.COLUMNS} FROM t_p13795046_functional_diagnosti.doctors WHERE id = %s",
+                int(doctor_id)
+            ))
+        
+        return {
+            'statusCode': 200,
+            'headers': http_cache.cache_headers(headers, tag, http_cache.REVALIDATE),
+            'body': json.dumps({'doctor': doctor}),
+            'isBase64Encoded': False
+        }
+    
+    except resilience.UNAVAILABLE_ERRORS as e:
+        return resilience.unavailable_response(headers, e)
+    except Exception as e:
+        return {
+            'statusCode': 500,
+            'headers': headers,
+            'body': json.dumps({'error': f'Ошибка сервера: {str(e)}'}),
+            'isBase64Encoded': False
+        }
+    finally:
+        if 'slot' in locals():
+            slot.release()
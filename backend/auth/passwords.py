@@ -0,0 +1,180 @@
+'''
+Хэширование паролей врачей: scrypt с солью, ограниченный пул вычислений и ограничение попыток входа.
+
+Формат хэша: scrypt$<n>$<r>$<p>$<соль base64>$<ключ base64>. Старые хэши (SHA-256 без соли, 64 hex-символа)
+проверяются как раньше, после успешного входа handler перезаписывает их в scrypt; так же обновляются
+хэши с параметрами, отличными от текущих PASSWORD_SCRYPT_*.
+
+scrypt нагружает процессор и память, поэтому вычисления идут в пуле из PASSWORD_HASH_WORKERS потоков
+(hashlib.scrypt отпускает GIL), в очереди пула ждут не больше PASSWORD_HASH_QUEUE запросов — остальные
+сразу получают 503. До любого хэширования запрос проходит корзины токенов по email и по IP (429),
+так что перебор паролей не занимает весь процессор. Параметры подбирает benchmarks/bench_kdf.py.
+'''
+import base64
+import hashlib
+import hmac
+import json
+import math
+import os
+import secrets
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, NamedTuple, Optional, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from shared import resilience  # noqa: E402
+
+PASSWORD_SCRYPT_N = int(os.environ.get('PASSWORD_SCRYPT_N', str(2 ** 14)))
+PASSWORD_SCRYPT_R = int(os.environ.get('PASSWORD_SCRYPT_R', '8'))
+PASSWORD_SCRYPT_P = int(os.environ.get('PASSWORD_SCRYPT_P', '1'))
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', str(os.cpu_count() or 1)))
+PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE', str(4 * PASSWORD_HASH_WORKERS)))
+
+# Корзины токенов: ёмкость (попыток подряд) и пополнение (попыток в секунду)
+LOGIN_EMAIL_BURST = float(os.environ.get('LOGIN_EMAIL_BURST', '5'))
+LOGIN_EMAIL_PER_SECOND = float(os.environ.get('LOGIN_EMAIL_PER_SECOND', str(5 / 60)))
+LOGIN_IP_BURST = float(os.environ.get('LOGIN_IP_BURST', '20'))
+LOGIN_IP_PER_SECOND = float(os.environ.get('LOGIN_IP_PER_SECOND', '1'))
+
+SALT_BYTES = 16
+KEY_BYTES = 32
+SCHEME = 'scrypt'
+
+
+class ScryptParams(NamedTuple):
+    n: int
+    r: int
+    p: int
+
+
+CURRENT_PARAMS = ScryptParams(PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P)
+
+
+class TooManyAttempts(Exception):
+    '''Попытки исчерпаны; повторить через retry_after секунд'''
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    '''Корзины токенов по ключам (email, IP) в памяти процесса'''
+
+    def __init__(self, burst: float, per_second: float, max_keys: int = 100_000):
+        self.burst = burst
+        self.per_second = per_second
+        self.max_keys = max_keys
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def take(self, key: str) -> float:
+        '''Забирает токен ключа; 0 — успешно, иначе через сколько секунд появится токен'''
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.per_second)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                return (1 - tokens) / self.per_second
+            self._buckets[key] = (tokens - 1, now)
+            if len(self._buckets) > self.max_keys:
+                self._evict_full(now)
+            return 0.0
+
+    def _evict_full(self, now: float) -> None:
+        full_after = self.burst / self.per_second
+        for key in [k for k, (_, updated) in self._buckets.items() if now - updated >= full_after]:
+            del self._buckets[key]
+
+
+email_buckets = TokenBucket(LOGIN_EMAIL_BURST, LOGIN_EMAIL_PER_SECOND)
+ip_buckets = TokenBucket(LOGIN_IP_BURST, LOGIN_IP_PER_SECOND)
+
+
+def throttle(ip: Optional[str], account: Optional[str] = None) -> None:
+    '''Проверяет корзины IP и учётной записи (email или id врача) до хэширования; поднимает TooManyAttempts'''
+    for buckets, key in ((ip_buckets, ip), (email_buckets, account)):
+        if key:
+            wait = buckets.take(key)
+            if wait > 0:
+                raise TooManyAttempts('Слишком много попыток, повторите позже', wait)
+
+
+class HashPool:
+    '''Пул потоков для scrypt с ограниченной очередью'''
+
+    def __init__(self, workers: int, queue: int):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+        self._slots = threading.BoundedSemaphore(workers + queue)
+
+    def run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            raise resilience.ServiceUnavailable('Сервер авторизации перегружен, повторите запрос позже')
+        try:
+            future = self._executor.submit(func, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future.result()
+
+
+pool = HashPool(PASSWORD_HASH_WORKERS, PASSWORD_HASH_QUEUE)
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.b64encode(data).decode('ascii').rstrip('=')
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+
+def derive(password: str, salt: bytes, params: ScryptParams) -> bytes:
+    return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=params.n, r=params.r, p=params.p,
+                          maxmem=256 * params.n * params.r + (1 << 20), dklen=KEY_BYTES)
+
+
+def _hash(password: str, params: ScryptParams) -> str:
+    salt = secrets.token_bytes(SALT_BYTES)
+    key = derive(password, salt, params)
+    return f'{SCHEME}${params.n}${params.r}${params.p}${_b64encode(salt)}${_b64encode(key)}'
+
+
+def _verify(password: str, stored: str) -> Tuple[bool, bool]:
+    if stored.startswith(SCHEME + '$'):
+        _, n, r, p, salt, key = stored.split('$')
+        params = ScryptParams(int(n), int(r), int(p))
+        ok = hmac.compare_digest(derive(password, _b64decode(salt), params), _b64decode(key))
+        return ok, ok and params != CURRENT_PARAMS
+    # Старый формат: SHA-256 без соли
+    ok = hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored)
+    return ok, ok
+
+
+def hash_password(password: str, params: ScryptParams = CURRENT_PARAMS) -> str:
+    '''Хэш пароля в пуле; поднимает ServiceUnavailable, если очередь пула заполнена'''
+    return pool.run(_hash, password, params)
+
+
+def verify_password(password: str, stored: Optional[str]) -> Tuple[bool, bool]:
+    '''
+    Проверяет пароль в пуле: (совпал, нужно перехэшировать). Для несуществующего врача (stored None)
+    хэширование всё равно выполняется, чтобы время ответа не выдавало зарегистрированные email.
+    '''
+    if stored is None:
+        pool.run(_hash, password, CURRENT_PARAMS)
+        return False, False
+    return pool.run(_verify, password, stored)
+
+
+def too_many_attempts_response(headers: Dict[str, str], error: TooManyAttempts) -> Dict[str, object]:
+    return {
+        'statusCode': 429,
+        'headers': dict(headers, **{'Retry-After': str(max(1, math.ceil(error.retry_after)))}),
+        'body': json.dumps({'error': str(error)}),
+        'isBase64Encoded': False
+    }
@@ -0,0 +1,215 @@
+'''
+Бенчмарк холодного архива протоколов: объём оперативной таблицы и попадания в буферный кэш до и после архивации.
+
+Для --doctors врачей бенчмарка создаётся --protocols синтетических протоколов за --years лет
+(показатели в results, заключение). Затем через handler protocols выполняется нагрузка:
+70% открытий недавних протоколов по id, 20% списков за последние три месяца, 10% полных списков врача.
+Замеры нагрузки повторяются после переноса в архив протоколов старше --older-than-days дней.
+Доля попаданий в кэш считается по приращению pg_statio_user_tables для секций protocols.
+Архивация обучает собственный словарь сжатия на данных бенчмарка.
+Для наглядности объём данных должен превышать shared_buffers. Данные бенчмарка удаляются после замеров.
+
+Запуск: DATABASE_URL=postgresql://... python backend/benchmarks/bench_archive.py --protocols 200000
+'''
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from typing import Dict, List
+
+import psycopg2
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(BACKEND_DIR, 'protocols'))
+
+import archiver  # noqa: E402
+
+BENCH_EMAIL = 'bench-archive-{}@example.com'
+
+CONCLUSIONS = [
+    'Полости сердца не расширены. Глобальная и локальная сократимость миокарда левого желудочка '
+    'удовлетворительная. Клапанный аппарат без патологии. Диастолическая функция не нарушена.',
+    'Умеренная гипертрофия миокарда левого желудочка. Уплотнение створок аортального клапана. '
+    'Недостаточность митрального клапана I степени. Нарушение диастолической функции по I типу.',
+    'Дилатация левого предсердия. Фракция выброса левого желудочка снижена. Признаки лёгочной '
+    'гипертензии. Рекомендована консультация кардиолога и повторное исследование через 3 месяца.',
+]
+
+
+def setup(cur, protocols: int, doctors: int, years: int, params: int) -> List[int]:
+    cur.execute("""
+        INSERT INTO t_p13795046_functional_diagnosti.doctors (email, password_hash, full_name)
+        SELECT format(%s, n), 'bench', 'Врач бенчмарка ' || n
+        FROM generate_series(1, %s) n
+        ON CONFLICT (email) DO UPDATE SET full_name = EXCLUDED.full_name
+        RETURNING id
+    """, (BENCH_EMAIL.format('%s'), doctors))
+    doctor_ids = [row[0] for row in cur.fetchall()]
+
+    cur.execute("""
+        SELECT t_p13795046_functional_diagnosti.ensure_protocol_partition(
+            (date_trunc('month', CURRENT_DATE) - make_interval(months => m))::date)
+        FROM generate_series(0, %s) m
+    """, (years * 12,))
+
+    started = time.perf_counter()
+    cur.execute("""
+        INSERT INTO t_p13795046_functional_diagnosti.protocols
+        (doctor_id, study_type, patient_name, patient_gender, patient_birth_date, patient_weight,
+         patient_height, patient_bsa, ultrasound_device, study_date, results, conclusion, signed, created_at,
+         patient_age_years, patient_age_months, patient_age_days, patient_age_total_days)
+        SELECT (%(doctor_ids)s::int[])[1 + g %% %(doctors)s],
+               'ЭхоКГ',
+               'Пациент ' || (g %% 50000),
+               CASE WHEN g %% 2 = 0 THEN 'male' ELSE 'female' END,
+               DATE '1950-01-01' + (g %% 25000),
+               50 + g %% 50, 150 + g %% 40, 1.5 + (g %% 60) / 100.0,
+               'Vivid E95',
+               s.study_date,
+               (SELECT jsonb_object_agg('param_' || k, round((g %% 997 + k * 7.3)::numeric %% 100, 1))
+                FROM generate_series(1, %(params)s) k),
+               (%(conclusions)s::text[])[1 + g %% 3] || ' Протокол ' || g,
+               true,
+               s.study_date + TIME '10:00',
+               40, 0, 0, 14610
+        FROM generate_series(1, %(protocols)s) g
+        CROSS JOIN LATERAL (SELECT CURRENT_DATE - ((g::bigint * 7919) %% (%(years)s * 365))::int AS study_date) s
+    """, {'doctor_ids': doctor_ids, 'doctors': doctors, 'params': params, 'conclusions': CONCLUSIONS,
+          'protocols': protocols, 'years': years})
+    cur.execute("VACUUM ANALYZE t_p13795046_functional_diagnosti.protocols")
+    cur.execute("VACUUM ANALYZE t_p13795046_functional_diagnosti.protocol_results")
+    print(f'Сгенерировано {protocols} протоколов за {time.perf_counter() - started:.1f} с')
+    return doctor_ids
+
+
+def cleanup(cur) -> None:
+    cur.execute("""
+        SELECT COALESCE(array_agg(id), '{}') FROM t_p13795046_functional_diagnosti.doctors WHERE email LIKE %s
+    """, (BENCH_EMAIL.format('%'),))
+    doctor_ids = cur.fetchone()[0]
+    if not doctor_ids:
+        return
+    for table in ('protocols', 'protocols_archive', 'protocol_results', 'patients'):
+        cur.execute(f"DELETE FROM t_p13795046_functional_diagnosti.{table} WHERE doctor_id = ANY(%s)", (doctor_ids,))
+    cur.execute("DELETE FROM t_p13795046_functional_diagnosti.doctors WHERE id = ANY(%s)", (doctor_ids,))
+    cur.execute("VACUUM t_p13795046_functional_diagnosti.protocols")
+
+
+def run_workload(handler, cur, doctors: Dict[int, List[int]], requests: int, recent_days: int) -> Dict[str, float]:
+    rng = random.Random(42)
+    cur.execute("SELECT CURRENT_DATE - %s, CURRENT_DATE - 90", (recent_days,))
+    _, list_from = cur.fetchone()
+    emails = {doctor_id: BENCH_EMAIL.format(index + 1) for index, doctor_id in enumerate(sorted(doctors))}
+    doctor_ids = sorted(doctors)
+
+    counters_before = archiver.cache_hit_counters(cur)
+    timings: List[float] = []
+    started = time.perf_counter()
+    for _ in range(requests):
+        doctor_id = rng.choice(doctor_ids)
+        roll = rng.random()
+        if roll < 0.7:
+            query = {'id': str(rng.choice(doctors[doctor_id]))}
+        elif roll < 0.9:
+            query = {'date_from': list_from.isoformat()}
+        else:
+            query = {}
+        event = {'httpMethod': 'GET', 'headers': {'X-Auth-Token': emails[doctor_id]}, 'queryStringParameters': query}
+        request_started = time.perf_counter()
+        response = handler(event, None)
+        timings.append((time.perf_counter() - request_started) * 1000)
+        assert response['statusCode'] == 200, response['body']
+    elapsed = time.perf_counter() - started
+    ratio = archiver.hit_ratio(counters_before, archiver.cache_hit_counters(cur))
+
+    timings.sort()
+    return {
+        'hit_ratio': ratio or 0.0,
+        'rps': requests / elapsed,
+        'p50_ms': statistics.median(timings),
+        'p99_ms': timings[min(len(timings) - 1, int(len(timings) * 0.99))],
+    }
+
+
+def print_phase(title: str, sizes: Dict[str, int], stats: Dict[str, float]) -> None:
+    print(f'\n{title}:')
+    print(f"  protocols {archiver.format_size(sizes['hot'])}, protocols_archive {archiver.format_size(sizes['archive'])}, "
+          f"protocol_results {archiver.format_size(sizes['results'])}")
+    print(f"  попадания в кэш {stats['hit_ratio'] * 100:6.2f}%  {stats['rps']:7.0f} запросов/с  "
+          f"p50 {stats['p50_ms']:6.2f} мс  p99 {stats['p99_ms']:6.2f} мс")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--protocols', type=int, default=200_000)
+    parser.add_argument('--doctors', type=int, default=100)
+    parser.add_argument('--years', type=int, default=8)
+    parser.add_argument('--params', type=int, default=25, help='показателей в протоколе')
+    parser.add_argument('--older-than-days', type=int, default=730)
+    parser.add_argument('--requests', type=int, default=3000)
+    args = parser.parse_args()
+
+    dsn = os.environ['DATABASE_URL']
+    os.environ.pop('DATABASE_REPLICA_URL', None)
+    sys.path.insert(0, BACKEND_DIR)
+    from serve import load_handlers
+    from shared import db
+
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    cur = conn.cursor()
+    db.init_pool(1, 2)
+    handler = load_handlers(BACKEND_DIR)['protocols']
+    dictionary_id = None
+    try:
+        cleanup(cur)
+        doctor_ids = setup(cur, args.protocols, args.doctors, args.years, args.params)
+
+        # Нагрузка обращается к протоколам, которые останутся в оперативной таблице
+        cur.execute("""
+            SELECT doctor_id, array_agg(id) FROM t_p13795046_functional_diagnosti.protocols
+            WHERE doctor_id = ANY(%s) AND study_date >= CURRENT_DATE - %s
+            GROUP BY doctor_id
+        """, (doctor_ids, args.older_than_days))
+        recent = dict(cur.fetchall())
+
+        sizes_before = archiver.storage_report(cur)
+        run_workload(handler, cur, recent, args.requests // 5, args.older_than_days)
+        before = run_workload(handler, cur, recent, args.requests, args.older_than_days)
+
+        started = time.perf_counter()
+        archive_conn = psycopg2.connect(dsn)
+        try:
+            stats = archiver.archive_protocols(archive_conn, args.older_than_days, doctor_ids=doctor_ids, retrain=True)
+        finally:
+            archive_conn.close()
+        archiver.vacuum_hot_table(dsn)
+        print(f"Перенесено в архив {stats['archived']} протоколов за {time.perf_counter() - started:.1f} с, "
+              f"сжатие полей x{stats['raw_bytes'] / max(stats['stored_bytes'], 1):.1f}")
+        dictionary_id = stats['dictionary_id']
+
+        sizes_after = archiver.storage_report(cur)
+        run_workload(handler, cur, recent, args.requests // 5, args.older_than_days)
+        after = run_workload(handler, cur, recent, args.requests, args.older_than_days)
+
+        print_phase('До архивации', sizes_before, before)
+        print_phase('После архивации', sizes_after, after)
+        saved = sizes_before['hot'] + sizes_before['archive'] - sizes_after['hot'] - sizes_after['archive']
+        print(f'\nОсвобождено: {archiver.format_size(saved)} '
+              f"(оперативная таблица x{sizes_before['hot'] / max(sizes_after['hot'], 1):.1f} меньше)")
+    finally:
+        cleanup(cur)
+        if dictionary_id is not None:
+            cur.execute(
+                "DELETE FROM t_p13795046_functional_diagnosti.protocols_archive_dictionaries WHERE id = %s",
+                (dictionary_id,)
+            )
+        db.close_pool()
+        cur.close()
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+'''
+Сравнение синхронного и асинхронного (--async) режимов serve.py: запросов в секунду на ядро и задержки.
+
+Для каждого режима запускается serve.py с одним рабочим процессом на свободном порту; --concurrency
+клиентов с keep-alive соединениями в течение --duration секунд запрашивают карточки протоколов
+(GET /protocols?id=..., доля --protocol-share) и настройки врача (GET /doctor-settings?type=settings).
+Между сервером и PostgreSQL ставится TCP-прокси с задержкой ответа --db-latency-ms, как у БД в соседней
+зоне: синхронный процесс в это время держит поток (не больше --threads запросов), асинхронный — нет.
+Выводятся успешные запросы в секунду, они же на секунду процессорного времени сервера, p50/p99 и доля ошибок.
+Клиент работает в том же процессе на той же машине, поэтому сравнивать нужно режимы между собой.
+
+Запуск: DATABASE_URL=... python backend/benchmarks/bench_async.py --token doctor@example.ru --upstream /tmp/.s.PGSQL.5432
+'''
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+
+import psycopg2
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SERVE = os.path.join(BACKEND_DIR, 'serve.py')
+
+
+def run_proxy(port: int, upstream: str, latency: float) -> None:
+    '''TCP-прокси к PostgreSQL: данные от сервера БД отдаются клиенту с задержкой latency секунд'''
+    async def connect_upstream():
+        if upstream.startswith('/'):
+            return await asyncio.open_unix_connection(upstream)
+        host, upstream_port = upstream.rsplit(':', 1)
+        return await asyncio.open_connection(host, int(upstream_port))
+
+    async def pump(reader, writer, delay: float) -> None:
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                if delay:
+                    await asyncio.sleep(delay)
+                writer.write(data)
+                await writer.drain()
+        except OSError:
+            pass
+        finally:
+            writer.close()
+
+    async def on_client(client_reader, client_writer) -> None:
+        upstream_reader, upstream_writer = await connect_upstream()
+        await asyncio.gather(pump(client_reader, upstream_writer, 0),
+                             pump(upstream_reader, client_writer, latency))
+
+    async def main() -> None:
+        server = await asyncio.start_server(on_client, '127.0.0.1', port, backlog=512)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(main())
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def proxied_dsn(dsn: str, port: int) -> str:
+    '''DSN через прокси: тот же пользователь и БД, хост 127.0.0.1:port'''
+    parts = urlsplit(dsn)
+    credentials = parts.netloc.rsplit('@', 1)[0] + '@' if '@' in parts.netloc else ''
+    return f'{parts.scheme}://{credentials}127.0.0.1:{port}{parts.path}'
+
+
+def process_cpu_seconds(pid: int) -> float:
+    '''Процессорное время процесса и его потомков (Linux, /proc)'''
+    total = 0.0
+    ticks = os.sysconf('SC_CLK_TCK')
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        total += (int(fields[11]) + int(fields[12])) / ticks
+        for task in os.listdir(f'/proc/{pid}/task'):
+            with open(f'/proc/{pid}/task/{task}/children') as f:
+                for child in f.read().split():
+                    total += process_cpu_seconds(int(child))
+    except OSError:
+        pass
+    return total
+
+
+def start_server(port: int, use_async: bool, args: argparse.Namespace, dsn: str) -> subprocess.Popen:
+    command = [sys.executable, SERVE, '--host', '127.0.0.1', '--port', str(port), '--workers', '1',
+               '--threads', str(args.threads)]
+    if use_async:
+        command += ['--async', '--pool-size', str(args.pool_size)]
+    else:
+        command += ['--pool-size', str(args.threads)]
+    env = dict(os.environ, DATABASE_URL=dsn)
+    env.pop('DATABASE_REPLICA_URL', None)
+    server = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            request = urllib.request.Request(f'http://127.0.0.1:{port}/doctor-settings?type=settings',
+                                             headers={'X-Auth-Token': args.token})
+            urllib.request.urlopen(request, timeout=5).read()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError('serve.py не запустился за 30 секунд')
+
+
+async def read_response(reader) -> int:
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('соединение закрыто сервером')
+    status = int(status_line.split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.lower() == 'content-length':
+            length = int(value)
+    if length:
+        await reader.readexactly(length)
+    return status
+
+
+async def run_load(port: int, args: argparse.Namespace, protocol_ids: List[int]) -> Dict[str, object]:
+    latencies: List[float] = []
+    errors = [0]
+    deadline = time.monotonic() + args.duration
+
+    async def client() -> None:
+        rng = random.Random()
+        reader = writer = None
+        while time.monotonic() < deadline:
+            if rng.random() < args.protocol_share:
+                path = f'/protocols?id={rng.choice(protocol_ids)}'
+            else:
+                path = '/doctor-settings?type=settings'
+            request = (f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nX-Auth-Token: {args.token}\r\n'
+                       f'Connection: keep-alive\r\n\r\n').encode('utf-8')
+            started = time.perf_counter()
+            try:
+                if writer is None:
+                    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.write(request)
+                status = await read_response(reader)
+            except (OSError, ValueError, IndexError, asyncio.IncompleteReadError):
+                errors[0] += 1
+                if writer is not None:
+                    writer.close()
+                reader = writer = None
+                continue
+            if status == 200:
+                latencies.append((time.perf_counter() - started) * 1000)
+            else:
+                errors[0] += 1
+        if writer is not None:
+            writer.close()
+
+    started = time.monotonic()
+    await asyncio.gather(*(client() for _ in range(args.concurrency)))
+    elapsed = time.monotonic() - started
+    ordered = sorted(latencies)
+
+    def percentile(q: float) -> float:
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+    return {'requests': len(latencies), 'rps': len(latencies) / elapsed, 'p50': percentile(0.5),
+            'p99': percentile(0.99), 'errors': errors[0]}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--token', required=True, help='email врача с протоколами (X-Auth-Token)')
+    parser.add_argument('--upstream', default='/tmp/.s.PGSQL.5432',
+                        help='адрес PostgreSQL для прокси: путь к unix-сокету или host:port')
+    parser.add_argument('--db-latency-ms', type=float, default=2.0)
+    parser.add_argument('--concurrency', type=int, default=128)
+    parser.add_argument('--duration', type=float, default=15.0)
+    parser.add_argument('--threads', type=int, default=8, help='--threads serve.py в обоих режимах')
+    parser.add_argument('--pool-size', type=int, default=32, help='размер пула asyncpg в режиме --async')
+    parser.add_argument('--protocol-share', type=float, default=0.7)
+    parser.add_argument('--modes', default='sync,async')
+    args = parser.parse_args()
+
+    dsn = os.environ['DATABASE_URL']
+    with psycopg2.connect(dsn) as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT p.id FROM t_p13795046_functional_diagnosti.protocols p
+            JOIN t_p13795046_functional_diagnosti.doctors d ON d.id = p.doctor_id
+            WHERE d.email = %s
+            ORDER BY p.id DESC LIMIT 1000
+        """, (args.token,))
+        protocol_ids = [row[0] for row in cur.fetchall()]
+    if not protocol_ids:
+        sys.exit(f'У врача {args.token} нет протоколов')
+
+    proxy_port = free_port()
+    proxy = multiprocessing.Process(target=run_proxy, args=(proxy_port, args.upstream, args.db_latency_ms / 1000),
+                                    daemon=True)
+    proxy.start()
+    time.sleep(0.5)
+
+    print(f'Протоколов: {len(protocol_ids)}, клиентов: {args.concurrency}, задержка БД: {args.db_latency_ms} мс, '
+          f'ядер: {os.cpu_count()}')
+    print(f"\n{'режим':>6}{'запросов':>10}{'запр/с':>9}{'запр/с CPU':>12}{'p50, мс':>9}{'p99, мс':>9}{'ошибок':>8}")
+    results: Dict[str, Optional[float]] = {}
+    for mode in args.modes.split(','):
+        port = free_port()
+        server = start_server(port, mode == 'async', args, proxied_dsn(dsn, proxy_port))
+        try:
+            cpu_before = process_cpu_seconds(server.pid)
+            stats = asyncio.run(run_load(port, args, protocol_ids))
+            cpu_used = process_cpu_seconds(server.pid) - cpu_before
+        finally:
+            server.terminate()
+            server.wait(timeout=60)
+        per_cpu = stats['requests'] / cpu_used if cpu_used > 0 else None
+        results[mode] = per_cpu
+        print(f"{mode:>6}{stats['requests']:>10}{stats['rps']:>9.0f}"
+              f"{(f'{per_cpu:.0f}' if per_cpu else '—'):>12}{stats['p50']:>9.1f}{stats['p99']:>9.1f}"
+              f"{stats['errors']:>8}")
+    proxy.terminate()
+    print(json.dumps({'requests_per_cpu_second': results}, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+'''
+Возраст и BSA для --rows протоколов: построчный перенос calculateAge/calculateBSA из клиента
+против пакетного расчёта shared/derived.py (NumPy).
+
+Даты и измерения генерируются случайно (--seed), как их возвращает psycopg2: date и float, часть
+значений отсутствует. Вариант numpy замеряется вместе с переводом значений в массивы (to_dates, to_floats),
+вариант «массивы» — только расчёт по готовым массивам. Перед замером результаты построчного расчёта
+и numpy сравниваются. Время — лучшее из --repeat прогонов. БД не нужна.
+
+Запуск: python backend/benchmarks/bench_derived.py --rows 1000000
+'''
+import argparse
+import calendar
+import math
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+from typing import Any, Callable, List, Optional
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, BACKEND_DIR)
+
+from shared import derived  # noqa: E402
+
+
+def row_age(birth: Optional[date], study: Optional[date]) -> Optional[tuple]:
+    '''calculateAge из src/utils/ageCalculator.ts для одной пары дат'''
+    if birth is None or study is None or birth > study:
+        return None
+    years = study.year - birth.year
+    months = study.month - birth.month
+    days = study.day - birth.day
+    if days < 0:
+        months -= 1
+        previous = date(study.year, study.month, 1) - timedelta(days=1)
+        days += calendar.monthrange(previous.year, previous.month)[1]
+    if months < 0:
+        years -= 1
+        months += 12
+    return years, months, days, round(years * 365.25 + months * 30.44 + days)
+
+
+def row_bsa(weight: Optional[float], height: Optional[float]) -> Optional[float]:
+    '''calculateBSA (формула Мостеллера) с округлением до сотых, как в patient_bsa'''
+    if not weight or not height:
+        return None
+    return round(math.sqrt(weight * height / 3600), 2)
+
+
+def generate(rows: int, seed: int) -> tuple:
+    rng = random.Random(seed)
+    start = date(1930, 1, 1)
+    births: List[Optional[date]] = []
+    studies: List[Optional[date]] = []
+    weights: List[Optional[float]] = []
+    heights: List[Optional[float]] = []
+    for _ in range(rows):
+        birth = start + timedelta(days=rng.randrange(33000))
+        births.append(birth if rng.random() > 0.01 else None)
+        studies.append(birth + timedelta(days=rng.randrange(36000)))
+        known = rng.random() > 0.2
+        weights.append(round(rng.uniform(3, 150), 2) if known else None)
+        heights.append(round(rng.uniform(45, 210), 2) if known else None)
+    return births, studies, weights, heights
+
+
+def best_of(repeat: int, func: Callable[[], Any]) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    births, studies, weights, heights = generate(args.rows, args.seed)
+
+    def rows_variant() -> tuple:
+        return ([row_age(b, s) for b, s in zip(births, studies)],
+                [row_bsa(w, h) for w, h in zip(weights, heights)])
+
+    def numpy_variant() -> tuple:
+        return (derived.ages(derived.to_dates(births), derived.to_dates(studies)),
+                derived.bsa(derived.to_floats(weights), derived.to_floats(heights), 'mosteller'))
+
+    arrays = (derived.to_dates(births), derived.to_dates(studies), derived.to_floats(weights),
+              derived.to_floats(heights))
+
+    def arrays_variant() -> tuple:
+        return derived.ages(arrays[0], arrays[1]), derived.bsa(arrays[2], arrays[3], 'mosteller')
+
+    expected_ages, expected_bsa = rows_variant()
+    ages, bsa = numpy_variant()
+    actual_ages = [
+        (int(y), int(m), int(d), int(t)) if ok else None
+        for y, m, d, t, ok in zip(ages.years, ages.months, ages.days, ages.total_days, ages.valid)
+    ]
+    assert actual_ages == expected_ages, 'возраст различается'
+    # округление до сотых может разойтись на границе x.xx5 (np.round против round)
+    assert all((a is None and e is None) or (a is not None and e is not None and abs(a - e) < 0.0101)
+               for a, e in zip(derived.column(bsa), expected_bsa)), 'BSA различается'
+
+    print(f'Протоколов: {args.rows}')
+    print(f"\n{'вариант':<12}{'всего, мс':>12}{'нс/строку':>12}")
+    for name, func in (('построчно', rows_variant), ('numpy', numpy_variant), ('массивы', arrays_variant)):
+        seconds = best_of(args.repeat, func)
+        print(f'{name:<12}{seconds * 1000:>12.1f}{seconds / args.rows * 1e9:>12.0f}')
+
+
+if __name__ == '__main__':
+    main()
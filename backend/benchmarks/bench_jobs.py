@@ -0,0 +1,99 @@
+'''
+Бенчмарк очереди задач: пропускная способность (задач в секунду) при разном числе обработчиков.
+
+Каждая задача bench_sleep выполняет короткий запрос к БД и ждёт --work-ms, имитируя ввод-вывод.
+Задачи ставятся в очередь одной транзакцией, затем --workers процессов разбирают её в режиме burst.
+После прогона проверяется, что каждая задача выполнена ровно один раз; задачи бенчмарка удаляются.
+
+Запуск: DATABASE_URL=... python backend/benchmarks/bench_jobs.py --jobs 2000 --workers 1 2 4 8
+'''
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from shared import db, jobs  # noqa: E402
+from worker import work  # noqa: E402
+
+BENCH_KIND = 'bench_sleep'
+
+
+@jobs.register(BENCH_KIND)
+def bench_sleep(conn, job: jobs.Job) -> dict:
+    with conn.cursor() as cur:
+        cur.execute('SELECT %s::int + 1', (job.payload['n'],))
+        value = cur.fetchone()[0]
+    time.sleep(job.payload['work_ms'] / 1000.0)
+    return {'value': value}
+
+
+def execute(sql: str, params: tuple = ()) -> list:
+    conn = db.connect()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(sql, params)
+            rows = cur.fetchall() if cur.description else []
+        conn.commit()
+        return rows
+    finally:
+        conn.close()
+
+
+def run(n_jobs: int, n_workers: int, work_ms: float) -> float:
+    execute("DELETE FROM t_p13795046_functional_diagnosti.jobs WHERE kind = %s", (BENCH_KIND,))
+    execute("""
+        INSERT INTO t_p13795046_functional_diagnosti.jobs (kind, payload)
+        SELECT %s, jsonb_build_object('n', n, 'work_ms', %s::float8)
+        FROM generate_series(1, %s) n
+    """, (BENCH_KIND, work_ms, n_jobs))
+
+    started = time.perf_counter()
+    pids = []
+    for index in range(n_workers):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                work(f'bench:{index}', [BENCH_KIND], poll_interval=0.1, burst=True)
+            except Exception as e:
+                print(f'[bench:{index}] ошибка: {e!r}', file=sys.stderr)
+                code = 1
+            finally:
+                os._exit(code)
+        pids.append(pid)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    elapsed = time.perf_counter() - started
+
+    (done, once, wrong), = execute("""
+        SELECT count(*) FILTER (WHERE status = 'done'),
+               count(*) FILTER (WHERE attempts = 1),
+               count(*) FILTER (WHERE (result ->> 'value')::int <> (payload ->> 'n')::int + 1)
+        FROM t_p13795046_functional_diagnosti.jobs WHERE kind = %s
+    """, (BENCH_KIND,))
+    assert done == n_jobs and once == n_jobs and wrong == 0, (done, once, wrong)
+    execute("DELETE FROM t_p13795046_functional_diagnosti.jobs WHERE kind = %s", (BENCH_KIND,))
+    return elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--jobs', type=int, default=2000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--work-ms', type=float, default=2.0, help='имитация работы задачи, мс')
+    args = parser.parse_args()
+
+    baseline = None
+    for n_workers in args.workers:
+        elapsed = run(args.jobs, n_workers, args.work_ms)
+        rate = args.jobs / elapsed
+        baseline = baseline or rate
+        print(f'обработчиков: {n_workers:2d}  {args.jobs} задач за {elapsed:6.2f} с  '
+              f'{rate:8.0f} задач/с  ускорение x{rate / baseline:.2f}')
+    print('Каждая задача выполнена ровно один раз')
+
+
+if __name__ == '__main__':
+    main()
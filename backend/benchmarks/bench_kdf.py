@@ -0,0 +1,98 @@
+'''
+Подбор параметров scrypt для паролей (auth/passwords.py) под целевой p99 входа при параллельной нагрузке.
+
+Для каждого N из --n-values (r и p фиксированы) --concurrency клиентских потоков выполняют --requests
+проверок пароля через пул хэширования того же устройства, что и в auth/passwords.py
+(--workers потоков, очередь без ограничения — замеряется ожидание в очереди, а не отказы).
+Выводится время одного хэша, память на хэш, p50/p99 задержки и пропускная способность;
+рекомендуется наибольшее N, при котором p99 не превышает --target-p99-ms.
+БД не нужна; запускать на железе, где будет работать auth.
+
+Запуск: python backend/benchmarks/bench_kdf.py --concurrency 32 --target-p99-ms 500
+'''
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+from typing import List, Optional
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(BACKEND_DIR, 'auth'))
+
+import passwords  # noqa: E402
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_load(params: passwords.ScryptParams, workers: int, concurrency: int, requests: int) -> tuple:
+    '''Задержки проверки пароля (мс) и пропускная способность (проверок в секунду)'''
+    pool = passwords.HashPool(workers, queue=concurrency)
+    stored = passwords._hash('correct horse battery staple', params)
+    latencies: List[float] = []
+    lock = threading.Lock()
+    remaining = [requests]
+
+    def client() -> None:
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    return
+                remaining[0] -= 1
+            started = time.perf_counter()
+            ok, _ = pool.run(passwords._verify, 'correct horse battery staple', stored)
+            assert ok
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                latencies.append(elapsed)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, requests / (time.perf_counter() - started)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n-values', default='4096,8192,16384,32768,65536,131072')
+    parser.add_argument('--r', type=int, default=8)
+    parser.add_argument('--p', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='потоков пула хэширования')
+    parser.add_argument('--concurrency', type=int, default=32, help='одновременных входов')
+    parser.add_argument('--requests', type=int, default=200, help='проверок пароля на каждое N')
+    parser.add_argument('--target-p99-ms', type=float, default=500)
+    args = parser.parse_args()
+
+    print(f'Пул: {args.workers} потоков, одновременных входов: {args.concurrency}, r={args.r}, p={args.p}')
+    print(f"\n{'N':>8}{'память, МБ':>12}{'хэш, мс':>10}{'p50, мс':>10}{'p99, мс':>10}{'входов/с':>11}")
+    chosen: Optional[int] = None
+    for n in (int(value) for value in args.n_values.split(',')):
+        params = passwords.ScryptParams(n, args.r, args.p)
+        single = []
+        for _ in range(5):
+            started = time.perf_counter()
+            passwords.derive('password', b'0' * passwords.SALT_BYTES, params)
+            single.append((time.perf_counter() - started) * 1000)
+        latencies, throughput = run_load(params, args.workers, args.concurrency, args.requests)
+        p99 = percentile(latencies, 0.99)
+        print(f'{n:>8}{128 * n * args.r / 1024 / 1024:>12.1f}{statistics.median(single):>10.1f}'
+              f'{statistics.median(latencies):>10.1f}{p99:>10.1f}{throughput:>11.1f}')
+        if p99 <= args.target_p99_ms:
+            chosen = n
+
+    if chosen is None:
+        print(f'\nНи одно N не укладывается в p99 {args.target_p99_ms:.0f} мс: уменьшите нагрузку или добавьте ядра')
+    else:
+        print(f'\nРекомендуется: PASSWORD_SCRYPT_N={chosen} PASSWORD_SCRYPT_R={args.r} PASSWORD_SCRYPT_P={args.p} '
+              f'PASSWORD_HASH_WORKERS={args.workers}')
+
+
+if __name__ == '__main__':
+    main()
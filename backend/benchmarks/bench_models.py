@@ -0,0 +1,161 @@
+'''
+Строки БД -> JSON для списка из --rows строк: прежний код handler'ов против записей shared/models.py.
+
+    templates  — RealDictCursor, dict(row) и isoformat() в цикле (GET type=templates)
+                 против обычного курсора и ConclusionTemplate.serialize;
+    doctors    — то же для профиля врача (auth) и Doctor.serialize;
+    protocols  — обычный курсор в обоих случаях: позиционный format_protocol_row против Protocol.serialize.
+Строки строит generate_series в БД (таблицы не нужны), замеряются выборка, преобразование и json.dumps.
+Время — лучшее из --repeat прогонов; память — пик tracemalloc за выборку и преобразование
+(позиции строк курсора и словари ответа).
+
+Запуск: DATABASE_URL=... python backend/benchmarks/bench_models.py --rows 10000
+'''
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.extras import RealDictCursor
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, BACKEND_DIR)
+
+from shared import models  # noqa: E402
+
+TEMPLATES_SQL = """
+    SELECT i AS id, 1 AS doctor_id, 'ЭхоКГ'::varchar AS study_type, 'Шаблон ' || i AS template_name,
+           i %% 10 AS priority, '[{"param": "ФВ", "operator": "<", "value": 50}]'::jsonb AS conditions,
+           'Снижение глобальной сократимости'::text AS conclusion_text,
+           timestamp '2024-06-01 12:00' - i * interval '1 minute' AS created_at, timestamp '2024-06-01 12:00' AS updated_at
+    FROM generate_series(1, %s) i
+"""
+
+DOCTORS_SQL = """
+    SELECT i AS id, 'doctor' || i || '@example.ru' AS email, 'Врач ' || i AS full_name,
+           'Функциональная диагностика'::varchar AS specialization, NULL::text AS signature_url,
+           timestamp '2024-06-01 12:00' - i * interval '1 hour' AS created_at
+    FROM generate_series(1, %s) i
+"""
+
+PROTOCOLS_SQL = """
+    SELECT i, 1, 'ЭхоКГ'::varchar, 'Пациент ' || i, CASE WHEN i %% 2 = 0 THEN 'male' ELSE 'female' END,
+           date '1960-01-01' + i %% 20000, NULL::text, (40 + i %% 80)::numeric, (150 + i %% 50)::numeric,
+           1.85::numeric, 'Vivid E95'::varchar, date '2024-01-01' + i %% 700,
+           jsonb_build_object('ФВ', (50 + i %% 20)::text, 'КДР', (40 + i %% 15)::text, 'ЛП', (30 + i %% 10)::text),
+           '{"ФВ": {"min": 55, "max": 70}}'::jsonb, 'Без патологии'::text, i %% 3 = 0,
+           timestamp '2024-06-01 12:00' - i * interval '1 minute', 18 + i %% 70, i %% 12, i %% 30, i / 3
+    FROM generate_series(1, %s) i
+"""
+
+
+def legacy_dict_rows(rows: List[Dict[str, Any]], fields: tuple) -> List[Dict[str, Any]]:
+    '''dict(row) из RealDictCursor и isoformat() дат в цикле — как в handler'ах до models'''
+    items = [dict(row) for row in rows]
+    for item in items:
+        for field in fields:
+            if item.get(field):
+                item[field] = item[field].isoformat()
+    return items
+
+
+def legacy_protocol(row: tuple) -> Dict[str, Any]:
+    '''format_protocol_row до перехода на models.Protocol'''
+    if row[17] is not None:
+        patient_age = {'years': row[17], 'months': row[18], 'days': row[19]}
+    else:
+        patient_age = row[6]
+        if patient_age:
+            try:
+                patient_age = json.loads(patient_age)
+            except (json.JSONDecodeError, TypeError):
+                pass
+
+    return {
+        'id': row[0],
+        'doctor_id': row[1],
+        'study_type': row[2],
+        'patient_name': row[3],
+        'patient_gender': row[4],
+        'patient_birth_date': row[5].isoformat() if row[5] else None,
+        'patient_age': patient_age,
+        'patient_weight': float(row[7]) if row[7] else None,
+        'patient_height': float(row[8]) if row[8] else None,
+        'patient_bsa': float(row[9]) if row[9] else None,
+        'ultrasound_device': row[10],
+        'study_date': row[11].isoformat() if row[11] else None,
+        'results': row[12],
+        'results_min_max': row[13],
+        'conclusion': row[14],
+        'signed': row[15],
+        'created_at': row[16].isoformat() if row[16] else None,
+        'patient_id': row[20]
+    }
+
+
+def fetch(conn, sql: str, rows: int, cursor_factory: Any) -> List[Any]:
+    with conn.cursor(cursor_factory=cursor_factory) as cur:
+        cur.execute(sql, (rows,))
+        return cur.fetchall()
+
+
+def measure(load: Callable[[], List[Dict[str, Any]]], repeat: int) -> Dict[str, float]:
+    best = best_total = float('inf')
+    for _ in range(repeat):
+        gc.collect()
+        started = time.perf_counter()
+        result = load()
+        converted = time.perf_counter()
+        json.dumps(result)
+        best = min(best, converted - started)
+        best_total = min(best_total, time.perf_counter() - started)
+        del result
+
+    gc.collect()
+    tracemalloc.start()
+    result = load()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return {'ms': best * 1000, 'total_ms': best_total * 1000, 'peak_kb': peak / 1024}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=7)
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    tuple_cursor = psycopg2.extensions.cursor
+    n = args.rows
+    cases = [
+        ('templates',
+         lambda: legacy_dict_rows(fetch(conn, TEMPLATES_SQL, n, RealDictCursor), ('created_at', 'updated_at')),
+         lambda: models.serialize_rows(models.ConclusionTemplate, fetch(conn, TEMPLATES_SQL, n, tuple_cursor))),
+        ('doctors',
+         lambda: legacy_dict_rows(fetch(conn, DOCTORS_SQL, n, RealDictCursor), ('created_at',)),
+         lambda: models.serialize_rows(models.Doctor, fetch(conn, DOCTORS_SQL, n, tuple_cursor))),
+        ('protocols',
+         lambda: [legacy_protocol(row) for row in fetch(conn, PROTOCOLS_SQL, n, tuple_cursor)],
+         lambda: models.serialize_rows(models.Protocol, fetch(conn, PROTOCOLS_SQL, n, tuple_cursor))),
+    ]
+
+    print(f'Строк: {n}')
+    print(f"\n{'список':<11}{'код':<9}{'выборка, мс':>13}{'+dumps, мс':>12}{'пик, КБ':>10}")
+    for name, legacy, current in cases:
+        assert legacy() == current(), f'{name}: ответы различаются'
+        for variant, load in (('прежний', legacy), ('models', current)):
+            stats = measure(load, args.repeat)
+            print(f"{name:<11}{variant:<9}{stats['ms']:>13.1f}{stats['total_ms']:>12.1f}{stats['peak_kb']:>10.0f}")
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
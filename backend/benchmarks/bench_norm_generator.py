@@ -0,0 +1,55 @@
+'''
+Бенчмарк генератора таблиц норм: векторные перцентили по группам на синтетических измерениях.
+
+Запуск: python backend/benchmarks/bench_norm_generator.py --measurements 5000000
+'''
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'doctor-settings'))
+
+from norm_generator import Measurements, compute_norm_drafts, group_percentiles  # noqa: E402
+
+
+def synthetic_measurements(n: int, n_params: int, seed: int = 0) -> Measurements:
+    rng = np.random.default_rng(seed)
+    param_codes = rng.integers(0, n_params, n, dtype=np.int32)
+    categories = rng.integers(0, 4, n).astype(np.int8)
+    age_years = np.where(categories >= 2, rng.uniform(0, 18, n), rng.uniform(18, 90, n))
+    values = 50 + param_codes * 3 + age_years * 0.1 + rng.normal(0, 5, n)
+    return Measurements([f'param_{i}' for i in range(n_params)], param_codes, values, categories, age_years)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--measurements', type=int, default=5_000_000)
+    parser.add_argument('--parameters', type=int, default=20)
+    parser.add_argument('--bins', type=int, default=6)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    measurements = synthetic_measurements(args.measurements, args.parameters)
+
+    timings = []
+    for _ in range(args.repeats):
+        started = time.perf_counter()
+        drafts = compute_norm_drafts(measurements, 'ЭхоКГ', 'age', bin_count=args.bins)
+        timings.append(time.perf_counter() - started)
+    print(f'{args.measurements} измерений, {len(drafts)} таблиц: '
+          f'лучшее {min(timings):.2f} с, среднее {sum(timings) / len(timings):.2f} с')
+
+    # Проверка совпадения с np.percentile на нескольких группах
+    groups = (measurements.param_codes.astype(np.int64) * 4 + measurements.categories).astype(np.int64)
+    counts, stats = group_percentiles(groups, measurements.values, args.parameters * 4, (2.5, 97.5))
+    for group in range(0, args.parameters * 4, max(1, args.parameters)):
+        expected = np.percentile(measurements.values[groups == group], [2.5, 97.5])
+        assert np.allclose(stats[group], expected), (group, stats[group], expected)
+    print('Перцентили совпадают с np.percentile')
+
+
+if __name__ == '__main__':
+    main()
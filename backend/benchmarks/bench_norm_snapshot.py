@@ -0,0 +1,160 @@
+'''
+Бенчмарк снимков норм: запуск процесса, память процесса и проверка показателей — разбор JSON против mmap.
+
+Для --doctors врачей генерируются синтетические наборы по --tables таблиц норм. В каждом из --workers
+новых процессов нормы всех врачей загружаются двумя способами:
+- json: разбор строк таблиц из JSON в объекты Python, как при чтении norm_tables.rows в каждом процессе;
+- snapshot: открытие скомпилированных снимков shared/norm_snapshot.py через mmap.
+Замеряются время загрузки, частная память процесса (Private_* из /proc/self/smaps_rollup — страницы
+снимков общие и в неё не входят) и время проверки одного значения показателя.
+
+Запуск: python backend/benchmarks/bench_norm_snapshot.py --doctors 200 --tables 300 --workers 4
+'''
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Tuple
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, BACKEND_DIR)
+
+from shared import norm_snapshot  # noqa: E402
+
+CATEGORIES = ('adult_male', 'adult_female', 'child_male', 'child_female')
+
+
+def synthetic_tables(doctor_id: int, count: int) -> List[Dict[str, Any]]:
+    rng = random.Random(doctor_id)
+    tables = []
+    for index in range(count):
+        category = CATEGORIES[index % 4]
+        child = category.startswith('child')
+        edges = sorted(rng.sample(range(0, 18) if child else range(18, 90), 7))
+        rows = []
+        for row_index, (start, end) in enumerate(zip(edges, edges[1:])):
+            low = 30 + rng.random() * 20
+            rows.append({
+                'id': f'row_{index}_{row_index}',
+                'rangeFrom': str(start), 'rangeTo': str(end), 'rangeUnit': 'years',
+                'parameterFrom': f'{low:.1f}', 'parameterTo': f'{low + 15:.1f}',
+                'borderlineLow': f'{low - 3:.1f}', 'borderlineHigh': f'{low + 18:.1f}',
+            })
+        tables.append({
+            'id': f'{doctor_id}-{index}', 'study_type': 'ЭхоКГ', 'category': category,
+            'parameter': f'param_{index // 4}', 'norm_type': 'age', 'rows': rows, 'show_in_report': True,
+            'conclusion_below': f'Показатель {index // 4} снижен', 'conclusion_above': f'Показатель {index // 4} повышен',
+            'conclusion_borderline_low': None, 'conclusion_borderline_high': None,
+        })
+    return tables
+
+
+def private_memory_kb() -> int:
+    with open('/proc/self/smaps_rollup') as f:
+        return sum(int(line.split()[1]) for line in f if line.startswith(('Private_Clean', 'Private_Dirty')))
+
+
+def check_parsed(tables: List[Dict[str, Any]], parameter: str, category: str, value: float, age: float) -> str:
+    '''Та же проверка по разобранным таблицам, построчно, как в normsChecker.ts'''
+    for table in tables:
+        if table['parameter'] != parameter or table['category'] != category:
+            continue
+        for row in table['rows']:
+            if float(row['rangeFrom']) <= age <= float(row['rangeTo']):
+                if value < float(row['parameterFrom']):
+                    return 'below'
+                if value > float(row['parameterTo']):
+                    return 'above'
+                return 'normal'
+    return 'normal'
+
+
+def worker(mode: str, directory: str, doctors: int, tables: int, lookups: int, queue) -> None:
+    memory_before = private_memory_kb()
+    started = time.perf_counter()
+    if mode == 'json':
+        with open(os.path.join(directory, 'tables.json')) as f:
+            raw = json.load(f)
+        loaded: Dict[int, Any] = {}
+        for doctor_id, doctor_tables in raw.items():
+            for table in doctor_tables:
+                table['rows'] = json.loads(table['rows'])
+            loaded[int(doctor_id)] = doctor_tables
+        del raw
+    else:
+        loaded = {doctor_id: norm_snapshot.load(doctor_id, 1, 1, directory) for doctor_id in range(1, doctors + 1)}
+        assert all(loaded.values())
+    load_ms = (time.perf_counter() - started) * 1000
+
+    rng = random.Random(0)
+    timings: List[float] = []
+    for _ in range(lookups):
+        doctor_id = rng.randint(1, doctors)
+        parameter = f'param_{rng.randrange(tables // 4)}'
+        category = rng.choice(CATEGORIES)
+        age = rng.uniform(0, 17.9) if category.startswith('child') else rng.uniform(18, 89)
+        value = rng.uniform(20, 70)
+        lookup_started = time.perf_counter()
+        if mode == 'json':
+            check_parsed(loaded[doctor_id], parameter, category, value, age)
+        else:
+            loaded[doctor_id].check('ЭхоКГ', parameter, value, category,
+                                    norm_snapshot.patient_dimensions(int(age), 0, 0))
+        timings.append((time.perf_counter() - lookup_started) * 1_000_000)
+    queue.put((load_ms, private_memory_kb() - memory_before, statistics.median(timings)))
+
+
+def run_mode(mode: str, directory: str, args) -> Tuple[float, float, float]:
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    processes = [context.Process(target=worker, args=(mode, directory, args.doctors, args.tables, args.lookups, queue))
+                 for _ in range(args.workers)]
+    for process in processes:
+        process.start()
+    results = [queue.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return tuple(statistics.mean(column) for column in zip(*results))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--doctors', type=int, default=200)
+    parser.add_argument('--tables', type=int, default=300, help='таблиц норм у врача')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--lookups', type=int, default=20000)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bench-norm-snapshot-')
+    try:
+        started = time.perf_counter()
+        raw: Dict[int, List[Dict[str, Any]]] = {}
+        for doctor_id in range(1, args.doctors + 1):
+            tables = synthetic_tables(doctor_id, args.tables)
+            norm_snapshot.write(doctor_id, tables, 1, 1, directory)
+            raw[doctor_id] = [dict(table, rows=json.dumps(table['rows'])) for table in tables]
+        compile_seconds = time.perf_counter() - started
+        with open(os.path.join(directory, 'tables.json'), 'w') as f:
+            json.dump(raw, f)
+        snapshot_bytes = sum(os.path.getsize(os.path.join(directory, name))
+                             for name in os.listdir(directory) if name.endswith('.norms'))
+        print(f'{args.doctors} врачей x {args.tables} таблиц: снимки {snapshot_bytes / 1024 / 1024:.1f} МБ, '
+              f'компиляция {compile_seconds:.1f} с')
+
+        print(f"\n{'режим':<10}{'загрузка, мс':>14}{'память процесса, МБ':>21}{'проверка p50, мкс':>19}")
+        for mode in ('json', 'snapshot'):
+            load_ms, memory_kb, lookup_us = run_mode(mode, directory, args)
+            print(f'{mode:<10}{load_ms:>14.1f}{memory_kb / 1024:>21.1f}{lookup_us:>19.1f}')
+        print(f'\nСреднее по {args.workers} процессам; страницы снимков общие через кэш ОС')
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+'''
+Бенчмарк сохранённых статусов норм: пересчёт после изменения одной таблицы норм против полного пересчёта.
+
+Для врача бенчмарка создаётся --protocols протоколов с --params показателями (строки protocol_norm_status
+создаёт триггер), на каждый показатель и категорию — таблица норм по возрасту. Замеряются:
+первичный расчёт всех статусов, пересчёт после изменения одной таблицы (save_norm_table через handler,
+затронутые строки ищутся по индексу) и полный пересчёт врача ({"full": true}).
+Задачи выполняются тем же кодом, что и в backend/worker.py. Данные бенчмарка удаляются после замеров.
+
+Запуск: DATABASE_URL=postgresql://... python backend/benchmarks/bench_norm_status.py --protocols 100000
+'''
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+import psycopg2
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, BACKEND_DIR)
+
+BENCH_EMAIL = 'bench-norm-status@example.com'
+CATEGORIES = ('adult_male', 'adult_female', 'child_male', 'child_female')
+
+
+def norm_table(parameter: str, category: str, shift: float = 0) -> Dict[str, Any]:
+    child = category.startswith('child')
+    edges = [0, 3, 7, 12, 18] if child else [18, 30, 45, 60, 75, 100]
+    rows = [{
+        'id': f'{index}', 'rangeFrom': str(start), 'rangeTo': str(end), 'rangeUnit': 'years',
+        'parameterFrom': str(40 + index + shift), 'parameterTo': str(60 + index + shift),
+        'borderlineLow': str(35 + index + shift), 'borderlineHigh': str(65 + index + shift),
+    } for index, (start, end) in enumerate(zip(edges, edges[1:]))]
+    return {'id': 'new', 'studyType': 'ЭхоКГ', 'category': category, 'parameter': parameter, 'normType': 'age',
+            'rows': rows, 'conclusionBelow': f'{parameter} снижен', 'conclusionAbove': f'{parameter} повышен'}
+
+
+def cleanup(cur) -> None:
+    cur.execute("SELECT id FROM t_p13795046_functional_diagnosti.doctors WHERE email = %s", (BENCH_EMAIL,))
+    row = cur.fetchone()
+    if not row:
+        return
+    for table in ('protocols', 'protocol_results', 'protocol_norm_status', 'norm_tables', 'jobs', 'patients'):
+        cur.execute(f"DELETE FROM t_p13795046_functional_diagnosti.{table} WHERE doctor_id = %s", (row[0],))
+    cur.execute("DELETE FROM t_p13795046_functional_diagnosti.doctors WHERE id = %s", (row[0],))
+
+
+def run_jobs(jobs, conn) -> List[Dict[str, Any]]:
+    '''Выполняет задачи пересчёта врача бенчмарка до опустошения очереди'''
+    results = []
+    while jobs.run_next(conn, 'bench', ['evaluate_norm_status']):
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT result, error FROM t_p13795046_functional_diagnosti.jobs
+                WHERE kind = 'evaluate_norm_status' AND locked_by IS NULL ORDER BY updated_at DESC LIMIT 1
+            """)
+            result, error = cur.fetchone()
+        conn.commit()
+        assert error is None, error
+        results.append(result)
+    return results
+
+
+def timed(title: str, jobs, conn) -> None:
+    started = time.perf_counter()
+    results = run_jobs(jobs, conn)
+    elapsed = time.perf_counter() - started
+    marked = sum(result.get('marked', 0) for result in results)
+    evaluated = sum(result['evaluated'] for result in results)
+    print(f'{title:<34}{marked:>10}{evaluated:>12}{elapsed:>10.2f}')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--protocols', type=int, default=100_000)
+    parser.add_argument('--params', type=int, default=10, help='показателей в протоколе')
+    args = parser.parse_args()
+
+    dsn = os.environ['DATABASE_URL']
+    os.environ.pop('DATABASE_REPLICA_URL', None)
+    os.environ.setdefault('NORM_SNAPSHOT_DIR', tempfile.mkdtemp(prefix='bench-norm-status-'))
+    from serve import load_handlers
+    from shared import db, jobs
+
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    cur = conn.cursor()
+    db.init_pool(1, 2)
+    handler = load_handlers(BACKEND_DIR)['doctor-settings']
+    job_conn = psycopg2.connect(dsn)
+    parameters = [f'param_{k}' for k in range(args.params)]
+    try:
+        cleanup(cur)
+        cur.execute("""
+            INSERT INTO t_p13795046_functional_diagnosti.doctors (email, password_hash, full_name)
+            VALUES (%s, 'bench', 'Врач бенчмарка') RETURNING id
+        """, (BENCH_EMAIL,))
+        doctor_id = cur.fetchone()[0]
+
+        def save(table: Dict[str, Any]) -> None:
+            response = handler({'httpMethod': 'POST', 'headers': {'X-Auth-Token': BENCH_EMAIL},
+                                'body': json.dumps({'action': 'save_norm_table', 'table': table})}, None)
+            assert response['statusCode'] == 200, response['body']
+
+        table_ids = {}
+        for parameter in parameters:
+            for category in CATEGORIES:
+                save(norm_table(parameter, category))
+        cur.execute("""
+            SELECT parameter, category, id FROM t_p13795046_functional_diagnosti.norm_tables WHERE doctor_id = %s
+        """, (doctor_id,))
+        table_ids = {(parameter, category): str(table_id) for parameter, category, table_id in cur.fetchall()}
+        cur.execute("DELETE FROM t_p13795046_functional_diagnosti.jobs WHERE doctor_id = %s", (doctor_id,))
+
+        started = time.perf_counter()
+        cur.execute("""
+            SELECT t_p13795046_functional_diagnosti.ensure_protocol_partition(
+                (date_trunc('month', CURRENT_DATE) - make_interval(months => m))::date)
+            FROM generate_series(0, 24) m
+        """)
+        cur.execute("""
+            INSERT INTO t_p13795046_functional_diagnosti.protocols
+            (doctor_id, study_type, patient_name, patient_gender, patient_birth_date, study_date, results, conclusion,
+             patient_age_years, patient_age_months, patient_age_days, patient_age_total_days)
+            SELECT %(doctor_id)s, 'ЭхоКГ', 'Пациент ' || g, CASE WHEN g %% 2 = 0 THEN 'male' ELSE 'female' END,
+                   DATE '1950-01-01', CURRENT_DATE - (g %% 700),
+                   (SELECT jsonb_object_agg(p, 30 + (g * 7 + length(p) * 13) %% 45) FROM unnest(%(params)s::text[]) p), '',
+                   a.years, 0, 0, round(a.years * 365.25)::int
+            FROM generate_series(1, %(protocols)s) g
+            CROSS JOIN LATERAL (SELECT (g * 37) %% 95 AS years) a
+        """, {'doctor_id': doctor_id, 'params': parameters, 'protocols': args.protocols})
+        cur.execute("ANALYZE t_p13795046_functional_diagnosti.protocol_norm_status")
+        print(f'Сгенерировано {args.protocols} протоколов за {time.perf_counter() - started:.1f} с')
+
+        print(f"\n{'операция':<34}{'помечено':>10}{'вычислено':>12}{'время, с':>10}")
+        timed('первичный расчёт', jobs, job_conn)
+
+        changed = norm_table(parameters[0], 'adult_male', shift=5)
+        changed['id'] = table_ids[(parameters[0], 'adult_male')]
+        changed['rows'] = norm_table(parameters[0], 'adult_male')['rows']
+        changed['rows'][1]['parameterFrom'] = '50'
+        save(changed)
+        timed('изменение одной строки таблицы', jobs, job_conn)
+
+        changed = norm_table(parameters[0], 'child_female', shift=-5)
+        changed['id'] = table_ids[(parameters[0], 'child_female')]
+        save(changed)
+        timed('изменение всей таблицы', jobs, job_conn)
+
+        jobs.enqueue(cur, doctor_id, 'evaluate_norm_status', {'full': True})
+        timed('полный пересчёт врача', jobs, job_conn)
+
+        cur.execute("""
+            SELECT status, count(*) FROM t_p13795046_functional_diagnosti.protocol_norm_status
+            WHERE doctor_id = %s GROUP BY status ORDER BY status
+        """, (doctor_id,))
+        print('\nСтатусы: ' + ', '.join(f'{status} {count}' for status, count in cur.fetchall()))
+    finally:
+        job_conn.close()
+        cleanup(cur)
+        db.close_pool()
+        cur.close()
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+'''
+Бенчмарк деградации: задержки ответов handler протоколов при неисправной БД с защитой и без неё.
+
+Клиентские потоки --duration секунд отправляют запросы с паузой --think-ms (80% чтений протокола
+по id, 20% списков) через TCP-прокси перед PostgreSQL. Сценарии:
+    healthy — БД в порядке;
+    locked  — таблица protocols заблокирована (ACCESS EXCLUSIVE), запросы ждут снятия блокировки;
+    down    — прокси разрывает соединения и отклоняет новые.
+Режим "защита" — таймауты запросов, предохранитель и ограничитель из shared/resilience.py,
+режим "без защиты" — таймауты и предохранитель отключены. Каждый режим выполняется в отдельном процессе.
+
+Запуск:
+    DATABASE_URL=postgresql://... python backend/benchmarks/bench_overload.py \
+        --token doctor@example.com --upstream /tmp/pgdata/.s.PGSQL.5432
+--upstream — адрес PostgreSQL для прокси: путь к unix-сокету или host:port.
+'''
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List, Tuple
+
+import psycopg2
+import psycopg2.extensions
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+PROTECTION_ENV = {
+    'on': {
+        'DB_TIMEOUT_READ_MS': '500',
+        'DB_TIMEOUT_WRITE_MS': '1000',
+        'DB_TIMEOUT_SCAN_MS': '1000',
+        'DB_BREAKER_FAILURES': '5',
+        'DB_BREAKER_RESET_SECONDS': '1',
+        'DB_LOW_PRIORITY_SLOTS': '2',
+    },
+    'off': {
+        'DB_STATEMENT_TIMEOUT_MS': '0',
+        'DB_TIMEOUT_READ_MS': '0',
+        'DB_TIMEOUT_WRITE_MS': '0',
+        'DB_TIMEOUT_SCAN_MS': '0',
+        'DB_BREAKER_FAILURES': '1000000000',
+        'DB_MAX_CONCURRENT_REQUESTS': '1000000',
+        'DB_LOW_PRIORITY_SLOTS': '1000000',
+    },
+}
+
+SCENARIOS = ('healthy', 'locked', 'down')
+
+
+class FaultProxy:
+    '''TCP-прокси к PostgreSQL; в режиме down разрывает соединения и отклоняет новые'''
+
+    def __init__(self, upstream: str):
+        self.upstream = upstream
+        self.down = False
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(256)
+        self.port = self.listener.getsockname()[1]
+        self._sockets: List[socket.socket] = []
+        self._lock = threading.Lock()
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+
+    def _connect_upstream(self) -> socket.socket:
+        if self.upstream.startswith('/'):
+            upstream = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            upstream.connect(self.upstream)
+        else:
+            host, port = self.upstream.rsplit(':', 1)
+            upstream = socket.create_connection((host, int(port)))
+        return upstream
+
+    def _accept_loop(self) -> None:
+        while True:
+            client, _ = self.listener.accept()
+            if self.down:
+                client.close()
+                continue
+            upstream = self._connect_upstream()
+            with self._lock:
+                self._sockets.extend((client, upstream))
+            threading.Thread(target=self._pump, args=(client, upstream), daemon=True).start()
+            threading.Thread(target=self._pump, args=(upstream, client), daemon=True).start()
+
+    @staticmethod
+    def _pump(source: socket.socket, target: socket.socket) -> None:
+        try:
+            while True:
+                data = source.recv(65536)
+                if not data:
+                    break
+                target.sendall(data)
+        except OSError:
+            pass
+        finally:
+            for sock in (source, target):
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def set_down(self, down: bool) -> None:
+        self.down = down
+        if down:
+            with self._lock:
+                sockets, self._sockets = self._sockets, []
+            for sock in sockets:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100.0 * len(ordered)))]
+
+
+def run_scenario(handler, scenario: str, args: argparse.Namespace, proxy: FaultProxy,
+                 protocol_ids: List[int]) -> Dict[str, object]:
+    results: List[Tuple[float, int]] = []
+    results_lock = threading.Lock()
+    deadline = time.monotonic() + args.duration
+
+    def client() -> None:
+        rng = random.Random()
+        while time.monotonic() < deadline:
+            if rng.random() < 0.8:
+                query = {'id': str(rng.choice(protocol_ids))}
+            else:
+                query = {'search_study_type': 'ЭхоКГ'}
+            event = {'httpMethod': 'GET', 'headers': {'X-Auth-Token': args.token}, 'queryStringParameters': query}
+            started = time.perf_counter()
+            status = handler(event, None)['statusCode']
+            with results_lock:
+                results.append((time.perf_counter() - started, status))
+            time.sleep(args.think_ms / 1000.0)
+
+    lock_conn = None
+    if scenario == 'locked':
+        lock_conn = psycopg2.connect(args.database_url)
+        lock_conn.cursor().execute('LOCK TABLE t_p13795046_functional_diagnosti.protocols IN ACCESS EXCLUSIVE MODE')
+    elif scenario == 'down':
+        proxy.set_down(True)
+
+    threads = [threading.Thread(target=client) for _ in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    # Неисправность устраняется по окончании сценария; запросы, ждавшие всё это время, завершаются позже
+    if lock_conn is not None:
+        lock_conn.rollback()
+        lock_conn.close()
+    proxy.set_down(False)
+    for thread in threads:
+        thread.join()
+
+    latencies = [latency * 1000 for latency, _ in results]
+    statuses: Dict[str, int] = {}
+    for _, status in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        'requests': len(results),
+        'statuses': statuses,
+        'p50_ms': round(percentile(latencies, 50), 1),
+        'p99_ms': round(percentile(latencies, 99), 1),
+        'max_ms': round(max(latencies) if latencies else 0.0, 1),
+    }
+
+
+def run_child(args: argparse.Namespace) -> None:
+    '''Процесс одного режима защиты: прокси, пул соединений через прокси и все сценарии'''
+    proxy = FaultProxy(args.upstream)
+    dsn = psycopg2.extensions.parse_dsn(args.database_url)
+    dsn.update(host='127.0.0.1', port=str(proxy.port))
+    os.environ['DATABASE_URL'] = psycopg2.extensions.make_dsn(**dsn)
+    os.environ.pop('DATABASE_REPLICA_URL', None)
+
+    sys.path.insert(0, BACKEND_DIR)
+    from serve import load_handlers
+    from shared import db, resilience
+
+    db.init_pool(args.threads, args.threads)
+    handler = load_handlers(BACKEND_DIR)['protocols']
+
+    conn = psycopg2.connect(args.database_url)
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT p.id FROM t_p13795046_functional_diagnosti.protocols p
+        JOIN t_p13795046_functional_diagnosti.doctors d ON d.id = p.doctor_id
+        WHERE d.email = %s LIMIT 100
+    """, (args.token,))
+    protocol_ids = [row[0] for row in cur.fetchall()]
+    conn.close()
+
+    report = {}
+    for scenario in SCENARIOS:
+        report[scenario] = run_scenario(handler, scenario, args, proxy, protocol_ids)
+        # пауза, чтобы предохранитель вернулся в исходное состояние перед следующим сценарием
+        time.sleep(resilience.db_breaker.reset_timeout if args.protection == 'on' else 0.5)
+        resilience.db_breaker.record_success()
+    db.close_pool()
+    print(json.dumps(report))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--token', required=True, help='email врача (X-Auth-Token) в тестовой БД')
+    parser.add_argument('--upstream', required=True, help='unix-сокет или host:port PostgreSQL')
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--think-ms', type=float, default=5.0, help='пауза клиента между запросами')
+    parser.add_argument('--protection', choices=('on', 'off'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.protection:
+        run_child(args)
+        return
+
+    print(f'{args.threads} клиентских потоков, {args.duration:g} с на сценарий')
+    for protection in ('off', 'on'):
+        env = dict(os.environ, **PROTECTION_ENV[protection])
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--protection', protection] + sys.argv[1:],
+            env=env, check=True, capture_output=True, text=True
+        ).stdout
+        report = json.loads(output.strip().splitlines()[-1])
+        title = 'защита включена' if protection == 'on' else 'без защиты'
+        print(f'\n{title}:')
+        for scenario in SCENARIOS:
+            r = report[scenario]
+            statuses = ', '.join(f'{code}: {count}' for code, count in sorted(r['statuses'].items()))
+            print(f"  {scenario:8s} запросов {r['requests']:6d}  p50 {r['p50_ms']:8.1f} мс  "
+                  f"p99 {r['p99_ms']:8.1f} мс  max {r['max_ms']:8.1f} мс  ({statuses})")
+
+
+if __name__ == '__main__':
+    main()
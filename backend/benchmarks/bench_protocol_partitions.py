@@ -0,0 +1,186 @@
+'''
+Бенчмарк секционирования протоколов: обычная таблица против помесячных секций по study_date.
+
+Создаёт во временной схеме две таблицы с одинаковыми синтетическими данными
+(по умолчанию 3 млн строк за 5 лет), затем сравнивает время типичных запросов архива
+за недавнее окно дат и число секций, которые просматривает планировщик.
+
+Запуск: DATABASE_URL=postgres://... python backend/benchmarks/bench_protocol_partitions.py --rows 3000000
+'''
+import argparse
+import os
+import statistics
+import time
+from typing import Any, Dict, List
+
+import psycopg2
+
+SCHEMA = 'bench_protocol_partitions'
+
+COLUMNS_SQL = """
+    id BIGINT NOT NULL,
+    doctor_id INTEGER NOT NULL,
+    study_type VARCHAR(50) NOT NULL,
+    patient_name VARCHAR(255) NOT NULL,
+    patient_gender VARCHAR(10) NOT NULL,
+    patient_birth_date DATE NOT NULL,
+    study_date DATE NOT NULL,
+    results JSONB NOT NULL,
+    conclusion TEXT NOT NULL,
+    signed BOOLEAN DEFAULT FALSE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+"""
+
+QUERIES = {
+    'doctor_last_30_days': """
+        SELECT id, study_type, patient_name, study_date, results
+        FROM {table}
+        WHERE doctor_id = %(doctor_id)s AND study_date >= %(recent)s::date AND study_date <= %(today)s::date
+        ORDER BY created_at DESC
+    """,
+    'doctor_last_year_count': """
+        SELECT count(*) FROM {table}
+        WHERE doctor_id = %(doctor_id)s AND study_date >= %(year_ago)s::date
+    """,
+    'all_doctors_last_week': """
+        SELECT study_type, count(*) FROM {table}
+        WHERE study_date >= %(week_ago)s::date
+        GROUP BY study_type
+    """,
+}
+
+
+def setup(cur, rows: int, doctors: int, years: int) -> None:
+    cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    cur.execute(f"CREATE SCHEMA {SCHEMA}")
+    cur.execute(f"CREATE TABLE {SCHEMA}.plain ({COLUMNS_SQL}, PRIMARY KEY (id))")
+    cur.execute(
+        f"CREATE TABLE {SCHEMA}.partitioned ({COLUMNS_SQL}, PRIMARY KEY (id, study_date)) "
+        "PARTITION BY RANGE (study_date)"
+    )
+    cur.execute(f"CREATE TABLE {SCHEMA}.partitioned_default PARTITION OF {SCHEMA}.partitioned DEFAULT")
+    cur.execute(f"""
+        DO $$
+        DECLARE m DATE;
+        BEGIN
+            FOR m IN SELECT generate_series(
+                date_trunc('month', CURRENT_DATE - INTERVAL '{years} years'),
+                date_trunc('month', CURRENT_DATE + INTERVAL '3 months'),
+                INTERVAL '1 month')::date
+            LOOP
+                EXECUTE format(
+                    'CREATE TABLE {SCHEMA}.%I PARTITION OF {SCHEMA}.partitioned FOR VALUES FROM (%L) TO (%L)',
+                    'partitioned_' || to_char(m, 'YYYY_MM'), m, (m + INTERVAL '1 month')::date
+                );
+            END LOOP;
+        END $$;
+    """)
+
+    started = time.perf_counter()
+    cur.execute(f"""
+        INSERT INTO {SCHEMA}.plain (id, doctor_id, study_type, patient_name, patient_gender,
+                                    patient_birth_date, study_date, results, conclusion, created_at)
+        SELECT g,
+               1 + (g % %(doctors)s),
+               (ARRAY['ЭхоКГ', 'ЭКГ', 'УЗИ сосудов'])[1 + g % 3],
+               'Пациент ' || (g % 100000),
+               CASE WHEN g % 2 = 0 THEN 'male' ELSE 'female' END,
+               DATE '1950-01-01' + (g % 25000),
+               CURRENT_DATE - ((g * 7919) % (%(years)s * 365)),
+               jsonb_build_object('ef', 40 + g % 35, 'lvdd', 40 + g % 20),
+               'Заключение ' || g,
+               CURRENT_TIMESTAMP - make_interval(secs => (g * 7919) % (%(years)s * 365 * 86400))
+        FROM generate_series(1, %(rows)s) g
+    """, {'rows': rows, 'doctors': doctors, 'years': years})
+    cur.execute(f"INSERT INTO {SCHEMA}.partitioned SELECT * FROM {SCHEMA}.plain")
+    print(f'Сгенерировано {rows} строк за {time.perf_counter() - started:.1f} с')
+
+    for table in ('plain', 'partitioned'):
+        cur.execute(f"CREATE INDEX ON {SCHEMA}.{table}(doctor_id, study_date)")
+        cur.execute(f"CREATE INDEX ON {SCHEMA}.{table}(doctor_id, created_at)")
+        cur.execute(f"CREATE INDEX ON {SCHEMA}.{table}(study_date)")
+        cur.execute(f"ANALYZE {SCHEMA}.{table}")
+
+
+def count_scanned_relations(plan: Any) -> int:
+    if isinstance(plan, dict):
+        own = 1 if 'Relation Name' in plan else 0
+        return own + sum(count_scanned_relations(child) for child in plan.get('Plans', []))
+    if isinstance(plan, list):
+        return sum(count_scanned_relations(item) for item in plan)
+    return 0
+
+
+def run_query(cur, table: str, sql: str, params: Dict[str, Any], repeats: int) -> Dict[str, Any]:
+    query = sql.format(table=f'{SCHEMA}.{table}')
+    timings: List[float] = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        cur.execute(query, params)
+        cur.fetchall()
+        timings.append((time.perf_counter() - started) * 1000)
+
+    cur.execute('EXPLAIN (FORMAT JSON) ' + query, params)
+    plan = cur.fetchone()[0]
+    return {
+        'median_ms': statistics.median(timings),
+        'p95_ms': sorted(timings)[max(0, int(len(timings) * 0.95) - 1)],
+        'relations': count_scanned_relations(plan),
+    }
+
+
+def relation_size(cur, table: str) -> int:
+    cur.execute(f"""
+        SELECT COALESCE(sum(pg_total_relation_size(c.oid)), 0)
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = %s AND c.relkind = 'r' AND c.relname LIKE %s
+    """, (SCHEMA, table + '%'))
+    return int(cur.fetchone()[0])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=3_000_000)
+    parser.add_argument('--doctors', type=int, default=500)
+    parser.add_argument('--years', type=int, default=5)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--keep', action='store_true', help='не удалять схему после замеров')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    try:
+        setup(cur, args.rows, args.doctors, args.years)
+
+        cur.execute("""
+            SELECT CURRENT_DATE, CURRENT_DATE - 7, CURRENT_DATE - 30, CURRENT_DATE - 365
+        """)
+        today, week_ago, recent, year_ago = cur.fetchone()
+        params = {
+            'doctor_id': 42,
+            'today': today.isoformat(),
+            'week_ago': week_ago.isoformat(),
+            'recent': recent.isoformat(),
+            'year_ago': year_ago.isoformat(),
+        }
+
+        print(f"{'запрос':<26}{'таблица':<14}{'медиана, мс':>12}{'p95, мс':>10}{'таблиц в плане':>16}")
+        for name, sql in QUERIES.items():
+            for table in ('plain', 'partitioned'):
+                stats = run_query(cur, table, sql, params, args.repeats)
+                print(f"{name:<26}{table:<14}{stats['median_ms']:>12.2f}{stats['p95_ms']:>10.2f}{stats['relations']:>16}")
+
+        for table in ('plain', 'partitioned'):
+            print(f'Размер {table}: {relation_size(cur, table) / 1024 / 1024:.1f} МБ')
+    finally:
+        if not args.keep:
+            cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        cur.close()
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+'''
+Бенчмарк полнотекстового поиска протоколов: задержка GET /protocols?q=... на большом синтетическом архиве.
+
+Для --doctors врачей бенчмарка создаётся --protocols протоколов за --years лет с заключениями
+из набора типовых фраз; протоколы старше --older-than-days переносятся в холодный архив, так что поиск
+идёт по обеим таблицам. Для каждого запроса замеряется handler (первая страница с рангом и фрагментами)
+и, для сравнения, поиск подстроки ILIKE по заключениям оперативной таблицы без индекса.
+Данные бенчмарка удаляются после замеров.
+
+Запуск: DATABASE_URL=postgresql://... python backend/benchmarks/bench_search.py --protocols 300000
+'''
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from typing import Callable, Dict, List
+
+import psycopg2
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(BACKEND_DIR, 'protocols'))
+
+import archiver  # noqa: E402
+
+BENCH_EMAIL = 'bench-search-{}@example.com'
+
+PHRASES = [
+    'Полости сердца не расширены.',
+    'Глобальная сократимость миокарда левого желудочка удовлетворительная.',
+    'Умеренная гипертрофия миокарда левого желудочка.',
+    'Концентрическое ремоделирование левого желудочка.',
+    'Уплотнение створок аортального клапана.',
+    'Недостаточность митрального клапана I степени.',
+    'Недостаточность трикуспидального клапана II степени.',
+    'Нарушение диастолической функции левого желудочка по I типу.',
+    'Дилатация левого предсердия.',
+    'Дилатация восходящего отдела аорты.',
+    'Признаки лёгочной гипертензии.',
+    'Зоны гипокинезии в области верхушки.',
+    'Фракция выброса левого желудочка снижена.',
+    'Дополнительная хорда в полости левого желудочка.',
+    'Пролапс митрального клапана без регургитации.',
+    'Синусовый ритм, ЧСС 72 в минуту.',
+    'Неполная блокада правой ножки пучка Гиса.',
+    'Полная блокада левой ножки пучка Гиса.',
+    'Атриовентрикулярная блокада I степени.',
+    'Одиночные наджелудочковые экстрасистолы.',
+    'Фибрилляция предсердий, тахисистолическая форма.',
+    'Атеросклеротические бляшки в бифуркации общей сонной артерии.',
+    'Стеноз внутренней сонной артерии до 40%.',
+    'Извитость позвоночных артерий.',
+    'Рекомендована консультация кардиолога.',
+    'Рекомендовано повторное исследование через 6 месяцев.',
+]
+
+QUERIES = {
+    'редкое слово': ('бляшки', 'бляшк'),
+    'частое слово': ('левого желудочка', 'левого желудочка'),
+    'фраза': ('"блокада левой ножки"', 'блокада левой ножки'),
+    'исключение': ('блокада -правой', 'блокада'),
+    'нет совпадений': ('перикардит', 'перикардит'),
+}
+
+
+def setup(cur, protocols: int, doctors: int, years: int) -> List[int]:
+    cur.execute("""
+        INSERT INTO t_p13795046_functional_diagnosti.doctors (email, password_hash, full_name)
+        SELECT format(%s, n), 'bench', 'Врач бенчмарка ' || n
+        FROM generate_series(1, %s) n
+        ON CONFLICT (email) DO UPDATE SET full_name = EXCLUDED.full_name
+        RETURNING id
+    """, (BENCH_EMAIL.format('%s'), doctors))
+    doctor_ids = [row[0] for row in cur.fetchall()]
+
+    cur.execute("""
+        SELECT t_p13795046_functional_diagnosti.ensure_protocol_partition(
+            (date_trunc('month', CURRENT_DATE) - make_interval(months => m))::date)
+        FROM generate_series(0, %s) m
+    """, (years * 12,))
+
+    started = time.perf_counter()
+    cur.execute("""
+        INSERT INTO t_p13795046_functional_diagnosti.protocols
+        (doctor_id, study_type, patient_name, patient_gender, patient_birth_date, ultrasound_device,
+         study_date, results, conclusion, signed, created_at)
+        SELECT (%(doctor_ids)s::int[])[1 + g %% %(doctors)s],
+               (ARRAY['ЭхоКГ', 'ЭКГ', 'УЗИ сосудов'])[1 + g %% 3],
+               'Пациент ' || (g %% 50000),
+               CASE WHEN g %% 2 = 0 THEN 'male' ELSE 'female' END,
+               DATE '1950-01-01' + (g %% 25000),
+               'Vivid E95',
+               s.study_date,
+               jsonb_build_object('ef', 40 + g %% 35, 'lvdd', 40 + g %% 20, 'rhythm', 'синусовый'),
+               (SELECT string_agg(p.phrases[1 + (g::bigint * k * 7919 + k) %% array_length(p.phrases, 1)], ' ')
+                FROM generate_series(1, 3 + g %% 4) k, (SELECT %(phrases)s::text[] AS phrases) p),
+               true,
+               s.study_date + TIME '10:00'
+        FROM generate_series(1, %(protocols)s) g
+        CROSS JOIN LATERAL (SELECT CURRENT_DATE - ((g::bigint * 7919) %% (%(years)s * 365))::int AS study_date) s
+    """, {'doctor_ids': doctor_ids, 'doctors': doctors, 'phrases': PHRASES,
+          'protocols': protocols, 'years': years})
+    cur.execute("VACUUM ANALYZE t_p13795046_functional_diagnosti.protocols")
+    print(f'Сгенерировано {protocols} протоколов за {time.perf_counter() - started:.1f} с')
+    return doctor_ids
+
+
+def cleanup(cur) -> None:
+    cur.execute("""
+        SELECT COALESCE(array_agg(id), '{}') FROM t_p13795046_functional_diagnosti.doctors WHERE email LIKE %s
+    """, (BENCH_EMAIL.format('%'),))
+    doctor_ids = cur.fetchone()[0]
+    if not doctor_ids:
+        return
+    for table in ('protocols', 'protocols_archive', 'protocol_results', 'patients'):
+        cur.execute(f"DELETE FROM t_p13795046_functional_diagnosti.{table} WHERE doctor_id = ANY(%s)", (doctor_ids,))
+    cur.execute("DELETE FROM t_p13795046_functional_diagnosti.doctors WHERE id = ANY(%s)", (doctor_ids,))
+    cur.execute("VACUUM t_p13795046_functional_diagnosti.protocols")
+
+
+def measure(call: Callable[[], int], repeats: int) -> Dict[str, float]:
+    timings: List[float] = []
+    found = 0
+    for _ in range(repeats):
+        started = time.perf_counter()
+        found += call()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return {
+        'p50_ms': statistics.median(timings),
+        'p95_ms': timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+        'found': found / repeats,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--protocols', type=int, default=300_000)
+    parser.add_argument('--doctors', type=int, default=20)
+    parser.add_argument('--years', type=int, default=6)
+    parser.add_argument('--older-than-days', type=int, default=730)
+    parser.add_argument('--repeats', type=int, default=30)
+    parser.add_argument('--keep', action='store_true', help='не удалять данные бенчмарка после замеров')
+    args = parser.parse_args()
+
+    dsn = os.environ['DATABASE_URL']
+    os.environ.pop('DATABASE_REPLICA_URL', None)
+    sys.path.insert(0, BACKEND_DIR)
+    from serve import load_handlers
+    from shared import db
+
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    cur = conn.cursor()
+    db.init_pool(1, 2)
+    handler = load_handlers(BACKEND_DIR)['protocols']
+    dictionary_id = None
+    try:
+        cleanup(cur)
+        doctor_ids = setup(cur, args.protocols, args.doctors, args.years)
+        archive_conn = psycopg2.connect(dsn)
+        try:
+            stats = archiver.archive_protocols(archive_conn, args.older_than_days, doctor_ids=doctor_ids, retrain=True)
+        finally:
+            archive_conn.close()
+        dictionary_id = stats['dictionary_id']
+        cur.execute("ANALYZE t_p13795046_functional_diagnosti.protocols_archive")
+        print(f"В архиве {stats['archived']} протоколов, в оперативной таблице {args.protocols - stats['archived']}")
+
+        rng = random.Random(7)
+        print(f"\n{'запрос':<16}{'найдено':>9}{'поиск p50':>11}{'p95, мс':>9}{'ILIKE p50':>11}{'p95, мс':>9}")
+        for title, (search_query, substring) in QUERIES.items():
+            def search() -> int:
+                token = BENCH_EMAIL.format(rng.randint(1, args.doctors))
+                response = handler({'httpMethod': 'GET', 'headers': {'X-Auth-Token': token},
+                                    'queryStringParameters': {'q': search_query}}, None)
+                assert response['statusCode'] == 200, response['body']
+                return response['body'].count('"snippet"')
+
+            def substring_scan() -> int:
+                cur.execute("""
+                    SELECT id, conclusion FROM t_p13795046_functional_diagnosti.protocols
+                    WHERE doctor_id = %s AND conclusion ILIKE %s
+                    ORDER BY created_at DESC LIMIT 20
+                """, (rng.choice(doctor_ids), f'%{substring}%'))
+                return len(cur.fetchall())
+
+            fts = measure(search, args.repeats)
+            scan = measure(substring_scan, args.repeats)
+            print(f"{title:<16}{fts['found']:>9.1f}{fts['p50_ms']:>11.2f}{fts['p95_ms']:>9.2f}"
+                  f"{scan['p50_ms']:>11.2f}{scan['p95_ms']:>9.2f}")
+        print('\nILIKE — поиск подстроки только по оперативной таблице, без ранжирования и фрагментов')
+    finally:
+        if not args.keep:
+            cleanup(cur)
+        if dictionary_id is not None and not args.keep:
+            cur.execute(
+                "DELETE FROM t_p13795046_functional_diagnosti.protocols_archive_dictionaries WHERE id = %s",
+                (dictionary_id,)
+            )
+        db.close_pool()
+        cur.close()
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
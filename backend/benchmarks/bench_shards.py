@@ -0,0 +1,147 @@
+'''
+Бенчмарк распределения врачей по узлам БД (shared/shards.py): пропускная способность запросов,
+ограниченных одним врачом, на 1..N узлах.
+
+Каждый --dsn — отдельный узел (свой экземпляр PostgreSQL; базы одного сервера покажут только накладные
+расходы маршрутизации). На каждом узле создаётся схема bench_shards с таблицей записей врачей,
+врачи раскладываются по кольцу HashRing первых n узлов. --threads потоков выполняют смесь чтений
+последних записей врача и вставок (--read-ratio) в течение --seconds, у каждого потока своё
+соединение с каждым узлом. Дополнительно печатается равномерность кольца и доля врачей,
+меняющих узел при добавлении следующего.
+
+Запуск: python backend/benchmarks/bench_shards.py --dsn postgres://host1/fd --dsn postgres://host2/fd --threads 32
+'''
+import argparse
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, List
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, BACKEND_DIR)
+
+from shared import shards  # noqa: E402
+
+SCHEMA = 'bench_shards'
+
+
+def setup(dsn: str, doctors: List[int], rows_per_doctor: int) -> None:
+    conn = psycopg2.connect(dsn)
+    try:
+        cur = conn.cursor()
+        cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        cur.execute(f"CREATE SCHEMA {SCHEMA}")
+        cur.execute(f"""
+            CREATE TABLE {SCHEMA}.records (
+                id BIGSERIAL,
+                doctor_id INTEGER NOT NULL,
+                payload JSONB NOT NULL,
+                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (doctor_id, id)
+            )
+        """)
+        rows = [(doctor_id, '{"lvef": 60, "ivs": 9}') for doctor_id in doctors for _ in range(rows_per_doctor)]
+        execute_values(cur, f"INSERT INTO {SCHEMA}.records (doctor_id, payload) VALUES %s", rows, page_size=5000)
+        cur.execute(f"ANALYZE {SCHEMA}.records")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def run(dsns: Dict[str, str], ring: shards.HashRing, doctors: List[int], threads: int, seconds: float,
+        read_ratio: float) -> Dict[str, float]:
+    latencies: List[List[float]] = [[] for _ in range(threads)]
+    stop = threading.Event()
+
+    def worker(index: int) -> None:
+        rng = random.Random(index)
+        connections = {name: psycopg2.connect(dsn) for name, dsn in dsns.items()}
+        for conn in connections.values():
+            conn.autocommit = True
+        try:
+            while not stop.is_set():
+                doctor_id = rng.choice(doctors)
+                cur = connections[ring.lookup(doctor_id)].cursor()
+                started = time.perf_counter()
+                if rng.random() < read_ratio:
+                    cur.execute(f"""
+                        SELECT id, payload, created_at FROM {SCHEMA}.records
+                        WHERE doctor_id = %s ORDER BY id DESC LIMIT 20
+                    """, (doctor_id,))
+                    cur.fetchall()
+                else:
+                    cur.execute(f"INSERT INTO {SCHEMA}.records (doctor_id, payload) VALUES (%s, %s)",
+                                (doctor_id, '{"lvef": 55}'))
+                latencies[index].append(time.perf_counter() - started)
+        finally:
+            for conn in connections.values():
+                conn.close()
+
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    started = time.perf_counter()
+    for thread in pool:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in pool:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    merged = sorted(value for values in latencies for value in values)
+    return {
+        'ops': len(merged) / elapsed,
+        'p50': statistics.median(merged) * 1000,
+        'p99': merged[int(len(merged) * 0.99)] * 1000,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--dsn', action='append', required=True, help='узел БД (можно несколько раз)')
+    parser.add_argument('--doctors', type=int, default=1000)
+    parser.add_argument('--rows-per-doctor', type=int, default=50)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--read-ratio', type=float, default=0.8)
+    parser.add_argument('--vnodes', type=int, default=shards.SHARD_VNODES)
+    args = parser.parse_args()
+
+    names = [f'shard{i}' for i in range(len(args.dsn))]
+    doctors = list(range(1, args.doctors + 1))
+
+    print(f'Врачей: {args.doctors}, потоков: {args.threads}, чтений: {args.read_ratio:.0%}, '
+          f'виртуальных точек на узел: {args.vnodes}')
+    print(f"\n{'узлов':>6}{'оп/с':>12}{'p50, мс':>10}{'p99, мс':>10}{'макс/средн.':>13}{'перемещено':>12}")
+    previous = None
+    for count in range(1, len(names) + 1):
+        ring = shards.HashRing(names[:count], args.vnodes)
+        placement = {doctor_id: ring.lookup(doctor_id) for doctor_id in doctors}
+        per_node = Counter(placement.values())
+        skew = max(per_node.values()) / (len(doctors) / count)
+        moved = '' if previous is None else \
+            f'{sum(previous[d] != placement[d] for d in doctors) / len(doctors):.1%}'
+        previous = placement
+
+        dsns = dict(zip(names[:count], args.dsn[:count]))
+        for name, dsn in dsns.items():
+            setup(dsn, [d for d in doctors if placement[d] == name], args.rows_per_doctor)
+        stats = run(dsns, ring, doctors, args.threads, args.seconds, args.read_ratio)
+        print(f"{count:>6}{stats['ops']:>12.0f}{stats['p50']:>10.2f}{stats['p99']:>10.2f}{skew:>13.2f}{moved:>12}")
+
+    for dsn in args.dsn:
+        conn = psycopg2.connect(dsn)
+        try:
+            conn.cursor().execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+            conn.commit()
+        finally:
+            conn.close()
+
+
+if __name__ == '__main__':
+    main()
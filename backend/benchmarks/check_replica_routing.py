@@ -0,0 +1,109 @@
+'''
+Проверка маршрутизации чтений на реплику на двух локальных PostgreSQL в потоковой репликации.
+
+Сценарии:
+1. чтение без недавних записей уходит на реплику;
+2. сразу после записи того же врача чтение уходит на основную БД, после окна привязки — снова на реплику;
+3. при остановленном применении WAL на реплике (отставание) чтения уходят на основную БД;
+4. при недоступной реплике чтения уходят на основную БД.
+
+Запуск (реплика должна разрешать pg_wal_replay_pause для пользователя):
+    DATABASE_URL=postgresql://...primary DATABASE_REPLICA_URL=postgresql://...replica \
+    python backend/benchmarks/check_replica_routing.py --token doctor@example.com
+'''
+import argparse
+import os
+import sys
+import time
+
+os.environ.setdefault('REPLICA_STICKY_SECONDS', '1')
+os.environ.setdefault('REPLICA_MAX_LAG_SECONDS', '1')
+os.environ.setdefault('REPLICA_CHECK_INTERVAL', '0')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import psycopg2  # noqa: E402
+
+from shared import db  # noqa: E402
+
+
+def served_by_replica(sticky_key: str) -> bool:
+    conn = db.connect(readonly=True, sticky_key=sticky_key)
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT pg_is_in_recovery()')
+        return bool(cur.fetchone()[0])
+    finally:
+        conn.close()
+
+
+def write_as(sticky_key: str, email: str) -> None:
+    conn = db.connect(sticky_key=sticky_key)
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            "UPDATE t_p13795046_functional_diagnosti.doctors SET updated_at = CURRENT_TIMESTAMP WHERE email = %s",
+            (email,)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def check(name: str, actual: bool, expected: bool) -> bool:
+    status = 'OK' if actual == expected else 'FAIL'
+    print(f"[{status}] {name}: {'реплика' if actual else 'основная БД'}")
+    return actual == expected
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--token', required=True, help='email врача (X-Auth-Token) в тестовой БД')
+    parser.add_argument('--pool', action='store_true', help='проверить с пулами соединений self-hosted режима')
+    args = parser.parse_args()
+
+    if args.pool:
+        db.init_pool(1, 4)
+
+    sticky = float(os.environ['REPLICA_STICKY_SECONDS'])
+    max_lag = float(os.environ['REPLICA_MAX_LAG_SECONDS'])
+    ok = True
+
+    ok &= check('чтение без записей', served_by_replica(args.token), True)
+
+    write_as(args.token, args.token)
+    ok &= check('чтение сразу после записи', served_by_replica(args.token), False)
+    ok &= check('чтение другого врача после записи', served_by_replica('other-' + args.token), True)
+    time.sleep(sticky + 0.2)
+    ok &= check('чтение после окна привязки', served_by_replica(args.token), True)
+
+    replica = psycopg2.connect(os.environ['DATABASE_REPLICA_URL'])
+    replica.autocommit = True
+    replica_cur = replica.cursor()
+    replica_cur.execute('SELECT pg_wal_replay_pause()')
+    try:
+        # запись от имени другого ключа, чтобы чтение проверяло именно отставание, а не привязку
+        write_as('lag-' + args.token, args.token)
+        time.sleep(max_lag + 0.5)
+        ok &= check('чтение при отставании реплики', served_by_replica(args.token), False)
+    finally:
+        replica_cur.execute('SELECT pg_wal_replay_resume()')
+        replica.close()
+    time.sleep(0.5)
+    ok &= check('чтение после восстановления реплики', served_by_replica(args.token), True)
+
+    replica_url = os.environ['DATABASE_REPLICA_URL']
+    os.environ['DATABASE_REPLICA_URL'] = 'postgresql://invalid@127.0.0.1:1/none?connect_timeout=1'
+    if args.pool:
+        db.init_pool(1, 4)
+    try:
+        ok &= check('чтение при недоступной реплике', served_by_replica(args.token), False)
+    finally:
+        os.environ['DATABASE_REPLICA_URL'] = replica_url
+        db.close_pool()
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
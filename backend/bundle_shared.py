@@ -0,0 +1,46 @@
+'''
+Копирует общий пакет backend/shared в каталог каждой облачной функции перед деплоем.
+
+Облачная функция разворачивается из своего каталога (index.py, requirements.txt, модули рядом),
+родительский backend/ на платформу не попадает. index.py функций ищут shared сначала в backend/
+(локальный запуск, serve.py, worker.py), затем в каталоге функции — там, где его оставляет этот шаг.
+Копии не хранятся в git (.gitignore); запускать после каждого изменения shared и перед каждым деплоем.
+
+Копирование: python backend/bundle_shared.py
+Удаление:    python backend/bundle_shared.py --clean
+'''
+import argparse
+import json
+import os
+import shutil
+from typing import List
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+SHARED_DIR = os.path.join(BACKEND_DIR, 'shared')
+
+
+def function_dirs() -> List[str]:
+    '''Каталоги функций из func2url.json'''
+    with open(os.path.join(BACKEND_DIR, 'func2url.json'), encoding='utf-8') as f:
+        return [os.path.join(BACKEND_DIR, name) for name in sorted(json.load(f))]
+
+
+def bundle(clean: bool = False) -> None:
+    for directory in function_dirs():
+        target = os.path.join(directory, 'shared')
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+        if not clean:
+            shutil.copytree(SHARED_DIR, target, ignore=shutil.ignore_patterns('__pycache__', '*.pyc'))
+        print(f"{'Удалено' if clean else 'Скопировано'}: {os.path.relpath(target, BACKEND_DIR)}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Копирование backend/shared в каталоги облачных функций')
+    parser.add_argument('--clean', action='store_true', help='удалить копии shared из каталогов функций')
+    args = parser.parse_args()
+    bundle(args.clean)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,157 @@
+import asyncio
+import base64
+import binascii
 import json
 import os
-from typing import Dict, Any, List
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import sys
+import time
+from typing import Dict, Any, List, Optional
+import psycopg2.extensions
+from psycopg2.extras import RealDictCursor, execute_values
+import norm_import
+from norm_generator import NORM_TYPES, load_measurements, compute_norm_drafts
+from norm_library import load_merged_norm_tables, find_base_table, hide_base_table, norm_state
+from norm_status import norm_selectors, mark_pending, evaluate_pending
 
-def get_db_connection():
-    return psycopg2.connect(os.environ['DATABASE_URL'], cursor_factory=RealDictCursor)
+# shared: из backend/ при локальном запуске, из каталога функции после bundle_shared.py при деплое
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from shared import adb, db, idempotency, jobs, metrics, models, norm_snapshot, resilience
 
+# Размер файла Excel для action=import_norm_tables (после декодирования base64)
+MAX_IMPORT_BYTES = int(os.environ.get('MAX_IMPORT_BYTES', str(10 * 1024 * 1024)))
+
+def get_db_connection(readonly: bool = False, sticky_key: Optional[str] = None,
+                      statement_timeout_ms: Optional[int] = None, doctor_token: Optional[str] = None):
+    return db.connect(cursor_factory=RealDictCursor, readonly=readonly, sticky_key=sticky_key,
+                      statement_timeout_ms=statement_timeout_ms, doctor_token=doctor_token)
+
+# Чтения настроек врача для GET type=...; type=settings возвращает все три сразу
+SETTINGS_MODELS = {
+    'templates': models.ConclusionTemplate,
+    'input_settings': models.InputSettings,
+    'clinic_settings': models.ClinicSettings,
+}
+SETTINGS_SQL = {
+    'templates': f"SELECT {models.ConclusionTemplate.COLUMNS} FROM t_p13795046_functional_diagnosti.conclusion_templates WHERE doctor_id = %s AND (%s::text IS NULL OR study_type = %s) ORDER BY study_type, priority DESC",
+    'input_settings': f"SELECT {models.InputSettings.COLUMNS} FROM t_p13795046_functional_diagnosti.input_settings WHERE doctor_id = %s AND study_type = %s",
+    'clinic_settings': f"SELECT {models.ClinicSettings.COLUMNS} FROM t_p13795046_functional_diagnosti.clinic_settings WHERE doctor_id = %s",
+}
+
+def settings_params(kind: str, doctor_id: int, study_type: Optional[str]) -> tuple:
+    if kind == 'templates':
+        return (doctor_id, study_type, study_type)
+    if kind == 'input_settings':
+        return (doctor_id, study_type)
+    return (doctor_id,)
+
+def format_settings(kind: str, rows: List[Any]) -> Any:
+    '''Строки SETTINGS_SQL[kind] -> список шаблонов или одна запись настроек (None, если её нет)'''
+    if kind == 'templates':
+        return models.serialize_rows(SETTINGS_MODELS[kind], rows)
+    return models.serialize_row(SETTINGS_MODELS[kind], rows[0] if rows else None)
+
+def read_settings(conn, kind: str, doctor_id: int, study_type: Optional[str]) -> Any:
+    with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as settings_cur:
+        settings_cur.execute(SETTINGS_SQL[kind], settings_params(kind, doctor_id, study_type))
+        return format_settings(kind, settings_cur.fetchall())
+
+def generate_norm_drafts(conn, doctor_id: int, options: Dict[str, Any]) -> Dict[str, Any]:
+    '''Черновики таблиц норм по архиву врача с параметрами из запроса generate_norm_tables'''
+    started = time.perf_counter()
+    study_type = options['study_type']
+    norm_type = options.get('norm_type', 'age')
+    measurements = load_measurements(conn, [doctor_id], study_type, norm_type, options.get('parameters'))
+    norm_percentiles = options.get('norm_percentiles', [2.5, 97.5])
+    borderline_percentiles = options.get('borderline_percentiles', [1, 99])
+    drafts = compute_norm_drafts(
+        measurements, study_type, norm_type,
+        bin_count=int(options.get('bin_count', 6)),
+        min_samples=int(options.get('min_samples', 30)),
+        norm_percentiles=(float(norm_percentiles[0]), float(norm_percentiles[1])),
+        borderline_percentiles=(float(borderline_percentiles[0]), float(borderline_percentiles[1]))
+    )
+    return {
+        'norm_tables': drafts,
+        'measurements': len(measurements),
+        'elapsed_ms': round((time.perf_counter() - started) * 1000, 1)
+    }
+
+def get_norm_snapshot(cur, doctor_id: int) -> norm_snapshot.NormSnapshot:
+    '''Снимок норм врача для текущей ревизии; отсутствующий или устаревший строится из БД'''
+    version, revision = norm_state(cur, doctor_id)
+    snapshot = norm_snapshot.load(doctor_id, version, revision)
+    if snapshot is None:
+        tables, _ = load_merged_norm_tables(cur, doctor_id)
+        snapshot = norm_snapshot.write(doctor_id, tables, version, revision)
+    return snapshot
+
+def refresh_norm_snapshot(cur, doctor_id: int) -> None:
+    '''Перестраивает снимок после изменения норм, чтобы процессы не строили его сами при чтении'''
+    try:
+        get_norm_snapshot(cur, doctor_id)
+    except OSError:
+        # Снимок будет построен при следующей проверке норм
+        pass
+
+def check_norms(snapshot: norm_snapshot.NormSnapshot, study_type: str, patient: Dict[str, Any],
+                results: Dict[str, Any]) -> Dict[str, Any]:
+    '''Проверка показателей по нормам в формате NormCheckResult (getAllParameterChecks в normsChecker.ts)'''
+    age = patient.get('age') or {}
+    if not age:
+        return {param: {'status': 'normal'} for param in results}
+    years = norm_snapshot.parse_float(age.get('years'))
+    months = norm_snapshot.parse_float(age.get('months'))
+    days = norm_snapshot.parse_float(age.get('days'))
+    category = norm_snapshot.patient_category(patient.get('gender'), years)
+    dimensions = norm_snapshot.patient_dimensions(years, months, days, patient.get('weight'),
+                                                  patient.get('height'), patient.get('bsa'))
+    checks = {}
+    for param, value in results.items():
+        check = snapshot.check(study_type, param, norm_snapshot.parse_float(value), category, dimensions)
+        item: Dict[str, Any] = {'status': check.status}
+        if check.norm_min is not None:
+            item['normRange'] = {'min': check.norm_min, 'max': check.norm_max}
+            item['borderlineRange'] = {'low': check.borderline_low, 'high': check.borderline_high}
+        if check.conclusion:
+            item['conclusion'] = check.conclusion
+        checks[param] = item
+    return checks
+
+def enqueue_norm_status(cur, doctor_id: int, tables: List[Dict[str, Any]]) -> None:
+    '''Ставит пересчёт статусов протоколов, затронутых старыми и новыми версиями таблиц норм'''
+    selectors = norm_selectors(tables)
+    if selectors:
+        jobs.enqueue(cur, doctor_id, 'evaluate_norm_status', {'selectors': selectors})
+
+@jobs.register('evaluate_norm_status')
+def evaluate_norm_status_job(conn, job: jobs.Job) -> Dict[str, Any]:
+    '''Пересчёт статусов показателей протоколов врача: новые строки и строки, затронутые изменением норм'''
+    marked = 0
+    if job.payload.get('full'):
+        marked = mark_pending(conn, job.doctor_id)
+    elif job.payload.get('selectors'):
+        marked = mark_pending(conn, job.doctor_id, job.payload['selectors'])
+    
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute(
+        "SELECT count(*) AS pending FROM t_p13795046_functional_diagnosti.protocol_norm_status WHERE doctor_id = %s AND pending",
+        (job.doctor_id,)
+    )
+    total = max(cur.fetchone()['pending'], 1)
+    result = evaluate_pending(
+        conn, job.doctor_id, lambda: get_norm_snapshot(cur, job.doctor_id),
+        on_batch=lambda evaluated: job.progress(evaluated / total, f'Пересчитано показателей: {evaluated}')
+    )
+    result['marked'] = marked
+    return result
+
+@jobs.register('generate_norm_tables')
+def generate_norm_tables_job(conn, job: jobs.Job) -> Dict[str, Any]:
+    return generate_norm_drafts(conn, job.doctor_id, job.payload)
+
+@metrics.instrumented('doctor-settings')
+@db.read_your_writes
+@idempotency.idempotent('doctor-settings')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     API для управления настройками врача: нормы, шаблоны заключений, настройки ввода
@@ -19,7 +164,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token, Idempotency-Key, X-Last-Write',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
@@ -42,8 +187,12 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
+    policy = resilience.READ if method == 'GET' else resilience.WRITE
+    
     try:
-        conn = get_db_connection()
+        slot = resilience.admit(policy)
+        conn = get_db_connection(readonly=(method == 'GET'), sticky_key=auth_token,
+                                 statement_timeout_ms=policy.statement_timeout_ms, doctor_token=auth_token)
         cur = conn.cursor()
         
         cur.execute(
@@ -75,48 +224,17 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 }
             
             if data_type == 'norm_tables':
-                study_type = params.get('study_type')
-                if study_type:
-                    cur.execute(
-                        "SELECT * FROM t_p13795046_functional_diagnosti.norm_tables WHERE doctor_id = %s AND study_type = %s ORDER BY parameter",
-                        (doctor_id, study_type)
-                    )
-                else:
-                    cur.execute("SELECT * FROM t_p13795046_functional_diagnosti.norm_tables WHERE doctor_id = %s ORDER BY study_type, parameter", (doctor_id,))
-                
-                norm_tables = []
-                for row in cur.fetchall():
-                    table = dict(row)
-                    table['id'] = str(table['id'])
-                    if table.get('created_at'):
-                        table['created_at'] = table['created_at'].isoformat()
-                    if table.get('updated_at'):
-                        table['updated_at'] = table['updated_at'].isoformat()
-                    norm_tables.append(table)
+                norm_tables, base_version = load_merged_norm_tables(cur, authenticated_doctor_id, params.get('study_type'))
                 
                 return {
                     'statusCode': 200,
                     'headers': headers,
-                    'body': json.dumps({'norm_tables': norm_tables}),
+                    'body': json.dumps({'norm_tables': norm_tables, 'base_version': base_version}),
                     'isBase64Encoded': False
                 }
             
             elif data_type == 'templates':
-                study_type = params.get('study_type')
-                if study_type:
-                    cur.execute(
-                        "SELECT * FROM t_p13795046_functional_diagnosti.conclusion_templates WHERE doctor_id = %s AND study_type = %s ORDER BY priority DESC",
-                        (doctor_id, study_type)
-                    )
-                else:
-                    cur.execute("SELECT * FROM t_p13795046_functional_diagnosti.conclusion_templates WHERE doctor_id = %s ORDER BY study_type, priority DESC", (doctor_id,))
-                
-                templates = [dict(row) for row in cur.fetchall()]
-                for template in templates:
-                    if template.get('created_at'):
-                        template['created_at'] = template['created_at'].isoformat()
-                    if template.get('updated_at'):
-                        template['updated_at'] = template['updated_at'].isoformat()
+                templates = read_settings(conn, 'templates', int(doctor_id), params.get('study_type'))
                 
                 return {
                     'statusCode': 200,
@@ -135,18 +253,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'isBase64Encoded': False
                     }
                 
-                cur.execute(
-                    "SELECT * FROM t_p13795046_functional_diagnosti.input_settings WHERE doctor_id = %s AND study_type = %s",
-                    (doctor_id, study_type)
-                )
-                settings = cur.fetchone()
-                
-                if settings:
-                    settings = dict(settings)
-                    if settings.get('created_at'):
-                        settings['created_at'] = settings['created_at'].isoformat()
-                    if settings.get('updated_at'):
-                        settings['updated_at'] = settings['updated_at'].isoformat()
+                settings = read_settings(conn, 'input_settings', int(doctor_id), study_type)
                 
                 return {
                     'statusCode': 200,
@@ -155,19 +262,24 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'isBase64Encoded': False
                 }
             
-            elif data_type == 'clinic_settings':
-                cur.execute(
-                    "SELECT * FROM t_p13795046_functional_diagnosti.clinic_settings WHERE doctor_id = %s",
-                    (doctor_id,)
-                )
-                settings = cur.fetchone()
+            elif data_type == 'settings':
+                study_type = params.get('study_type')
+                result = {}
+                for kind in SETTINGS_SQL:
+                    if kind == 'input_settings' and not study_type:
+                        result[kind] = None
+                        continue
+                    result[kind] = read_settings(conn, kind, int(doctor_id), study_type)
                 
-                if settings:
-                    settings = dict(settings)
-                    if settings.get('created_at'):
-                        settings['created_at'] = settings['created_at'].isoformat()
-                    if settings.get('updated_at'):
-                        settings['updated_at'] = settings['updated_at'].isoformat()
+                return {
+                    'statusCode': 200,
+                    'headers': headers,
+                    'body': json.dumps(result),
+                    'isBase64Encoded': False
+                }
+            
+            elif data_type == 'clinic_settings':
+                settings = read_settings(conn, 'clinic_settings', int(doctor_id), None)
                 
                 return {
                     'statusCode': 200,
@@ -264,12 +376,26 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 conclusion_borderline_low = table_data.get('conclusionBorderlineLow')
                 conclusion_borderline_high = table_data.get('conclusionBorderlineHigh')
                 
+                # Старые версии таблицы: по ним и по новой версии пересчитываются статусы протоколов
+                affected_tables = [{'study_type': study_type, 'category': category, 'parameter': parameter,
+                                    'norm_type': norm_type, 'rows': table_data.get('rows', [])}]
+                
                 if table_id and table_id != 'new':
                     cur.execute(
-                        "SELECT id FROM t_p13795046_functional_diagnosti.norm_tables WHERE id = %s::uuid AND doctor_id = %s",
+                        "SELECT id, study_type, category, parameter, norm_type, rows FROM t_p13795046_functional_diagnosti.norm_tables WHERE id = %s::uuid AND doctor_id = %s",
                         (table_id, doctor_id)
                     )
                     existing = cur.fetchone()
+                    base_table = None if existing else find_base_table(cur, table_id)
+                    if existing:
+                        affected_tables.append(existing)
+                    elif base_table:
+                        affected_tables.append(base_table)
+                        cur.execute(
+                            "SELECT study_type, category, parameter, norm_type, rows FROM t_p13795046_functional_diagnosti.norm_tables WHERE doctor_id = %s AND base_key = %s AND NOT deleted",
+                            (doctor_id, base_table['base_key'])
+                        )
+                        affected_tables.extend(cur.fetchall())
                     
                     if existing:
                         cur.execute(
@@ -279,7 +405,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                                 rows = %s::jsonb, show_in_report = %s,
                                 conclusion_below = %s, conclusion_above = %s,
                                 conclusion_borderline_low = %s, conclusion_borderline_high = %s,
-                                updated_at = CURRENT_TIMESTAMP
+                                deleted = false, updated_at = CURRENT_TIMESTAMP
                             WHERE id = %s::uuid AND doctor_id = %s
                             RETURNING id
                             """,
@@ -288,6 +414,31 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                              conclusion_borderline_high, table_id, doctor_id)
                         )
                         saved_id = str(cur.fetchone()['id'])
+                    elif base_table:
+                        # Изменение базовой таблицы сохраняется как переопределение врача
+                        cur.execute(
+                            """
+                            INSERT INTO t_p13795046_functional_diagnosti.norm_tables
+                            (doctor_id, base_key, study_type, category, parameter, norm_type, rows,
+                             show_in_report, conclusion_below, conclusion_above,
+                             conclusion_borderline_low, conclusion_borderline_high)
+                            VALUES (%s, %s, %s, %s, %s, %s, %s::jsonb, %s, %s, %s, %s, %s)
+                            ON CONFLICT (doctor_id, base_key) WHERE base_key IS NOT NULL
+                            DO UPDATE SET study_type = EXCLUDED.study_type, category = EXCLUDED.category,
+                                parameter = EXCLUDED.parameter, norm_type = EXCLUDED.norm_type,
+                                rows = EXCLUDED.rows, show_in_report = EXCLUDED.show_in_report,
+                                conclusion_below = EXCLUDED.conclusion_below,
+                                conclusion_above = EXCLUDED.conclusion_above,
+                                conclusion_borderline_low = EXCLUDED.conclusion_borderline_low,
+                                conclusion_borderline_high = EXCLUDED.conclusion_borderline_high,
+                                deleted = false, updated_at = CURRENT_TIMESTAMP
+                            RETURNING id
+                            """,
+                            (doctor_id, base_table['base_key'], study_type, category, parameter, norm_type,
+                             rows, show_in_report, conclusion_below, conclusion_above,
+                             conclusion_borderline_low, conclusion_borderline_high)
+                        )
+                        saved_id = str(cur.fetchone()['id'])
                     else:
                         cur.execute(
                             """
@@ -319,7 +470,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     )
                     saved_id = str(cur.fetchone()['id'])
                 
+                enqueue_norm_status(cur, authenticated_doctor_id, affected_tables)
                 conn.commit()
+                refresh_norm_snapshot(cur, authenticated_doctor_id)
                 
                 return {
                     'statusCode': 200,
@@ -328,6 +481,151 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'isBase64Encoded': False
                 }
             
+            elif action == 'check_norms':
+                study_type = body_data.get('study_type')
+                if not study_type:
+                    return {
+                        'statusCode': 400,
+                        'headers': headers,
+                        'body': json.dumps({'error': 'Не указан тип исследования'}),
+                        'isBase64Encoded': False
+                    }
+                
+                snapshot = get_norm_snapshot(cur, authenticated_doctor_id)
+                checks = check_norms(snapshot, study_type, body_data.get('patient') or {},
+                                     body_data.get('results') or {})
+                
+                return {
+                    'statusCode': 200,
+                    'headers': headers,
+                    'body': json.dumps({'checks': checks}),
+                    'isBase64Encoded': False
+                }
+            
+            elif action == 'import_norm_tables':
+                try:
+                    data = base64.b64decode(body_data.get('file') or '', validate=True)
+                except (binascii.Error, ValueError):
+                    data = b''
+                if not data:
+                    return {
+                        'statusCode': 400,
+                        'headers': headers,
+                        'body': json.dumps({'error': 'Не передан файл Excel (поле file, base64)'}),
+                        'isBase64Encoded': False
+                    }
+                if len(data) > MAX_IMPORT_BYTES:
+                    return {
+                        'statusCode': 413,
+                        'headers': headers,
+                        'body': json.dumps({'error': f'Файл больше {MAX_IMPORT_BYTES // (1024 * 1024)} МБ'}),
+                        'isBase64Encoded': False
+                    }
+
+                try:
+                    tables, import_errors, read_rows = norm_import.parse_workbook(
+                        data, body_data.get('study_type'), body_data.get('category'),
+                        body_data.get('norm_type', 'age')
+                    )
+                except norm_import.WorkbookError as e:
+                    return {
+                        'statusCode': 400,
+                        'headers': headers,
+                        'body': json.dumps({'error': str(e)}),
+                        'isBase64Encoded': False
+                    }
+
+                result = {
+                    'tables': norm_import.preview(tables),
+                    'rows': read_rows,
+                    'imported_rows': sum(len(table['rows']) for table in tables),
+                    'errors': import_errors,
+                }
+                # С ошибками без skip_invalid ничего не сохраняется, как и при preview
+                if body_data.get('preview') or (import_errors and not body_data.get('skip_invalid')) or not tables:
+                    return {
+                        'statusCode': 200 if body_data.get('preview') else 400,
+                        'headers': headers,
+                        'body': json.dumps(dict(result, saved=False, **(
+                            {} if body_data.get('preview') else {'error': 'В файле есть ошибки, таблицы не сохранены'}
+                        ))),
+                        'isBase64Encoded': False
+                    }
+
+                saved = execute_values(
+                    cur,
+                    """
+                    INSERT INTO t_p13795046_functional_diagnosti.norm_tables
+                    (doctor_id, study_type, category, parameter, norm_type, rows,
+                     show_in_report, conclusion_below, conclusion_above,
+                     conclusion_borderline_low, conclusion_borderline_high)
+                    VALUES %s
+                    RETURNING id
+                    """,
+                    [(authenticated_doctor_id, table['studyType'], table['category'], table['parameter'],
+                      table['normType'], json.dumps(table['rows']), table['showInReport'],
+                      table.get('conclusionBelow'), table.get('conclusionAbove'),
+                      table.get('conclusionBorderlineLow'), table.get('conclusionBorderlineHigh'))
+                     for table in tables],
+                    template='(%s, %s, %s, %s, %s, %s::jsonb, %s, %s, %s, %s, %s)',
+                    page_size=500,
+                    fetch=True
+                )
+                enqueue_norm_status(cur, authenticated_doctor_id, [
+                    {'study_type': table['studyType'], 'category': table['category'], 'parameter': table['parameter'],
+                     'norm_type': table['normType'], 'rows': table['rows']}
+                    for table in tables
+                ])
+                conn.commit()
+                refresh_norm_snapshot(cur, authenticated_doctor_id)
+
+                return {
+                    'statusCode': 200,
+                    'headers': headers,
+                    'body': json.dumps(dict(result, saved=True, ids=[str(row['id']) for row in saved],
+                                            message=f'Импортировано таблиц норм: {len(saved)}')),
+                    'isBase64Encoded': False
+                }
+
+            elif action == 'generate_norm_tables':
+                study_type = body_data.get('study_type')
+                norm_type = body_data.get('norm_type', 'age')
+                if not study_type or norm_type not in NORM_TYPES:
+                    return {
+                        'statusCode': 400,
+                        'headers': headers,
+                        'body': json.dumps({'error': 'Не указан тип исследования или тип нормирования'}),
+                        'isBase64Encoded': False
+                    }
+                
+                if body_data.get('background'):
+                    options = {key: value for key, value in body_data.items() if key not in ('action', 'background')}
+                    job_id = jobs.enqueue(cur, authenticated_doctor_id, 'generate_norm_tables', options)
+                    conn.commit()
+                    
+                    return {
+                        'statusCode': 202,
+                        'headers': headers,
+                        'body': json.dumps({'message': 'Генерация поставлена в очередь', 'job_id': job_id}),
+                        'isBase64Encoded': False
+                    }
+                
+                # Синхронная генерация сканирует архив: низкий приоритет и таймаут сканирования
+                slot.release()
+                policy = resilience.SCAN
+                slot = resilience.admit(policy)
+                cur.execute(
+                    "SELECT set_config('statement_timeout', %s, true)",
+                    (f'{policy.statement_timeout_ms}ms',)
+                )
+                
+                return {
+                    'statusCode': 200,
+                    'headers': headers,
+                    'body': json.dumps(generate_norm_drafts(conn, authenticated_doctor_id, body_data)),
+                    'isBase64Encoded': False
+                }
+            
             elif action == 'save_template':
                 study_type = body_data.get('study_type')
                 template_name = body_data.get('template_name')
@@ -435,7 +733,10 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     "DELETE FROM t_p13795046_functional_diagnosti.norm_tables WHERE doctor_id = %s",
                     (authenticated_doctor_id,)
                 )
+                # Вместе с переопределениями возвращаются все базовые таблицы — пересчёт всех статусов
+                jobs.enqueue(cur, authenticated_doctor_id, 'evaluate_norm_status', {'full': True})
                 conn.commit()
+                refresh_norm_snapshot(cur, authenticated_doctor_id)
                 
                 return {
                     'statusCode': 200,
@@ -452,11 +753,28 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'isBase64Encoded': False
                 }
             
+            # Удалённое переопределение остаётся надгробием, иначе снова показалась бы базовая таблица
             cur.execute(
-                "DELETE FROM t_p13795046_functional_diagnosti.norm_tables WHERE id = %s::uuid AND doctor_id = %s RETURNING id",
+                """
+                UPDATE t_p13795046_functional_diagnosti.norm_tables
+                SET deleted = true, updated_at = CURRENT_TIMESTAMP
+                WHERE id = %s::uuid AND doctor_id = %s AND base_key IS NOT NULL
+                RETURNING id, study_type, category, parameter, norm_type, rows
+                """,
                 (table_id, authenticated_doctor_id)
             )
             result = cur.fetchone()
+            if not result:
+                cur.execute(
+                    "DELETE FROM t_p13795046_functional_diagnosti.norm_tables WHERE id = %s::uuid AND doctor_id = %s RETURNING id, study_type, category, parameter, norm_type, rows",
+                    (table_id, authenticated_doctor_id)
+                )
+                result = cur.fetchone()
+            if not result:
+                base_table = find_base_table(cur, table_id)
+                if base_table:
+                    hide_base_table(cur, authenticated_doctor_id, base_table)
+                    result = base_table
             if not result:
                 return {
                     'statusCode': 404,
@@ -465,7 +783,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'isBase64Encoded': False
                 }
             
+            enqueue_norm_status(cur, authenticated_doctor_id, [result])
             conn.commit()
+            refresh_norm_snapshot(cur, authenticated_doctor_id)
             
             return {
                 'statusCode': 200,
@@ -481,6 +801,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
+    except resilience.UNAVAILABLE_ERRORS as e:
+        return resilience.unavailable_response(headers, e, policy)
     except Exception as e:
         return {
             'statusCode': 500,
@@ -492,4 +814,87 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         if 'cur' in locals():
             cur.close()
         if 'conn' in locals():
-            conn.close()
\ No newline at end of file
+            conn.close()
+        if 'slot' in locals():
+            slot.release()
+
+@metrics.instrumented('doctor-settings')
+@db.read_your_writes
+async def handler_async(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Режим serve.py --async: шаблоны, настройки ввода и клиники (GET type=...) читаются через asyncpg,
+    для type=settings — параллельно на отдельных соединениях; остальные запросы — синхронным handler в пуле потоков
+    '''
+    headers_dict = event.get('headers') or {}
+    auth_token = headers_dict.get('x-auth-token') or headers_dict.get('X-Auth-Token')
+    params = event.get('queryStringParameters') or {}
+    data_type = params.get('type')
+    study_type = params.get('study_type')
+    if event.get('httpMethod') != 'GET' or not auth_token or data_type not in ('settings', *SETTINGS_SQL) \
+            or (data_type == 'input_settings' and not study_type) or not str(params.get('doctor_id', '0')).isdigit():
+        return await adb.run_sync(handler, event, context)
+    
+    headers = {
+        'Access-Control-Allow-Origin': '*',
+        'Content-Type': 'application/json'
+    }
+    policy = resilience.READ
+    
+    async def read(kind: str, doctor_id: int) -> Any:
+        if kind == 'input_settings' and not study_type:
+            return None
+        async with adb.connect(readonly=True, sticky_key=auth_token,
+                               statement_timeout_ms=policy.statement_timeout_ms) as conn:
+            return format_settings(kind, await conn.fetch(SETTINGS_SQL[kind],
+                                                          *settings_params(kind, doctor_id, study_type)))
+    
+    try:
+        slot = resilience.admit(policy)
+        async with adb.connect(readonly=True, sticky_key=auth_token,
+                               statement_timeout_ms=policy.statement_timeout_ms) as conn:
+            authenticated_doctor_id = await conn.fetchval(
+                "SELECT id FROM t_p13795046_functional_diagnosti.doctors WHERE email = %s", auth_token
+            )
+        if authenticated_doctor_id is None:
+            return {
+                'statusCode': 401,
+                'headers': headers,
+                'body': json.dumps({'error': 'Неверный токен'}),
+                'isBase64Encoded': False
+            }
+        if int(params.get('doctor_id', authenticated_doctor_id)) != authenticated_doctor_id:
+            return {
+                'statusCode': 403,
+                'headers': headers,
+                'body': json.dumps({'error': 'Доступ запрещен'}),
+                'isBase64Encoded': False
+            }
+        
+        if data_type == 'settings':
+            kinds = list(SETTINGS_SQL)
+            values = await asyncio.gather(*(read(kind, authenticated_doctor_id) for kind in kinds))
+            body = dict(zip(kinds, values))
+        elif data_type == 'templates':
+            body = {'templates': await read(data_type, authenticated_doctor_id)}
+        else:
+            body = {'settings': await read(data_type, authenticated_doctor_id)}
+        
+        return {
+            'statusCode': 200,
+            'headers': headers,
+            'body': json.dumps(body),
+            'isBase64Encoded': False
+        }
+    
+    except resilience.UNAVAILABLE_ERRORS as e:
+        return resilience.unavailable_response(headers, e)
+    except Exception as e:
+        return {
+            'statusCode': 500,
+            'headers': headers,
+            'body': json.dumps({'error': f'Ошибка сервера: {str(e)}'}),
+            'isBase64Encoded': False
+        }
+    finally:
+        if 'slot' in locals():
+            slot.release()
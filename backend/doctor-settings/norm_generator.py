@@ -0,0 +1,273 @@
+'''
+Генерация черновиков таблиц норм по собственному архиву протоколов врача или клиники.
+
+Значения показателей берутся из protocol_results, пациенты делятся на категории
+(adult_male, adult_female, child_male, child_female) и на интервалы по измерению normType
+(возраст, масса, рост, BSA). Для каждой группы перцентили считаются векторно через NumPy:
+norm-перцентили дают parameterFrom/parameterTo, внешние перцентили дают borderlineLow/borderlineHigh.
+Результат совпадает по форме с NormTable/NormTableRow и может быть сохранён через save_norm_table.
+
+Запуск вручную:
+    DATABASE_URL=... python norm_generator.py --doctor-id 1 --doctor-id 2 --study-type ЭхоКГ --norm-type age
+'''
+import argparse
+import json
+import os
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import psycopg2
+import psycopg2.extensions
+
+CATEGORIES = ('adult_male', 'adult_female', 'child_male', 'child_female')
+NORM_TYPES = ('age', 'weight', 'height', 'bsa')
+DAYS_PER_YEAR = 365.25
+ADULT_AGE_YEARS = 18
+
+# Точность округления границ интервалов измерения
+RANGE_DECIMALS = {'age': 0, 'weight': 0, 'height': 0, 'bsa': 2}
+
+DIMENSION_SQL = {
+    'age': 'COALESCE(p.patient_age_total_days, p.study_date - p.patient_birth_date)::double precision / 365.25',
+    'weight': 'p.patient_weight::double precision',
+    'height': 'p.patient_height::double precision',
+    'bsa': 'p.patient_bsa::double precision',
+}
+
+
+class Measurements:
+    '''Столбцы измерений: код параметра, значение, код категории, значение измерения normType'''
+    __slots__ = ('parameters', 'param_codes', 'values', 'categories', 'dimension')
+
+    def __init__(self, parameters: List[str], param_codes: np.ndarray, values: np.ndarray,
+                 categories: np.ndarray, dimension: np.ndarray):
+        self.parameters = parameters
+        self.param_codes = param_codes
+        self.values = values
+        self.categories = categories
+        self.dimension = dimension
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+
+def load_measurements(conn, doctor_ids: Sequence[int], study_type: str, norm_type: str,
+                      parameters: Optional[Sequence[str]] = None,
+                      chunk_size: int = 100000) -> Measurements:
+    '''Потоково читает значения показателей серверным курсором и собирает их в массивы NumPy'''
+    if norm_type not in NORM_TYPES:
+        raise ValueError(f'Неизвестный тип нормирования: {norm_type}')
+
+    query = f"""
+        SELECT r.param, r.value, p.patient_gender,
+               COALESCE(p.patient_age_total_days, p.study_date - p.patient_birth_date) AS age_days,
+               {DIMENSION_SQL[norm_type]} AS dimension
+        FROM t_p13795046_functional_diagnosti.protocol_results r
+        JOIN t_p13795046_functional_diagnosti.protocols p
+          ON p.id = r.protocol_id AND p.study_date = r.study_date
+        WHERE r.doctor_id = ANY(%s) AND r.study_type = %s
+    """
+    query_params: List[Any] = [list(doctor_ids), study_type]
+    if parameters:
+        query += ' AND r.param = ANY(%s)'
+        query_params.append(list(parameters))
+
+    param_index: Dict[str, int] = {}
+    code_chunks, value_chunks, category_chunks, dimension_chunks = [], [], [], []
+
+    with conn.cursor(name='norm_generator_measurements', cursor_factory=psycopg2.extensions.cursor) as cur:
+        cur.itersize = chunk_size
+        cur.execute(query, query_params)
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            params_col, values_col, genders_col, age_days_col, dimension_col = zip(*rows)
+
+            codes = np.fromiter(
+                (param_index.setdefault(name, len(param_index)) for name in params_col),
+                dtype=np.int32, count=len(rows)
+            )
+            genders = np.asarray(genders_col, dtype=object)
+            age_days = np.asarray(age_days_col, dtype=np.float64)
+            is_child = age_days < ADULT_AGE_YEARS * DAYS_PER_YEAR
+            categories = np.full(len(rows), -1, dtype=np.int8)
+            categories[(genders == 'male') & ~is_child] = 0
+            categories[(genders == 'female') & ~is_child] = 1
+            categories[(genders == 'male') & is_child] = 2
+            categories[(genders == 'female') & is_child] = 3
+
+            code_chunks.append(codes)
+            value_chunks.append(np.asarray(values_col, dtype=np.float64))
+            category_chunks.append(categories)
+            dimension_chunks.append(np.asarray(
+                [np.nan if d is None else d for d in dimension_col], dtype=np.float64
+            ))
+
+    if not code_chunks:
+        empty = np.empty(0)
+        return Measurements([], empty.astype(np.int32), empty, empty.astype(np.int8), empty)
+
+    names = [''] * len(param_index)
+    for name, code in param_index.items():
+        names[code] = name
+    return Measurements(
+        names,
+        np.concatenate(code_chunks),
+        np.concatenate(value_chunks),
+        np.concatenate(category_chunks),
+        np.concatenate(dimension_chunks),
+    )
+
+
+def group_percentiles(groups: np.ndarray, values: np.ndarray, n_groups: int,
+                      percentiles: Sequence[float]) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Перцентили значений для каждой группы за одну сортировку (линейная интерполяция, как np.percentile).
+    Возвращает число значений в группе и матрицу [n_groups, len(percentiles)] (NaN для пустых групп).
+    '''
+    order = np.lexsort((values, groups))
+    sorted_values = values[order]
+    counts = np.bincount(groups, minlength=n_groups)
+    starts = np.cumsum(counts) - counts
+
+    q = np.asarray(percentiles, dtype=np.float64) / 100.0
+    positions = starts[:, None] + q[None, :] * np.maximum(counts - 1, 0)[:, None]
+    lower = np.floor(positions).astype(np.int64)
+    upper = np.minimum(lower + 1, (starts + np.maximum(counts - 1, 0))[:, None])
+    fraction = positions - lower
+
+    result = np.full((n_groups, len(q)), np.nan)
+    non_empty = counts > 0
+    if len(sorted_values):
+        lo_values = sorted_values[np.clip(lower, 0, len(sorted_values) - 1)]
+        hi_values = sorted_values[np.clip(upper, 0, len(sorted_values) - 1)]
+        interpolated = lo_values + (hi_values - lo_values) * fraction
+        result[non_empty] = interpolated[non_empty]
+    return counts, result
+
+
+def _format_number(value: float, decimals: int) -> str:
+    text = f'{value:.{decimals}f}'
+    if '.' in text:
+        text = text.rstrip('0').rstrip('.')
+    return '0' if text == '-0' else text
+
+
+def _bin_edges(dimension: np.ndarray, bin_count: int, decimals: int) -> np.ndarray:
+    '''Границы интервалов равной наполненности, округлённые до удобной точности'''
+    quantiles = np.quantile(dimension, np.linspace(0, 1, bin_count + 1))
+    factor = 10 ** decimals
+    edges = np.round(quantiles * factor) / factor
+    edges[0] = np.floor(quantiles[0] * factor) / factor
+    edges[-1] = np.ceil(quantiles[-1] * factor) / factor
+    return np.unique(edges)
+
+
+def compute_norm_drafts(measurements: Measurements, study_type: str, norm_type: str,
+                        bin_count: int = 6, min_samples: int = 30,
+                        norm_percentiles: Tuple[float, float] = (2.5, 97.5),
+                        borderline_percentiles: Tuple[float, float] = (1.0, 99.0),
+                        decimals: int = 1) -> List[Dict[str, Any]]:
+    '''Строит черновики таблиц норм (по одной на параметр и категорию) из массивов измерений'''
+    valid = (measurements.categories >= 0) & np.isfinite(measurements.values) & np.isfinite(measurements.dimension)
+    param_codes = measurements.param_codes[valid]
+    values = measurements.values[valid]
+    categories = measurements.categories[valid].astype(np.int64)
+    dimension = measurements.dimension[valid]
+
+    n_params = len(measurements.parameters)
+    n_categories = len(CATEGORIES)
+    range_decimals = RANGE_DECIMALS[norm_type]
+
+    # Интервалы измерения строятся отдельно для каждой категории пациентов
+    edges_by_category: List[Optional[np.ndarray]] = []
+    bin_index = np.zeros(len(values), dtype=np.int64)
+    for category_code in range(n_categories):
+        mask = categories == category_code
+        if not mask.any():
+            edges_by_category.append(None)
+            continue
+        edges = _bin_edges(dimension[mask], bin_count, range_decimals)
+        edges_by_category.append(edges)
+        if len(edges) < 2:
+            bin_index[mask] = 0
+            continue
+        bin_index[mask] = np.clip(np.searchsorted(edges, dimension[mask], side='right') - 1, 0, len(edges) - 2)
+
+    groups = (param_codes.astype(np.int64) * n_categories + categories) * bin_count + bin_index
+    n_groups = n_params * n_categories * bin_count
+    percentiles = (borderline_percentiles[0], norm_percentiles[0], norm_percentiles[1], borderline_percentiles[1])
+    counts, stats = group_percentiles(groups, values, n_groups, percentiles)
+    counts = counts.reshape(n_params, n_categories, bin_count)
+    stats = stats.reshape(n_params, n_categories, bin_count, len(percentiles))
+
+    drafts: List[Dict[str, Any]] = []
+    for param_code, parameter in enumerate(measurements.parameters):
+        for category_code, category in enumerate(CATEGORIES):
+            edges = edges_by_category[category_code]
+            if edges is None or len(edges) < 2:
+                continue
+
+            rows: List[Dict[str, Any]] = []
+            sample_sizes: List[int] = []
+            for b in range(len(edges) - 1):
+                n = int(counts[param_code, category_code, b])
+                if n < min_samples:
+                    continue
+                low_border, norm_from, norm_to, high_border = stats[param_code, category_code, b]
+                row = {
+                    'id': f'generated_{parameter}_{category}_{b}',
+                    'rangeFrom': _format_number(edges[b], range_decimals),
+                    'rangeTo': _format_number(edges[b + 1], range_decimals),
+                    'parameterFrom': _format_number(norm_from, decimals),
+                    'parameterTo': _format_number(norm_to, decimals),
+                    'borderlineLow': _format_number(low_border, decimals),
+                    'borderlineHigh': _format_number(high_border, decimals),
+                }
+                if norm_type == 'age':
+                    row['rangeUnit'] = 'years'
+                rows.append(row)
+                sample_sizes.append(n)
+
+            if not rows:
+                continue
+            drafts.append({
+                'id': 'new',
+                'studyType': study_type,
+                'category': category,
+                'parameter': parameter,
+                'normType': norm_type,
+                'rows': rows,
+                'showInReport': True,
+                'conclusionBelow': '',
+                'conclusionAbove': '',
+                'sampleSizes': sample_sizes,
+            })
+    return drafts
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Генерация черновиков таблиц норм по архиву протоколов')
+    parser.add_argument('--doctor-id', type=int, action='append', required=True,
+                        help='ID врача; для клиники укажите несколько раз')
+    parser.add_argument('--study-type', required=True)
+    parser.add_argument('--norm-type', default='age', choices=NORM_TYPES)
+    parser.add_argument('--parameter', action='append')
+    parser.add_argument('--bins', type=int, default=6)
+    parser.add_argument('--min-samples', type=int, default=30)
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        measurements = load_measurements(conn, args.doctor_id, args.study_type, args.norm_type, args.parameter)
+    finally:
+        conn.close()
+
+    drafts = compute_norm_drafts(measurements, args.study_type, args.norm_type,
+                                 bin_count=args.bins, min_samples=args.min_samples)
+    print(json.dumps(drafts, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+'''
+Импорт таблиц норм из Excel (XLSX) на сервере — замена разбора книги в браузере (ExcelImporter.tsx).
+
+Книга открывается openpyxl в режиме read_only: строки листов читаются потоком, без загрузки
+всего листа в память. Первая непустая строка листа — заголовки (регистр, пробелы и ё не важны, см. COLUMNS),
+каждая следующая — строка нормы (NormTableRow). Строки группируются в таблицы по
+(тип исследования, категория, параметр, тип нормирования); столбцы, которых нет в листе, берутся
+из параметров запроса. Каждая строка проверяется: числа, порядок границ (от <= до), пограничные значения
+вне нормы, единица возраста, пересечение интервалов с предыдущими строками той же таблицы.
+Ошибки возвращаются по строкам листа (номер строки — как в Excel).
+'''
+import io
+import math
+import zipfile
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from openpyxl import load_workbook
+
+from norm_generator import CATEGORIES, NORM_TYPES
+
+MAX_IMPORT_ROWS = 50_000
+MAX_IMPORT_TABLES = 2000
+PREVIEW_ROWS = 5
+
+# Поле NormTableRow / таблицы -> допустимые заголовки столбца
+COLUMNS = {
+    'study_type': ('тип исследования', 'исследование', 'study type', 'studytype'),
+    'category': ('категория', 'категория пациентов', 'category'),
+    'norm_type': ('тип нормирования', 'тип нормы', 'norm type', 'normtype'),
+    'parameter': ('параметр', 'показатель', 'parameter'),
+    'rangeFrom': ('от', 'интервал от', 'диапазон от', 'range from', 'rangefrom'),
+    'rangeTo': ('до', 'интервал до', 'диапазон до', 'range to', 'rangeto'),
+    'rangeUnit': ('единица', 'единица возраста', 'range unit', 'rangeunit'),
+    'parameterFrom': ('норма от', 'минимум', 'min', 'parameter from', 'parameterfrom'),
+    'parameterTo': ('норма до', 'максимум', 'max', 'parameter to', 'parameterto'),
+    'borderlineLow': ('пограничное от', 'пограничное снизу', 'borderline low', 'borderlinelow'),
+    'borderlineHigh': ('пограничное до', 'пограничное сверху', 'borderline high', 'borderlinehigh'),
+    'conclusionBelow': ('заключение ниже нормы', 'conclusion below', 'conclusionbelow'),
+    'conclusionAbove': ('заключение выше нормы', 'conclusion above', 'conclusionabove'),
+    'conclusionBorderlineLow': ('заключение пограничное снизу', 'conclusion borderline low', 'conclusionborderlinelow'),
+    'conclusionBorderlineHigh': ('заключение пограничное сверху', 'conclusion borderline high', 'conclusionborderlinehigh'),
+}
+REQUIRED_COLUMNS = ('parameter', 'rangeFrom', 'rangeTo', 'parameterFrom', 'parameterTo')
+CONCLUSION_FIELDS = ('conclusionBelow', 'conclusionAbove', 'conclusionBorderlineLow', 'conclusionBorderlineHigh')
+
+# Подписи категорий, типов нормирования и единиц возраста из интерфейса (src/types/norms.ts)
+CATEGORY_LABELS = {
+    'взрослые (мужчины)': 'adult_male', 'взрослые (женщины)': 'adult_female',
+    'дети (мальчики)': 'child_male', 'дети (девочки)': 'child_female',
+}
+NORM_TYPE_LABELS = {
+    'по возрасту': 'age', 'по массе тела (кг)': 'weight', 'по росту (см)': 'height',
+    'по площади поверхности тела (м²)': 'bsa',
+}
+AGE_UNITS = {'years': 'years', 'months': 'months', 'days': 'days', 'лет': 'years', 'годы': 'years',
+             'год': 'years', 'месяцев': 'months', 'месяцы': 'months', 'мес': 'months', 'дней': 'days', 'дни': 'days'}
+
+_HEADER_FIELDS = {alias: field for field, aliases in COLUMNS.items() for alias in aliases}
+
+
+class WorkbookError(ValueError):
+    '''Книгу нельзя разобрать целиком (не XLSX, превышены ограничения)'''
+
+
+def _normalize(value: Any) -> str:
+    return ' '.join(str(value).replace('ё', 'е').replace('Ё', 'Е').split()).lower()
+
+
+def _text(value: Any) -> str:
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
+
+
+def _number(value: Any, label: str, errors: List[str]) -> Tuple[Optional[str], Optional[float]]:
+    '''Ячейка -> (строка для NormTableRow, число); пустая ячейка -> (None, None)'''
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return None, None
+    if isinstance(value, bool):
+        errors.append(f'{label}: ожидается число')
+        return None, None
+    if isinstance(value, (int, float)):
+        text, number = _text(value), float(value)
+    else:
+        text = str(value).strip().replace(',', '.').replace(' ', '')
+        try:
+            number = float(text)
+        except ValueError:
+            number = math.nan
+    # float() принимает «nan», «inf» и «-Infinity»: границы нормы — только конечные числа
+    if not math.isfinite(number):
+        errors.append(f'{label}: «{value}» не число')
+        return None, None
+    return text, number
+
+
+def _choice(value: Any, allowed: Tuple[str, ...], labels: Dict[str, str], default: Optional[str]) -> Optional[str]:
+    if value is None or not str(value).strip():
+        return default
+    key = _normalize(value)
+    return key if key in allowed else labels.get(key)
+
+
+def _sheet_rows(workbook) -> Iterator[Tuple[str, int, Tuple[Any, ...]]]:
+    for sheet in workbook.worksheets:
+        for number, values in enumerate(sheet.iter_rows(values_only=True), start=1):
+            yield sheet.title, number, values
+
+
+def parse_workbook(data: bytes, study_type: Optional[str] = None, category: Optional[str] = None,
+                   norm_type: Optional[str] = 'age') -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]], int]:
+    '''
+    Разбирает книгу XLSX: (таблицы в формате NormTable клиента с номерами строк _source_rows,
+    ошибки по строкам [{sheet, row, errors}], число прочитанных строк норм).
+    study_type, category, norm_type — значения для столбцов, которых нет в листе.
+    '''
+    try:
+        workbook = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    except (zipfile.BadZipFile, KeyError, OSError, ValueError) as e:
+        raise WorkbookError(f'Не удалось прочитать файл Excel (.xlsx): {e}')
+
+    tables: Dict[Tuple[str, str, str, str], Dict[str, Any]] = {}
+    errors: List[Dict[str, Any]] = []
+    read_rows = 0
+    header: Optional[Dict[str, int]] = None
+    current_sheet = None
+    try:
+        for sheet, row_number, values in _sheet_rows(workbook):
+            if sheet != current_sheet:
+                current_sheet, header = sheet, None
+            if not values or all(value is None or not str(value).strip() for value in values):
+                continue
+            if header is None:
+                header = {}
+                for index, value in enumerate(values):
+                    field = _HEADER_FIELDS.get(_normalize(value)) if value is not None else None
+                    if field and field not in header:
+                        header[field] = index
+                missing = [COLUMNS[field][0] for field in REQUIRED_COLUMNS if field not in header]
+                if missing:
+                    errors.append({'sheet': sheet, 'row': row_number,
+                                   'errors': [f'Нет столбцов: {", ".join(missing)}']})
+                    header = {}
+                continue
+            if not header:
+                continue
+
+            read_rows += 1
+            if read_rows > MAX_IMPORT_ROWS:
+                raise WorkbookError(f'В файле больше {MAX_IMPORT_ROWS} строк норм')
+            cell = {field: (values[index] if index < len(values) else None) for field, index in header.items()}
+            row_errors: List[str] = []
+
+            table_study_type = _text(cell.get('study_type')) or study_type
+            table_category = _choice(cell.get('category'), CATEGORIES, CATEGORY_LABELS, category)
+            table_norm_type = _choice(cell.get('norm_type'), NORM_TYPES, NORM_TYPE_LABELS, norm_type)
+            parameter = _text(cell.get('parameter'))
+            if not table_study_type:
+                row_errors.append('Не указан тип исследования')
+            if not table_category:
+                row_errors.append(f'Неизвестная категория пациентов: «{_text(cell.get("category"))}»')
+            if not table_norm_type:
+                row_errors.append(f'Неизвестный тип нормирования: «{_text(cell.get("norm_type"))}»')
+            if not parameter:
+                row_errors.append('Не указан параметр')
+
+            row: Dict[str, Any] = {}
+            numbers: Dict[str, Optional[float]] = {}
+            for field in ('rangeFrom', 'rangeTo', 'parameterFrom', 'parameterTo', 'borderlineLow', 'borderlineHigh'):
+                text, number = _number(cell.get(field), COLUMNS[field][0].capitalize(), row_errors)
+                numbers[field] = number
+                if text is not None:
+                    row[field] = text
+            for field in ('rangeFrom', 'rangeTo', 'parameterFrom', 'parameterTo'):
+                if field not in row and cell.get(field) in (None, ''):
+                    row_errors.append(f'{COLUMNS[field][0].capitalize()}: пустая ячейка')
+            if None not in (numbers['rangeFrom'], numbers['rangeTo']) and numbers['rangeFrom'] > numbers['rangeTo']:
+                row_errors.append('Интервал: «от» больше «до»')
+            norm_from, norm_to = numbers['parameterFrom'], numbers['parameterTo']
+            if None not in (norm_from, norm_to) and norm_from > norm_to:
+                row_errors.append('Норма: «от» больше «до»')
+            if numbers['borderlineLow'] is not None and norm_from is not None and numbers['borderlineLow'] > norm_from:
+                row_errors.append('Пограничное снизу больше нижней границы нормы')
+            if numbers['borderlineHigh'] is not None and norm_to is not None and numbers['borderlineHigh'] < norm_to:
+                row_errors.append('Пограничное сверху меньше верхней границы нормы')
+            if table_norm_type == 'age':
+                unit = _text(cell.get('rangeUnit'))
+                row['rangeUnit'] = AGE_UNITS.get(_normalize(unit)) if unit else 'years'
+                if row['rangeUnit'] is None:
+                    row_errors.append(f'Неизвестная единица возраста: «{unit}»')
+
+            if row_errors:
+                errors.append({'sheet': sheet, 'row': row_number, 'errors': row_errors})
+                continue
+
+            key = (table_study_type, table_category, parameter, table_norm_type)
+            table = tables.get(key)
+            if table is None:
+                if len(tables) >= MAX_IMPORT_TABLES:
+                    raise WorkbookError(f'В файле больше {MAX_IMPORT_TABLES} таблиц норм')
+                table = tables[key] = {
+                    'id': 'new', 'studyType': table_study_type, 'category': table_category,
+                    'parameter': parameter, 'normType': table_norm_type, 'rows': [], 'showInReport': True,
+                    '_source_rows': [],
+                }
+            for field in CONCLUSION_FIELDS:
+                if not table.get(field) and _text(cell.get(field)):
+                    table[field] = _text(cell.get(field))
+            row['id'] = f'imported_{len(table["rows"]) + 1}'
+            table['rows'].append(row)
+            table['_source_rows'].append((sheet, row_number))
+    finally:
+        workbook.close()
+
+    result = list(tables.values())
+    for table in result:
+        errors.extend(_overlapping_rows(table))
+    sheets = {title: index for index, title in enumerate(workbook.sheetnames)}
+    errors.sort(key=lambda error: (sheets.get(error['sheet'], 0), error['row']))
+    return result, errors, read_rows
+
+
+def _overlapping_rows(table: Dict[str, Any]) -> List[Dict[str, Any]]:
+    '''Строки, интервал которых пересекается с предыдущей строкой той же единицы измерения; такие строки удаляются'''
+    errors = []
+    order = sorted(range(len(table['rows'])),
+                   key=lambda i: (table['rows'][i].get('rangeUnit', ''), float(table['rows'][i]['rangeFrom'])))
+    overlapping = set()
+    previous = None
+    for i in order:
+        row = table['rows'][i]
+        if previous is not None and previous.get('rangeUnit') == row.get('rangeUnit') \
+                and float(row['rangeFrom']) < float(previous['rangeTo']):
+            sheet, row_number = table['_source_rows'][i]
+            errors.append({'sheet': sheet, 'row': row_number, 'errors': [
+                f'Интервал {row["rangeFrom"]}–{row["rangeTo"]} пересекается с '
+                f'{previous["rangeFrom"]}–{previous["rangeTo"]} ({table["parameter"]}, {table["category"]})'
+            ]})
+            overlapping.add(i)
+            continue
+        previous = row
+    if overlapping:
+        table['rows'] = [row for i, row in enumerate(table['rows']) if i not in overlapping]
+        table['_source_rows'] = [source for i, source in enumerate(table['_source_rows']) if i not in overlapping]
+    return errors
+
+
+def preview(tables: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    '''Краткое описание таблиц для ответа: ключ таблицы, число строк и первые PREVIEW_ROWS строк'''
+    return [
+        {
+            'studyType': table['studyType'], 'category': table['category'], 'parameter': table['parameter'],
+            'normType': table['normType'], 'rowCount': len(table['rows']), 'rows': table['rows'][:PREVIEW_ROWS],
+        }
+        for table in tables
+    ]
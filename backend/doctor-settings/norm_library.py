@@ -0,0 +1,253 @@
+'''
+Базовая библиотека норм и переопределения врача.
+
+Действующая версия библиотеки — последняя из norm_library_versions. Врач видит объединённый набор:
+свои таблицы (переопределения базовых по base_key и собственные) плюс базовые таблицы без переопределения;
+запись с deleted = true скрывает базовую таблицу. Объединение выполняется одним запросом и кэшируется
+в процессе по (врач, версия библиотеки, doctors.norms_revision) — ревизию повышает триггер на norm_tables.
+
+Публикация новой версии:
+    DATABASE_URL=... python norm_library.py --from-doctor 1 --note "Нормы 2024" --link-existing
+    DATABASE_URL=... python norm_library.py --file norms.json
+--link-existing привязывает существующие частные копии врачей к базовым таблицам: копии, совпадающие
+с базовой таблицей, удаляются, отличающиеся становятся переопределениями.
+После публикации всем врачам со статусами протоколов ставится полный пересчёт protocol_norm_status.
+'''
+import argparse
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.extras import RealDictCursor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from shared import jobs, models  # noqa: E402
+
+NORM_CACHE_SIZE = int(os.environ.get('NORM_CACHE_SIZE', '512'))
+
+MERGED_NORM_TABLES_SQL = """
+    SELECT {columns} FROM (
+        SELECT n.id, n.doctor_id, n.study_type, n.category, n.parameter, n.norm_type, n.rows,
+               n.show_in_report, n.conclusion_below, n.conclusion_above,
+               n.conclusion_borderline_low, n.conclusion_borderline_high,
+               n.created_at, n.updated_at, n.base_key,
+               CASE WHEN n.base_key IS NULL THEN 'own' ELSE 'override' END AS source
+        FROM t_p13795046_functional_diagnosti.norm_tables n
+        WHERE n.doctor_id = %(doctor_id)s AND NOT n.deleted {doctor_filter}
+        UNION ALL
+        SELECT b.id, %(doctor_id)s, b.study_type, b.category, b.parameter, b.norm_type, b.rows,
+               b.show_in_report, b.conclusion_below, b.conclusion_above,
+               b.conclusion_borderline_low, b.conclusion_borderline_high,
+               b.created_at, b.updated_at, b.base_key,
+               'base'
+        FROM t_p13795046_functional_diagnosti.base_norm_tables b
+        WHERE b.version = %(version)s {base_filter}
+          AND NOT EXISTS (
+              SELECT 1 FROM t_p13795046_functional_diagnosti.norm_tables o
+              WHERE o.doctor_id = %(doctor_id)s AND o.base_key = b.base_key
+          )
+    ) merged
+    ORDER BY study_type, parameter
+"""
+
+_merged_cache: 'OrderedDict[Tuple, Tuple[int, int, List[Dict[str, Any]]]]' = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def make_base_key(study_type: str, category: str, parameter: str, norm_type: str) -> str:
+    return f'{study_type}:{category}:{parameter}:{norm_type}'
+
+
+def norm_state(cur, doctor_id: int) -> Tuple[Optional[int], int]:
+    '''Действующая версия библиотеки и ревизия норм врача'''
+    cur.execute("""
+        SELECT (SELECT max(id) FROM t_p13795046_functional_diagnosti.norm_library_versions) AS version,
+               norms_revision
+        FROM t_p13795046_functional_diagnosti.doctors WHERE id = %s
+    """, (doctor_id,))
+    row = cur.fetchone()
+    return row['version'], row['norms_revision']
+
+
+def load_merged_norm_tables(cur, doctor_id: int, study_type: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+    '''Объединённый набор таблиц норм врача и версия библиотеки, на которой он построен'''
+    version, revision = norm_state(cur, doctor_id)
+    cache_key = (doctor_id, study_type)
+    with _cache_lock:
+        cached = _merged_cache.get(cache_key)
+        if cached and cached[0] == version and cached[1] == revision:
+            _merged_cache.move_to_end(cache_key)
+            return cached[2], version
+
+    doctor_filter = 'AND n.study_type = %(study_type)s' if study_type else ''
+    base_filter = 'AND b.study_type = %(study_type)s' if study_type else ''
+    with cur.connection.cursor(cursor_factory=psycopg2.extensions.cursor) as tables_cur:
+        tables_cur.execute(
+            MERGED_NORM_TABLES_SQL.format(columns=models.NormTable.COLUMNS, doctor_filter=doctor_filter,
+                                          base_filter=base_filter),
+            {'doctor_id': doctor_id, 'version': version, 'study_type': study_type}
+        )
+        tables = models.serialize_rows(models.NormTable, tables_cur.fetchall())
+
+    with _cache_lock:
+        _merged_cache[cache_key] = (version, revision, tables)
+        _merged_cache.move_to_end(cache_key)
+        while len(_merged_cache) > NORM_CACHE_SIZE:
+            _merged_cache.popitem(last=False)
+    return tables, version
+
+
+def find_base_table(cur, table_id: str) -> Optional[Dict[str, Any]]:
+    '''Базовая таблица действующей версии по id (None, если id не из библиотеки)'''
+    cur.execute("""
+        SELECT * FROM t_p13795046_functional_diagnosti.base_norm_tables
+        WHERE id = %s::uuid
+          AND version = (SELECT max(id) FROM t_p13795046_functional_diagnosti.norm_library_versions)
+    """, (table_id,))
+    return cur.fetchone()
+
+
+def hide_base_table(cur, doctor_id: int, base_table: Dict[str, Any]) -> None:
+    '''Скрывает базовую таблицу для врача записью-надгробием'''
+    cur.execute("""
+        INSERT INTO t_p13795046_functional_diagnosti.norm_tables
+        (doctor_id, base_key, deleted, study_type, category, parameter, norm_type)
+        VALUES (%s, %s, true, %s, %s, %s, %s)
+        ON CONFLICT (doctor_id, base_key) WHERE base_key IS NOT NULL
+        DO UPDATE SET deleted = true, updated_at = CURRENT_TIMESTAMP
+    """, (doctor_id, base_table['base_key'], base_table['study_type'], base_table['category'],
+          base_table['parameter'], base_table['norm_type']))
+
+
+def publish_version(conn, tables: List[Dict[str, Any]], note: Optional[str], link_existing: bool) -> Tuple[int, int]:
+    '''Публикует новую версию библиотеки из таблиц в формате API; возвращает (версия, привязано копий)'''
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute(
+        "INSERT INTO t_p13795046_functional_diagnosti.norm_library_versions (note) VALUES (%s) RETURNING id",
+        (note,)
+    )
+    version = cur.fetchone()['id']
+
+    seen = set()
+    for table in tables:
+        base_key = make_base_key(table['study_type'], table['category'], table['parameter'], table['norm_type'])
+        if base_key in seen:
+            raise ValueError(f'Повторяющаяся таблица норм: {base_key}')
+        seen.add(base_key)
+        cur.execute("""
+            INSERT INTO t_p13795046_functional_diagnosti.base_norm_tables
+            (version, base_key, study_type, category, parameter, norm_type, rows, show_in_report,
+             conclusion_below, conclusion_above, conclusion_borderline_low, conclusion_borderline_high)
+            VALUES (%s, %s, %s, %s, %s, %s, %s::jsonb, %s, %s, %s, %s, %s)
+        """, (version, base_key, table['study_type'], table['category'], table['parameter'],
+              table['norm_type'], json.dumps(table.get('rows') or []), table.get('show_in_report', True),
+              table.get('conclusion_below'), table.get('conclusion_above'),
+              table.get('conclusion_borderline_low'), table.get('conclusion_borderline_high')))
+
+    linked = 0
+    if link_existing:
+        # Частные копии и переопределения, совпадающие с базовой таблицей по содержимому, больше не нужны
+        cur.execute("""
+            DELETE FROM t_p13795046_functional_diagnosti.norm_tables n
+            USING t_p13795046_functional_diagnosti.base_norm_tables b
+            WHERE b.version = %s AND (n.base_key IS NULL OR n.base_key = b.base_key) AND NOT n.deleted
+              AND b.study_type = n.study_type AND b.category = n.category
+              AND b.parameter = n.parameter AND b.norm_type = n.norm_type
+              AND t_p13795046_functional_diagnosti.norm_rows_content(n.rows)
+                  = t_p13795046_functional_diagnosti.norm_rows_content(b.rows)
+              AND n.show_in_report IS NOT DISTINCT FROM b.show_in_report
+              AND n.conclusion_below IS NOT DISTINCT FROM b.conclusion_below
+              AND n.conclusion_above IS NOT DISTINCT FROM b.conclusion_above
+              AND n.conclusion_borderline_low IS NOT DISTINCT FROM b.conclusion_borderline_low
+              AND n.conclusion_borderline_high IS NOT DISTINCT FROM b.conclusion_borderline_high
+              AND NOT EXISTS (
+                  SELECT 1 FROM t_p13795046_functional_diagnosti.norm_tables o
+                  WHERE o.doctor_id = n.doctor_id AND o.base_key = b.base_key AND o.id <> n.id
+              )
+        """, (version,))
+        linked += cur.rowcount
+        # Изменённые копии становятся переопределениями (по одной, самой свежей, на врача и таблицу)
+        cur.execute("""
+            UPDATE t_p13795046_functional_diagnosti.norm_tables n
+            SET base_key = c.base_key
+            FROM (
+                SELECT DISTINCT ON (n.doctor_id, b.base_key) n.id, b.base_key
+                FROM t_p13795046_functional_diagnosti.norm_tables n
+                JOIN t_p13795046_functional_diagnosti.base_norm_tables b
+                  ON b.version = %s AND b.study_type = n.study_type AND b.category = n.category
+                 AND b.parameter = n.parameter AND b.norm_type = n.norm_type
+                WHERE n.base_key IS NULL AND NOT n.deleted
+                  AND NOT EXISTS (
+                      SELECT 1 FROM t_p13795046_functional_diagnosti.norm_tables o
+                      WHERE o.doctor_id = n.doctor_id AND o.base_key = b.base_key
+                  )
+                ORDER BY n.doctor_id, b.base_key, n.updated_at DESC
+            ) c
+            WHERE n.id = c.id
+        """, (version,))
+        linked += cur.rowcount
+
+    cur.execute("""
+        SELECT d.id FROM t_p13795046_functional_diagnosti.doctors d
+        WHERE EXISTS (SELECT 1 FROM t_p13795046_functional_diagnosti.protocol_norm_status s WHERE s.doctor_id = d.id)
+    """)
+    for row in cur.fetchall():
+        jobs.enqueue(cur, row['id'], 'evaluate_norm_status', {'full': True})
+
+    conn.commit()
+    return version, linked
+
+
+def _from_api_table(table: Dict[str, Any]) -> Dict[str, Any]:
+    '''Таблица в формате клиента (NormTable, camelCase) -> поля norm_tables'''
+    return {
+        'study_type': table['studyType'],
+        'category': table['category'],
+        'parameter': table['parameter'],
+        'norm_type': table['normType'],
+        'rows': table.get('rows', []),
+        'show_in_report': table.get('showInReport', True),
+        'conclusion_below': table.get('conclusionBelow'),
+        'conclusion_above': table.get('conclusionAbove'),
+        'conclusion_borderline_low': table.get('conclusionBorderlineLow'),
+        'conclusion_borderline_high': table.get('conclusionBorderlineHigh'),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Публикация версии базовой библиотеки норм')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--from-doctor', type=int, help='взять объединённый набор норм врача')
+    source.add_argument('--file', help='JSON-массив таблиц в формате NormTable')
+    parser.add_argument('--note', help='описание версии')
+    parser.add_argument('--link-existing', action='store_true',
+                        help='привязать частные копии врачей к новой версии')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        if args.file:
+            with open(args.file, encoding='utf-8') as f:
+                tables = [_from_api_table(table) for table in json.load(f)]
+        else:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            merged, _ = load_merged_norm_tables(cur, args.from_doctor)
+            by_key: Dict[str, Dict[str, Any]] = {}
+            for table in merged:
+                key = make_base_key(table['study_type'], table['category'], table['parameter'], table['norm_type'])
+                by_key.setdefault(key, table)
+            tables = list(by_key.values())
+
+        version, linked = publish_version(conn, tables, args.note, args.link_existing)
+        print(f'Опубликована версия {version}: таблиц {len(tables)}, привязано частных копий {linked}')
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+'''
+Пересчёт сохранённых статусов показателей протоколов (protocol_norm_status) по нормам врача.
+
+Строки статусов создаёт триггер при записи протокола (pending = true) и ставит задачу
+evaluate_norm_status. При изменении таблицы норм пересчитываются только строки, затронутые
+изменёнными строками таблицы: тот же вид исследования, параметр и категория пациента,
+измерение пациента в пределах старого или нового интервала строки (по индексу idx_protocol_norm_status_norm_key).
+Такие строки помечаются pending пакетами, затем все pending-строки врача вычисляются пакетами
+по снимку норм (shared/norm_snapshot.py) без обращения к norm_tables и к самим протоколам.
+'''
+import os
+import sys
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from psycopg2.extras import execute_values
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from shared import norm_snapshot  # noqa: E402
+
+NORM_STATUS_BATCH_SIZE = 2000
+
+# Множитель перевода единицы возраста строки нормы в дни (как в patient_age_total_days)
+AGE_UNIT_DAYS = {'years': 365.25, 'months': 30.44, 'days': 1.0}
+
+DIMENSION_COLUMNS = {'weight': 'weight', 'height': 'height', 'bsa': 'bsa'}
+
+
+def _number(value: Any) -> Optional[float]:
+    try:
+        return float(str(value).strip().replace(',', '.'))
+    except (TypeError, ValueError):
+        return None
+
+
+ROW_CONTENT_FIELDS = ('rangeFrom', 'rangeTo', 'rangeUnit', 'parameterFrom', 'parameterTo', 'borderlineLow', 'borderlineHigh')
+TABLE_KEY_FIELDS = ('study_type', 'parameter', 'category', 'norm_type')
+
+# При большем числе изменённых строк берётся один охватывающий интервал
+MAX_ROW_SELECTORS = 20
+
+
+def _row_interval(norm_type: Optional[str], row: Dict[str, Any]) -> Optional[Tuple[float, float]]:
+    '''Интервал строки нормы в единицах столбца protocol_norm_status (возраст — в днях с запасом на округление)'''
+    range_from, range_to = _number(row.get('rangeFrom')), _number(row.get('rangeTo'))
+    if range_from is None or range_to is None:
+        return None
+    if norm_type == 'age':
+        factor = AGE_UNIT_DAYS.get(row.get('rangeUnit'))
+        if factor is None:
+            return None
+        return range_from * factor * 0.999 - 1, range_to * factor * 1.001 + 1
+    if norm_type in DIMENSION_COLUMNS:
+        return range_from, range_to
+    return None
+
+
+def norm_selectors(tables: Sequence[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    '''
+    Области, в которых могли измениться статусы, по старым и новой версиям таблицы норм (поля norm_tables).
+    Для версий с одним ключом (вид исследования, параметр, категория, тип нормы) учитываются только строки,
+    отличающиеся на той же позиции; для остальных — все строки таблицы.
+    '''
+    by_key: Dict[Tuple[Any, ...], List[Dict[str, Any]]] = {}
+    for table in tables:
+        by_key.setdefault(tuple(table.get(field) for field in TABLE_KEY_FIELDS), []).append(table)
+
+    selectors: List[Dict[str, Any]] = []
+    for key, versions in by_key.items():
+        row_lists = [list(table.get('rows') or []) for table in versions]
+        changed: List[Dict[str, Any]] = []
+        for position in range(max(len(rows) for rows in row_lists)):
+            contents = [tuple(rows[position].get(field) for field in ROW_CONTENT_FIELDS) if position < len(rows) else None
+                        for rows in row_lists]
+            if len(versions) == 1 or len(set(contents)) > 1:
+                changed.extend(rows[position] for rows in row_lists if position < len(rows))
+
+        intervals = [interval for interval in (_row_interval(key[3], row) for row in changed) if interval]
+        if len(intervals) > MAX_ROW_SELECTORS:
+            intervals = [(min(low for low, _ in intervals), max(high for _, high in intervals))]
+        for low, high in sorted(set(intervals)):
+            selectors.append(dict(zip(TABLE_KEY_FIELDS, key), low=low, high=high))
+    return selectors
+
+
+def _selector_sql(selector: Dict[str, Any]) -> Tuple[str, List[Any]]:
+    column = 'age_total_days' if selector['norm_type'] == 'age' else DIMENSION_COLUMNS[selector['norm_type']]
+    return (
+        f"study_type = %s AND param = %s AND category = %s AND {column} BETWEEN %s AND %s",
+        [selector['study_type'], selector['parameter'], selector['category'], selector['low'], selector['high']]
+    )
+
+
+def mark_pending(conn, doctor_id: int, selectors: Optional[Sequence[Dict[str, Any]]] = None,
+                 batch_size: int = NORM_STATUS_BATCH_SIZE) -> int:
+    '''
+    Помечает к пересчёту строки, затронутые таблицами selectors (None — все строки врача), пакетами по ключу.
+    Помечаются и уже pending-строки: строку, которую evaluate_pending сейчас вычисляет по прежнему снимку,
+    UPDATE дождётся (она заблокирована) и вернёт в очередь после записи устаревшего статуса.
+    '''
+    conditions = [_selector_sql(selector) for selector in selectors] if selectors is not None else [('true', [])]
+    marked = 0
+    with conn.cursor() as cur:
+        for condition_sql, condition_params in conditions:
+            after: Tuple[int, str] = (0, '')
+            while True:
+                cur.execute(f"""
+                    UPDATE t_p13795046_functional_diagnosti.protocol_norm_status s
+                    SET pending = true
+                    FROM (
+                        SELECT protocol_id, param FROM t_p13795046_functional_diagnosti.protocol_norm_status
+                        WHERE doctor_id = %s AND {condition_sql} AND (protocol_id, param) > (%s, %s)
+                        ORDER BY protocol_id, param
+                        LIMIT %s
+                    ) c
+                    WHERE s.protocol_id = c.protocol_id AND s.param = c.param
+                    RETURNING s.protocol_id, s.param
+                """, [doctor_id] + condition_params + [after[0], after[1], batch_size])
+                keys = cur.fetchall()
+                conn.commit()
+                marked += len(keys)
+                if len(keys) < batch_size:
+                    break
+                after = max(tuple(key) for key in keys)
+    return marked
+
+
+def evaluate_pending(conn, doctor_id: int, load_snapshot: Callable[[], Any],
+                     batch_size: int = NORM_STATUS_BATCH_SIZE,
+                     on_batch: Optional[Callable[[int], None]] = None) -> Dict[str, int]:
+    '''
+    Вычисляет статусы pending-строк врача пакетами (FOR UPDATE SKIP LOCKED, фиксация после пакета).
+    load_snapshot вызывается для каждого пакета уже после блокировки его строк и возвращает снимок норм
+    для текущей ревизии: нормы, сохранённые до пометки строк mark_pending, в снимок пакета уже входят.
+    '''
+    counts: Dict[str, int] = {}
+    evaluated = 0
+    with conn.cursor() as cur:
+        while True:
+            cur.execute("""
+                SELECT protocol_id, param, study_type, category, age_years, age_months, age_days,
+                       weight, height, bsa, value
+                FROM t_p13795046_functional_diagnosti.protocol_norm_status
+                WHERE doctor_id = %s AND pending
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            """, (doctor_id, batch_size))
+            rows = cur.fetchall()
+            if not rows:
+                conn.commit()
+                break
+
+            snapshot = load_snapshot()
+            values = []
+            for (protocol_id, param, study_type, category, years, months, days,
+                 weight, height, bsa, value) in rows:
+                if years is None:
+                    check = norm_snapshot.NORMAL
+                else:
+                    dimensions = norm_snapshot.patient_dimensions(years, months or 0, days or 0, weight, height, bsa)
+                    check = snapshot.check(study_type, param, value, category, dimensions)
+                values.append((protocol_id, param, check.status, check.norm_min, check.norm_max, check.table_id))
+                counts[check.status] = counts.get(check.status, 0) + 1
+
+            execute_values(cur, """
+                UPDATE t_p13795046_functional_diagnosti.protocol_norm_status s
+                SET status = v.status, norm_min = v.norm_min, norm_max = v.norm_max,
+                    norm_table_id = v.norm_table_id::uuid, pending = false, evaluated_at = CURRENT_TIMESTAMP
+                FROM (VALUES %s) AS v (protocol_id, param, status, norm_min, norm_max, norm_table_id)
+                WHERE s.protocol_id = v.protocol_id AND s.param = v.param
+            """, values, template='(%s, %s, %s, %s::double precision, %s::double precision, %s)')
+            conn.commit()
+            evaluated += len(rows)
+            if on_batch:
+                on_batch(evaluated)
+
+    counts['evaluated'] = evaluated
+    return counts
@@ -0,0 +1,320 @@
+'''
+Перенос данных врача на другой узел БД (shared/shards.py) без остановки сервиса.
+
+1. Копия: строки врача во всех таблицах с doctor_id копируются на новый узел, пока врач продолжает работать.
+2. Врач помечается в doctor_shards как переносимый (state = 'moving'): handler'ы отклоняют его запись
+   с 503, чтение идёт с прежнего узла. Перенос ждёт, пока истекут кэши маршрутов процессов
+   и завершатся начатые запросы и фоновые задачи врача.
+3. Досинхронизация: строки сравниваются по md5 и копируются только изменённые после шага 1, лишние удаляются.
+4. Переключение: doctor_shards указывает на новый узел, запись снова разрешена.
+5. Через SHARD_MAP_TTL_SECONDS (когда старый маршрут не осталось ни в одном кэше) строки врача
+   удаляются с прежнего узла, если не задан --keep-source.
+
+На новом узле копирование идёт с session_replication_role = replica: триггеры не пересчитывают
+protocol_results и статусы норм — они переносятся как есть (нужны права суперпользователя),
+ревизия норм врача на новом узле выставляется выше, чем на обоих узлах.
+
+Перенос:        DATABASE_URL=... DATABASE_SHARDS=... python backend/move_doctor.py --doctor-id 42 --to b
+Чередование id: DATABASE_URL=... DATABASE_SHARDS=... python backend/move_doctor.py --init-sequences
+'''
+import argparse
+import os
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BACKEND_DIR)
+
+from shared import resilience, shards  # noqa: E402
+
+SCHEMA = 't_p13795046_functional_diagnosti'
+
+# Таблицы со столбцом doctor_id: копируются в этом порядке, удаляются в обратном
+DOCTOR_TABLES = (
+    'patients', 'protocols', 'protocols_archive', 'protocol_results', 'protocol_norm_status',
+    'norm_tables', 'conclusion_templates', 'input_settings', 'clinic_settings', 'doctor_norms',
+    'protocols_legacy', 'jobs', 'job_result_chunks',
+)
+
+MOVE_CHUNK_SIZE = int(os.environ.get('MOVE_CHUNK_SIZE', '1000'))
+# Сколько ждать после смены маршрута: кэши процессов плюс самый долгий запрос handler'а
+SETTLE_SECONDS = shards.SHARD_MAP_TTL_SECONDS + max(
+    policy.statement_timeout_ms for policy in (resilience.READ, resilience.WRITE, resilience.SCAN)
+) / 1000 + 1
+JOB_WAIT_SECONDS = float(os.environ.get('MOVE_JOB_WAIT_SECONDS', '600'))
+
+
+def table_columns(cur, table: str) -> Tuple[List[str], List[str]]:
+    '''(столбцы таблицы без вычисляемых, столбцы первичного ключа)'''
+    cur.execute("""
+        SELECT attname FROM pg_attribute
+        WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped AND attgenerated = ''
+        ORDER BY attnum
+    """, (f'{SCHEMA}.{table}',))
+    columns = [row[0] for row in cur.fetchall()]
+    cur.execute("""
+        SELECT a.attname
+        FROM pg_index i
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+        WHERE i.indrelid = %s::regclass AND i.indisprimary
+        ORDER BY array_position(i.indkey::int2[], a.attnum)
+    """, (f'{SCHEMA}.{table}',))
+    return columns, [row[0] for row in cur.fetchall()]
+
+
+def row_hashes(cur, table: str, columns: List[str], pk: List[str], doctor_id: int) -> Dict[tuple, str]:
+    '''Первичный ключ -> md5 текстового представления строки для всех строк врача'''
+    cur.execute(f"""
+        SELECT {', '.join(pk)}, md5(ROW({', '.join(columns)})::text)
+        FROM {SCHEMA}.{table}
+        WHERE doctor_id = %s
+    """, (doctor_id,))
+    return {tuple(row[:-1]): row[-1] for row in cur.fetchall()}
+
+
+def prepare_target(source_cur, target_cur, table: str, rows: List[tuple], columns: List[str]) -> None:
+    '''Секции protocols и словари сжатия архива, без которых строки не вставить на новом узле'''
+    if table == 'protocols':
+        study_dates = {row[columns.index('study_date')][:7] for row in rows}
+        for month in sorted(study_dates):
+            target_cur.execute(f"SELECT {SCHEMA}.ensure_protocol_partition(%s::date)", (f'{month}-01',))
+    elif table == 'protocols_archive':
+        dictionary_ids = tuple({row[columns.index('dictionary_id')] for row in rows} - {None})
+        if not dictionary_ids:
+            return
+        dictionary_columns, _ = table_columns(source_cur, 'protocols_archive_dictionaries')
+        source_cur.execute(f"""
+            SELECT {', '.join(f'{column}::text' for column in dictionary_columns)}
+            FROM {SCHEMA}.protocols_archive_dictionaries WHERE id::text IN %s
+        """, (dictionary_ids,))
+        execute_values(target_cur, f"""
+            INSERT INTO {SCHEMA}.protocols_archive_dictionaries ({', '.join(dictionary_columns)})
+            VALUES %s ON CONFLICT (id) DO NOTHING
+        """, source_cur.fetchall())
+
+
+def sync_table(source_cur, target_cur, table: str, doctor_id: int, chunk: int) -> Tuple[int, int]:
+    '''
+    Приводит строки врача в таблице на новом узле к строкам на прежнем: копирует отсутствующие
+    и изменённые (по md5), удаляет лишние. Возвращает (скопировано, удалено).
+    '''
+    columns, pk = table_columns(source_cur, table)
+    source = row_hashes(source_cur, table, columns, pk, doctor_id)
+    target = row_hashes(target_cur, table, columns, pk, doctor_id)
+    changed = [key for key, digest in source.items() if target.get(key) != digest]
+    extra = [key for key in target if key not in source]
+
+    # значения переносятся текстом: вставка приводит их к типам столбцов (jsonb, bytea, tsvector, массивы)
+    select_columns = ', '.join(f'{column}::text' for column in columns)
+    updates = ', '.join(f'{column} = EXCLUDED.{column}' for column in columns if column not in pk)
+    for start in range(0, len(changed), chunk):
+        keys = tuple(changed[start:start + chunk])
+        source_cur.execute(
+            f"SELECT {select_columns} FROM {SCHEMA}.{table} WHERE ({', '.join(pk)}) IN %s", (keys,)
+        )
+        rows = source_cur.fetchall()
+        prepare_target(source_cur, target_cur, table, rows, columns)
+        execute_values(target_cur, f"""
+            INSERT INTO {SCHEMA}.{table} ({', '.join(columns)}) VALUES %s
+            ON CONFLICT ({', '.join(pk)}) DO UPDATE SET {updates}
+        """, rows, page_size=chunk)
+    for start in range(0, len(extra), chunk):
+        target_cur.execute(f"DELETE FROM {SCHEMA}.{table} WHERE ({', '.join(pk)}) IN %s",
+                           (tuple(extra[start:start + chunk]),))
+    return len(changed), len(extra)
+
+
+def carry_norms_revision(source_cur, target_cur, doctor_id: int) -> None:
+    '''
+    Ревизия норм врача на новом узле становится больше, чем на обоих узлах: триггер norm_tables её
+    не повышает (replica), а снимок норм (shared/norm_snapshot.py) и кэши процессов с прежней ревизией
+    иначе не заменялись бы новыми
+    '''
+    source_cur.execute(f"SELECT norms_revision FROM {SCHEMA}.doctors WHERE id = %s", (doctor_id,))
+    row = source_cur.fetchone()
+    target_cur.execute(f"""
+        UPDATE {SCHEMA}.doctors SET norms_revision = GREATEST(norms_revision, %s) + 1 WHERE id = %s
+    """, (row[0] if row else 0, doctor_id))
+
+
+def sync_doctor(directory_cur, source_conn, target_conn, doctor_id: int, chunk: int) -> Dict[str, Tuple[int, int]]:
+    '''Один проход синхронизации всех таблиц врача; коммитит новый узел'''
+    stats = {}
+    with source_conn.cursor() as source_cur, target_conn.cursor() as target_cur:
+        shards.copy_doctor(directory_cur, target_cur, doctor_id)
+        for table in DOCTOR_TABLES:
+            stats[table] = sync_table(source_cur, target_cur, table, doctor_id, chunk)
+        carry_norms_revision(source_cur, target_cur, doctor_id)
+    target_conn.commit()
+    return stats
+
+
+def delete_doctor_rows(conn, doctor_id: int) -> int:
+    '''Удаляет строки врача с прежнего узла (копию строки врача и словари сжатия оставляет)'''
+    deleted = 0
+    with conn.cursor() as cur:
+        for table in reversed(DOCTOR_TABLES):
+            cur.execute(f"DELETE FROM {SCHEMA}.{table} WHERE doctor_id = %s", (doctor_id,))
+            deleted += cur.rowcount
+    conn.commit()
+    return deleted
+
+
+def wait_for_jobs(conn, doctor_id: int) -> None:
+    '''Ждёт завершения выполняемых задач врача на прежнем узле'''
+    deadline = time.monotonic() + JOB_WAIT_SECONDS
+    while True:
+        with conn.cursor() as cur:
+            cur.execute(f"SELECT count(*) FROM {SCHEMA}.jobs WHERE doctor_id = %s AND status = 'running'",
+                        (doctor_id,))
+            running = cur.fetchone()[0]
+        conn.commit()
+        if not running:
+            return
+        if time.monotonic() > deadline:
+            raise RuntimeError(f'Задачи врача выполняются дольше {JOB_WAIT_SECONDS:.0f} с, перенос прерван')
+        print(f'Ожидание задач врача: {running}', file=sys.stderr)
+        time.sleep(1)
+
+
+def current_shard(cur, doctor_id: int) -> Tuple[Optional[str], Optional[str]]:
+    '''(узел врача или None — каталог вне DATABASE_SHARDS, состояние или None — записи нет)'''
+    cur.execute(f"SELECT id FROM {SCHEMA}.doctors WHERE id = %s", (doctor_id,))
+    if cur.fetchone() is None:
+        raise ValueError(f'Врач {doctor_id} не найден в каталоге')
+    cur.execute(f"SELECT shard, state FROM {SCHEMA}.doctor_shards WHERE doctor_id = %s", (doctor_id,))
+    row = cur.fetchone()
+    return (row[0], row[1]) if row else (shards.directory_shard(), None)
+
+
+def set_route(directory_conn, doctor_id: int, shard: Optional[str], state: str, target: Optional[str]) -> None:
+    if shard is None:
+        # каталог не входит в DATABASE_SHARDS: врач без записи в doctor_shards остаётся в нём
+        with directory_conn.cursor() as cur:
+            cur.execute(f"DELETE FROM {SCHEMA}.doctor_shards WHERE doctor_id = %s", (doctor_id,))
+        directory_conn.commit()
+        return
+    with directory_conn.cursor() as cur:
+        cur.execute(f"""
+            INSERT INTO {SCHEMA}.doctor_shards (doctor_id, shard, state, target_shard)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (doctor_id) DO UPDATE
+            SET shard = EXCLUDED.shard, state = EXCLUDED.state, target_shard = EXCLUDED.target_shard,
+                updated_at = CURRENT_TIMESTAMP
+        """, (doctor_id, shard, state, target))
+    directory_conn.commit()
+
+
+def connect(dsn: str, replica_role: bool = False) -> Any:
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cur:
+        # одинаковое текстовое представление timestamptz на обоих узлах для сравнения md5
+        cur.execute("SET TIME ZONE 'UTC'")
+        if replica_role:
+            cur.execute("SET session_replication_role = replica")
+    conn.commit()
+    return conn
+
+
+def move_doctor(doctor_id: int, target: str, chunk: int, keep_source: bool) -> None:
+    shards.dsn(target)
+    directory = connect(os.environ['DATABASE_URL'])
+    try:
+        directory_cur = directory.cursor()
+        source_shard, state = current_shard(directory_cur, doctor_id)
+        directory.commit()
+        if source_shard == target and state != shards.MOVING:
+            print(f'Врач {doctor_id} уже на узле {target}')
+            return
+        source_name = source_shard or 'каталог'
+        source = connect(os.environ['DATABASE_URL'] if source_shard is None else shards.dsn(source_shard))
+        target_conn = connect(shards.dsn(target), replica_role=True)
+        try:
+            started = time.monotonic()
+            stats = sync_doctor(directory_cur, source, target_conn, doctor_id, chunk)
+            directory.commit()
+            print(f'Копия {source_name} -> {target}: {sum(c for c, _ in stats.values())} строк '
+                  f'за {time.monotonic() - started:.1f} с')
+
+            set_route(directory, doctor_id, source_shard, shards.MOVING, target)
+            print(f'Запись врача приостановлена, ожидание {SETTLE_SECONDS:.0f} с', file=sys.stderr)
+            time.sleep(SETTLE_SECONDS)
+            wait_for_jobs(source, doctor_id)
+
+            paused = time.monotonic()
+            # Задачи врача в очереди прежнего узла блокируются до переключения: обработчики их пропускают
+            with source.cursor() as cur:
+                cur.execute(f"SELECT id FROM {SCHEMA}.jobs WHERE doctor_id = %s AND status = 'queued' FOR UPDATE",
+                            (doctor_id,))
+                try:
+                    stats = sync_doctor(directory_cur, source, target_conn, doctor_id, chunk)
+                    directory.commit()
+                    set_route(directory, doctor_id, target, shards.ACTIVE, None)
+                except Exception:
+                    set_route(directory, doctor_id, source_shard, shards.ACTIVE, None)
+                    raise
+                cur.execute(f"DELETE FROM {SCHEMA}.jobs WHERE doctor_id = %s AND status = 'queued'", (doctor_id,))
+            source.commit()
+            changed = {table: counts for table, counts in stats.items() if any(counts)}
+            print(f'Досинхронизация: {changed or "изменений нет"}; запись была приостановлена '
+                  f'{time.monotonic() - paused + SETTLE_SECONDS:.1f} с')
+            print(f'Врач {doctor_id} переключён на узел {target}')
+
+            if keep_source:
+                return
+            time.sleep(shards.SHARD_MAP_TTL_SECONDS + 1)
+            print(f'Удалено строк на узле {source_name}: {delete_doctor_rows(source, doctor_id)}')
+        finally:
+            source.close()
+            target_conn.close()
+    finally:
+        directory.close()
+
+
+def init_sequences() -> None:
+    '''Чередует последовательности id всех узлов, начиная выше максимума по всем узлам'''
+    floors: Dict[str, int] = {}
+    dsns = {shard: shards.dsn(shard) for shard in shards.names()}
+    for dsn in set(dsns.values()) | {os.environ['DATABASE_URL']}:
+        conn = psycopg2.connect(dsn)
+        try:
+            for name, value in shards.sequence_values(conn.cursor()).items():
+                floors[name] = max(floors.get(name, 0), value)
+        finally:
+            conn.close()
+    for shard, dsn in dsns.items():
+        conn = psycopg2.connect(dsn)
+        try:
+            changed = shards.init_sequences(conn.cursor(), shard, floors)
+            conn.commit()
+        finally:
+            conn.close()
+        print(f'{shard}: {len(changed)} последовательностей, шаг {shards.SHARD_ID_STRIDE}')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Перенос данных врача на другой узел БД')
+    parser.add_argument('--doctor-id', type=int, help='id врача в каталоге')
+    parser.add_argument('--to', help='имя узла из DATABASE_SHARDS')
+    parser.add_argument('--chunk', type=int, default=MOVE_CHUNK_SIZE, help='строк за один запрос копирования')
+    parser.add_argument('--keep-source', action='store_true', help='не удалять строки врача с прежнего узла')
+    parser.add_argument('--init-sequences', action='store_true',
+                        help='чередовать последовательности id узлов (один раз при подключении узлов)')
+    args = parser.parse_args()
+
+    if not shards.enabled():
+        parser.error('DATABASE_SHARDS не задана')
+    if args.init_sequences:
+        init_sequences()
+        return
+    if args.doctor_id is None or not args.to:
+        parser.error('нужны --doctor-id и --to')
+    move_doctor(args.doctor_id, args.to, args.chunk, args.keep_source)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,495 @@
+'''
+Холодный архив протоколов.
+
+Протоколы с датой исследования старше ARCHIVE_AFTER_DAYS переносятся из секционированной таблицы
+protocols в protocols_archive. Сводные столбцы, по которым фильтруется и сортируется список, хранятся
+как есть, остальные поля — сжатым JSON: zstd с общим словарём (короткие записи с одинаковыми ключами
+показателей по отдельности почти не сжимаются) или zlib, если пакет zstandard не установлен.
+Словарь обучается на выборке протоколов при первом переносе или по --train-dictionary;
+старые словари остаются в protocols_archive_dictionaries для чтения записей, сжатых ими.
+Показатели протокола остаются в protocol_results. Handler protocols читает архив прозрачно,
+а изменение архивного протокола возвращает его в оперативную таблицу.
+
+Перенос (например, ежесуточно по расписанию):
+    DATABASE_URL=... python archiver.py --older-than-days 730 --vacuum
+'''
+import argparse
+import json
+import os
+import threading
+import zlib
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', '730'))
+ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE', '500'))
+ZSTD_LEVEL = 9
+ZLIB_LEVEL = 9
+ARCHIVE_DICT_SIZE = 16384
+ARCHIVE_DICT_SAMPLES = 2000
+ARCHIVE_DICT_MIN_SAMPLES = 100
+
+SUMMARY_COLUMNS = (
+    'id', 'doctor_id', 'patient_id', 'study_type', 'patient_name', 'patient_gender',
+    'patient_birth_date', 'patient_age_total_days', 'study_date', 'signed', 'created_at'
+)
+
+# Поля, уходящие в payload, и их позиции в строке PROTOCOL_COLUMNS handler'а
+PAYLOAD_POSITIONS = {
+    'patient_age': 6,
+    'patient_weight': 7,
+    'patient_height': 8,
+    'patient_bsa': 9,
+    'ultrasound_device': 10,
+    'results': 12,
+    'results_min_max': 13,
+    'conclusion': 14,
+    'patient_age_years': 17,
+    'patient_age_months': 18,
+    'patient_age_days': 19,
+}
+PAYLOAD_COLUMNS = tuple(PAYLOAD_POSITIONS)
+
+# Столбцы архива в порядке PROTOCOL_COLUMNS handler'а; поля из payload заполняет unpack_protocol_row
+ARCHIVE_PROTOCOL_COLUMNS = """
+    id, doctor_id, study_type, patient_name, patient_gender,
+    patient_birth_date, NULL, NULL, NULL,
+    NULL, NULL, study_date, NULL, NULL,
+    NULL, signed, created_at,
+    NULL, NULL, NULL, patient_id
+"""
+# Столбцы для распаковки, следующие в выборке за ARCHIVE_PROTOCOL_COLUMNS и дополнительными столбцами
+ARCHIVE_PAYLOAD_COLUMNS = 'codec, dictionary_id, payload'
+ARCHIVE_EXTRA_COLUMNS = 3
+
+# Словари неизменяемы и кэшируются навсегда; распаковщики zstd не потокобезопасны — свои у каждого потока
+_dictionaries: Dict[int, Any] = {}
+_local = threading.local()
+
+
+def serialize_payload(fields: Dict[str, Any]) -> bytes:
+    return json.dumps(fields, ensure_ascii=False, separators=(',', ':'), default=float).encode('utf-8')
+
+
+DICTIONARY_SQL = "SELECT dictionary FROM t_p13795046_functional_diagnosti.protocols_archive_dictionaries WHERE id = %s"
+
+
+def store_dictionary(dictionary_id: int, data: bytes):
+    dictionary = _dictionaries[dictionary_id] = zstandard.ZstdCompressionDict(bytes(data))
+    return dictionary
+
+
+def needs_dictionary(codec: str, dictionary_id: Optional[int]) -> bool:
+    '''Нужно ли загрузить словарь перед распаковкой (для чтения без курсора psycopg2)'''
+    return codec == 'zstd' and dictionary_id is not None and dictionary_id not in _dictionaries
+
+
+def load_dictionary(cur, dictionary_id: int):
+    dictionary = _dictionaries.get(dictionary_id)
+    if dictionary is None:
+        cur.execute(DICTIONARY_SQL, (dictionary_id,))
+        dictionary = store_dictionary(dictionary_id, cur.fetchone()[0])
+    return dictionary
+
+
+def _decompressor(cur, dictionary_id: Optional[int]):
+    decompressors = getattr(_local, 'decompressors', None)
+    if decompressors is None:
+        decompressors = _local.decompressors = {}
+    decompressor = decompressors.get(dictionary_id)
+    if decompressor is None:
+        dictionary = load_dictionary(cur, dictionary_id) if dictionary_id is not None else None
+        decompressor = decompressors[dictionary_id] = zstandard.ZstdDecompressor(dict_data=dictionary)
+    return decompressor
+
+
+def decompress_payload(cur, codec: str, dictionary_id: Optional[int], payload: bytes) -> Dict[str, Any]:
+    '''Распаковывает поля протокола; cur нужен для загрузки словаря, ещё не известного процессу'''
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('Для чтения архива требуется пакет zstandard')
+        raw = _decompressor(cur, dictionary_id).decompress(bytes(payload))
+    elif codec == 'zlib':
+        raw = zlib.decompress(bytes(payload))
+    else:
+        raise ValueError(f'Неизвестный кодек архива: {codec}')
+    return json.loads(raw)
+
+
+def unpack_protocol_row(cur, row: tuple) -> tuple:
+    '''Строка архива (ARCHIVE_PROTOCOL_COLUMNS, ARCHIVE_PAYLOAD_COLUMNS) -> строка в порядке PROTOCOL_COLUMNS'''
+    fields = decompress_payload(cur, *row[-ARCHIVE_EXTRA_COLUMNS:])
+    unpacked = list(row[:-ARCHIVE_EXTRA_COLUMNS])
+    for column, position in PAYLOAD_POSITIONS.items():
+        unpacked[position] = fields.get(column)
+    return tuple(unpacked)
+
+
+def latest_dictionary(cur) -> Optional[int]:
+    cur.execute("SELECT max(id) FROM t_p13795046_functional_diagnosti.protocols_archive_dictionaries")
+    return cur.fetchone()[0]
+
+
+def train_dictionary(conn, older_than_days: int, doctor_ids: Optional[Sequence[int]] = None) -> Optional[int]:
+    '''Обучает словарь zstd на последних протоколах-кандидатах в архив; None — мало данных для обучения'''
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT {', '.join(PAYLOAD_COLUMNS)}
+        FROM t_p13795046_functional_diagnosti.protocols
+        WHERE study_date < CURRENT_DATE - %s::int AND (%s::int[] IS NULL OR doctor_id = ANY(%s::int[]))
+        ORDER BY study_date DESC
+        LIMIT %s
+    """, (older_than_days, doctor_ids, doctor_ids, ARCHIVE_DICT_SAMPLES))
+    samples = [serialize_payload(dict(zip(PAYLOAD_COLUMNS, row))) for row in cur.fetchall()]
+    if len(samples) < ARCHIVE_DICT_MIN_SAMPLES:
+        conn.rollback()
+        return None
+    try:
+        dictionary = zstandard.train_dictionary(ARCHIVE_DICT_SIZE, samples)
+    except zstandard.ZstdError:
+        conn.rollback()
+        return None
+
+    cur.execute("""
+        INSERT INTO t_p13795046_functional_diagnosti.protocols_archive_dictionaries (dictionary, samples)
+        VALUES (%s, %s) RETURNING id
+    """, (psycopg2.Binary(dictionary.as_bytes()), len(samples)))
+    dictionary_id = cur.fetchone()[0]
+    conn.commit()
+    return dictionary_id
+
+
+def archive_batch(conn, older_than_days: int, batch_size: int, doctor_ids: Optional[Sequence[int]] = None,
+                  dictionary_id: Optional[int] = None) -> Tuple[int, int, int]:
+    '''
+    Переносит в архив до batch_size протоколов старше older_than_days дней одной транзакцией
+    (только врачей doctor_ids, если список задан), сжимая их словарём dictionary_id.
+    Возвращает (перенесено протоколов, байт JSON до сжатия, байт после сжатия).
+    '''
+    columns = SUMMARY_COLUMNS + PAYLOAD_COLUMNS
+    cur = conn.cursor()
+    compressor = None
+    if zstandard is not None:
+        dictionary = load_dictionary(cur, dictionary_id) if dictionary_id is not None else None
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=dictionary)
+    # Триггер sync_protocol_results не удаляет показатели переносимых протоколов
+    cur.execute("SELECT set_config('fd.archiving', 'on', true)")
+    cur.execute(f"""
+        SELECT {', '.join(columns)}, search_vector
+        FROM t_p13795046_functional_diagnosti.protocols
+        WHERE study_date < CURRENT_DATE - %s::int AND (%s::int[] IS NULL OR doctor_id = ANY(%s::int[]))
+        ORDER BY study_date, id
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    """, (older_than_days, doctor_ids, doctor_ids, batch_size))
+    rows = cur.fetchall()
+    if not rows:
+        conn.rollback()
+        return 0, 0, 0
+
+    raw_bytes = stored_bytes = 0
+    values = []
+    for row in rows:
+        summary = row[:len(SUMMARY_COLUMNS)]
+        fields = dict(zip(PAYLOAD_COLUMNS, row[len(SUMMARY_COLUMNS):len(columns)]))
+        raw = serialize_payload(fields)
+        if compressor is not None:
+            codec, payload = 'zstd', compressor.compress(raw)
+        else:
+            codec, payload = 'zlib', zlib.compress(raw, ZLIB_LEVEL)
+        raw_bytes += len(raw)
+        stored_bytes += len(payload)
+        values.append(summary + (codec, dictionary_id if compressor else None, psycopg2.Binary(payload), row[-1]))
+
+    execute_values(cur, f"""
+        INSERT INTO t_p13795046_functional_diagnosti.protocols_archive
+        ({', '.join(SUMMARY_COLUMNS)}, codec, dictionary_id, payload, search_vector)
+        VALUES %s
+    """, values)
+    cur.execute("""
+        DELETE FROM t_p13795046_functional_diagnosti.protocols
+        WHERE id = ANY(%s) AND study_date < CURRENT_DATE - %s::int
+    """, ([row[0] for row in rows], older_than_days))
+    conn.commit()
+    return len(rows), raw_bytes, stored_bytes
+
+
+def archive_protocols(conn, older_than_days: int = ARCHIVE_AFTER_DAYS, batch_size: int = ARCHIVE_BATCH_SIZE,
+                      doctor_ids: Optional[Sequence[int]] = None, retrain: bool = False) -> Dict[str, Any]:
+    '''
+    Переносит в архив все протоколы старше older_than_days дней пакетами по batch_size.
+    Сжимает последним словарём; новый словарь обучается, если словарей ещё нет или retrain.
+    '''
+    dictionary_id = None
+    if zstandard is not None:
+        dictionary_id = None if retrain else latest_dictionary(conn.cursor())
+        conn.commit()
+        if dictionary_id is None:
+            dictionary_id = train_dictionary(conn, older_than_days, doctor_ids)
+
+    stats = {'archived': 0, 'raw_bytes': 0, 'stored_bytes': 0, 'dictionary_id': dictionary_id}
+    while True:
+        count, raw_bytes, stored_bytes = archive_batch(conn, older_than_days, batch_size, doctor_ids, dictionary_id)
+        if not count:
+            return stats
+        stats['archived'] += count
+        stats['raw_bytes'] += raw_bytes
+        stats['stored_bytes'] += stored_bytes
+
+
+def restore_protocol(cur, doctor_id: int, protocol_id: Any) -> bool:
+    '''Возвращает архивный протокол врача в оперативную таблицу (в транзакции вызывающего); False — нет в архиве'''
+    cur.execute(f"""
+        DELETE FROM t_p13795046_functional_diagnosti.protocols_archive WHERE id = %s AND doctor_id = %s
+        RETURNING {', '.join(SUMMARY_COLUMNS)}, codec, dictionary_id, payload
+    """, (protocol_id, doctor_id))
+    row = cur.fetchone()
+    if not row:
+        return False
+
+    fields = dict(zip(SUMMARY_COLUMNS, row[:len(SUMMARY_COLUMNS)]))
+    fields.update(decompress_payload(cur, *row[len(SUMMARY_COLUMNS):]))
+    for column in ('results', 'results_min_max'):
+        if fields.get(column) is not None:
+            fields[column] = json.dumps(fields[column])
+
+    cur.execute(
+        "SELECT t_p13795046_functional_diagnosti.ensure_protocol_partition(%s::date)",
+        (fields['study_date'],)
+    )
+    # Показатели хранились всё время архивации; триггер вставки создаст их заново
+    cur.execute(
+        "DELETE FROM t_p13795046_functional_diagnosti.protocol_results WHERE protocol_id = %s",
+        (protocol_id,)
+    )
+    columns = SUMMARY_COLUMNS + PAYLOAD_COLUMNS
+    cur.execute(f"""
+        INSERT INTO t_p13795046_functional_diagnosti.protocols ({', '.join(columns)})
+        VALUES ({', '.join(['%s'] * len(columns))})
+    """, [fields.get(column) for column in columns])
+    return True
+
+
+def backfill_search_vectors(conn, batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    '''Заполняет search_vector архивных протоколов, перенесённых до появления полнотекстового поиска'''
+    total = 0
+    cur = conn.cursor()
+    while True:
+        cur.execute("""
+            SELECT id, study_type, codec, dictionary_id, payload
+            FROM t_p13795046_functional_diagnosti.protocols_archive
+            WHERE search_vector IS NULL
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        """, (batch_size,))
+        rows = cur.fetchall()
+        if not rows:
+            conn.rollback()
+            return total
+        values = []
+        for protocol_id, study_type, codec, dictionary_id, payload in rows:
+            fields = decompress_payload(cur, codec, dictionary_id, payload)
+            values.append((protocol_id, fields.get('conclusion'), study_type, fields.get('ultrasound_device'),
+                           json.dumps(fields.get('results'))))
+        execute_values(cur, """
+            UPDATE t_p13795046_functional_diagnosti.protocols_archive a
+            SET search_vector = t_p13795046_functional_diagnosti.protocol_search_vector(
+                v.conclusion, v.study_type, v.ultrasound_device, v.results::jsonb)
+            FROM (VALUES %s) AS v (id, conclusion, study_type, ultrasound_device, results)
+            WHERE a.id = v.id
+        """, values)
+        conn.commit()
+        total += len(rows)
+
+
+def delete_archived(cur, doctor_id: int, protocol_id: Any) -> bool:
+    '''Удаляет архивный протокол врача вместе с его показателями; False — нет в архиве'''
+    cur.execute(
+        "DELETE FROM t_p13795046_functional_diagnosti.protocols_archive WHERE id = %s AND doctor_id = %s",
+        (protocol_id, doctor_id)
+    )
+    if cur.rowcount == 0:
+        return False
+    cur.execute(
+        "DELETE FROM t_p13795046_functional_diagnosti.protocol_results WHERE protocol_id = %s",
+        (protocol_id,)
+    )
+    cur.execute(
+        "DELETE FROM t_p13795046_functional_diagnosti.protocol_norm_status WHERE protocol_id = %s",
+        (protocol_id,)
+    )
+    return True
+
+
+def delete_archived_many(cur, doctor_id: int, protocol_ids: Sequence[int]) -> List[int]:
+    '''Удаляет архивные протоколы врача из списка вместе с показателями одним запросом; возвращает удалённые id'''
+    if not protocol_ids:
+        return []
+    cur.execute("""
+        WITH deleted AS (
+            DELETE FROM t_p13795046_functional_diagnosti.protocols_archive
+            WHERE doctor_id = %s AND id = ANY(%s)
+            RETURNING id
+        ), results AS (
+            DELETE FROM t_p13795046_functional_diagnosti.protocol_results
+            WHERE protocol_id IN (SELECT id FROM deleted)
+        ), statuses AS (
+            DELETE FROM t_p13795046_functional_diagnosti.protocol_norm_status
+            WHERE protocol_id IN (SELECT id FROM deleted)
+        )
+        SELECT id FROM deleted ORDER BY id
+    """, (doctor_id, list(protocol_ids)))
+    return [row[0] for row in cur.fetchall()]
+
+
+def storage_report(cur) -> Dict[str, int]:
+    '''Размеры оперативной таблицы (все секции с индексами и TOAST), архива и protocol_results, байт'''
+    cur.execute("""
+        SELECT (SELECT COALESCE(sum(pg_total_relation_size(relid)), 0)
+                FROM pg_partition_tree('t_p13795046_functional_diagnosti.protocols')),
+               pg_total_relation_size('t_p13795046_functional_diagnosti.protocols_archive'),
+               pg_total_relation_size('t_p13795046_functional_diagnosti.protocol_results'),
+               (SELECT count(*) FROM t_p13795046_functional_diagnosti.protocols),
+               (SELECT count(*) FROM t_p13795046_functional_diagnosti.protocols_archive)
+    """)
+    hot, archive, results, hot_rows, archived_rows = cur.fetchone()
+    return {'hot': int(hot), 'archive': int(archive), 'results': int(results),
+            'hot_rows': hot_rows, 'archived_rows': archived_rows}
+
+
+def cache_hit_counters(cur) -> Tuple[int, int]:
+    '''Накопленные (попадания, чтения с диска) буферного кэша по секциям protocols, таблицы и индексы'''
+    cur.execute("""
+        SELECT COALESCE(sum(COALESCE(s.heap_blks_hit, 0) + COALESCE(s.idx_blks_hit, 0)
+                            + COALESCE(s.toast_blks_hit, 0) + COALESCE(s.tidx_blks_hit, 0)), 0),
+               COALESCE(sum(COALESCE(s.heap_blks_read, 0) + COALESCE(s.idx_blks_read, 0)
+                            + COALESCE(s.toast_blks_read, 0) + COALESCE(s.tidx_blks_read, 0)), 0)
+        FROM pg_partition_tree('t_p13795046_functional_diagnosti.protocols') t
+        JOIN pg_statio_user_tables s ON s.relid = t.relid
+    """)
+    hit, read = cur.fetchone()
+    return int(hit), int(read)
+
+
+def hit_ratio(before: Tuple[int, int], after: Tuple[int, int]) -> Optional[float]:
+    hit, read = after[0] - before[0], after[1] - before[1]
+    return hit / (hit + read) if hit + read else None
+
+
+def vacuum_hot_table(dsn: str) -> None:
+    '''VACUUM секций protocols: освобождает место и усекает опустевшие секции'''
+    conn = psycopg2.connect(dsn)
+    try:
+        conn.autocommit = True
+        conn.cursor().execute('VACUUM (ANALYZE) t_p13795046_functional_diagnosti.protocols')
+    finally:
+        conn.close()
+
+
+def format_size(size: int) -> str:
+    return f'{size / 1024 / 1024:.1f} МБ'
+
+
+def backfill_norm_status(conn, batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    '''
+    Создаёт строки protocol_norm_status для протоколов, заархивированных до их появления:
+    измерения пациента берутся из payload, значения — из protocol_results; статусы вычисляет
+    задача evaluate_norm_status врача
+    '''
+    total = 0
+    last_id = 0
+    cur = conn.cursor()
+    while True:
+        cur.execute("""
+            SELECT a.id, a.doctor_id, a.study_type, a.study_date, a.patient_gender, a.patient_age_total_days,
+                   a.codec, a.dictionary_id, a.payload
+            FROM t_p13795046_functional_diagnosti.protocols_archive a
+            WHERE a.id > %s
+              AND EXISTS (SELECT 1 FROM t_p13795046_functional_diagnosti.protocol_results r WHERE r.protocol_id = a.id)
+              AND NOT EXISTS (SELECT 1 FROM t_p13795046_functional_diagnosti.protocol_norm_status s WHERE s.protocol_id = a.id)
+            ORDER BY a.id
+            LIMIT %s
+        """, (last_id, batch_size))
+        rows = cur.fetchall()
+        if not rows:
+            conn.rollback()
+            return total
+        values = []
+        for protocol_id, doctor_id, study_type, study_date, gender, total_days, codec, dictionary_id, payload in rows:
+            fields = decompress_payload(cur, codec, dictionary_id, payload)
+            values.append((protocol_id, doctor_id, study_type, study_date, gender,
+                           fields.get('patient_age_years'), fields.get('patient_age_months'),
+                           fields.get('patient_age_days'), total_days, fields.get('patient_weight'),
+                           fields.get('patient_height'), fields.get('patient_bsa')))
+        execute_values(cur, """
+            INSERT INTO t_p13795046_functional_diagnosti.protocol_norm_status
+                (protocol_id, param, doctor_id, study_type, study_date, category,
+                 age_years, age_months, age_days, age_total_days, weight, height, bsa, value)
+            SELECT r.protocol_id, r.param, v.doctor_id, v.study_type, v.study_date::date,
+                   CASE WHEN v.age_years IS NULL OR v.gender NOT IN ('male', 'female') THEN NULL
+                        WHEN v.age_years < 18 THEN 'child_' || v.gender
+                        ELSE 'adult_' || v.gender END,
+                   v.age_years, v.age_months, v.age_days, v.age_total_days,
+                   v.weight::double precision, v.height::double precision, v.bsa::double precision, r.value
+            FROM (VALUES %s) AS v (id, doctor_id, study_type, study_date, gender, age_years, age_months,
+                                   age_days, age_total_days, weight, height, bsa)
+            JOIN t_p13795046_functional_diagnosti.protocol_results r ON r.protocol_id = v.id
+            ON CONFLICT (protocol_id, param) DO NOTHING
+        """, values, template='(%s, %s, %s, %s, %s, %s::smallint, %s::smallint, %s::smallint, %s, %s, %s, %s)')
+        cur.execute(
+            "SELECT t_p13795046_functional_diagnosti.enqueue_norm_status(d) FROM unnest(%s::int[]) d",
+            (sorted({row[1] for row in rows}),)
+        )
+        conn.commit()
+        total += len(rows)
+        last_id = rows[-1][0]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Перенос старых протоколов в холодный архив')
+    parser.add_argument('--older-than-days', type=int, default=ARCHIVE_AFTER_DAYS)
+    parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE)
+    parser.add_argument('--doctor', type=int, nargs='+', help='архивировать протоколы только этих врачей')
+    parser.add_argument('--train-dictionary', action='store_true',
+                        help='обучить новый словарь сжатия на текущих кандидатах в архив')
+    parser.add_argument('--vacuum', action='store_true', help='выполнить VACUUM секций после переноса')
+    args = parser.parse_args()
+
+    dsn = os.environ['DATABASE_URL']
+    conn = psycopg2.connect(dsn)
+    try:
+        before = storage_report(conn.cursor())
+        conn.commit()
+        reindexed = backfill_search_vectors(conn, args.batch_size)
+        norm_status_backfilled = backfill_norm_status(conn, args.batch_size)
+        stats = archive_protocols(conn, args.older_than_days, args.batch_size, args.doctor, args.train_dictionary)
+        if args.vacuum:
+            vacuum_hot_table(dsn)
+        after = storage_report(conn.cursor())
+        conn.commit()
+    finally:
+        conn.close()
+
+    if reindexed:
+        print(f'Заполнен поисковый индекс {reindexed} архивных протоколов')
+    if norm_status_backfilled:
+        print(f'Поставлен расчёт статусов норм {norm_status_backfilled} архивных протоколов')
+    print(f"Перенесено в архив: {stats['archived']} протоколов (словарь сжатия: {stats['dictionary_id'] or 'нет'})")
+    if stats['stored_bytes']:
+        print(f"Сжатие полей протоколов: {format_size(stats['raw_bytes'])} -> {format_size(stats['stored_bytes'])} "
+              f"(x{stats['raw_bytes'] / stats['stored_bytes']:.1f})")
+    for title, key in (('protocols', 'hot'), ('protocols_archive', 'archive'), ('protocol_results', 'results')):
+        print(f'{title:18s} {format_size(before[key]):>12s} -> {format_size(after[key]):>12s}')
+    print(f"Строк: оперативных {before['hot_rows']} -> {after['hot_rows']}, "
+          f"архивных {before['archived_rows']} -> {after['archived_rows']}")
+
+
+if __name__ == '__main__':
+    main()
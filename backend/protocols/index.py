@@ -1,9 +1,751 @@
+import asyncio
 import json
 import os
-import psycopg2
+import sys
 from typing import Dict, Any, List, Optional
 from datetime import datetime, date
+import numpy as np
+from psycopg2.extras import execute_values
+import archiver
 
+# shared: из backend/ при локальном запуске, из каталога функции после bundle_shared.py при деплое
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from shared import adb, db, derived, http_cache, idempotency, jobs, metrics, models, resilience
+
+PROTOCOL_COLUMNS = models.Protocol.COLUMNS
+
+
+SEARCH_CONFIG = 'russian'
+SEARCH_PAGE_SIZE = 20
+LIST_MAX_LIMIT = 1000
+SEARCH_HEADLINE_OPTIONS = 'MaxFragments=2, MinWords=5, MaxWords=20, StartSel=<mark>, StopSel=</mark>'
+SEARCH_RANK_SQL = f", ts_rank_cd(search_vector, websearch_to_tsquery('{SEARCH_CONFIG}', %s), 32) AS rank"
+
+
+def select_protocols_sql(where_sql: str, order_sql: str = '', extra_sql: str = '') -> str:
+    '''
+    Выборка протоколов из оперативной таблицы и архива (UNION ALL); параметры extra_sql и where_sql
+    передаются дважды. Дополнительные столбцы extra_sql идут сразу за PROTOCOL_COLUMNS.
+    Строки разбирает format_listed_row.
+    '''
+    return f"""
+        SELECT {PROTOCOL_COLUMNS}{extra_sql},
+               NULL::varchar AS codec, NULL::integer AS dictionary_id, NULL::bytea AS payload
+        FROM t_p13795046_functional_diagnosti.protocols
+        {where_sql}
+        UNION ALL
+        SELECT {archiver.ARCHIVE_PROTOCOL_COLUMNS}{extra_sql}, {archiver.ARCHIVE_PAYLOAD_COLUMNS}
+        FROM t_p13795046_functional_diagnosti.protocols_archive
+        {where_sql}
+        {order_sql}
+    """
+
+
+def parse_page(query_params: Dict[str, Any], default_limit: Optional[int]) -> tuple:
+    '''Параметры постраничного вывода limit и offset; limit=None — без ограничения'''
+    error = 'Некорректные параметры limit и offset'
+    try:
+        limit = int(query_params['limit']) if query_params.get('limit') else default_limit
+        offset = int(query_params.get('offset') or 0)
+    except ValueError:
+        raise ValueError(error)
+    if (limit is not None and limit < 1) or offset < 0:
+        raise ValueError(error)
+    return (min(limit, LIST_MAX_LIMIT) if limit is not None else None), offset
+
+
+def add_search_snippets(cur, protocols: List[Dict[str, Any]], search_query: str) -> None:
+    '''Добавляет к протоколам фрагменты заключения с подсвеченными совпадениями (snippet)'''
+    if not protocols:
+        return
+    cur.execute(f"""
+        SELECT ts_headline('{SEARCH_CONFIG}', u.conclusion, websearch_to_tsquery('{SEARCH_CONFIG}', %s), %s)
+        FROM unnest(%s::text[]) WITH ORDINALITY AS u(conclusion, n)
+        ORDER BY u.n
+    """, (search_query, SEARCH_HEADLINE_OPTIONS, [p['conclusion'] or '' for p in protocols]))
+    for protocol, (snippet,) in zip(protocols, cur.fetchall()):
+        protocol['snippet'] = snippet
+
+
+def ensure_study_month_partition(cur, study_date: Any) -> None:
+    '''
+    Создаёт секцию protocols на месяц исследования, если её ещё нет. Результат не кэшируется в процессе:
+    при откате транзакции секция не создаётся, а существующую функция находит по to_regclass без блокировок
+    '''
+    cur.execute(
+        "SELECT t_p13795046_functional_diagnosti.ensure_protocol_partition(%s::date)",
+        (study_date,)
+    )
+
+
+def upsert_patient(cur, doctor_id: int, patient_name: str, birth_date: Any, gender: Optional[str]) -> int:
+    '''Находит или создаёт пациента врача по нормализованному ФИО и дате рождения'''
+    cur.execute("""
+        INSERT INTO t_p13795046_functional_diagnosti.patients
+            (doctor_id, full_name, normalized_name, birth_date, gender)
+        VALUES (%s, %s, t_p13795046_functional_diagnosti.normalize_patient_name(%s), %s, %s)
+        ON CONFLICT (doctor_id, normalized_name, birth_date)
+        DO UPDATE SET full_name = EXCLUDED.full_name, gender = EXCLUDED.gender, updated_at = CURRENT_TIMESTAMP
+        RETURNING id
+    """, (doctor_id, patient_name, patient_name, birth_date, gender))
+    return cur.fetchone()[0]
+
+
+PROTOCOL_VERSION_SQL = """
+    SELECT v.version, v.signed, s.evaluated_at, s.pending
+    FROM (
+        SELECT updated_at AS version, signed FROM t_p13795046_functional_diagnosti.protocols
+        WHERE id = %s AND doctor_id = %s
+        UNION ALL
+        SELECT archived_at, signed FROM t_p13795046_functional_diagnosti.protocols_archive
+        WHERE id = %s AND doctor_id = %s
+    ) v
+    CROSS JOIN (
+        SELECT max(evaluated_at) AS evaluated_at, bool_or(pending) AS pending
+        FROM t_p13795046_functional_diagnosti.protocol_norm_status WHERE protocol_id = %s
+    ) s
+    LIMIT 1
+"""
+
+PROTOCOL_NORM_STATUS_SQL = """
+    SELECT param, status, norm_min, norm_max, pending
+    FROM t_p13795046_functional_diagnosti.protocol_norm_status
+    WHERE protocol_id = %s AND status IS NOT NULL
+"""
+
+
+def format_norm_status(rows: List[tuple]) -> Dict[str, Any]:
+    '''Сохранённые статусы показателей по нормам (pending — пересчёт ещё не выполнен)'''
+    return {
+        param: {'status': status, 'norm_min': norm_min, 'norm_max': norm_max, 'pending': pending}
+        for param, status, norm_min, norm_max, pending in rows
+    }
+
+
+def get_protocol_version(cur, doctor_id: int, protocol_id: Any) -> Optional[tuple]:
+    '''
+    Версия протокола для ETag без чтения его полей: (время изменения или архивации, подписан,
+    последний пересчёт статусов норм, есть ли статусы в ожидании пересчёта). None — протокола нет.
+    '''
+    cur.execute(PROTOCOL_VERSION_SQL, (protocol_id, doctor_id, protocol_id, doctor_id, protocol_id))
+    row = cur.fetchone()
+    return tuple(row) if row else None
+
+
+def get_patient_history(cur, doctor_id: int, patient_id: Any) -> Optional[Dict[str, Any]]:
+    '''История пациента: список исследований и временные ряды показателей для графиков динамики'''
+    cur.execute("""
+        SELECT id, full_name, birth_date, gender
+        FROM t_p13795046_functional_diagnosti.patients
+        WHERE id = %s AND doctor_id = %s
+    """, (patient_id, doctor_id))
+    patient_row = cur.fetchone()
+    if not patient_row:
+        return None
+    
+    cur.execute("""
+        SELECT p.id, p.study_date, p.study_type, r.param, r.value
+        FROM (
+            SELECT id, study_date, study_type FROM t_p13795046_functional_diagnosti.protocols
+            WHERE patient_id = %s AND doctor_id = %s
+            UNION ALL
+            SELECT id, study_date, study_type FROM t_p13795046_functional_diagnosti.protocols_archive
+            WHERE patient_id = %s AND doctor_id = %s
+        ) p
+        LEFT JOIN t_p13795046_functional_diagnosti.protocol_results r ON r.protocol_id = p.id
+        ORDER BY p.study_date, p.id
+    """, (patient_id, doctor_id, patient_id, doctor_id))
+    
+    studies: List[Dict[str, Any]] = []
+    series: Dict[str, List[Dict[str, Any]]] = {}
+    last_protocol_id = None
+    for protocol_id, study_date, study_type, param, value in cur.fetchall():
+        study_date_iso = study_date.isoformat() if study_date else None
+        if protocol_id != last_protocol_id:
+            studies.append({'id': protocol_id, 'study_date': study_date_iso, 'study_type': study_type})
+            last_protocol_id = protocol_id
+        if param is not None:
+            series.setdefault(param, []).append({
+                'protocol_id': protocol_id,
+                'study_date': study_date_iso,
+                'study_type': study_type,
+                'value': value
+            })
+    
+    return {
+        'patient': {
+            'id': patient_row[0],
+            'full_name': patient_row[1],
+            'birth_date': patient_row[2].isoformat() if patient_row[2] else None,
+            'gender': patient_row[3]
+        },
+        'studies': studies,
+        'series': series
+    }
+
+
+AGE_UNIT_DAYS = {
+    'years': 365.25,
+    'months': 30.44,
+    'days': 1
+}
+
+
+# Верхние границы частей возраста (столбцы patient_age_* — smallint)
+PATIENT_AGE_MAX = {
+    'years': 150,
+    'months': 1800,
+    'days': 32767
+}
+
+
+def patient_age_part(patient_age: Dict[str, Any], unit: str) -> int:
+    '''Целая неотрицательная часть возраста из запроса; некорректное значение — ValueError'''
+    value = patient_age.get(unit) or 0
+    if isinstance(value, str) and value.strip().isdigit():
+        value = int(value)
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if isinstance(value, bool) or not isinstance(value, int) or not 0 <= value <= PATIENT_AGE_MAX[unit]:
+        raise ValueError(f'Некорректный возраст пациента: {unit} = {value!r} '
+                         f'(целое число от 0 до {PATIENT_AGE_MAX[unit]})')
+    return value
+
+
+def split_patient_age(patient_age: Any) -> tuple:
+    '''
+    Раскладывает возраст из запроса на столбцы: (patient_age, years, months, days, total_days).
+    Словарь {years, months, days} хранится в числовых столбцах, прочие значения остаются в patient_age.
+    Некорректные части словаря — ValueError.
+    '''
+    if isinstance(patient_age, dict) and patient_age.get('years') is not None:
+        years = patient_age_part(patient_age, 'years')
+        months = patient_age_part(patient_age, 'months')
+        days = patient_age_part(patient_age, 'days')
+        total_days = round(years * AGE_UNIT_DAYS['years'] + months * AGE_UNIT_DAYS['months'] + days)
+        return None, years, months, days, total_days
+    if patient_age and not isinstance(patient_age, str):
+        patient_age = json.dumps(patient_age)
+    return patient_age or None, None, None, None, None
+
+
+RESULT_FILTER_OPS = {
+    'eq': '=',
+    'ne': '<>',
+    'lt': '<',
+    'lte': '<=',
+    'gt': '>',
+    'gte': '>='
+}
+
+
+NORM_STATUSES = ('normal', 'below', 'above', 'borderline_low', 'borderline_high')
+NORM_ABNORMAL_STATUSES = ('below', 'above', 'borderline_low', 'borderline_high')
+
+
+def build_list_filters(query_params: Dict[str, Any], doctor_id: int) -> tuple:
+    '''
+    Собирает условия WHERE для списка протоколов из параметров запроса.
+    Возраст: age_from, age_to, age_unit (years/months/days) по индексу patient_age_total_days.
+    Фильтры по значениям показателей: param, op, value (несколько фильтров через запятую,
+    например param=ef,lvdd&op=lt,gt&value=50,56.5), выполняются по индексу protocol_results.
+    Запятая разделяет фильтры, поэтому дробная часть value записывается только через точку.
+    Полнотекстовый поиск: q (синтаксис websearch_to_tsquery) по GIN-индексу search_vector.
+    Отклонения от норм: norm_status (abnormal или статусы через запятую), необязательно norm_param —
+    по сохранённым статусам protocol_norm_status.
+    '''
+    search_name = query_params.get('search_name')
+    search_study_type = query_params.get('search_study_type')
+    date_from = query_params.get('date_from')
+    date_to = query_params.get('date_to')
+    
+    where_clauses = ['doctor_id = %s']
+    params: List[Any] = [doctor_id]
+    
+    if search_name:
+        where_clauses.append("LOWER(patient_name) LIKE LOWER(%s)")
+        params.append(f'%{search_name}%')
+    
+    if search_study_type:
+        where_clauses.append("study_type = %s")
+        params.append(search_study_type)
+    
+    if date_from:
+        where_clauses.append("study_date >= %s::date")
+        params.append(date_from)
+    
+    if date_to:
+        where_clauses.append("study_date <= %s::date")
+        params.append(date_to)
+    
+    search_query = (query_params.get('q') or '').strip()
+    if search_query:
+        where_clauses.append(f"search_vector @@ websearch_to_tsquery('{SEARCH_CONFIG}', %s)")
+        params.append(search_query)
+    
+    age_from = query_params.get('age_from')
+    age_to = query_params.get('age_to')
+    if age_from or age_to:
+        age_unit = query_params.get('age_unit', 'years')
+        if age_unit not in AGE_UNIT_DAYS:
+            raise ValueError(f'Неизвестная единица возраста: {age_unit}')
+        try:
+            if age_from:
+                where_clauses.append("patient_age_total_days >= %s")
+                params.append(round(float(age_from) * AGE_UNIT_DAYS[age_unit]))
+            if age_to:
+                where_clauses.append("patient_age_total_days <= %s")
+                params.append(round(float(age_to) * AGE_UNIT_DAYS[age_unit]))
+        except ValueError:
+            raise ValueError('Некорректный диапазон возраста')
+    
+    result_params = [p.strip() for p in (query_params.get('param') or '').split(',') if p.strip()]
+    if result_params:
+        result_ops = [o.strip() for o in (query_params.get('op') or '').split(',')]
+        result_values = [v.strip() for v in (query_params.get('value') or '').split(',')]
+        if len(result_ops) != len(result_params) or len(result_values) != len(result_params):
+            raise ValueError('Количество значений param, op и value должно совпадать')
+        
+        for param_name, op, raw_value in zip(result_params, result_ops, result_values):
+            sql_op = RESULT_FILTER_OPS.get(op)
+            if not sql_op:
+                raise ValueError(f'Неизвестный оператор фильтра: {op}')
+            try:
+                value = float(raw_value)
+            except ValueError:
+                raise ValueError(f'Некорректное значение фильтра для {param_name}: {raw_value} '
+                                 f'(дробная часть — через точку)')
+            
+            subquery_clauses = ['r.doctor_id = %s', 'r.param = %s', f'r.value {sql_op} %s']
+            subquery_params: List[Any] = [doctor_id, param_name, value]
+            if search_study_type:
+                subquery_clauses.append('r.study_type = %s')
+                subquery_params.append(search_study_type)
+            if date_from:
+                subquery_clauses.append('r.study_date >= %s::date')
+                subquery_params.append(date_from)
+            if date_to:
+                subquery_clauses.append('r.study_date <= %s::date')
+                subquery_params.append(date_to)
+            
+            where_clauses.append(
+                "id IN (SELECT r.protocol_id FROM t_p13795046_functional_diagnosti.protocol_results r "
+                "WHERE " + " AND ".join(subquery_clauses) + ")"
+            )
+            params.extend(subquery_params)
+    
+    norm_statuses = [v.strip() for v in (query_params.get('norm_status') or '').split(',') if v.strip()]
+    if norm_statuses:
+        statuses = set()
+        for status in norm_statuses:
+            if status == 'abnormal':
+                statuses.update(NORM_ABNORMAL_STATUSES)
+            elif status in NORM_STATUSES:
+                statuses.add(status)
+            else:
+                raise ValueError(f'Неизвестный статус нормы: {status}')
+        
+        subquery_clauses = ['s.doctor_id = %s', 's.status = ANY(%s)']
+        subquery_params = [doctor_id, sorted(statuses)]
+        if 'normal' not in statuses:
+            subquery_clauses.append("s.status <> 'normal'")
+        norm_params = [p.strip() for p in (query_params.get('norm_param') or '').split(',') if p.strip()]
+        if norm_params:
+            subquery_clauses.append('s.param = ANY(%s)')
+            subquery_params.append(norm_params)
+        if date_from:
+            subquery_clauses.append('s.study_date >= %s::date')
+            subquery_params.append(date_from)
+        if date_to:
+            subquery_clauses.append('s.study_date <= %s::date')
+            subquery_params.append(date_to)
+        
+        where_clauses.append(
+            "id IN (SELECT s.protocol_id FROM t_p13795046_functional_diagnosti.protocol_norm_status s "
+            "WHERE " + " AND ".join(subquery_clauses) + ")"
+        )
+        params.extend(subquery_params)
+    
+    return where_clauses, params
+
+
+BULK_MAX_BATCH = int(os.environ.get('BULK_MAX_BATCH', '500'))
+BULK_ACTIONS = ('bulk_sign', 'bulk_delete', 'bulk_set_study_type')
+
+
+def build_bulk_filters(body_data: Dict[str, Any], doctor_id: int) -> tuple:
+    '''
+    Условия WHERE для групповой операции: явный список ids (не больше BULK_MAX_BATCH) или filters
+    в формате параметров списка (build_list_filters); оба вместе — пересечение. Без ids и filters — ошибка,
+    чтобы пустое тело не затронуло все протоколы врача.
+    '''
+    ids = body_data.get('ids')
+    filters = body_data.get('filters') or {}
+    if ids is None and not filters:
+        raise ValueError('Укажите ids или filters')
+    where_clauses, params = build_list_filters(filters, doctor_id)
+    if ids is not None:
+        if not isinstance(ids, list) or not ids:
+            raise ValueError('ids должен быть непустым списком')
+        try:
+            ids = sorted({int(protocol_id) for protocol_id in ids})
+        except (TypeError, ValueError):
+            raise ValueError('Некорректный id протокола в ids')
+        if len(ids) > BULK_MAX_BATCH:
+            raise ValueError(f'Не больше {BULK_MAX_BATCH} протоколов за запрос')
+        where_clauses.append('id = ANY(%s)')
+        params.append(ids)
+    return where_clauses, params
+
+
+def bulk_update_protocols(cur, doctor_id: int, action: str, where_clauses: List[str], params: List[Any],
+                          study_type: Optional[str] = None) -> tuple:
+    '''
+    Подпись, удаление или смена вида исследования для протоколов врача по условиям build_bulk_filters
+    в транзакции вызывающего: до BULK_MAX_BATCH протоколов (по возрастанию id) одной выборкой id
+    из оперативной таблицы и архива и одним запросом на таблицу. Уже подписанные протоколы и протоколы
+    с тем же видом исследования не затрагиваются, поэтому повтор запроса доходит до оставшихся.
+    Возвращает (id изменённых протоколов, остались ли ещё подходящие).
+    '''
+    where_clauses = list(where_clauses)
+    params = list(params)
+    if action == 'bulk_sign':
+        where_clauses.append('signed IS NOT TRUE')
+    elif action == 'bulk_set_study_type':
+        where_clauses.append('study_type <> %s')
+        params.append(study_type)
+    where_sql = "WHERE " + " AND ".join(where_clauses)
+
+    cur.execute(f"""
+        SELECT id, archived FROM (
+            (SELECT id, false AS archived FROM t_p13795046_functional_diagnosti.protocols {where_sql}
+             ORDER BY id LIMIT %s)
+            UNION ALL
+            (SELECT id, true AS archived FROM t_p13795046_functional_diagnosti.protocols_archive {where_sql}
+             ORDER BY id LIMIT %s)
+        ) targets
+        ORDER BY id
+        LIMIT %s
+    """, params + [BULK_MAX_BATCH + 1] + params + [BULK_MAX_BATCH + 1, BULK_MAX_BATCH + 1])
+    targets = cur.fetchall()
+    has_more = len(targets) > BULK_MAX_BATCH
+    targets = targets[:BULK_MAX_BATCH]
+    hot_ids = [protocol_id for protocol_id, archived in targets if not archived]
+    archived_ids = [protocol_id for protocol_id, archived in targets if archived]
+
+    affected: List[int] = []
+    if action == 'bulk_sign':
+        # signed хранится в сводных столбцах архива, распаковка не нужна
+        for table, table_ids in (('protocols', hot_ids), ('protocols_archive', archived_ids)):
+            if table_ids:
+                cur.execute(
+                    f"UPDATE t_p13795046_functional_diagnosti.{table} SET signed = true "
+                    "WHERE doctor_id = %s AND id = ANY(%s) RETURNING id",
+                    (doctor_id, table_ids)
+                )
+                affected.extend(row[0] for row in cur.fetchall())
+    elif action == 'bulk_delete':
+        if hot_ids:
+            cur.execute(
+                "DELETE FROM t_p13795046_functional_diagnosti.protocols WHERE doctor_id = %s AND id = ANY(%s) RETURNING id",
+                (doctor_id, hot_ids)
+            )
+            affected.extend(row[0] for row in cur.fetchall())
+        affected.extend(archiver.delete_archived_many(cur, doctor_id, archived_ids))
+    else:
+        # Вид исследования входит в сжатый поисковый вектор архива: изменяемые архивные протоколы,
+        # как и при PUT, возвращаются в оперативную таблицу
+        for protocol_id in archived_ids:
+            if archiver.restore_protocol(cur, doctor_id, protocol_id):
+                hot_ids.append(protocol_id)
+        if hot_ids:
+            cur.execute(
+                "UPDATE t_p13795046_functional_diagnosti.protocols SET study_type = %s "
+                "WHERE doctor_id = %s AND id = ANY(%s) RETURNING id",
+                (study_type, doctor_id, hot_ids)
+            )
+            affected.extend(row[0] for row in cur.fetchall())
+    return sorted(affected), has_more
+
+
+EXPORT_CHUNK_SIZE = 1000
+
+
+@jobs.register('export_protocols')
+def export_protocols_job(conn, job: jobs.Job) -> Dict[str, Any]:
+    '''
+    Фоновая выгрузка протоколов врача по фильтрам списка (payload.filters). Протоколы пишутся частями
+    по EXPORT_CHUNK_SIZE в job_result_chunks, результат задачи — число протоколов и частей;
+    части читаются через GET ?job_id=...&offset=...
+    '''
+    try:
+        where_clauses, params = build_list_filters(job.payload.get('filters') or {}, job.doctor_id)
+    except ValueError as e:
+        raise jobs.PermanentJobError(str(e))
+    where_sql = "WHERE " + " AND ".join(where_clauses)
+    
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT (SELECT count(*) FROM t_p13795046_functional_diagnosti.protocols {where_sql})
+             + (SELECT count(*) FROM t_p13795046_functional_diagnosti.protocols_archive {where_sql})
+    """, params + params)
+    total = cur.fetchone()[0]
+    
+    # В памяти — одна часть: части пишутся в job_result_chunks и фиксируются вместе с отметкой о выполнении
+    count = 0
+    chunks = 0
+    protocols: List[Dict[str, Any]] = []
+    with conn.cursor(name='export_protocols') as stream:
+        stream.itersize = EXPORT_CHUNK_SIZE
+        stream.execute(select_protocols_sql(where_sql, 'ORDER BY study_date, id'), params + params)
+        for row in stream:
+            protocols.append(format_listed_row(cur, row))
+            if len(protocols) == EXPORT_CHUNK_SIZE:
+                jobs.save_result_chunk(cur, job, chunks, protocols)
+                count += len(protocols)
+                chunks += 1
+                protocols = []
+                job.progress(count / max(total, 1), f'Выгружено {count} из {total}')
+    if protocols:
+        jobs.save_result_chunk(cur, job, chunks, protocols)
+        count += len(protocols)
+        chunks += 1
+    jobs.clear_result_chunks(cur, job, chunks)
+    
+    return {'count': count, 'chunks': chunks, 'chunk_size': EXPORT_CHUNK_SIZE}
+
+
+IMPORT_MAX_PROTOCOLS = int(os.environ.get('IMPORT_MAX_PROTOCOLS', '1000'))
+IMPORT_REQUIRED_FIELDS = ('study_type', 'patient_name', 'patient_gender', 'patient_birth_date', 'study_date',
+                          'results')
+
+
+def prepare_import(items: Any, bsa_formula: Optional[str] = None) -> tuple:
+    '''
+    Проверяет протоколы импорта и вычисляет возраст и BSA всего пакета (shared.derived).
+    Возвращает (строки для insert_imported_protocols, ошибки [{index, errors}]). Присланный клиентом
+    patient_age не используется, patient_bsa — только если нет массы или роста.
+    '''
+    if not isinstance(items, list) or not items:
+        raise ValueError('protocols должен быть непустым списком')
+    if len(items) > IMPORT_MAX_PROTOCOLS:
+        raise ValueError(f'Не больше {IMPORT_MAX_PROTOCOLS} протоколов за запрос')
+    items = [item if isinstance(item, dict) else {} for item in items]
+
+    birth_dates = derived.to_dates(item.get('patient_birth_date') for item in items)
+    study_dates = derived.to_dates(item.get('study_date') for item in items)
+    ages = derived.ages(birth_dates, study_dates)
+    bsa = derived.bsa([item.get('patient_weight') for item in items],
+                      [item.get('patient_height') for item in items], bsa_formula)
+    weights = derived.column(derived.to_floats(item.get('patient_weight') for item in items))
+    heights = derived.column(derived.to_floats(item.get('patient_height') for item in items))
+    bsa_values = derived.column(bsa)
+
+    rows: List[Dict[str, Any]] = []
+    errors: List[Dict[str, Any]] = []
+    for index, item in enumerate(items):
+        item_errors = [f'Отсутствует обязательное поле: {field}' for field in IMPORT_REQUIRED_FIELDS
+                       if item.get(field) in (None, '')]
+        if item.get('results') is not None and not isinstance(item.get('results'), dict):
+            item_errors.append('results должен быть объектом')
+        if item.get('patient_birth_date') and np.isnat(birth_dates[index]):
+            item_errors.append('Некорректная дата рождения')
+        if item.get('study_date') and np.isnat(study_dates[index]):
+            item_errors.append('Некорректная дата исследования')
+        if not item_errors and not ages.valid[index]:
+            item_errors.append('Дата рождения не может быть позже даты исследования')
+        if item_errors:
+            errors.append({'index': index, 'errors': item_errors})
+            continue
+
+        results_min_max = item.get('results_min_max')
+        rows.append({
+            'study_type': item['study_type'],
+            'patient_name': item['patient_name'],
+            'patient_gender': item['patient_gender'],
+            'patient_birth_date': str(birth_dates[index]),
+            'age': (int(ages.years[index]), int(ages.months[index]), int(ages.days[index]),
+                    int(ages.total_days[index])),
+            'patient_weight': weights[index],
+            'patient_height': heights[index],
+            'patient_bsa': bsa_values[index] if bsa_values[index] is not None else item.get('patient_bsa'),
+            'ultrasound_device': item.get('ultrasound_device'),
+            'study_date': str(study_dates[index]),
+            'results': json.dumps(item['results']),
+            'results_min_max': json.dumps(results_min_max) if results_min_max else None,
+            'conclusion': item.get('conclusion') or '',
+        })
+    return rows, errors
+
+
+def upsert_patients(cur, doctor_id: int, patients: List[tuple]) -> List[int]:
+    '''upsert_patient для пакета (ФИО, дата рождения, пол) одним запросом; id пациента для каждой строки'''
+    values = [(n, doctor_id, name, birth_date, gender) for n, (name, birth_date, gender) in enumerate(patients)]
+    rows = execute_values(cur, """
+        WITH v (n, doctor_id, full_name, birth_date, gender) AS (VALUES %s),
+        k AS (
+            SELECT v.*, t_p13795046_functional_diagnosti.normalize_patient_name(v.full_name) AS normalized_name
+            FROM v
+        ),
+        upserted AS (
+            INSERT INTO t_p13795046_functional_diagnosti.patients
+                (doctor_id, full_name, normalized_name, birth_date, gender)
+            SELECT DISTINCT ON (normalized_name, birth_date) doctor_id, full_name, normalized_name, birth_date, gender
+            FROM k
+            ORDER BY normalized_name, birth_date, n DESC
+            ON CONFLICT (doctor_id, normalized_name, birth_date)
+            DO UPDATE SET full_name = EXCLUDED.full_name, gender = EXCLUDED.gender, updated_at = CURRENT_TIMESTAMP
+            RETURNING id, normalized_name, birth_date
+        )
+        SELECT k.n, u.id FROM k
+        JOIN upserted u ON u.normalized_name = k.normalized_name AND u.birth_date = k.birth_date
+        ORDER BY k.n
+    """, values, template='(%s, %s, %s, %s::date, %s)', page_size=len(values), fetch=True)
+    return [patient_id for _, patient_id in rows]
+
+
+def insert_imported_protocols(cur, doctor_id: int, rows: List[Dict[str, Any]]) -> List[int]:
+    '''Вставляет подготовленные prepare_import протоколы; id в порядке rows'''
+    for month in sorted({row['study_date'][:7] for row in rows}):
+        ensure_study_month_partition(cur, f'{month}-01')
+    patient_ids = upsert_patients(
+        cur, doctor_id, [(row['patient_name'], row['patient_birth_date'], row['patient_gender']) for row in rows]
+    )
+    values = [
+        (doctor_id, patient_id, row['study_type'], row['patient_name'], row['patient_gender'],
+         row['patient_birth_date'], *row['age'], row['patient_weight'], row['patient_height'],
+         row['patient_bsa'], row['ultrasound_device'], row['study_date'], row['results'],
+         row['results_min_max'], row['conclusion'])
+        for patient_id, row in zip(patient_ids, rows)
+    ]
+    inserted = execute_values(cur, """
+        INSERT INTO t_p13795046_functional_diagnosti.protocols
+        (doctor_id, patient_id, study_type, patient_name, patient_gender, patient_birth_date,
+         patient_age_years, patient_age_months, patient_age_days, patient_age_total_days,
+         patient_weight, patient_height, patient_bsa, ultrasound_device,
+         study_date, results, results_min_max, conclusion)
+        VALUES %s
+        RETURNING id
+    """, values, page_size=len(values), fetch=True)
+    return [row[0] for row in inserted]
+
+
+BACKFILL_CHUNK_SIZE = int(os.environ.get('BACKFILL_CHUNK_SIZE', '5000'))
+BSA_TOLERANCE = 0.005
+
+
+@jobs.register('backfill_patient_age')
+def backfill_patient_age_job(conn, job: jobs.Job) -> Dict[str, Any]:
+    '''
+    Заполнение числовых столбцов возраста из старого текстового patient_age (ставится миграцией V0020)
+    пакетами по BACKFILL_CHUNK_SIZE id с фиксацией после пакета; текст patient_age сохраняется.
+    payload: after_id (продолжить с id).
+    '''
+    after_id = int(job.payload.get('after_id') or 0)
+    cur = conn.cursor()
+    cur.execute("SELECT COALESCE(max(id), 0) FROM t_p13795046_functional_diagnosti.protocols")
+    last_id = cur.fetchone()[0]
+    updated = 0
+    while after_id < last_id:
+        cur.execute("SELECT t_p13795046_functional_diagnosti.backfill_patient_age_batch(%s, %s)",
+                    (after_id, BACKFILL_CHUNK_SIZE))
+        updated += cur.fetchone()[0]
+        conn.commit()
+        after_id += BACKFILL_CHUNK_SIZE
+        job.progress(min(after_id, last_id) / max(last_id, 1), f'Заполнено {updated}')
+    return {'updated': updated, 'last_id': last_id}
+
+
+@jobs.register('backfill_derived_fields')
+def backfill_derived_fields_job(conn, job: jobs.Job) -> Dict[str, Any]:
+    '''
+    Пересчёт возраста и BSA протоколов врача задачи (или всех врачей, если doctor_id не задан) пакетами
+    по id с фиксацией после пакета. Обновляются только строки, где сохранённые значения расходятся
+    с вычисленными shared.derived; возраст без дат и BSA без массы или роста не трогаются.
+    Архивные протоколы не пересчитываются. payload: bsa_formula, after_id (продолжить с id), bsa (false —
+    только возраст).
+    '''
+    try:
+        derived.bsa([], [], job.payload.get('bsa_formula'))
+    except ValueError as e:
+        raise jobs.PermanentJobError(str(e))
+    fix_bsa = job.payload.get('bsa', True)
+    after_id = int(job.payload.get('after_id') or 0)
+    doctor_sql = 'AND doctor_id = %s' if job.doctor_id is not None else ''
+    doctor_params = [job.doctor_id] if job.doctor_id is not None else []
+
+    cur = conn.cursor()
+    cur.execute(f"SELECT max(id) FROM t_p13795046_functional_diagnosti.protocols WHERE true {doctor_sql}",
+                doctor_params)
+    last_id = cur.fetchone()[0] or 0
+    scanned = age_fixed = bsa_fixed = 0
+    while True:
+        cur.execute(f"""
+            SELECT id, study_date, patient_birth_date, patient_weight::float8, patient_height::float8,
+                   patient_bsa::float8, patient_age_years, patient_age_months, patient_age_days,
+                   patient_age_total_days
+            FROM t_p13795046_functional_diagnosti.protocols
+            WHERE id > %s {doctor_sql}
+            ORDER BY id
+            LIMIT %s
+        """, [after_id] + doctor_params + [BACKFILL_CHUNK_SIZE])
+        rows = cur.fetchall()
+        if not rows:
+            break
+        columns = list(zip(*rows))
+        ages = derived.ages(derived.to_dates(columns[2]), derived.to_dates(columns[1]))
+        stored = [derived.to_floats(column) for column in columns[6:10]]
+        age_wrong = ages.valid & (
+            (stored[0] != ages.years) | (stored[1] != ages.months) | (stored[2] != ages.days)
+            | (stored[3] != ages.total_days)
+        )
+        if fix_bsa:
+            bsa = derived.bsa(derived.to_floats(columns[3]), derived.to_floats(columns[4]),
+                              job.payload.get('bsa_formula'))
+            stored_bsa = derived.to_floats(columns[5])
+            bsa_wrong = ~np.isnan(bsa) & ~(np.abs(stored_bsa - bsa) < BSA_TOLERANCE)
+        else:
+            bsa = np.full(len(rows), np.nan)
+            bsa_wrong = np.zeros(len(rows), dtype=bool)
+
+        changed = np.flatnonzero(age_wrong | bsa_wrong)
+        if len(changed):
+            ids = np.array(columns[0], dtype=np.int64)[changed].tolist()
+            study_dates = [columns[1][i] for i in changed]
+            years = derived.column(ages.years[changed], age_wrong[changed])
+            months = derived.column(ages.months[changed], age_wrong[changed])
+            days = derived.column(ages.days[changed], age_wrong[changed])
+            total_days = derived.column(ages.total_days[changed], age_wrong[changed])
+            bsa_values = derived.column(bsa[changed], bsa_wrong[changed])
+            execute_values(cur, """
+                UPDATE t_p13795046_functional_diagnosti.protocols p
+                SET patient_age_years = COALESCE(v.years, p.patient_age_years),
+                    patient_age_months = COALESCE(v.months, p.patient_age_months),
+                    patient_age_days = COALESCE(v.days, p.patient_age_days),
+                    patient_age_total_days = COALESCE(v.total_days, p.patient_age_total_days),
+                    patient_bsa = COALESCE(v.bsa, p.patient_bsa)
+                FROM (VALUES %s) AS v (id, study_date, years, months, days, total_days, bsa)
+                WHERE p.id = v.id AND p.study_date = v.study_date
+            """, list(zip(ids, study_dates, years, months, days, total_days, bsa_values)),
+                template='(%s, %s::date, %s::smallint, %s::smallint, %s::smallint, %s::integer, %s::numeric)',
+                page_size=len(ids))
+        conn.commit()
+
+        scanned += len(rows)
+        age_fixed += int(age_wrong.sum())
+        bsa_fixed += int(bsa_wrong.sum())
+        after_id = rows[-1][0]
+        job.progress(after_id / max(last_id, 1),
+                     f'Проверено {scanned}, исправлено: возраст {age_fixed}, BSA {bsa_fixed}')
+        if len(rows) < BACKFILL_CHUNK_SIZE:
+            break
+
+    return {'scanned': scanned, 'age_fixed': age_fixed, 'bsa_fixed': bsa_fixed, 'last_id': after_id}
+
+
+@metrics.instrumented('protocols')
+@db.read_your_writes
+@idempotency.idempotent('protocols')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Управление протоколами исследований: создание, чтение, обновление, удаление, поиск, сортировка
@@ -20,7 +762,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token, x-auth-token',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token, x-auth-token, Idempotency-Key, If-None-Match, X-Last-Write',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
@@ -39,8 +781,18 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     headers_dict = event.get('headers', {})
     auth_token = headers_dict.get('x-auth-token') or headers_dict.get('X-Auth-Token')
     
+    query_params = event.get('queryStringParameters') or {}
+    if method != 'GET':
+        policy = resilience.WRITE
+    elif query_params.get('id') or query_params.get('patient_id') or query_params.get('job_id'):
+        policy = resilience.READ
+    else:
+        policy = resilience.SCAN
+    
     try:
-        conn = psycopg2.connect(dsn)
+        slot = resilience.admit(policy)
+        conn = db.connect(readonly=(method == 'GET'), sticky_key=auth_token,
+                          statement_timeout_ms=policy.statement_timeout_ms, doctor_token=auth_token)
         cur = conn.cursor()
         
         if method == 'GET':
@@ -66,17 +818,94 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 }
             
             doctor_id = doctor_row[0]
-            protocol_id = event.get('queryStringParameters', {}).get('id')
+            protocol_id = query_params.get('id')
+            patient_id = query_params.get('patient_id')
+            job_id = query_params.get('job_id')
+            
+            if job_id:
+                try:
+                    if not job_id.isdigit():
+                        raise ValueError('Некорректный id задачи')
+                    _, offset = parse_page(query_params, None)
+                except ValueError as e:
+                    return {
+                        'statusCode': 400,
+                        'headers': headers,
+                        'body': json.dumps({'error': str(e)}),
+                        'isBase64Encoded': False
+                    }
+                job = jobs.get_job(cur, job_id, doctor_id)
+                if not job:
+                    return {
+                        'statusCode': 404,
+                        'headers': headers,
+                        'body': json.dumps({'error': 'Задача не найдена'}),
+                        'isBase64Encoded': False
+                    }
+                
+                response = {'job': job}
+                result = job['result']
+                if job['kind'] == 'export_protocols' and isinstance(result, dict) and result.get('chunk_size'):
+                    # выгрузка отдаётся по одной части job_result_chunks, начиная с offset
+                    chunk_size = result['chunk_size']
+                    chunk = jobs.get_result_chunk(cur, job_id, doctor_id, offset // chunk_size) or []
+                    protocols = chunk[offset % chunk_size:]
+                    next_offset = offset + len(protocols)
+                    response.update({
+                        'protocols': protocols,
+                        'offset': offset,
+                        'next_offset': next_offset if protocols and next_offset < result['count'] else None
+                    })
+                
+                return {
+                    'statusCode': 200,
+                    'headers': headers,
+                    'body': json.dumps(response),
+                    'isBase64Encoded': False
+                }
+            
+            if patient_id:
+                if not patient_id.isdigit():
+                    return {
+                        'statusCode': 400,
+                        'headers': headers,
+                        'body': json.dumps({'error': 'Некорректный id пациента'}),
+                        'isBase64Encoded': False
+                    }
+                history = get_patient_history(cur, doctor_id, patient_id)
+                if not history:
+                    return {
+                        'statusCode': 404,
+                        'headers': headers,
+                        'body': json.dumps({'error': 'Пациент не найден'}),
+                        'isBase64Encoded': False
+                    }
+                
+                return {
+                    'statusCode': 200,
+                    'headers': headers,
+                    'body': json.dumps(history),
+                    'isBase64Encoded': False
+                }
             
             if protocol_id:
-                cur.execute("""
-                    SELECT id, doctor_id, study_type, patient_name, patient_gender, 
-                           patient_birth_date, patient_age, patient_weight, patient_height, 
-                           patient_bsa, ultrasound_device, study_date, results, results_min_max,
-                           conclusion, signed, created_at 
-                    FROM t_p13795046_functional_diagnosti.protocols 
-                    WHERE id = %s AND doctor_id = %s
-                """, (protocol_id, doctor_id))
+                version = get_protocol_version(cur, doctor_id, protocol_id)
+                if not version:
+                    return {
+                        'statusCode': 404,
+                        'headers': headers,
+                        'body': json.dumps({'error': 'Протокол не найден'}),
+                        'isBase64Encoded': False
+                    }
+                tag = http_cache.etag(protocol_id, *version)
+                cache_control = http_cache.SIGNED_PROTOCOL if version[1] else http_cache.REVALIDATE
+                if http_cache.if_none_match(event, tag):
+                    return http_cache.not_modified(headers, tag, cache_control)
+                
+                cur.execute(
+                    select_protocols_sql("WHERE id = %s AND doctor_id = %s"),
+                    (protocol_id, doctor_id, protocol_id, doctor_id)
+                )
                 
                 row = cur.fetchone()
                 if not row:
@@ -87,69 +916,74 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'isBase64Encoded': False
                     }
                 
-                protocol = format_protocol_row(row)
+                protocol = format_listed_row(cur, row)
+                cur.execute(PROTOCOL_NORM_STATUS_SQL, (protocol_id,))
+                protocol['norm_status'] = format_norm_status(cur.fetchall())
                 return {
                     'statusCode': 200,
-                    'headers': headers,
+                    'headers': http_cache.cache_headers(headers, tag, cache_control),
                     'body': json.dumps({'protocol': protocol}),
                     'isBase64Encoded': False
                 }
             
             else:
-                query_params = event.get('queryStringParameters', {})
-                search_name = query_params.get('search_name')
-                search_study_type = query_params.get('search_study_type')
-                date_from = query_params.get('date_from')
-                date_to = query_params.get('date_to')
-                sort_by = query_params.get('sort_by', 'created_at')
+                search_query = (query_params.get('q') or '').strip()
+                sort_by = query_params.get('sort_by', 'rank' if search_query else 'created_at')
                 sort_order = query_params.get('sort_order', 'desc')
                 
-                where_clauses = ['doctor_id = %s']
-                params = [doctor_id]
-                
-                if search_name:
-                    where_clauses.append("LOWER(patient_name) LIKE LOWER(%s)")
-                    params.append(f'%{search_name}%')
-                
-                if search_study_type:
-                    where_clauses.append("study_type = %s")
-                    params.append(search_study_type)
-                
-                if date_from:
-                    where_clauses.append("study_date >= %s")
-                    params.append(date_from)
-                
-                if date_to:
-                    where_clauses.append("study_date <= %s")
-                    params.append(date_to)
+                try:
+                    where_clauses, params = build_list_filters(query_params, doctor_id)
+                    limit, offset = parse_page(query_params, SEARCH_PAGE_SIZE if search_query else None)
+                except ValueError as e:
+                    return {
+                        'statusCode': 400,
+                        'headers': headers,
+                        'body': json.dumps({'error': str(e)}),
+                        'isBase64Encoded': False
+                    }
                 
                 where_sql = "WHERE " + " AND ".join(where_clauses)
                 
                 allowed_sort = ['created_at', 'study_date', 'patient_name', 'study_type']
+                if search_query:
+                    allowed_sort.append('rank')
                 if sort_by not in allowed_sort:
                     sort_by = 'created_at'
                 
                 sort_order = 'DESC' if sort_order.lower() == 'desc' else 'ASC'
                 
-                query = f"""
-                    SELECT id, doctor_id, study_type, patient_name, patient_gender, 
-                           patient_birth_date, patient_age, patient_weight, patient_height, 
-                           patient_bsa, ultrasound_device, study_date, results, results_min_max,
-                           conclusion, signed, created_at 
-                    FROM t_p13795046_functional_diagnosti.protocols 
-                    {where_sql}
-                    ORDER BY {sort_by} {sort_order}
-                """
+                extra_sql = SEARCH_RANK_SQL if search_query else ''
+                branch_params = ([search_query] if search_query else []) + params
+                order_sql = f"ORDER BY {sort_by} {sort_order}, id {sort_order}"
+                query_args = branch_params + branch_params
+                if limit is not None:
+                    # лишняя строка показывает, есть ли следующая страница
+                    order_sql += " LIMIT %s OFFSET %s"
+                    query_args += [limit + 1, offset]
                 
-                cur.execute(query, params)
+                cur.execute(select_protocols_sql(where_sql, order_sql, extra_sql), query_args)
                 rows = cur.fetchall()
+                has_more = limit is not None and len(rows) > limit
+                if has_more:
+                    rows = rows[:limit]
                 
-                protocols = [format_protocol_row(row) for row in rows]
+                protocols = []
+                for row in rows:
+                    protocol = format_listed_row(cur, row)
+                    if search_query:
+                        protocol['rank'] = row[-archiver.ARCHIVE_EXTRA_COLUMNS - 1]
+                    protocols.append(protocol)
+                
+                response_body: Dict[str, Any] = {'protocols': protocols}
+                if search_query:
+                    add_search_snippets(cur, protocols, search_query)
+                if limit is not None:
+                    response_body.update({'limit': limit, 'offset': offset, 'has_more': has_more})
                 
                 return {
                     'statusCode': 200,
                     'headers': headers,
-                    'body': json.dumps({'protocols': protocols}),
+                    'body': json.dumps(response_body),
                     'isBase64Encoded': False
                 }
         
@@ -178,6 +1012,123 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             doctor_id = doctor_row[0]
             body_data = json.loads(event.get('body', '{}'))
             
+            if body_data.get('action') == 'export_protocols':
+                filters = body_data.get('filters') or {}
+                try:
+                    build_list_filters(filters, doctor_id)
+                except ValueError as e:
+                    return {
+                        'statusCode': 400,
+                        'headers': headers,
+                        'body': json.dumps({'error': str(e)}),
+                        'isBase64Encoded': False
+                    }
+                
+                job_id = jobs.enqueue(cur, doctor_id, 'export_protocols', {'filters': filters})
+                conn.commit()
+                
+                return {
+                    'statusCode': 202,
+                    'headers': headers,
+                    'body': json.dumps({'message': 'Выгрузка поставлена в очередь', 'job_id': job_id}),
+                    'isBase64Encoded': False
+                }
+
+            if body_data.get('action') == 'import_protocols':
+                try:
+                    rows, import_errors = prepare_import(body_data.get('protocols'), body_data.get('bsa_formula'))
+                except ValueError as e:
+                    return {
+                        'statusCode': 400,
+                        'headers': headers,
+                        'body': json.dumps({'error': str(e)}),
+                        'isBase64Encoded': False
+                    }
+
+                if import_errors and not body_data.get('skip_invalid'):
+                    return {
+                        'statusCode': 400,
+                        'headers': headers,
+                        'body': json.dumps({
+                            'error': f'Протоколов с ошибками: {len(import_errors)}',
+                            'errors': import_errors
+                        }),
+                        'isBase64Encoded': False
+                    }
+
+                created_ids = insert_imported_protocols(cur, doctor_id, rows) if rows else []
+                conn.commit()
+
+                return {
+                    'statusCode': 201,
+                    'headers': headers,
+                    'body': json.dumps({
+                        'message': f'Импортировано протоколов: {len(created_ids)}',
+                        'ids': created_ids,
+                        'count': len(created_ids),
+                        'errors': import_errors
+                    }),
+                    'isBase64Encoded': False
+                }
+
+            if body_data.get('action') == 'backfill_derived_fields':
+                options = {key: body_data[key] for key in ('bsa_formula', 'bsa') if key in body_data}
+                try:
+                    derived.bsa([], [], options.get('bsa_formula'))
+                except ValueError as e:
+                    return {
+                        'statusCode': 400,
+                        'headers': headers,
+                        'body': json.dumps({'error': str(e)}),
+                        'isBase64Encoded': False
+                    }
+
+                job_id = jobs.enqueue(cur, doctor_id, 'backfill_derived_fields', options)
+                conn.commit()
+
+                return {
+                    'statusCode': 202,
+                    'headers': headers,
+                    'body': json.dumps({'message': 'Пересчёт возраста и BSA поставлен в очередь', 'job_id': job_id}),
+                    'isBase64Encoded': False
+                }
+
+            if body_data.get('action') in BULK_ACTIONS:
+                action = body_data['action']
+                study_type = body_data.get('study_type')
+                try:
+                    if action == 'bulk_set_study_type' and not study_type:
+                        raise ValueError('Не указан новый вид исследования (study_type)')
+                    where_clauses, params = build_bulk_filters(body_data, doctor_id)
+                except ValueError as e:
+                    return {
+                        'statusCode': 400,
+                        'headers': headers,
+                        'body': json.dumps({'error': str(e)}),
+                        'isBase64Encoded': False
+                    }
+
+                affected_ids, has_more = bulk_update_protocols(cur, doctor_id, action, where_clauses, params,
+                                                               study_type)
+                conn.commit()
+
+                messages = {
+                    'bulk_sign': 'Подписано протоколов',
+                    'bulk_delete': 'Удалено протоколов',
+                    'bulk_set_study_type': 'Изменён вид исследования у протоколов',
+                }
+                return {
+                    'statusCode': 200,
+                    'headers': headers,
+                    'body': json.dumps({
+                        'message': f'{messages[action]}: {len(affected_ids)}',
+                        'ids': affected_ids,
+                        'count': len(affected_ids),
+                        'has_more': has_more
+                    }),
+                    'isBase64Encoded': False
+                }
+
             required_fields = ['study_type', 'patient_name', 'patient_gender', 
                              'patient_birth_date', 'study_date', 'results', 'conclusion']
             for field in required_fields:
@@ -189,27 +1140,45 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'isBase64Encoded': False
                     }
             
-            patient_age = body_data.get('patient_age')
-            if patient_age and isinstance(patient_age, dict):
-                patient_age = json.dumps(patient_age)
+            try:
+                patient_age, age_years, age_months, age_days, age_total_days = split_patient_age(
+                    body_data.get('patient_age')
+                )
+            except ValueError as e:
+                return {
+                    'statusCode': 400,
+                    'headers': headers,
+                    'body': json.dumps({'error': str(e)}),
+                    'isBase64Encoded': False
+                }
             
             results_min_max = body_data.get('results_min_max')
             results_min_max_json = json.dumps(results_min_max) if results_min_max else None
             
+            ensure_study_month_partition(cur, body_data['study_date'])
+            patient_id = upsert_patient(cur, doctor_id, body_data['patient_name'],
+                                        body_data['patient_birth_date'], body_data['patient_gender'])
+            
             cur.execute("""
                 INSERT INTO t_p13795046_functional_diagnosti.protocols 
-                (doctor_id, study_type, patient_name, patient_gender, patient_birth_date, 
-                 patient_age, patient_weight, patient_height, patient_bsa, ultrasound_device, 
+                (doctor_id, patient_id, study_type, patient_name, patient_gender, patient_birth_date, 
+                 patient_age, patient_age_years, patient_age_months, patient_age_days,
+                 patient_age_total_days, patient_weight, patient_height, patient_bsa, ultrasound_device, 
                  study_date, results, results_min_max, conclusion, signed, created_at)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
                 RETURNING id
             """, (
                 doctor_id,
+                patient_id,
                 body_data['study_type'],
                 body_data['patient_name'],
                 body_data['patient_gender'],
                 body_data['patient_birth_date'],
                 patient_age,
+                age_years,
+                age_months,
+                age_days,
+                age_total_days,
                 body_data.get('patient_weight'),
                 body_data.get('patient_height'),
                 body_data.get('patient_bsa'),
@@ -240,6 +1209,20 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'isBase64Encoded': False
                 }
             
+            cur.execute(
+                "SELECT id FROM t_p13795046_functional_diagnosti.doctors WHERE email = %s",
+                (auth_token,)
+            )
+            doctor_row = cur.fetchone()
+            if not doctor_row:
+                return {
+                    'statusCode': 401,
+                    'headers': headers,
+                    'body': json.dumps({'error': 'Неверный токен'}),
+                    'isBase64Encoded': False
+                }
+            
+            doctor_id = doctor_row[0]
             body_data = json.loads(event.get('body', '{}'))
             protocol_id = body_data.get('id')
             
@@ -251,11 +1234,17 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'isBase64Encoded': False
                 }
             
-            cur.execute(
-                "SELECT id FROM t_p13795046_functional_diagnosti.protocols WHERE id = %s",
-                (protocol_id,)
-            )
-            if not cur.fetchone():
+            existing_query = """
+                SELECT id, doctor_id, patient_name, patient_birth_date, patient_gender
+                FROM t_p13795046_functional_diagnosti.protocols WHERE id = %s AND doctor_id = %s
+            """
+            cur.execute(existing_query, (protocol_id, doctor_id))
+            existing = cur.fetchone()
+            # Изменяемый архивный протокол возвращается в оперативную таблицу
+            if not existing and archiver.restore_protocol(cur, doctor_id, protocol_id):
+                cur.execute(existing_query, (protocol_id, doctor_id))
+                existing = cur.fetchone()
+            if not existing:
                 return {
                     'statusCode': 404,
                     'headers': headers,
@@ -266,6 +1255,16 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             update_fields = []
             params = []
             
+            if any(field in body_data for field in ('patient_name', 'patient_birth_date', 'patient_gender')):
+                update_fields.append("patient_id = %s")
+                params.append(upsert_patient(
+                    cur,
+                    existing[1],
+                    body_data.get('patient_name', existing[2]),
+                    body_data.get('patient_birth_date', existing[3]),
+                    body_data.get('patient_gender', existing[4])
+                ))
+            
             if 'study_type' in body_data:
                 update_fields.append("study_type = %s")
                 params.append(body_data['study_type'])
@@ -283,11 +1282,20 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 params.append(body_data['patient_birth_date'])
             
             if 'patient_age' in body_data:
-                update_fields.append("patient_age = %s")
-                patient_age_update = body_data['patient_age']
-                if patient_age_update and isinstance(patient_age_update, dict):
-                    patient_age_update = json.dumps(patient_age_update)
-                params.append(patient_age_update)
+                try:
+                    age_columns = split_patient_age(body_data['patient_age'])
+                except ValueError as e:
+                    return {
+                        'statusCode': 400,
+                        'headers': headers,
+                        'body': json.dumps({'error': str(e)}),
+                        'isBase64Encoded': False
+                    }
+                update_fields.append(
+                    "patient_age = %s, patient_age_years = %s, patient_age_months = %s, "
+                    "patient_age_days = %s, patient_age_total_days = %s"
+                )
+                params.extend(age_columns)
             
             if 'patient_weight' in body_data:
                 update_fields.append("patient_weight = %s")
@@ -306,6 +1314,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 params.append(body_data['ultrasound_device'])
             
             if 'study_date' in body_data:
+                ensure_study_month_partition(cur, body_data['study_date'])
                 update_fields.append("study_date = %s")
                 params.append(body_data['study_date'])
             
@@ -334,11 +1343,11 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'isBase64Encoded': False
                 }
             
-            params.append(protocol_id)
+            params.extend([protocol_id, doctor_id])
             query = f"""
                 UPDATE t_p13795046_functional_diagnosti.protocols 
                 SET {', '.join(update_fields)}
-                WHERE id = %s
+                WHERE id = %s AND doctor_id = %s
             """
             
             cur.execute(query, params)
@@ -360,7 +1369,20 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'isBase64Encoded': False
                 }
             
-            query_params = event.get('queryStringParameters', {})
+            cur.execute(
+                "SELECT id FROM t_p13795046_functional_diagnosti.doctors WHERE email = %s",
+                (auth_token,)
+            )
+            doctor_row = cur.fetchone()
+            if not doctor_row:
+                return {
+                    'statusCode': 401,
+                    'headers': headers,
+                    'body': json.dumps({'error': 'Неверный токен'}),
+                    'isBase64Encoded': False
+                }
+            
+            doctor_id = doctor_row[0]
             protocol_id = query_params.get('id')
             
             if not protocol_id:
@@ -372,11 +1394,11 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 }
             
             cur.execute(
-                "DELETE FROM t_p13795046_functional_diagnosti.protocols WHERE id = %s",
-                (protocol_id,)
+                "DELETE FROM t_p13795046_functional_diagnosti.protocols WHERE id = %s AND doctor_id = %s",
+                (protocol_id, doctor_id)
             )
             
-            if cur.rowcount == 0:
+            if cur.rowcount == 0 and not archiver.delete_archived(cur, doctor_id, protocol_id):
                 return {
                     'statusCode': 404,
                     'headers': headers,
@@ -401,6 +1423,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'isBase64Encoded': False
             }
     
+    except resilience.UNAVAILABLE_ERRORS as e:
+        return resilience.unavailable_response(headers, e, policy)
     except Exception as e:
         return {
             'statusCode': 500,
@@ -413,33 +1437,109 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             cur.close()
         if 'conn' in locals():
             conn.close()
+        if 'slot' in locals():
+            slot.release()
 
 
-def format_protocol_row(row: tuple) -> Dict[str, Any]:
-    '''Форматирует строку из БД в словарь протокола'''
-    patient_age = row[6]
-    if patient_age:
-        try:
-            patient_age = json.loads(patient_age)
-        except (json.JSONDecodeError, TypeError):
-            pass
+def format_listed_row(cur, row: tuple) -> Dict[str, Any]:
+    '''Форматирует строку select_protocols_sql: архивные поля распаковываются из payload'''
+    archived = row[-archiver.ARCHIVE_EXTRA_COLUMNS] is not None
+    protocol = models.Protocol.serialize(archiver.unpack_protocol_row(cur, row) if archived else row)
+    protocol['archived'] = archived
+    return protocol
+
+
+@metrics.instrumented('protocols')
+@db.read_your_writes
+async def handler_async(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Режим serve.py --async: карточка протокола (GET ?id=) читается через asyncpg без потока на запрос,
+    сам протокол и его статусы норм — параллельно; остальные запросы — синхронным handler в пуле потоков
+    '''
+    headers_dict = event.get('headers') or {}
+    auth_token = headers_dict.get('x-auth-token') or headers_dict.get('X-Auth-Token')
+    query_params = event.get('queryStringParameters') or {}
+    protocol_id = query_params.get('id') or ''
+    if event.get('httpMethod') != 'GET' or not auth_token or not protocol_id.isdigit() \
+            or query_params.get('patient_id') or query_params.get('job_id'):
+        return await adb.run_sync(handler, event, context)
     
-    return {
-        'id': row[0],
-        'doctor_id': row[1],
-        'study_type': row[2],
-        'patient_name': row[3],
-        'patient_gender': row[4],
-        'patient_birth_date': row[5].isoformat() if row[5] else None,
-        'patient_age': patient_age,
-        'patient_weight': float(row[7]) if row[7] else None,
-        'patient_height': float(row[8]) if row[8] else None,
-        'patient_bsa': float(row[9]) if row[9] else None,
-        'ultrasound_device': row[10],
-        'study_date': row[11].isoformat() if row[11] else None,
-        'results': row[12],
-        'results_min_max': row[13],
-        'conclusion': row[14],
-        'signed': row[15],
-        'created_at': row[16].isoformat() if row[16] else None
-    }
\ No newline at end of file
+    headers = {
+        'Content-Type': 'application/json',
+        'Access-Control-Allow-Origin': '*'
+    }
+    policy = resilience.READ
+    
+    async def fetch_protocol() -> Optional[Dict[str, Any]]:
+        async with adb.connect(readonly=True, sticky_key=auth_token,
+                               statement_timeout_ms=policy.statement_timeout_ms) as conn:
+            row = await conn.fetchrow(select_protocols_sql("WHERE id = %s AND doctor_id = %s"),
+                                      int(protocol_id), doctor_id, int(protocol_id), doctor_id)
+            if row and archiver.needs_dictionary(*row[-archiver.ARCHIVE_EXTRA_COLUMNS:-1]):
+                dictionary_id = row[-2]
+                archiver.store_dictionary(dictionary_id, await conn.fetchval(archiver.DICTIONARY_SQL, dictionary_id))
+        # Словарь уже в кэше процесса: курсор для распаковки не нужен
+        return format_listed_row(None, row) if row else None
+    
+    async def fetch_norm_status() -> Dict[str, Any]:
+        async with adb.connect(readonly=True, sticky_key=auth_token,
+                               statement_timeout_ms=policy.statement_timeout_ms) as conn:
+            return format_norm_status(await conn.fetch(PROTOCOL_NORM_STATUS_SQL, int(protocol_id)))
+    
+    try:
+        slot = resilience.admit(policy)
+        async with adb.connect(readonly=True, sticky_key=auth_token,
+                               statement_timeout_ms=policy.statement_timeout_ms) as conn:
+            doctor_id = await conn.fetchval(
+                "SELECT id FROM t_p13795046_functional_diagnosti.doctors WHERE email = %s", auth_token
+            )
+            if doctor_id is None:
+                return {
+                    'statusCode': 401,
+                    'headers': headers,
+                    'body': json.dumps({'error': 'Неверный токен'}),
+                    'isBase64Encoded': False
+                }
+            version = await conn.fetchrow(PROTOCOL_VERSION_SQL, int(protocol_id), doctor_id,
+                                          int(protocol_id), doctor_id, int(protocol_id))
+        
+        if not version:
+            return {
+                'statusCode': 404,
+                'headers': headers,
+                'body': json.dumps({'error': 'Протокол не найден'}),
+                'isBase64Encoded': False
+            }
+        tag = http_cache.etag(protocol_id, *version)
+        cache_control = http_cache.SIGNED_PROTOCOL if version[1] else http_cache.REVALIDATE
+        if http_cache.if_none_match(event, tag):
+            return http_cache.not_modified(headers, tag, cache_control)
+        
+        protocol, norm_status = await asyncio.gather(fetch_protocol(), fetch_norm_status())
+        if protocol is None:
+            return {
+                'statusCode': 404,
+                'headers': headers,
+                'body': json.dumps({'error': 'Протокол не найден'}),
+                'isBase64Encoded': False
+            }
+        protocol['norm_status'] = norm_status
+        return {
+            'statusCode': 200,
+            'headers': http_cache.cache_headers(headers, tag, cache_control),
+            'body': json.dumps({'protocol': protocol}),
+            'isBase64Encoded': False
+        }
+    
+    except resilience.UNAVAILABLE_ERRORS as e:
+        return resilience.unavailable_response(headers, e)
+    except Exception as e:
+        return {
+            'statusCode': 500,
+            'headers': headers,
+            'body': json.dumps({'error': str(e)}),
+            'isBase64Encoded': False
+        }
+    finally:
+        if 'slot' in locals():
+            slot.release()
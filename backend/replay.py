@@ -0,0 +1,254 @@
+'''
+Воспроизведение записанного трафика (shared/capture.py) для поиска регрессий производительности.
+
+run  — отправляет записанные запросы в handler функций этой сборки в исходном порядке и темпе
+       (--speed 10 — в 10 раз быстрее, --speed 0 — без пауз, параллельность ограничена --concurrency)
+       на локальной копии БД (DATABASE_URL) и пишет результат каждого запроса: статус, длительность,
+       число запросов к БД, задержку отправки относительно расписания.
+diff — сравнивает распределения длительностей двух прогонов по функции, методу и действию
+       и завершается с кодом 1, если p95 какой-либо группы выросла больше --threshold процентов.
+
+Токены записи — псевдонимы: с солью записи (CAPTURE_SALT или .salt в каталоге записи) они сопоставляются
+врачам копии БД точно, остальные — по рангу: самые активные в записи врачи получают врачей копии
+с наибольшим числом протоколов. Запись изменяет БД: для сравнения сборок восстанавливайте копию
+перед каждым прогоном или воспроизводите только чтения (--read-only).
+
+Запуск: DATABASE_URL=... python backend/replay.py run /var/capture --speed 5 --out before.jsonl
+        DATABASE_URL=... python backend/replay.py run /var/capture --speed 5 --out after.jsonl
+        python backend/replay.py diff before.jsonl after.jsonl --threshold 20
+'''
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import psycopg2
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BACKEND_DIR)
+
+from shared import capture, db, metrics  # noqa: E402
+from serve import load_handlers  # noqa: E402
+
+MIN_GROUP_SIZE = 20
+
+
+def read_salt(paths: List[str]) -> Optional[bytes]:
+    '''Соль записи: CAPTURE_SALT или .salt из каталога записи; None — сопоставление только по рангу'''
+    if os.environ.get('CAPTURE_SALT'):
+        return os.environ['CAPTURE_SALT'].encode('utf-8')
+    for path in paths:
+        salt_path = os.path.join(path if os.path.isdir(path) else os.path.dirname(path), '.salt')
+        if os.path.exists(salt_path):
+            with open(salt_path, 'rb') as f:
+                return f.read().strip()
+    return None
+
+
+def map_tokens(entries: List[Dict[str, Any]], salt: Optional[bytes]) -> Dict[str, str]:
+    '''Псевдоним токена -> email врача копии БД'''
+    activity = Counter(entry['ev']['headers'].get('X-Auth-Token') for entry in entries)
+    activity.pop(None, None)
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT d.email, count(p.id) AS protocols
+            FROM t_p13795046_functional_diagnosti.doctors d
+            LEFT JOIN t_p13795046_functional_diagnosti.protocols p ON p.doctor_id = d.id
+            GROUP BY d.id, d.email
+            ORDER BY protocols DESC, d.id
+        """)
+        doctors = [row[0] for row in cur.fetchall()]
+    finally:
+        conn.close()
+    if not doctors:
+        raise SystemExit('В копии БД нет врачей')
+
+    mapping: Dict[str, str] = {}
+    if salt is not None:
+        by_pseudonym = {capture.pseudonym_email(salt, email): email for email in doctors}
+        mapping = {token: by_pseudonym[token] for token in activity if token in by_pseudonym}
+    used = set(mapping.values())
+    free = [email for email in doctors if email not in used] or doctors
+    unmatched = [token for token, _ in activity.most_common() if token not in mapping]
+    for rank, token in enumerate(unmatched):
+        mapping[token] = free[rank % len(free)]
+    return mapping
+
+
+def build_event(entry: Dict[str, Any], tokens: Dict[str, str]) -> Dict[str, Any]:
+    captured = entry['ev']
+    headers = dict(captured['headers'])
+    if 'X-Auth-Token' in headers:
+        headers['X-Auth-Token'] = tokens[headers['X-Auth-Token']]
+    event = {
+        'httpMethod': captured['httpMethod'],
+        'headers': headers,
+        'queryStringParameters': dict(captured['queryStringParameters']),
+        'requestContext': {'identity': {'sourceIp': '127.0.0.1'}},
+        'isBase64Encoded': False,
+    }
+    if 'body' in captured:
+        event['body'] = json.dumps(captured['body'], ensure_ascii=False)
+    return event
+
+
+def run(args: argparse.Namespace) -> None:
+    # номер запроса в записи: по нему diff сопоставляет прогоны с разными фильтрами
+    entries = [dict(entry, i=index) for index, entry in enumerate(capture.read(args.paths))]
+    if args.functions:
+        entries = [entry for entry in entries if entry['fn'] in args.functions]
+    if args.read_only:
+        entries = [entry for entry in entries if entry['ev']['httpMethod'] == 'GET']
+    entries = entries[:args.limit] if args.limit else entries
+    if not entries:
+        raise SystemExit('Нет записанных запросов')
+
+    tokens = map_tokens(entries, read_salt(args.paths))
+    handlers = load_handlers(BACKEND_DIR)
+    db.init_pool(1, args.concurrency)
+
+    # instrumented() сообщает о запросе в потоке handler'а: результат забирает тот же поток
+    local = threading.local()
+    capture.set_sink(lambda fn, event, status, seconds, queries: setattr(local, 'result', (status, seconds, queries)))
+    results: List[Optional[Dict[str, Any]]] = [None] * len(entries)
+
+    def replay_one(index: int, entry: Dict[str, Any], due: float) -> None:
+        event = build_event(entry, tokens)
+        local.result = (500, 0.0, 0)
+        lag = time.monotonic() - due
+        try:
+            handlers[entry['fn']](event, None)
+        except Exception:
+            pass
+        status, seconds, queries = local.result
+        results[index] = {
+            'i': entry['i'], 'fn': entry['fn'], 'm': event['httpMethod'], 'a': metrics.request_action(event),
+            'st': status, 'ms': round(seconds * 1000, 3), 'q': queries,
+            'cst': entry['st'], 'cms': entry['ms'], 'cq': entry['q'], 'lag': round(max(lag, 0) * 1000, 3),
+        }
+
+    first = entries[0]['t']
+    started = time.monotonic()
+    try:
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            for index, entry in enumerate(entries):
+                due = started + ((entry['t'] - first) / args.speed if args.speed > 0 else 0)
+                delay = due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(replay_one, index, entry, due)
+    finally:
+        capture.set_sink(None)
+        db.close_pool()
+    elapsed = time.monotonic() - started
+
+    with open(args.out, 'w', encoding='utf-8') as f:
+        for result in results:
+            f.write(json.dumps(result, ensure_ascii=False) + '\n')
+
+    changed = sum(result['st'] != result['cst'] for result in results)
+    lags = sorted(result['lag'] for result in results)
+    print(f'Запросов: {len(results)} за {elapsed:.1f} с (запись: {entries[-1]["t"] - first:.1f} с), '
+          f'врачей: {len(tokens)}, статус отличается от записи: {changed}, '
+          f'p99 задержки отправки: {percentile(lags, 99):.1f} мс')
+    print_table(group(results, captured=True), group(results), 'запись', 'прогон')
+
+
+def percentile(values: List[float], p: float) -> float:
+    '''Перцентиль отсортированного списка (ближайший ранг)'''
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+def group(results: List[Dict[str, Any]], captured: bool = False) -> Dict[Tuple[str, str, str], Dict[str, float]]:
+    '''Длительности и число запросов к БД по (функция, метод, действие)'''
+    samples: Dict[Tuple[str, str, str], List[Dict[str, Any]]] = defaultdict(list)
+    for result in results:
+        samples[(result['fn'], result['m'], result['a'])].append(result)
+    stats = {}
+    for key, items in samples.items():
+        durations = sorted(item['cms' if captured else 'ms'] for item in items)
+        stats[key] = {
+            'n': len(items),
+            'p50': percentile(durations, 50),
+            'p95': percentile(durations, 95),
+            'p99': percentile(durations, 99),
+            'q': sum(item['cq' if captured else 'q'] for item in items) / len(items),
+        }
+    return stats
+
+
+def print_table(base: Dict[tuple, Dict[str, float]], candidate: Dict[tuple, Dict[str, float]],
+                base_name: str, candidate_name: str) -> List[tuple]:
+    '''Печатает сравнение групп; возвращает группы с изменением p95 в процентах'''
+    print(f"\n{'функция метод действие':<44}{'n':>7}{'p50, мс':>18}{'p95, мс':>18}{'p99, мс':>18}"
+          f"{'запросов к БД':>16}{'p95':>8}")
+    print(f"{'':<51}{(base_name + ' -> ' + candidate_name):>18}")
+    changes = []
+    for key in sorted(set(base) | set(candidate), key=lambda k: -candidate.get(k, base.get(k))['n']):
+        old, new = base.get(key), candidate.get(key)
+        if old is None or new is None:
+            print(f"{' '.join(key):<44}{(new or old)['n']:>7}  только: {candidate_name if old is None else base_name}")
+            continue
+        change = (new['p95'] - old['p95']) / old['p95'] * 100 if old['p95'] else 0.0
+        changes.append((key, new['n'], change))
+        cells = ''.join(f"{old[p]:>8.1f} -> {new[p]:<6.1f}" for p in ('p50', 'p95', 'p99'))
+        print(f"{' '.join(key):<44}{new['n']:>7}{cells}{old['q']:>6.1f} -> {new['q']:<6.1f}{change:>+7.0f}%")
+    return changes
+
+
+def read_results(path: str) -> List[Dict[str, Any]]:
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def diff(args: argparse.Namespace) -> None:
+    base, candidate = read_results(args.base), read_results(args.candidate)
+    statuses = {result['i']: result['st'] for result in base}
+    changed = sum(result['i'] in statuses and statuses[result['i']] != result['st'] for result in candidate)
+    print(f'Запросов: {len(base)} -> {len(candidate)}, статус отличается: {changed}')
+    changes = print_table(group(base), group(candidate), 'база', 'новая')
+    regressions = [(key, change) for key, n, change in changes
+                   if n >= args.min_count and change > args.threshold]
+    for key, change in regressions:
+        print(f"Регрессия: {' '.join(key)} p95 {change:+.0f}%")
+    if regressions:
+        sys.exit(1)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Воспроизведение записанного трафика и сравнение сборок')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='воспроизвести запись против handler этой сборки')
+    run_parser.add_argument('paths', nargs='+', help='каталоги или файлы записи (CAPTURE_DIR)')
+    run_parser.add_argument('--out', required=True, help='файл результатов (JSON Lines)')
+    run_parser.add_argument('--speed', type=float, default=1.0, help='ускорение темпа записи; 0 — без пауз')
+    run_parser.add_argument('--concurrency', type=int, default=16, help='одновременных запросов')
+    run_parser.add_argument('--functions', nargs='*', help='только эти функции')
+    run_parser.add_argument('--read-only', action='store_true', help='только GET-запросы')
+    run_parser.add_argument('--limit', type=int, help='первые N запросов записи')
+    run_parser.set_defaults(func=run)
+
+    diff_parser = commands.add_parser('diff', help='сравнить результаты двух прогонов')
+    diff_parser.add_argument('base')
+    diff_parser.add_argument('candidate')
+    diff_parser.add_argument('--threshold', type=float, default=20.0, help='допустимый рост p95, %%')
+    diff_parser.add_argument('--min-count', type=int, default=MIN_GROUP_SIZE,
+                             help='группы с меньшим числом запросов не считаются регрессией')
+    diff_parser.set_defaults(func=diff)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
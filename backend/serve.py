@@ -0,0 +1,474 @@
+'''
+Self-hosted режим backend: один HTTP-сервер вместо трёх облачных функций.
+
+Маршруты строятся по именам из func2url.json: запрос /<имя функции>/... передаётся в handler
+из backend/<имя функции>/index.py в виде event-словаря облачной платформы.
+Модель pre-fork: главный процесс открывает сокет и запускает --workers рабочих процессов,
+каждый обслуживает до --threads запросов одновременно и держит собственный пул соединений с БД.
+С --async рабочий процесс обслуживает запросы в цикле asyncio (shared/adb.py, asyncpg): функции
+с handler_async выполняют частые чтения без потока на запрос, остальные запросы идут в пул из --threads потоков.
+При DATABASE_SHARDS (shared/shards.py) handler_async не используются: пул asyncpg подключён только к каталогу.
+
+GET /metrics — метрики всех рабочих процессов в формате Prometheus (shared/metrics.py): каждый процесс
+раз в METRICS_FLUSH_SECONDS пишет снимок в --metrics-dir, ответ суммирует их со свежим снимком ответившего процесса.
+С CAPTURE_DIR процессы записывают запросы для backend/replay.py (shared/capture.py).
+
+Сигналы главному процессу:
+    SIGHUP          — плавная перезагрузка: новые процессы загружают код заново, старые дообслуживают запросы
+    SIGTERM/SIGINT  — плавная остановка
+
+Запуск: DATABASE_URL=... python backend/serve.py --port 8000 --workers 4 --threads 16
+        DATABASE_URL=... python backend/serve.py --port 8000 --workers 4 --async --pool-size 32
+'''
+import argparse
+import asyncio
+import base64
+import importlib.util
+import json
+import os
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import parse_qsl, urlsplit
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BACKEND_DIR)
+
+from shared import adb, capture, db, metrics, shards  # noqa: E402
+
+TEXT_CONTENT_TYPES = ('application/json', 'text/', 'application/x-www-form-urlencoded')
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def load_modules(backend_dir: str) -> Dict[str, Any]:
+    '''Импортирует index.py каждой функции из func2url.json'''
+    with open(os.path.join(backend_dir, 'func2url.json')) as f:
+        names = list(json.load(f).keys())
+
+    modules: Dict[str, Any] = {}
+    for name in names:
+        function_dir = os.path.join(backend_dir, name)
+        if function_dir not in sys.path:
+            sys.path.insert(1, function_dir)
+        module_name = 'function_' + name.replace('-', '_')
+        spec = importlib.util.spec_from_file_location(module_name, os.path.join(function_dir, 'index.py'))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        spec.loader.exec_module(module)
+        modules[name] = module
+    return modules
+
+
+def load_handlers(backend_dir: str) -> Dict[str, Callable]:
+    '''handler каждой функции из func2url.json'''
+    return {name: module.handler for name, module in load_modules(backend_dir).items()}
+
+
+def load_async_handlers(backend_dir: str) -> Dict[str, Callable]:
+    '''Корутины для --async: handler_async функции или её синхронный handler в пуле потоков'''
+    handlers: Dict[str, Callable] = {}
+    for name, module in load_modules(backend_dir).items():
+        handler_async = getattr(module, 'handler_async', None)
+        if handler_async is None or shards.enabled():
+            handler_async = (lambda handler: lambda event, context: adb.run_sync(handler, event, context))(module.handler)
+        handlers[name] = handler_async
+    return handlers
+
+
+def build_event(method: str, raw_path: str, headers: List[tuple], body: bytes, client_ip: str) -> tuple:
+    '''Переводит HTTP-запрос в (имя функции, event) в формате облачной платформы'''
+    parts = urlsplit(raw_path)
+    segments = [s for s in parts.path.split('/') if s]
+    function_name = segments[0] if segments else ''
+    path = '/' + '/'.join(segments[1:])
+
+    event_headers: Dict[str, str] = {}
+    for key, value in headers:
+        event_headers[key] = value
+        event_headers[key.lower()] = value
+
+    content_type = event_headers.get('content-type', '')
+    is_text = not body or any(content_type.startswith(t) for t in TEXT_CONTENT_TYPES)
+    if is_text:
+        try:
+            event_body = body.decode('utf-8')
+            is_base64 = False
+        except UnicodeDecodeError:
+            is_text = False
+    if not is_text:
+        event_body = base64.b64encode(body).decode('ascii')
+        is_base64 = True
+
+    event = {
+        'httpMethod': method,
+        'path': path,
+        'headers': event_headers,
+        'queryStringParameters': dict(parse_qsl(parts.query, keep_blank_values=True)),
+        'body': event_body,
+        'isBase64Encoded': is_base64,
+        'requestContext': {
+            'requestId': uuid.uuid4().hex,
+            'identity': {'sourceIp': client_ip},
+            'httpMethod': method,
+        },
+    }
+    return function_name, event
+
+
+def make_context(function_name: str, event: Dict[str, Any]) -> SimpleNamespace:
+    return SimpleNamespace(
+        request_id=event['requestContext']['requestId'],
+        function_name=function_name,
+        function_version='self-hosted',
+        memory_limit_in_mb=None,
+    )
+
+
+def response_payload(response: Dict[str, Any]) -> bytes:
+    '''Тело ответа handler в байтах'''
+    response_body = response.get('body') or ''
+    if response.get('isBase64Encoded'):
+        return base64.b64decode(response_body)
+    if isinstance(response_body, bytes):
+        return response_body
+    return str(response_body).encode('utf-8')
+
+
+NOT_FOUND_PAYLOAD = json.dumps({'error': 'Функция не найдена'}).encode('utf-8')
+INTERNAL_ERROR_PAYLOAD = json.dumps({'error': 'Внутренняя ошибка сервера'}).encode('utf-8')
+
+
+class FunctionRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'functional-diagnostics'
+    # Простаивающее keep-alive соединение не должно надолго занимать поток процесса
+    timeout = 5
+
+    def _dispatch(self) -> None:
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+
+        if self.path in ('/healthz', '/healthz/'):
+            self._send(200, {'Content-Type': 'text/plain'}, b'ok')
+            return
+        if self.path in ('/metrics', '/metrics/'):
+            payload = metrics.collect_workers(self.server.metrics_dir).encode('utf-8')
+            self._send(200, {'Content-Type': METRICS_CONTENT_TYPE}, payload)
+            return
+
+        function_name, event = build_event(
+            self.command, self.path, list(self.headers.items()), body, self.client_address[0]
+        )
+        handler = self.server.handlers.get(function_name)
+        if handler is None:
+            self._send(404, {'Content-Type': 'application/json'}, NOT_FOUND_PAYLOAD)
+            return
+
+        try:
+            response = handler(event, make_context(function_name, event))
+        except Exception as e:
+            self.log_error('Необработанная ошибка в %s: %r', function_name, e)
+            self._send(500, {'Content-Type': 'application/json'}, INTERNAL_ERROR_PAYLOAD)
+            return
+
+        self._send(int(response.get('statusCode', 200)), response.get('headers') or {}, response_payload(response))
+
+    def _send(self, status: int, headers: Dict[str, Any], payload: bytes) -> None:
+        self.send_response(status)
+        for key, value in headers.items():
+            if key.lower() != 'content-length':
+                self.send_header(key, str(value))
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(payload)
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_PATCH = do_OPTIONS = do_HEAD = _dispatch
+
+    def log_message(self, format: str, *args: Any) -> None:
+        if self.server.access_log:
+            super().log_message(format, *args)
+
+
+class WorkerHTTPServer(HTTPServer):
+    '''HTTP-сервер рабочего процесса на унаследованном сокете с ограниченным пулом потоков'''
+
+    def __init__(self, listen_socket: socket.socket, handlers: Dict[str, Callable],
+                 threads: int, access_log: bool, metrics_dir: str):
+        super().__init__(listen_socket.getsockname()[:2], FunctionRequestHandler, bind_and_activate=False)
+        self.socket.close()
+        self.socket = listen_socket
+        self.handlers = handlers
+        self.access_log = access_log
+        self.metrics_dir = metrics_dir
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='request')
+
+    def process_request(self, request, client_address) -> None:
+        self.executor.submit(self._process_request_thread, request, client_address)
+
+    def _process_request_thread(self, request, client_address) -> None:
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self) -> None:
+        self.executor.shutdown(wait=True)
+
+
+def run_worker(listen_socket: socket.socket, args: argparse.Namespace) -> None:
+    '''Тело рабочего процесса: пул соединений, загрузка функций, обслуживание до SIGTERM'''
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    db.init_pool(1, args.pool_size or args.threads)
+    server = WorkerHTTPServer(listen_socket, load_handlers(BACKEND_DIR), args.threads, args.access_log,
+                              args.metrics_dir)
+    metrics_sink = metrics.start_worker_sink(args.metrics_dir)
+
+    def stop(signum, frame):
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        server.serve_forever(poll_interval=0.5)
+    finally:
+        server.server_close()
+        metrics_sink.set()
+        capture.flush()
+        db.close_pool()
+
+
+class AsyncWorker:
+    '''Рабочий процесс --async: HTTP/1.1 с keep-alive поверх asyncio на унаследованном сокете'''
+
+    IDLE_TIMEOUT = 5.0
+    MAX_HEADER_BYTES = 65536
+
+    def __init__(self, listen_socket: socket.socket, handlers: Dict[str, Callable], access_log: bool,
+                 metrics_dir: str):
+        self.listen_socket = listen_socket
+        self.handlers = handlers
+        self.access_log = access_log
+        self.metrics_dir = metrics_dir
+        self.connections: set = set()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        self.connections.add(task)
+        client_ip = (writer.get_extra_info('peername') or ('',))[0]
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.IDLE_TIMEOUT)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                        ConnectionError):
+                    return
+                lines = head.decode('latin-1').split('\r\n')
+                try:
+                    method, raw_path, version = lines[0].split(' ', 2)
+                except ValueError:
+                    return
+                headers = [tuple(part.strip() for part in line.split(':', 1)) for line in lines[1:] if ':' in line]
+                header_map = {key.lower(): value for key, value in headers}
+                length = int(header_map.get('content-length') or 0)
+                body = await reader.readexactly(length) if length else b''
+
+                status, response_headers, payload = await self.dispatch(method, raw_path, headers, body, client_ip)
+                keep_alive = version == 'HTTP/1.1' and header_map.get('connection', '').lower() != 'close'
+                writer.write(self.encode(status, response_headers, payload, method == 'HEAD', keep_alive))
+                await writer.drain()
+                if self.access_log:
+                    print(f'{client_ip} "{method} {raw_path}" {status}', file=sys.stderr)
+                if not keep_alive:
+                    return
+        except ConnectionError:
+            pass
+        finally:
+            self.connections.discard(task)
+            writer.close()
+
+    async def dispatch(self, method: str, raw_path: str, headers: List[tuple], body: bytes, client_ip: str) -> tuple:
+        path = urlsplit(raw_path).path
+        if path in ('/healthz', '/healthz/'):
+            return 200, {'Content-Type': 'text/plain'}, b'ok'
+        if path in ('/metrics', '/metrics/'):
+            text = await adb.run_sync(metrics.collect_workers, self.metrics_dir)
+            return 200, {'Content-Type': METRICS_CONTENT_TYPE}, text.encode('utf-8')
+        function_name, event = build_event(method, raw_path, headers, body, client_ip)
+        handler = self.handlers.get(function_name)
+        if handler is None:
+            return 404, {'Content-Type': 'application/json'}, NOT_FOUND_PAYLOAD
+        try:
+            response = await handler(event, make_context(function_name, event))
+        except Exception as e:
+            print(f'Необработанная ошибка в {function_name}: {e!r}', file=sys.stderr)
+            return 500, {'Content-Type': 'application/json'}, INTERNAL_ERROR_PAYLOAD
+        return int(response.get('statusCode', 200)), response.get('headers') or {}, response_payload(response)
+
+    @staticmethod
+    def encode(status: int, headers: Dict[str, Any], payload: bytes, head: bool, keep_alive: bool) -> bytes:
+        reason = BaseHTTPRequestHandler.responses.get(status, ('',))[0]
+        lines = [f'HTTP/1.1 {status} {reason}', f'Server: {FunctionRequestHandler.server_version}']
+        lines += [f'{key}: {value}' for key, value in headers.items() if key.lower() != 'content-length']
+        lines.append(f'Content-Length: {len(payload)}')
+        if not keep_alive:
+            lines.append('Connection: close')
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1', 'replace') + (b'' if head else payload)
+
+    async def serve(self, pool_size: int, threads: int) -> None:
+        await adb.init_pool(1, pool_size, threads)
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, stopped.set)
+        server = await asyncio.start_server(self.handle_connection, sock=self.listen_socket,
+                                            limit=self.MAX_HEADER_BYTES)
+        try:
+            await stopped.wait()
+        finally:
+            server.close()
+            # Соединения дообслуживают текущий запрос; простаивающие закрываются по IDLE_TIMEOUT
+            if self.connections:
+                await asyncio.wait(self.connections, timeout=self.IDLE_TIMEOUT * 2)
+            await adb.close_pool()
+
+
+def run_async_worker(listen_socket: socket.socket, args: argparse.Namespace) -> None:
+    '''Тело рабочего процесса --async'''
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # Синхронные handler в пуле потоков пользуются обычным пулом shared/db.py
+    db.init_pool(1, args.threads)
+    metrics_sink = metrics.start_worker_sink(args.metrics_dir)
+    try:
+        worker = AsyncWorker(listen_socket, load_async_handlers(BACKEND_DIR), args.access_log, args.metrics_dir)
+        asyncio.run(worker.serve(args.pool_size or 4 * args.threads, args.threads))
+    finally:
+        metrics_sink.set()
+        capture.flush()
+        db.close_pool()
+
+
+class Master:
+    '''Главный процесс: запуск, перезапуск упавших и плавная замена рабочих процессов'''
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((args.host, args.port))
+        self.socket.listen(args.backlog)
+        # Снимки метрик прошлого запуска не должны попасть в сумму
+        os.makedirs(args.metrics_dir, exist_ok=True)
+        for name in os.listdir(args.metrics_dir):
+            if name.startswith('worker-'):
+                os.remove(os.path.join(args.metrics_dir, name))
+        self.workers: Dict[int, int] = {}
+        self.generation = 0
+        self.stopping = False
+        self.reload_requested = False
+
+    def spawn(self) -> None:
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                (run_async_worker if self.args.use_async else run_worker)(self.socket, self.args)
+            except Exception as e:
+                print(f'[worker {os.getpid()}] ошибка: {e!r}', file=sys.stderr)
+                code = 1
+            finally:
+                os._exit(code)
+        self.workers[pid] = self.generation
+
+    def reload(self) -> None:
+        old = [pid for pid, generation in self.workers.items() if generation == self.generation]
+        self.generation += 1
+        for _ in range(self.args.workers):
+            self.spawn()
+        for pid in old:
+            self._signal(pid, signal.SIGTERM)
+
+    def _signal(self, pid: int, signum: int) -> None:
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            self.workers.pop(pid, None)
+
+    def run(self) -> None:
+        signal.signal(signal.SIGHUP, lambda s, f: setattr(self, 'reload_requested', True))
+        signal.signal(signal.SIGTERM, lambda s, f: setattr(self, 'stopping', True))
+        signal.signal(signal.SIGINT, lambda s, f: setattr(self, 'stopping', True))
+
+        for _ in range(self.args.workers):
+            self.spawn()
+        print(f'Слушаю {self.args.host}:{self.args.port}, процессов: {self.args.workers}, '
+              f'потоков на процесс: {self.args.threads}{", asyncio" if self.args.use_async else ""}', file=sys.stderr)
+
+        while not self.stopping:
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+            self._reap(respawn=True)
+            time.sleep(0.2)
+
+        for pid in list(self.workers):
+            self._signal(pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.args.graceful_timeout
+        while self.workers and time.monotonic() < deadline:
+            self._reap(respawn=False)
+            time.sleep(0.1)
+        for pid in list(self.workers):
+            self._signal(pid, signal.SIGKILL)
+        self.socket.close()
+
+    def _reap(self, respawn: bool) -> None:
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            generation = self.workers.pop(pid, None)
+            if respawn and generation == self.generation and not self.stopping:
+                print(f'[master] процесс {pid} завершился ({status}), перезапуск', file=sys.stderr)
+                self.spawn()
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Self-hosted сервер функций backend')
+    parser.add_argument('--host', default=os.environ.get('HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', '8000')))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WEB_WORKERS', os.cpu_count() or 1)))
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('WEB_THREADS', '8')),
+                        help='одновременных запросов на процесс')
+    parser.add_argument('--pool-size', type=int, default=int(os.environ.get('DB_POOL_SIZE', '0')),
+                        help='соединений с БД на процесс (по умолчанию --threads, с --async — 4 x --threads)')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        default=os.environ.get('WEB_ASYNC') == '1',
+                        help='цикл asyncio и asyncpg вместо потока на запрос')
+    parser.add_argument('--metrics-dir', default=os.environ.get('METRICS_DIR'),
+                        help='каталог снимков метрик рабочих процессов (по умолчанию во временном каталоге)')
+    parser.add_argument('--backlog', type=int, default=1024)
+    parser.add_argument('--graceful-timeout', type=float, default=30.0)
+    parser.add_argument('--access-log', action='store_true')
+    args = parser.parse_args(argv)
+    if not args.metrics_dir:
+        args.metrics_dir = os.path.join(tempfile.gettempdir(), f'fd-metrics-{args.port}')
+    return args
+
+
+if __name__ == '__main__':
+    Master(parse_args()).run()
@@ -0,0 +1 @@
+'''Общий код функций backend: подключения к БД и инфраструктура self-hosted режима'''
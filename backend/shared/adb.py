@@ -0,0 +1,193 @@
+'''
+Асинхронные подключения к PostgreSQL (asyncpg) для режима serve.py --async.
+
+Рабочий процесс в этом режиме обслуживает запросы в одном цикле asyncio: пока запрос ждёт ответа БД,
+процесс принимает и выполняет другие. Функция может объявить в index.py корутину handler_async(event, context)
+для частых чтений; остальные запросы она передаёт синхронному handler через run_sync() — он выполняется
+в пуле из --threads потоков с обычными соединениями shared/db.py.
+
+Правила те же, что в shared/db.py: предохранитель db_breaker, ServiceUnavailable (503) при недоступной БД,
+таймаут запросов statement_timeout_ms, чтения с реплики DATABASE_REPLICA_URL с учётом sticky_key
+и отставания. Запросы пишутся с плейсхолдерами %s, как для psycopg2, — они переводятся в $1, $2, ...
+Значения передаются типами столбцов (int для integer и т.п.): asyncpg не приводит строки неявно.
+'''
+import asyncio
+import contextvars
+import functools
+import json
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+from shared import db, metrics
+from shared.resilience import ServiceUnavailable, db_breaker
+
+_pool = None
+_replica_pool = None
+_executor: Optional[ThreadPoolExecutor] = None
+_replica_state = {'checked_at': 0.0, 'healthy': True}
+
+CONNECTION_ERRORS = (OSError, asyncio.TimeoutError) + (
+    (asyncpg.PostgresConnectionError, asyncpg.CannotConnectNowError) if asyncpg else ()
+)
+
+_PLACEHOLDER = re.compile(r'%%|%s')
+
+
+@lru_cache(maxsize=1024)
+def convert(query: str) -> str:
+    '''Плейсхолдеры psycopg2 (%s, %%) -> asyncpg ($1, $2, ..., %)'''
+    counter = iter(range(1, 10_000))
+    return _PLACEHOLDER.sub(lambda m: '%' if m.group(0) == '%%' else f'${next(counter)}', query)
+
+
+async def _init_connection(conn) -> None:
+    for type_name in ('json', 'jsonb'):
+        await conn.set_type_codec(type_name, encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+
+
+async def init_pool(min_size: int, max_size: int, sync_threads: int, dsn: Optional[str] = None) -> None:
+    '''Создаёт пулы asyncpg и пул потоков для синхронных handler текущего процесса'''
+    global _pool, _replica_pool, _executor
+    if asyncpg is None:
+        raise RuntimeError('Для режима --async требуется пакет asyncpg')
+    options = dict(min_size=min_size, max_size=max_size, init=_init_connection, timeout=db.DB_CONNECT_TIMEOUT,
+                   server_settings={'statement_timeout': str(db.DB_STATEMENT_TIMEOUT_MS)})
+    _pool = await asyncpg.create_pool(dsn or os.environ['DATABASE_URL'], **options)
+    replica_dsn = os.environ.get('DATABASE_REPLICA_URL')
+    _replica_pool = await asyncpg.create_pool(replica_dsn, **dict(options, min_size=0)) if replica_dsn else None
+    _executor = ThreadPoolExecutor(max_workers=sync_threads, thread_name_prefix='request')
+
+
+async def close_pool() -> None:
+    global _pool, _replica_pool, _executor
+    for pool in (_pool, _replica_pool):
+        if pool is not None:
+            await pool.close()
+    _pool = _replica_pool = None
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+async def run_sync(func: Callable, *args: Any) -> Any:
+    '''Выполняет синхронную функцию (handler функции) в пуле потоков процесса'''
+    # Контекст (счётчик запросов shared.metrics) переходит в поток вместе с вызовом
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(_executor, functools.partial(context.run, func, *args))
+
+
+class Connection:
+    '''Соединение из пула asyncpg с таймаутом запросов и плейсхолдерами psycopg2'''
+    __slots__ = ('_conn', 'timeout', 'is_replica')
+
+    def __init__(self, conn, timeout: float, is_replica: bool):
+        self._conn = conn
+        self.timeout = timeout
+        self.is_replica = is_replica
+
+    async def _call(self, method: str, query: str, args: tuple) -> Any:
+        metrics.record_query()
+        try:
+            return await getattr(self._conn, method)(convert(query), *args, timeout=self.timeout)
+        except asyncio.TimeoutError:
+            db_breaker.record_failure()
+            raise ServiceUnavailable('Превышено время выполнения запроса')
+        except CONNECTION_ERRORS:
+            db_breaker.record_failure()
+            raise ServiceUnavailable('База данных недоступна')
+
+    async def fetch(self, query: str, *args: Any) -> List[Any]:
+        return await self._call('fetch', query, args)
+
+    async def fetchrow(self, query: str, *args: Any) -> Any:
+        return await self._call('fetchrow', query, args)
+
+    async def fetchval(self, query: str, *args: Any) -> Any:
+        return await self._call('fetchval', query, args)
+
+    async def execute(self, query: str, *args: Any) -> str:
+        return await self._call('execute', query, args)
+
+
+def pool_stats() -> Dict[tuple, float]:
+    '''Соединения пулов asyncpg процесса: занятые, свободные и максимум'''
+    stats: Dict[tuple, float] = {}
+    for name, pool in (('async_primary', _pool), ('async_replica', _replica_pool)):
+        if pool is not None:
+            idle = pool.get_idle_size()
+            stats[(name, 'used')] = pool.get_size() - idle
+            stats[(name, 'idle')] = idle
+            stats[(name, 'max')] = pool.get_max_size()
+    return stats
+
+
+metrics.register_callback('fd_db_async_pool_connections', 'Соединения пула asyncpg процесса', 'gauge',
+                          ('pool', 'state'), pool_stats)
+
+
+async def _replica_healthy(conn) -> bool:
+    '''Проверяет отставание реплики не чаще REPLICA_CHECK_INTERVAL'''
+    now = time.monotonic()
+    if now - _replica_state['checked_at'] < db.REPLICA_CHECK_INTERVAL:
+        return _replica_state['healthy']
+    _replica_state['checked_at'] = now
+    try:
+        lag = float(await conn.fetchval(db.REPLICA_LAG_SQL, timeout=db.DB_CONNECT_TIMEOUT))
+    except (asyncpg.PostgresError,) + CONNECTION_ERRORS:
+        lag = None
+    _replica_state['healthy'] = lag is not None and lag <= db.REPLICA_MAX_LAG_SECONDS
+    return _replica_state['healthy']
+
+
+@asynccontextmanager
+async def connect(readonly: bool = False, sticky_key: Optional[str] = None,
+                  statement_timeout_ms: Optional[int] = None) -> AsyncIterator[Connection]:
+    '''
+    Соединение на время блока async with: для readonly-запросов — с репликой, если она настроена,
+    здорова и для sticky_key не было недавней записи; иначе — с основной БД.
+    '''
+    timeout = (db.DB_STATEMENT_TIMEOUT_MS if statement_timeout_ms is None else statement_timeout_ms) / 1000
+    if readonly and _replica_pool is not None and not db.is_sticky(sticky_key) \
+            and (_replica_state['healthy'] or time.monotonic() - _replica_state['checked_at'] >= db.REPLICA_CHECK_INTERVAL):
+        try:
+            conn = await _replica_pool.acquire(timeout=db.DB_CONNECT_TIMEOUT)
+        except CONNECTION_ERRORS:
+            _replica_state['healthy'] = False
+            conn = None
+        if conn is not None:
+            try:
+                if await _replica_healthy(conn):
+                    yield Connection(conn, timeout, is_replica=True)
+                    return
+            finally:
+                await _replica_pool.release(conn)
+
+    probe = db_breaker.before_call()
+    try:
+        conn = await _pool.acquire(timeout=db.DB_CONNECT_TIMEOUT)
+    except asyncio.TimeoutError:
+        db.POOL_EXHAUSTED.inc(('async_primary',))
+        if probe:
+            db_breaker.release_probe()
+        raise ServiceUnavailable('Все соединения с базой данных заняты, повторите запрос позже')
+    except CONNECTION_ERRORS:
+        db_breaker.record_failure()
+        raise ServiceUnavailable('База данных недоступна')
+    try:
+        yield Connection(conn, timeout, is_replica=False)
+        db_breaker.record_success()
+    finally:
+        # блок завершился исключением без отказа БД (его засчитывает Connection._call) — БД ответила
+        if probe:
+            db_breaker.settle_probe(answered=True)
+        await _pool.release(conn)
@@ -0,0 +1,219 @@
+'''
+Запись реального трафика функций для воспроизведения (backend/replay.py).
+
+Включается CAPTURE_DIR: instrumented() (shared/metrics.py) передаёт сюда каждый запрос — event,
+статус, длительность и число запросов к БД. Доля записываемых запросов — CAPTURE_SAMPLE_RATE.
+Каждый процесс пишет свой файл capture-<хост>-<pid>.jsonl.gz: строка JSON на запрос, пачки строк
+сжимаются отдельными членами gzip не реже CAPTURE_FLUSH_SECONDS (gzip читает такой файл целиком).
+
+Запись обезличена: токен (email врача), email и текстовые поля тела и параметров заменяются псевдонимами
+HMAC с солью той же длины (один и тот же пациент остаётся одним псевдонимом), пароли — заглушкой,
+в датах рождения остаются год и месяц, строки длиннее CAPTURE_MAX_STRING (файлы base64) — только длина.
+Числа, ключи, id и служебные значения (action, type, study_type...) сохраняются: от них зависит путь
+выполнения запроса. Соль — CAPTURE_SALT или файл .salt в CAPTURE_DIR, общий для процессов хоста;
+replay.py с той же солью находит врачей копии БД по псевдонимам токенов.
+'''
+import atexit
+import gzip
+import hashlib
+import hmac
+import json
+import os
+import random
+import re
+import secrets
+import socket
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+CAPTURE_DIR = os.environ.get('CAPTURE_DIR')
+CAPTURE_SAMPLE_RATE = float(os.environ.get('CAPTURE_SAMPLE_RATE', '1'))
+CAPTURE_FLUSH_SECONDS = float(os.environ.get('CAPTURE_FLUSH_SECONDS', '5'))
+CAPTURE_BUFFER_SIZE = int(os.environ.get('CAPTURE_BUFFER_SIZE', '500'))
+CAPTURE_MAX_STRING = int(os.environ.get('CAPTURE_MAX_STRING', '4096'))
+
+# Значения, которые выбирают путь выполнения и не содержат данных пациента
+SAFE_KEYS = {
+    'action', 'type', 'study_type', 'patient_gender', 'gender', 'category', 'parameter', 'parameter_id',
+    'norm_type', 'condition_type', 'condition_value', 'sort', 'order', 'format', 'bsa_formula', 'status',
+    'study_date', 'date_from', 'date_to', 'field_order', 'enabled_fields', 'base_key', 'kind',
+}
+SECRET_KEYS = {'password', 'old_password', 'new_password', 'current_password'}
+CAPTURED_PASSWORD = 'Captured-Passw0rd'
+KEEP_HEADERS = {'content-type', 'if-none-match'}
+PSEUDONYM_HEADERS = {'idempotency-key'}
+TOKEN_HEADERS = {'x-auth-token'}
+EMAIL_DOMAIN = 'capture.invalid'
+
+DATE_RE = re.compile(r'^\d{4}-\d{2}-\d{2}')
+NUMBER_RE = re.compile(r'^-?\d+([.,]\d+)?$')
+PSEUDONYM_ALPHABET = 'абвгдеёжзийклмнопрстуфхцчшщэюяabcdefghijklmnopqrstuvwxyz'
+
+_sink: List[Optional[Callable[..., None]]] = [None]
+_lock = threading.Lock()
+_state: Dict[str, Any] = {'pid': None, 'path': None, 'buffer': [], 'flushed': 0.0, 'salt': None}
+
+
+def set_sink(sink: Optional[Callable[..., None]]) -> None:
+    '''Заменяет запись в файл своим обработчиком sink(function_name, event, status, seconds, queries)'''
+    _sink[0] = sink
+
+
+def load_salt(directory: Optional[str] = None) -> bytes:
+    '''Соль псевдонимов: CAPTURE_SALT или файл .salt в directory (создаётся при первой записи)'''
+    salt = os.environ.get('CAPTURE_SALT')
+    if salt:
+        return salt.encode('utf-8')
+    path = os.path.join(directory or CAPTURE_DIR or '.', '.salt')
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(path, 'rb') as f:
+            return f.read().strip()
+    with os.fdopen(fd, 'wb') as f:
+        salt = secrets.token_hex(16).encode('ascii')
+        f.write(salt)
+    return salt
+
+
+def _digest(salt: bytes, value: str) -> bytes:
+    return hmac.new(salt, value.encode('utf-8'), hashlib.sha256).digest()
+
+
+def pseudonym_email(salt: bytes, value: str) -> str:
+    '''Псевдоним токена или email врача; одинаков для одного значения при одной соли'''
+    return f'd{_digest(salt, value).hex()[:16]}@{EMAIL_DOMAIN}'
+
+
+def pseudonym_text(salt: bytes, value: str) -> str:
+    '''Текст той же длины из букв, определяемый значением (пробелы сохраняются)'''
+    digest = _digest(salt, value)
+    while len(digest) < len(value):
+        digest += hashlib.sha256(digest).digest()
+    return ''.join(' ' if char == ' ' else PSEUDONYM_ALPHABET[byte % len(PSEUDONYM_ALPHABET)]
+                   for char, byte in zip(value, digest))
+
+
+def scrub(value: Any, salt: bytes, key: str = '') -> Any:
+    '''Обезличивает значение тела или параметра запроса, сохраняя структуру, ключи и числа'''
+    if isinstance(value, dict):
+        return {k: scrub(v, salt, str(k)) for k, v in value.items()}
+    if isinstance(value, list):
+        return [scrub(item, salt, key) for item in value]
+    if not isinstance(value, str) or not value:
+        return value
+    if key in SECRET_KEYS:
+        return CAPTURED_PASSWORD
+    if len(value) > CAPTURE_MAX_STRING:
+        return {'captured_length': len(value)}
+    if key in SAFE_KEYS or NUMBER_RE.match(value.strip()):
+        return value
+    if DATE_RE.match(value):
+        return value[:7] + '-01' if 'birth' in key else value
+    if '@' in value:
+        return pseudonym_email(salt, value)
+    return pseudonym_text(salt, value)
+
+
+def anonymise(event: Dict[str, Any], salt: bytes) -> Dict[str, Any]:
+    '''Обезличенная копия event: метод, нужные заголовки, параметры и тело (объектом JSON)'''
+    headers = {}
+    for name, value in (event.get('headers') or {}).items():
+        lower = name.lower()
+        if lower in TOKEN_HEADERS and value:
+            headers['X-Auth-Token'] = pseudonym_email(salt, value)
+        elif lower in PSEUDONYM_HEADERS and value:
+            headers[name] = _digest(salt, value).hex()[:32]
+        elif lower in KEEP_HEADERS:
+            headers[name] = value
+    captured = {'httpMethod': event.get('httpMethod', 'GET'), 'headers': headers,
+                'queryStringParameters': scrub(event.get('queryStringParameters') or {}, salt)}
+    body = event.get('body')
+    if body:
+        if event.get('isBase64Encoded'):
+            captured['body'] = {'captured_length': len(body)}
+        else:
+            try:
+                captured['body'] = scrub(json.loads(body), salt)
+            except ValueError:
+                captured['body'] = {'captured_length': len(body)}
+    return captured
+
+
+def _path() -> str:
+    return os.path.join(CAPTURE_DIR, f'capture-{socket.gethostname()}-{os.getpid()}.jsonl.gz')
+
+
+def flush() -> None:
+    '''Дописывает накопленные строки процесса одним членом gzip'''
+    with _lock:
+        lines, _state['buffer'] = _state['buffer'], []
+        _state['flushed'] = time.monotonic()
+        path = _state['path']
+    if not lines or path is None:
+        return
+    try:
+        with open(path, 'ab') as f:
+            f.write(gzip.compress(''.join(lines).encode('utf-8')))
+    except OSError:
+        pass
+
+
+def _write(function_name: str, event: Dict[str, Any], status: int, seconds: float, queries: int) -> None:
+    if CAPTURE_SAMPLE_RATE < 1 and random.random() >= CAPTURE_SAMPLE_RATE:
+        return
+    if _state['pid'] != os.getpid():
+        # после fork (serve.py) у процесса свой файл и пустой буфер
+        with _lock:
+            if _state['pid'] != os.getpid():
+                os.makedirs(CAPTURE_DIR, exist_ok=True)
+                _state.update(pid=os.getpid(), path=_path(), buffer=[], flushed=time.monotonic(),
+                              salt=load_salt())
+    line = json.dumps({
+        't': round(time.time() - seconds, 6),
+        'fn': function_name,
+        'ev': anonymise(event, _state['salt']),
+        'st': status,
+        'ms': round(seconds * 1000, 3),
+        'q': queries,
+    }, ensure_ascii=False, separators=(',', ':')) + '\n'
+    with _lock:
+        _state['buffer'].append(line)
+        due = len(_state['buffer']) >= CAPTURE_BUFFER_SIZE or \
+            time.monotonic() - _state['flushed'] >= CAPTURE_FLUSH_SECONDS
+    if due:
+        flush()
+
+
+def record(function_name: str, event: Dict[str, Any], status: int, seconds: float, queries: int) -> None:
+    '''Запрос к функции: в обработчик set_sink() или в файл CAPTURE_DIR (вне режима записи ничего не делает)'''
+    sink = _sink[0]
+    if sink is not None:
+        sink(function_name, event, status, seconds, queries)
+    elif CAPTURE_DIR:
+        try:
+            _write(function_name, event, status, seconds, queries)
+        except (OSError, TypeError, ValueError):
+            pass
+
+
+def read(paths: List[str]) -> List[Dict[str, Any]]:
+    '''Записи из файлов и каталогов записи (.jsonl.gz или .jsonl) в порядке времени начала запроса'''
+    files: List[str] = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(os.path.join(path, name) for name in os.listdir(path)
+                            if name.endswith('.jsonl') or name.endswith('.jsonl.gz'))
+        else:
+            files.append(path)
+    entries = []
+    for path in files:
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8') as f:
+            entries += [json.loads(line) for line in f if line.strip()]
+    entries.sort(key=lambda entry: entry['t'])
+    return entries
+
+
+atexit.register(flush)
@@ -0,0 +1,417 @@
+'''
+Подключения к PostgreSQL для функций backend.
+
+В облачном режиме каждый вызов открывает своё соединение по DATABASE_URL.
+В self-hosted режиме (backend/serve.py) каждый рабочий процесс после fork вызывает init_pool(),
+и connect() выдаёт соединения из пула процесса; close() возвращает соединение в пул.
+
+Перед соединением с основной БД проверяется предохранитель shared.resilience.db_breaker:
+при ошибке соединения или исчерпании пула connect() поднимает ServiceUnavailable (ответ 503).
+statement_timeout_ms задаёт таймаут запросов соединения (по умолчанию DB_STATEMENT_TIMEOUT_MS).
+
+Если задан DATABASE_REPLICA_URL, соединения для чтения (readonly=True) направляются на реплику:
+- после записи чтения REPLICA_STICKY_SECONDS идут на основную БД (read-your-writes): время записи
+  клиент получает в заголовке X-Last-Write ответа и присылает в следующих запросах (read_your_writes),
+  поэтому привязка действует в любом процессе и экземпляре функции; внутри процесса она также
+  запоминается по sticky_key для клиентов без этого заголовка;
+- при недоступности реплики или отставании больше REPLICA_MAX_LAG_SECONDS чтения идут на основную БД.
+
+Если задан DATABASE_SHARDS (см. shared/shards.py), connect(doctor_token=...) открывает соединение с узлом,
+который хранит данные врача с этим токеном; DATABASE_URL остаётся каталогом. Реплики используются только
+для каталога, соединения с узлами берутся из пулов узлов процесса.
+'''
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+import time
+import weakref
+from typing import Any, Callable, Dict, Optional
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+
+from shared import metrics, shards
+from shared.resilience import ServiceUnavailable, db_breaker
+
+REPLICA_STICKY_SECONDS = float(os.environ.get('REPLICA_STICKY_SECONDS', '5'))
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', '10'))
+REPLICA_CHECK_INTERVAL = float(os.environ.get('REPLICA_CHECK_INTERVAL', '2'))
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', '5000'))
+DB_CONNECT_TIMEOUT = int(os.environ.get('DB_CONNECT_TIMEOUT', '3'))
+
+WRITE_MARK_HEADER = 'X-Last-Write'
+
+REPLICA_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+
+_pool: Optional[ThreadedConnectionPool] = None
+_replica_pool: Optional[ThreadedConnectionPool] = None
+_shard_pools: Dict[str, ThreadedConnectionPool] = {}
+_pool_lock = threading.Lock()
+
+_sticky_until: Dict[str, float] = {}
+_sticky_lock = threading.Lock()
+
+# Запрос под read_your_writes: 'seen' — время записи из заголовка клиента, 'written' — время commit запроса
+_write_marks: contextvars.ContextVar = contextvars.ContextVar('fd_db_write_marks', default=None)
+
+_replica_state = {'checked_at': 0.0, 'healthy': True, 'lag': 0.0}
+_replica_lock = threading.Lock()
+
+# statement_timeout, уже установленный на соединении из пула
+_applied_timeouts: 'weakref.WeakKeyDictionary' = weakref.WeakKeyDictionary()
+
+
+@functools.lru_cache(maxsize=None)
+def _counting_cursor(factory: type) -> type:
+    '''Подкласс курсора factory, учитывающий запросы в shared.metrics'''
+    def execute(self, query, vars=None):
+        metrics.record_query()
+        return factory.execute(self, query, vars)
+
+    def executemany(self, query, vars_list):
+        metrics.record_query()
+        return factory.executemany(self, query, vars_list)
+
+    return type(f'Counting{factory.__name__}', (factory,), {'execute': execute, 'executemany': executemany})
+
+
+class CountingConnection(psycopg2.extensions.connection):
+    '''Соединение psycopg2, курсоры которого (любого cursor_factory) считают запросы к БД'''
+
+    def cursor(self, *args: Any, **kwargs: Any):
+        factory = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = _counting_cursor(factory)
+        return super().cursor(*args, **kwargs)
+
+
+class Connection:
+    '''
+    Обёртка соединения: commit() продлевает привязку sticky_key к основной БД,
+    close() возвращает соединение в пул (с откатом незавершённой транзакции) или закрывает его.
+    '''
+
+    def __init__(self, conn: psycopg2.extensions.connection, pool: Optional[ThreadedConnectionPool] = None,
+                 sticky_key: Optional[str] = None, is_replica: bool = False, shard: Optional[str] = None,
+                 probe: bool = False):
+        self._conn = conn
+        self._pool = pool
+        self.sticky_key = sticky_key
+        self.is_replica = is_replica
+        # узел DATABASE_SHARDS, с которым открыто соединение (None — каталог без шардирования)
+        self.shard = shard
+        # соединение открыто пробным запросом полуоткрытого предохранителя
+        self.probe = probe
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._conn, name)
+
+    def commit(self) -> None:
+        self._conn.commit()
+        if self.is_replica:
+            return
+        marks = _write_marks.get()
+        if marks is not None:
+            marks['written'] = time.time()
+        if self.sticky_key:
+            mark_write(self.sticky_key)
+
+    def close(self) -> None:
+        conn = self._conn
+        if conn is None:
+            return
+        self._conn = None
+        broken = bool(conn.closed)
+        if not broken and not self.is_replica and shards.is_directory(self.shard) and \
+                conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+            db_breaker.record_success()
+        elif self.probe:
+            # ошибка запроса (транзакция INERROR) — БД ответила; таймаут уже засчитан unavailable_response
+            db_breaker.settle_probe(answered=not broken)
+        if self._pool is None:
+            conn.close()
+            return
+        if not broken:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                conn.cursor_factory = None
+            except psycopg2.Error:
+                broken = True
+        self._pool.putconn(conn, close=broken)
+
+
+def init_pool(minconn: int, maxconn: int, dsn: Optional[str] = None) -> None:
+    '''Создаёт пулы соединений текущего процесса (вызывать после fork)'''
+    global _pool, _replica_pool
+    with _pool_lock:
+        for pool in (_pool, _replica_pool, *_shard_pools.values()):
+            if pool is not None:
+                pool.closeall()
+        _pool = ThreadedConnectionPool(minconn, maxconn, dsn or os.environ['DATABASE_URL'],
+                                       connect_timeout=DB_CONNECT_TIMEOUT, connection_factory=CountingConnection)
+        replica_dsn = os.environ.get('DATABASE_REPLICA_URL')
+        _replica_pool = ThreadedConnectionPool(0, maxconn, replica_dsn, connect_timeout=DB_CONNECT_TIMEOUT,
+                                               connection_factory=CountingConnection) if replica_dsn else None
+        _shard_pools.clear()
+        for shard in shards.names():
+            if not shards.is_directory(shard):
+                _shard_pools[shard] = ThreadedConnectionPool(0, maxconn, shards.dsn(shard),
+                                                             connect_timeout=DB_CONNECT_TIMEOUT,
+                                                             connection_factory=CountingConnection)
+
+
+def close_pool() -> None:
+    global _pool, _replica_pool
+    with _pool_lock:
+        for pool in (_pool, _replica_pool, *_shard_pools.values()):
+            if pool is not None:
+                pool.closeall()
+        _pool = None
+        _replica_pool = None
+        _shard_pools.clear()
+
+
+def mark_write(sticky_key: str) -> None:
+    '''Направляет чтения sticky_key на основную БД на время REPLICA_STICKY_SECONDS'''
+    now = time.monotonic()
+    with _sticky_lock:
+        _sticky_until[sticky_key] = now + REPLICA_STICKY_SECONDS
+        if len(_sticky_until) > 10000:
+            for key in [k for k, until in _sticky_until.items() if until <= now]:
+                del _sticky_until[key]
+
+
+def is_sticky(sticky_key: Optional[str]) -> bool:
+    marks = _write_marks.get()
+    if marks is not None:
+        written_at = marks['written'] or marks['seen']
+        if written_at is not None and time.time() - written_at < REPLICA_STICKY_SECONDS:
+            return True
+    if not sticky_key:
+        return False
+    with _sticky_lock:
+        until = _sticky_until.get(sticky_key)
+    return until is not None and until > time.monotonic()
+
+
+def _begin_request(event: Dict[str, Any]) -> Dict[str, Optional[float]]:
+    value = next((v for k, v in (event.get('headers') or {}).items() if k.lower() == WRITE_MARK_HEADER.lower()), None)
+    try:
+        seen = float(value) if value else None
+    except ValueError:
+        seen = None
+    # время из будущего (расхождение часов больше окна или подделка) не продлевает привязку
+    if seen is not None and seen > time.time() + REPLICA_STICKY_SECONDS:
+        seen = None
+    return {'seen': seen, 'written': None}
+
+
+def _finish_request(response: Dict[str, Any], marks: Dict[str, Optional[float]]) -> Dict[str, Any]:
+    if marks['written'] is None or not isinstance(response, dict):
+        return response
+    headers = dict(response.get('headers') or {})
+    headers[WRITE_MARK_HEADER] = f"{marks['written']:.3f}"
+    exposed = headers.get('Access-Control-Expose-Headers')
+    headers['Access-Control-Expose-Headers'] = f'{exposed}, {WRITE_MARK_HEADER}' if exposed else WRITE_MARK_HEADER
+    return dict(response, headers=headers)
+
+
+def read_your_writes(handler: Callable) -> Callable:
+    '''
+    Декоратор handler или handler_async: ответ запроса, записавшего в основную БД, получает заголовок
+    X-Last-Write со временем commit; тот же заголовок в запросе направляет чтения на основную БД,
+    пока не прошло REPLICA_STICKY_SECONDS
+    '''
+    if asyncio.iscoroutinefunction(handler):
+        @functools.wraps(handler)
+        async def async_wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+            if _write_marks.get() is not None:
+                return await handler(event, context)
+            marks = _begin_request(event)
+            token = _write_marks.set(marks)
+            try:
+                return _finish_request(await handler(event, context), marks)
+            finally:
+                _write_marks.reset(token)
+        return async_wrapper
+
+    @functools.wraps(handler)
+    def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        # handler, вызванный из handler_async (adb.run_sync переносит контекст), отмечает запись в тех же marks
+        if _write_marks.get() is not None:
+            return handler(event, context)
+        marks = _begin_request(event)
+        token = _write_marks.set(marks)
+        try:
+            return _finish_request(handler(event, context), marks)
+        finally:
+            _write_marks.reset(token)
+    return wrapper
+
+
+def _open(dsn: str, pool: Optional[ThreadedConnectionPool], cursor_factory: Any,
+          statement_timeout_ms: int) -> tuple:
+    if pool is None:
+        conn = psycopg2.connect(dsn, cursor_factory=cursor_factory, connect_timeout=DB_CONNECT_TIMEOUT,
+                                options=f'-c statement_timeout={statement_timeout_ms}',
+                                connection_factory=CountingConnection)
+        return conn, None
+    conn = pool.getconn()
+    conn.cursor_factory = cursor_factory
+    if _applied_timeouts.get(conn) != statement_timeout_ms:
+        try:
+            with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+                cur.execute("SELECT set_config('statement_timeout', %s, false)", (f'{statement_timeout_ms}ms',))
+            conn.commit()
+        except psycopg2.Error:
+            pool.putconn(conn, close=True)
+            raise
+        _applied_timeouts[conn] = statement_timeout_ms
+    return conn, pool
+
+
+def _replica_connection(cursor_factory: Any, sticky_key: Optional[str],
+                        statement_timeout_ms: int) -> Optional[Connection]:
+    '''Соединение с репликой или None, если реплика недоступна или отстаёт'''
+    replica_dsn = os.environ.get('DATABASE_REPLICA_URL')
+    if not replica_dsn:
+        return None
+
+    now = time.monotonic()
+    with _replica_lock:
+        check_due = now - _replica_state['checked_at'] >= REPLICA_CHECK_INTERVAL
+        if not check_due and not _replica_state['healthy']:
+            return None
+        if check_due:
+            _replica_state['checked_at'] = now
+
+    try:
+        conn, pool = _open(replica_dsn, _replica_pool, cursor_factory, statement_timeout_ms)
+    except PoolError:
+        POOL_EXHAUSTED.inc(('replica',))
+        return None
+    except psycopg2.Error:
+        with _replica_lock:
+            _replica_state['healthy'] = False
+        return None
+
+    wrapped = Connection(conn, pool, sticky_key, is_replica=True)
+    if check_due:
+        try:
+            with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+                cur.execute(REPLICA_LAG_SQL)
+                lag = float(cur.fetchone()[0])
+            conn.rollback()
+        except psycopg2.Error:
+            lag = None
+        with _replica_lock:
+            _replica_state['healthy'] = lag is not None and lag <= REPLICA_MAX_LAG_SECONDS
+            _replica_state['lag'] = lag if lag is not None else -1.0
+        if not _replica_state['healthy']:
+            wrapped.close()
+            return None
+    return wrapped
+
+
+def _doctor_shard(doctor_token: str, readonly: bool) -> Optional[str]:
+    '''Узел врача с токеном doctor_token (None — врача нет); запись во время переноса врача отклоняется'''
+    found, route = shards.cached_route(doctor_token)
+    if not found:
+        conn = _connect_directory(psycopg2.extensions.cursor, None, DB_STATEMENT_TIMEOUT_MS)
+        try:
+            with conn.cursor() as cur:
+                route = shards.lookup_route(cur, doctor_token)
+            conn.commit()
+        finally:
+            conn.close()
+    if route is None:
+        return None
+    if route.state == shards.MOVING and not readonly:
+        raise ServiceUnavailable('Данные врача переносятся на другой узел, повторите запрос позже',
+                                 retry_after=shards.SHARD_MAP_TTL_SECONDS)
+    return route.shard
+
+
+def _connect_directory(cursor_factory: Any, sticky_key: Optional[str], timeout_ms: int,
+                       shard: Optional[str] = None) -> Connection:
+    probe = db_breaker.before_call()
+    try:
+        conn, pool = _open(os.environ['DATABASE_URL'], _pool, cursor_factory, timeout_ms)
+    except PoolError:
+        POOL_EXHAUSTED.inc(('primary',))
+        if probe:
+            db_breaker.release_probe()
+        raise ServiceUnavailable('Все соединения с базой данных заняты, повторите запрос позже')
+    except psycopg2.OperationalError:
+        db_breaker.record_failure()
+        raise ServiceUnavailable('База данных недоступна')
+    except BaseException:
+        if probe:
+            db_breaker.settle_probe(answered=True)
+        raise
+    return Connection(conn, pool, sticky_key, shard=shard, probe=probe)
+
+
+def connect(cursor_factory: Any = None, readonly: bool = False, sticky_key: Optional[str] = None,
+            statement_timeout_ms: Optional[int] = None, doctor_token: Optional[str] = None,
+            shard: Optional[str] = None) -> Connection:
+    '''
+    Соединение с БД: для readonly-запросов — с репликой, если она настроена, здорова
+    и для sticky_key не было недавней записи; иначе — с основной БД.
+    При шардировании — с узлом shard или узлом врача с токеном doctor_token.
+    '''
+    timeout_ms = DB_STATEMENT_TIMEOUT_MS if statement_timeout_ms is None else statement_timeout_ms
+    if shard is None and doctor_token and shards.enabled():
+        shard = _doctor_shard(doctor_token, readonly)
+    if not shards.is_directory(shard):
+        try:
+            conn, pool = _open(shards.dsn(shard), _shard_pools.get(shard), cursor_factory, timeout_ms)
+        except PoolError:
+            POOL_EXHAUSTED.inc((f'shard:{shard}',))
+            raise ServiceUnavailable('Все соединения с базой данных заняты, повторите запрос позже')
+        except psycopg2.OperationalError:
+            raise ServiceUnavailable(f'Узел базы данных {shard} недоступен')
+        return Connection(conn, pool, sticky_key, shard=shard)
+
+    if readonly and not is_sticky(sticky_key):
+        replica = _replica_connection(cursor_factory, sticky_key, timeout_ms)
+        if replica is not None:
+            replica.shard = shard
+            return replica
+
+    return _connect_directory(cursor_factory, sticky_key, timeout_ms, shard)
+
+
+POOL_EXHAUSTED = metrics.counter('fd_db_pool_exhausted_total', 'Отказы в соединении: пул процесса исчерпан', ('pool',))
+
+
+def pool_stats() -> Dict[tuple, float]:
+    '''Соединения пулов процесса: занятые, свободные и максимум'''
+    stats: Dict[tuple, float] = {}
+    pools = [('primary', _pool), ('replica', _replica_pool)]
+    pools += [(f'shard:{shard}', pool) for shard, pool in _shard_pools.items()]
+    for name, pool in pools:
+        if pool is not None:
+            stats[(name, 'used')] = len(pool._used)
+            stats[(name, 'idle')] = len(pool._pool)
+            stats[(name, 'max')] = pool.maxconn
+    return stats
+
+
+metrics.register_callback('fd_db_pool_connections', 'Соединения пула psycopg2 процесса', 'gauge',
+                          ('pool', 'state'), pool_stats)
+
+
+def replica_status() -> Dict[str, Any]:
+    '''Последнее известное состояние реплики (для диагностики)'''
+    with _replica_lock:
+        return dict(_replica_state, configured=bool(os.environ.get('DATABASE_REPLICA_URL')))
@@ -0,0 +1,154 @@
+'''
+Производные поля пациента, вычисляемые на сервере пакетами: возраст на дату исследования и BSA.
+
+Клиент считает их по одному протоколу (src/utils/ageCalculator.ts, calculateBSA) и присылает готовыми;
+импорт протоколов и задача backfill_derived_fields пересчитывают их здесь для целых пакетов строк
+арифметикой NumPy над массивами datetime64[D] и float64, без цикла Python по строкам.
+
+ages() повторяет calculateAge: разница лет, месяцев и дней, при отрицательных днях заимствуется
+длина месяца, предшествующего месяцу исследования. total_days — как split_patient_age в protocols
+(годы по 365.25, месяцы по 30.44 дня). bsa() считает площадь поверхности тела по формуле из BSA_FORMULAS
+(по умолчанию — формула Мостеллера, как в клиенте) с округлением до сотых, как в столбце patient_bsa.
+'''
+import os
+from datetime import date
+from decimal import Decimal
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional
+
+import numpy as np
+
+from shared.norm_snapshot import parse_float
+
+DAYS_IN_YEAR = 365.25
+DAYS_IN_MONTH = 30.44
+
+BSA_FORMULAS: Dict[str, Callable[[np.ndarray, np.ndarray], np.ndarray]] = {
+    'mosteller': lambda w, h: np.sqrt(w * h / 3600.0),
+    'dubois': lambda w, h: 0.007184 * w ** 0.425 * h ** 0.725,
+    'haycock': lambda w, h: 0.024265 * w ** 0.5378 * h ** 0.3964,
+    'gehan_george': lambda w, h: 0.0235 * w ** 0.51456 * h ** 0.42246,
+}
+DEFAULT_BSA_FORMULA = os.environ.get('BSA_FORMULA', 'mosteller')
+
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+NAT = np.iinfo(np.int64).min
+NUMERIC_TYPES = {float, int, Decimal, type(None)}
+MONTH_DAYS = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31], dtype=np.int64)
+
+# Предел столбца patient_bsa DECIMAL(4,2)
+MAX_BSA = 99.99
+
+
+class Ages(NamedTuple):
+    '''Возраст на дату исследования; valid = False, если даты нет или рождение позже исследования'''
+    years: np.ndarray
+    months: np.ndarray
+    days: np.ndarray
+    total_days: np.ndarray
+    valid: np.ndarray
+
+
+def _date_text(value: Any) -> Optional[str]:
+    if value is None or value == '':
+        return None
+    if hasattr(value, 'isoformat'):
+        value = value.isoformat()
+    return str(value).strip()[:10]
+
+
+def to_dates(values: Iterable[Any]) -> np.ndarray:
+    '''Даты (date, datetime, 'YYYY-MM-DD…' или None) -> datetime64[D]; нераспознанные значения — NaT'''
+    values = list(values)
+    if all(value is None or isinstance(value, date) for value in values):
+        # даты из psycopg2: порядковый номер дня без разбора строк
+        days = (NAT if value is None else value.toordinal() - EPOCH_ORDINAL for value in values)
+        return np.fromiter(days, dtype=np.int64, count=len(values)).view('datetime64[D]')
+    texts = [_date_text(value) for value in values]
+    try:
+        return np.array(texts, dtype='datetime64[D]')
+    except ValueError:
+        pass
+    dates = np.empty(len(texts), dtype='datetime64[D]')
+    for i, text in enumerate(texts):
+        try:
+            dates[i] = np.datetime64(text, 'D') if text else np.datetime64('NaT')
+        except ValueError:
+            dates[i] = np.datetime64('NaT')
+    return dates
+
+
+def to_floats(values: Iterable[Any]) -> np.ndarray:
+    '''Числа как parseFloat в JS (Decimal, строки, None) -> float64; нечисловые значения — NaN'''
+    values = list(values)
+    if set(map(type, values)) <= NUMERIC_TYPES:
+        return np.array(values, dtype=np.float64)
+    return np.fromiter((parse_float(value) for value in values), dtype=np.float64, count=len(values))
+
+
+def _split(days: np.ndarray) -> tuple:
+    '''Дни от 1970-01-01 -> (год, месяц 1..12, день 1..31) целочисленной арифметикой (civil_from_days)'''
+    z = days + 719468
+    era = z // 146097
+    day_of_era = z - era * 146097
+    year_of_era = (day_of_era - day_of_era // 1460 + day_of_era // 36524 - day_of_era // 146096) // 365
+    day_of_year = day_of_era - (365 * year_of_era + year_of_era // 4 - year_of_era // 100)
+    shifted_month = (5 * day_of_year + 2) // 153
+    day = day_of_year - (153 * shifted_month + 2) // 5 + 1
+    month = np.where(shifted_month < 10, shifted_month + 3, shifted_month - 9)
+    year = year_of_era + era * 400 + (month <= 2)
+    return year, month, day
+
+
+def _month_days(year: np.ndarray, month: np.ndarray) -> np.ndarray:
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    return MONTH_DAYS[month - 1] + ((month == 2) & leap)
+
+
+def ages(birth_dates: Any, study_dates: Any) -> Ages:
+    '''Возраст пациентов на даты исследований (массивы datetime64[D] или значения для to_dates)'''
+    birth = np.asarray(birth_dates, dtype='datetime64[D]') if isinstance(birth_dates, np.ndarray) \
+        else to_dates(birth_dates)
+    study = np.asarray(study_dates, dtype='datetime64[D]') if isinstance(study_dates, np.ndarray) \
+        else to_dates(study_dates)
+    valid = ~np.isnat(birth) & ~np.isnat(study) & (birth <= study)
+    birth_year, birth_month, birth_day = _split(np.where(valid, birth.view(np.int64), 0))
+    study_year, study_month, study_day = _split(np.where(valid, study.view(np.int64), 0))
+    years = study_year - birth_year
+    months = study_month - birth_month
+    days = study_day - birth_day
+
+    # как в calculateAge: при отрицательных днях занимается длина месяца перед месяцем исследования
+    borrow = days < 0
+    first_month = study_month == 1
+    previous_month_days = _month_days(np.where(first_month, study_year - 1, study_year),
+                                      np.where(first_month, 12, study_month - 1))
+    months = months - borrow
+    days = days + np.where(borrow, previous_month_days, 0)
+
+    wrap = months < 0
+    years = years - wrap
+    months = months + np.where(wrap, 12, 0)
+
+    total_days = np.rint(years * DAYS_IN_YEAR + months * DAYS_IN_MONTH + days).astype(np.int64)
+    return Ages(years * valid, months * valid, days * valid, total_days * valid, valid)
+
+
+def bsa(weights: Any, heights: Any, formula: Optional[str] = None) -> np.ndarray:
+    '''BSA (м²) по массе (кг) и росту (см), округлённая до сотых; NaN — нет массы или роста'''
+    formula = formula or DEFAULT_BSA_FORMULA
+    if formula not in BSA_FORMULAS:
+        raise ValueError(f'Неизвестная формула BSA: {formula}. Доступны: {", ".join(sorted(BSA_FORMULAS))}')
+    weight = weights if isinstance(weights, np.ndarray) else to_floats(weights)
+    height = heights if isinstance(heights, np.ndarray) else to_floats(heights)
+    known = np.isfinite(weight) & np.isfinite(height) & (weight > 0) & (height > 0)
+    with np.errstate(invalid='ignore'):
+        values = BSA_FORMULAS[formula](np.where(known, weight, 1.0), np.where(known, height, 1.0))
+    values = np.round(values, 2)
+    return np.where(known & (values <= MAX_BSA), values, np.nan)
+
+
+def column(values: np.ndarray, valid: Optional[np.ndarray] = None) -> List[Any]:
+    '''Массив -> список значений Python для параметров запроса; NaN и строки с valid = False -> None'''
+    if valid is None:
+        valid = ~np.isnan(values) if values.dtype.kind == 'f' else np.ones(len(values), dtype=bool)
+    return [value if ok else None for value, ok in zip(values.tolist(), valid.tolist())]
@@ -0,0 +1,53 @@
+'''
+Условные GET-запросы: строгие ETag по версии строки, ответ 304 на If-None-Match и Cache-Control.
+
+Handler сначала выбирает только версию ресурса (updated_at и т.п.), считает etag() и, если клиент
+прислал совпадающий If-None-Match, отвечает not_modified() без основного запроса и тела.
+Иначе ответ 200 дополняется заголовками cache_headers().
+'''
+import hashlib
+import os
+from typing import Any, Dict
+
+from shared import metrics
+
+# Профиль и неподписанные протоколы кэшируются браузером, но каждый раз сверяются по ETag;
+# подписанные протоколы почти не меняются и переиспользуются без запроса SIGNED_PROTOCOL_MAX_AGE секунд
+REVALIDATE = 'private, no-cache'
+SIGNED_PROTOCOL_MAX_AGE = int(os.environ.get('SIGNED_PROTOCOL_MAX_AGE', '86400'))
+SIGNED_PROTOCOL = f'private, max-age={SIGNED_PROTOCOL_MAX_AGE}'
+
+
+def etag(*parts: Any) -> str:
+    '''Строгий ETag из частей версии ресурса'''
+    h = hashlib.blake2b(digest_size=12)
+    for part in parts:
+        h.update(repr(part).encode('utf-8'))
+        h.update(b'\x00')
+    return f'"{h.hexdigest()}"'
+
+
+def if_none_match(event: Dict[str, Any], tag: str) -> bool:
+    '''Совпадает ли If-None-Match запроса с tag (слабое сравнение, как требует RFC 9110 для GET)'''
+    value = next((v for k, v in (event.get('headers') or {}).items() if k.lower() == 'if-none-match'), None)
+    if not value:
+        metrics.cache_result('http_etag', False)
+        return False
+    candidates = [candidate.strip() for candidate in value.split(',')]
+    matched = '*' in candidates or tag in (c[2:] if c.startswith('W/') else c for c in candidates)
+    metrics.cache_result('http_etag', matched)
+    return matched
+
+
+def cache_headers(headers: Dict[str, str], tag: str, cache_control: str) -> Dict[str, str]:
+    return dict(headers, **{'ETag': tag, 'Cache-Control': cache_control, 'Vary': 'X-Auth-Token',
+                            'Access-Control-Expose-Headers': 'ETag'})
+
+
+def not_modified(headers: Dict[str, str], tag: str, cache_control: str) -> Dict[str, Any]:
+    return {
+        'statusCode': 304,
+        'headers': cache_headers({k: v for k, v in headers.items() if k != 'Content-Type'}, tag, cache_control),
+        'body': '',
+        'isBase64Encoded': False
+    }
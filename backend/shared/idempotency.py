@@ -0,0 +1,233 @@
+'''
+Идемпотентность запросов на запись по заголовку Idempotency-Key.
+
+Повтор запроса с тем же ключом (сеть оборвалась, клиент отправил ещё раз) получает сохранённый
+ответ первого запроса с заголовком Idempotent-Replayed: true, а handler функции не вызывается —
+протокол, шаблон или таблица норм не создаются повторно. Ключ действует для пользователя (X-Auth-Token)
+и функции; ответы хранятся в idempotency_keys IDEMPOTENCY_TTL_SECONDS, недавние — ещё и в LRU-кэше
+процесса, поэтому повтор в тот же процесс не обращается к БД.
+
+- Ключ занимается до вызова handler; параллельный запрос с тем же ключом получает 409.
+  Если процесс упал, не сохранив ответ, ключ освобождается через IDEMPOTENCY_LOCK_SECONDS.
+- Тот же ключ с другим телом или параметрами запроса — 422.
+- Ответы 5xx, 401, 409 и 429 и исключения handler не сохраняются: ключ освобождается, запрос можно повторить.
+'''
+import copy
+import functools
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import psycopg2
+import psycopg2.extensions
+
+from shared import db, metrics, resilience
+
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', '86400'))
+IDEMPOTENCY_LOCK_SECONDS = int(os.environ.get('IDEMPOTENCY_LOCK_SECONDS', '60'))
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', '2048'))
+IDEMPOTENCY_CACHE_SECONDS = float(os.environ.get('IDEMPOTENCY_CACHE_SECONDS', '600'))
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+WRITE_METHODS = ('POST', 'PUT', 'DELETE')
+NOT_STORED_STATUSES = (401, 409, 429)
+PURGE_BATCH_SIZE = 5000
+
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+_cache: 'OrderedDict[bytes, Tuple[bytes, Dict[str, Any], float]]' = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _digest(*parts: Any) -> bytes:
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        data = part if isinstance(part, bytes) else str(part).encode('utf-8')
+        h.update(len(data).to_bytes(8, 'little'))
+        h.update(data)
+    return h.digest()
+
+
+def _header(headers: Dict[str, Any], name: str) -> Optional[str]:
+    lowered = name.lower()
+    for key, value in headers.items():
+        if key.lower() == lowered:
+            return value
+    return None
+
+
+def _error(status_code: int, message: str) -> Dict[str, Any]:
+    return {
+        'statusCode': status_code,
+        'headers': JSON_HEADERS,
+        'body': json.dumps({'error': message}),
+        'isBase64Encoded': False
+    }
+
+
+def _cache_get(key_hash: bytes) -> Optional[Tuple[bytes, Dict[str, Any]]]:
+    with _cache_lock:
+        entry = _cache.get(key_hash)
+        if entry is None:
+            return None
+        if entry[2] <= time.monotonic():
+            del _cache[key_hash]
+            return None
+        _cache.move_to_end(key_hash)
+        return entry[0], entry[1]
+
+
+def _cache_put(key_hash: bytes, request_hash: bytes, response: Dict[str, Any]) -> None:
+    with _cache_lock:
+        _cache[key_hash] = (request_hash, response, time.monotonic() + IDEMPOTENCY_CACHE_SECONDS)
+        _cache.move_to_end(key_hash)
+        while len(_cache) > IDEMPOTENCY_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def _replay(stored_request_hash: bytes, request_hash: bytes, response: Dict[str, Any]) -> Dict[str, Any]:
+    if stored_request_hash != request_hash:
+        return _error(422, f'Ключ {HEADER} уже использован для другого запроса')
+    replayed = copy.deepcopy(response)
+    replayed['headers'] = dict(replayed.get('headers') or {}, **{'Idempotent-Replayed': 'true'})
+    return replayed
+
+
+def claim(cur, key_hash: bytes, request_hash: bytes) -> Optional[Tuple[bytes, Optional[int], Optional[bytes]]]:
+    '''
+    Занимает ключ (новый или просроченный) в текущей транзакции. None — ключ занят этим запросом,
+    иначе (request_hash, status_code, response) существующей строки; status_code None — запрос выполняется.
+    '''
+    cur.execute("""
+        INSERT INTO t_p13795046_functional_diagnosti.idempotency_keys (key_hash, request_hash, expires_at)
+        VALUES (%s, %s, CURRENT_TIMESTAMP + make_interval(secs => %s))
+        ON CONFLICT (key_hash) DO UPDATE
+        SET request_hash = EXCLUDED.request_hash, status_code = NULL, response = NULL,
+            expires_at = EXCLUDED.expires_at
+        WHERE idempotency_keys.expires_at < CURRENT_TIMESTAMP
+        RETURNING 1
+    """, (key_hash, request_hash, IDEMPOTENCY_LOCK_SECONDS))
+    if cur.fetchone():
+        return None
+    cur.execute("""
+        SELECT request_hash, status_code, response
+        FROM t_p13795046_functional_diagnosti.idempotency_keys
+        WHERE key_hash = %s
+    """, (key_hash,))
+    row = cur.fetchone()
+    return (bytes(row[0]), row[1], bytes(row[2]) if row[2] is not None else None) if row else (request_hash, None, None)
+
+
+def release(cur, key_hash: bytes) -> None:
+    '''Освобождает занятый ключ без сохранённого ответа: повтор запроса выполнит handler заново'''
+    cur.execute("""
+        DELETE FROM t_p13795046_functional_diagnosti.idempotency_keys
+        WHERE key_hash = %s AND status_code IS NULL
+    """, (key_hash,))
+
+
+def complete(cur, key_hash: bytes, response: Dict[str, Any]) -> None:
+    '''Сохраняет ответ занятого ключа или освобождает ключ, если ответ не подлежит сохранению'''
+    status_code = response.get('statusCode', 200)
+    if status_code >= 500 or status_code in NOT_STORED_STATUSES:
+        release(cur, key_hash)
+        return
+    cur.execute("""
+        UPDATE t_p13795046_functional_diagnosti.idempotency_keys
+        SET status_code = %s, response = %s, expires_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+        WHERE key_hash = %s
+    """, (status_code, zlib.compress(json.dumps(response).encode('utf-8')), IDEMPOTENCY_TTL_SECONDS, key_hash))
+
+
+def _run_in_transaction(func: Callable[[Any], Any]) -> Any:
+    conn = db.connect(statement_timeout_ms=resilience.WRITE.statement_timeout_ms)
+    try:
+        with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+            result = func(cur)
+        conn.commit()
+        return result
+    finally:
+        conn.close()
+
+
+def idempotent(function_name: str) -> Callable:
+    '''Декоратор handler функции function_name: запросы на запись с Idempotency-Key выполняются один раз'''
+    def decorator(handler: Callable[[Dict[str, Any], Any], Dict[str, Any]]) -> Callable:
+        @functools.wraps(handler)
+        def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+            headers = event.get('headers') or {}
+            key = _header(headers, HEADER)
+            auth_token = _header(headers, 'X-Auth-Token')
+            method = event.get('httpMethod', 'GET')
+            if not key or not auth_token or method not in WRITE_METHODS:
+                return handler(event, context)
+            if len(key) > MAX_KEY_LENGTH:
+                return _error(400, f'Заголовок {HEADER} длиннее {MAX_KEY_LENGTH} символов')
+
+            key_hash = _digest(function_name, auth_token, key)
+            request_hash = _digest(method, json.dumps(event.get('queryStringParameters') or {}, sort_keys=True),
+                                   event.get('body') or '')
+            cached = _cache_get(key_hash)
+            metrics.cache_result('idempotency_memory', cached is not None)
+            if cached:
+                return _replay(cached[0], request_hash, cached[1])
+
+            try:
+                existing = _run_in_transaction(lambda cur: claim(cur, key_hash, request_hash))
+            except resilience.UNAVAILABLE_ERRORS as e:
+                return resilience.unavailable_response(JSON_HEADERS, e)
+            if existing is not None:
+                stored_request_hash, status_code, stored = existing
+                if status_code is None:
+                    if stored_request_hash != request_hash:
+                        return _error(422, f'Ключ {HEADER} уже использован для другого запроса')
+                    return _error(409, 'Запрос с этим ключом ещё выполняется, повторите позже')
+                response = json.loads(zlib.decompress(stored))
+                _cache_put(key_hash, stored_request_hash, response)
+                return _replay(stored_request_hash, request_hash, response)
+
+            try:
+                response = handler(event, context)
+            except BaseException:
+                # Исключение handler — как ответ 5xx: ключ освобождается, клиент может повторить запрос
+                try:
+                    _run_in_transaction(lambda cur: release(cur, key_hash))
+                except (resilience.ServiceUnavailable, psycopg2.Error):
+                    pass
+                raise
+            try:
+                _run_in_transaction(lambda cur: complete(cur, key_hash, response))
+            except (resilience.ServiceUnavailable, psycopg2.Error):
+                # Ключ освободится через IDEMPOTENCY_LOCK_SECONDS; повтор в этот процесс получит ответ из кэша
+                pass
+            status_code = response.get('statusCode', 200)
+            if status_code < 500 and status_code not in NOT_STORED_STATUSES:
+                _cache_put(key_hash, request_hash, copy.deepcopy(response))
+            return response
+        return wrapper
+    return decorator
+
+
+def purge_expired(conn, batch_size: int = PURGE_BATCH_SIZE) -> int:
+    '''Удаляет просроченные ключи пакетами; возвращает число удалённых строк'''
+    purged = 0
+    with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+        while True:
+            cur.execute("""
+                DELETE FROM t_p13795046_functional_diagnosti.idempotency_keys
+                WHERE key_hash IN (
+                    SELECT key_hash FROM t_p13795046_functional_diagnosti.idempotency_keys
+                    WHERE expires_at < CURRENT_TIMESTAMP
+                    LIMIT %s
+                )
+            """, (batch_size,))
+            conn.commit()
+            purged += cur.rowcount
+            if cur.rowcount < batch_size:
+                return purged
@@ -0,0 +1,251 @@
+'''
+Очередь фоновых задач в PostgreSQL (таблица jobs).
+
+Функции backend ставят задачу через enqueue() в своей транзакции и сразу отвечают клиенту,
+обработчики backend/worker.py забирают задачи через claim() (FOR UPDATE SKIP LOCKED — без блокировок
+между обработчиками) и выполняют зарегистрированную через register() функцию.
+Ошибка задачи возвращает её в очередь с экспоненциальной задержкой, пока не исчерпаны попытки;
+PermanentJobError завершает задачу сразу. Зависшие задачи упавших обработчиков возвращает requeue_stale().
+Большой результат задача пишет частями (save_result_chunk, таблица job_result_chunks), в jobs.result — только сводка.
+При шардировании (shared/shards.py) у каждого узла своя очередь: задача ставится в транзакции handler'а
+на узле врача, worker.py распределяет процессы по узлам.
+'''
+import json
+import os
+import random
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import psycopg2.extensions
+
+from shared import db
+
+JOB_RETRY_BASE_SECONDS = float(os.environ.get('JOB_RETRY_BASE_SECONDS', '5'))
+JOB_RETRY_MAX_SECONDS = float(os.environ.get('JOB_RETRY_MAX_SECONDS', '3600'))
+JOB_LOCK_TIMEOUT_SECONDS = float(os.environ.get('JOB_LOCK_TIMEOUT_SECONDS', '600'))
+
+NOTIFY_CHANNEL = 'jobs'
+
+_registry: Dict[str, Callable[[Any, 'Job'], Any]] = {}
+
+
+class PermanentJobError(Exception):
+    '''Ошибка, при которой повтор задачи бессмысленен (некорректные параметры и т.п.)'''
+
+
+class Job:
+    '''Задача, захваченная обработчиком'''
+    __slots__ = ('id', 'doctor_id', 'kind', 'payload', 'attempts', 'max_attempts', 'worker_id', 'shard')
+
+    def __init__(self, id: int, doctor_id: Optional[int], kind: str, payload: Dict[str, Any],
+                 attempts: int, max_attempts: int, worker_id: str, shard: Optional[str] = None):
+        self.id = id
+        self.doctor_id = doctor_id
+        self.kind = kind
+        self.payload = payload
+        self.attempts = attempts
+        self.max_attempts = max_attempts
+        self.worker_id = worker_id
+        # узел БД (shared/shards.py), в очереди которого лежит задача
+        self.shard = shard
+
+    def progress(self, fraction: float, message: Optional[str] = None) -> None:
+        '''Сохраняет прогресс (0..1) отдельной транзакцией, заодно продлевая блокировку задачи'''
+        conn = db.connect(shard=self.shard)
+        try:
+            with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+                cur.execute("""
+                    UPDATE t_p13795046_functional_diagnosti.jobs
+                    SET progress = %s, progress_message = %s, locked_at = CURRENT_TIMESTAMP,
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE id = %s AND locked_by = %s AND status = 'running'
+                """, (max(0.0, min(1.0, float(fraction))), message, self.id, self.worker_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+
+def register(kind: str) -> Callable:
+    '''Декоратор: регистрирует функцию (conn, job) -> результат как обработчик задач вида kind'''
+    def decorator(func: Callable) -> Callable:
+        _registry[kind] = func
+        return func
+    return decorator
+
+
+def registered_kinds() -> List[str]:
+    return sorted(_registry)
+
+
+def enqueue(cur, doctor_id: Optional[int], kind: str, payload: Optional[Dict[str, Any]] = None,
+            priority: int = 0, max_attempts: int = 5, delay_seconds: float = 0) -> int:
+    '''Ставит задачу в очередь в текущей транзакции курсора cur; задача видна обработчикам после commit'''
+    cur.execute("""
+        INSERT INTO t_p13795046_functional_diagnosti.jobs
+            (doctor_id, kind, payload, priority, max_attempts, run_at)
+        VALUES (%s, %s, %s, %s, %s, CURRENT_TIMESTAMP + make_interval(secs => %s))
+        RETURNING id
+    """, (doctor_id, kind, json.dumps(payload or {}), priority, max_attempts, delay_seconds))
+    row = cur.fetchone()
+    job_id = row['id'] if isinstance(row, dict) else row[0]
+    cur.execute("SELECT pg_notify(%s, %s)", (NOTIFY_CHANNEL, kind))
+    return job_id
+
+
+def get_job(cur, job_id: Any, doctor_id: int) -> Optional[Dict[str, Any]]:
+    '''Состояние задачи врача; результат возвращается только у выполненной задачи'''
+    cur.execute("""
+        SELECT id, kind, status, progress, progress_message, attempts, max_attempts,
+               result, error, created_at, finished_at
+        FROM t_p13795046_functional_diagnosti.jobs
+        WHERE id = %s AND doctor_id = %s
+    """, (job_id, doctor_id))
+    row = cur.fetchone()
+    if not row:
+        return None
+    if isinstance(row, dict):
+        row = tuple(row.values())
+    return {
+        'id': row[0],
+        'kind': row[1],
+        'status': row[2],
+        'progress': row[3],
+        'progress_message': row[4],
+        'attempts': row[5],
+        'max_attempts': row[6],
+        'result': row[7] if row[2] == 'done' else None,
+        'error': row[8],
+        'created_at': row[9].isoformat() if row[9] else None,
+        'finished_at': row[10].isoformat() if row[10] else None
+    }
+
+
+def save_result_chunk(cur, job: Job, chunk: int, items: List[Any]) -> None:
+    '''Записывает часть результата задачи (job_result_chunks) в текущей транзакции; повтор задачи её заменяет'''
+    cur.execute("""
+        INSERT INTO t_p13795046_functional_diagnosti.job_result_chunks (job_id, chunk, doctor_id, items)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (job_id, chunk) DO UPDATE SET items = EXCLUDED.items
+    """, (job.id, chunk, job.doctor_id, json.dumps(items)))
+
+
+def clear_result_chunks(cur, job: Job, from_chunk: int = 0) -> None:
+    '''Удаляет части результата начиная с from_chunk (остатки прежней попытки задачи)'''
+    cur.execute("""
+        DELETE FROM t_p13795046_functional_diagnosti.job_result_chunks WHERE job_id = %s AND chunk >= %s
+    """, (job.id, from_chunk))
+
+
+def get_result_chunk(cur, job_id: Any, doctor_id: int, chunk: int) -> Optional[List[Any]]:
+    '''Часть результата задачи врача или None, если её нет'''
+    cur.execute("""
+        SELECT c.items
+        FROM t_p13795046_functional_diagnosti.job_result_chunks c
+        JOIN t_p13795046_functional_diagnosti.jobs j ON j.id = c.job_id
+        WHERE c.job_id = %s AND c.chunk = %s AND j.doctor_id = %s AND j.status = 'done'
+    """, (job_id, chunk, doctor_id))
+    row = cur.fetchone()
+    if not row:
+        return None
+    return row['items'] if isinstance(row, dict) else row[0]
+
+
+def claim(conn, worker_id: str, kinds: Optional[Sequence[str]] = None) -> Optional[Job]:
+    '''Захватывает следующую готовую задачу; задачи, захваченные другими обработчиками, пропускаются'''
+    kind_filter = 'AND kind = ANY(%s)' if kinds else ''
+    params: List[Any] = [worker_id]
+    if kinds:
+        params.append(list(kinds))
+    with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+        cur.execute(f"""
+            UPDATE t_p13795046_functional_diagnosti.jobs
+            SET status = 'running', attempts = attempts + 1, locked_by = %s,
+                locked_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+            WHERE id = (
+                SELECT id FROM t_p13795046_functional_diagnosti.jobs
+                WHERE status = 'queued' AND run_at <= CURRENT_TIMESTAMP {kind_filter}
+                ORDER BY priority DESC, run_at, id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, doctor_id, kind, payload, attempts, max_attempts
+        """, params)
+        row = cur.fetchone()
+    conn.commit()
+    if not row:
+        return None
+    return Job(row[0], row[1], row[2], row[3] or {}, row[4], row[5], worker_id, getattr(conn, 'shard', None))
+
+
+def complete(conn, job: Job, result: Any) -> None:
+    with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+        cur.execute("""
+            UPDATE t_p13795046_functional_diagnosti.jobs
+            SET status = 'done', progress = 1, result = %s, error = NULL, locked_by = NULL,
+                locked_at = NULL, updated_at = CURRENT_TIMESTAMP, finished_at = CURRENT_TIMESTAMP
+            WHERE id = %s AND locked_by = %s
+        """, (json.dumps(result), job.id, job.worker_id))
+    conn.commit()
+
+
+def backoff_seconds(attempts: int) -> float:
+    '''Задержка перед повтором: base * 2^(attempts-1), не больше JOB_RETRY_MAX_SECONDS, ±20% разброса'''
+    delay = min(JOB_RETRY_MAX_SECONDS, JOB_RETRY_BASE_SECONDS * (2 ** max(attempts - 1, 0)))
+    return delay * random.uniform(0.8, 1.2)
+
+
+def fail(conn, job: Job, error: str, permanent: bool = False) -> None:
+    '''Возвращает задачу в очередь с задержкой или окончательно помечает её неудавшейся'''
+    final = permanent or job.attempts >= job.max_attempts
+    with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+        cur.execute("""
+            UPDATE t_p13795046_functional_diagnosti.jobs
+            SET status = %s, error = %s, locked_by = NULL, locked_at = NULL,
+                run_at = CURRENT_TIMESTAMP + make_interval(secs => %s),
+                updated_at = CURRENT_TIMESTAMP,
+                finished_at = CASE WHEN %s THEN CURRENT_TIMESTAMP END
+            WHERE id = %s AND locked_by = %s
+        """, ('failed' if final else 'queued', error[:4000], 0 if final else backoff_seconds(job.attempts),
+              final, job.id, job.worker_id))
+    conn.commit()
+
+
+def requeue_stale(conn, timeout_seconds: float = JOB_LOCK_TIMEOUT_SECONDS) -> int:
+    '''Возвращает в очередь задачи, чей обработчик не обновлял блокировку дольше timeout_seconds'''
+    with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+        cur.execute("""
+            UPDATE t_p13795046_functional_diagnosti.jobs
+            SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'queued' END,
+                error = 'Обработчик не завершил задачу', locked_by = NULL, locked_at = NULL,
+                updated_at = CURRENT_TIMESTAMP,
+                finished_at = CASE WHEN attempts >= max_attempts THEN CURRENT_TIMESTAMP END
+            WHERE status = 'running'
+              AND locked_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+        """, (timeout_seconds,))
+        count = cur.rowcount
+    conn.commit()
+    return count
+
+
+def run_next(conn, worker_id: str, kinds: Optional[Sequence[str]] = None) -> bool:
+    '''Захватывает и выполняет одну задачу; False, если готовых задач нет'''
+    job = claim(conn, worker_id, kinds)
+    if job is None:
+        return False
+
+    func = _registry.get(job.kind)
+    if func is None:
+        fail(conn, job, f'Неизвестный тип задачи: {job.kind}', permanent=True)
+        return True
+
+    try:
+        result = func(conn, job)
+    except PermanentJobError as e:
+        conn.rollback()
+        fail(conn, job, str(e), permanent=True)
+    except Exception as e:
+        conn.rollback()
+        fail(conn, job, f'{type(e).__name__}: {e}')
+    else:
+        # изменения задачи и отметка о выполнении фиксируются одной транзакцией
+        complete(conn, job, result)
+    return True
@@ -0,0 +1,394 @@
+'''
+Метрики процесса: счётчики и гистограммы с фиксированными корзинами в памяти, экспорт в текстовом формате Prometheus.
+
+Handler функции оборачивается декоратором instrumented(): на каждый запрос — счётчик запросов и ошибок,
+гистограмма длительности по функции, методу и действию (action из тела, type из параметров) и гистограмма
+числа запросов к БД (их считают shared/db.py и shared/adb.py через record_query()). Пулы соединений и кэши
+добавляют свои значения через register_callback() и cache_result(). При CAPTURE_DIR запрос ещё и записывается
+для воспроизведения (shared/capture.py).
+
+Куда попадают метрики:
+- self-hosted (serve.py): каждый рабочий процесс раз в METRICS_FLUSH_SECONDS пишет снимок в каталог
+  start_worker_sink(), а GET /metrics суммирует снимки живых процессов;
+- облачные функции: при заданном METRICS_TEXTFILE снимок процесса не чаще METRICS_FLUSH_SECONDS
+  записывается в этот файл (формат textfile collector node_exporter).
+Обновление метрики — одна блокировка и поиск корзины bisect, без выделения памяти на запрос.
+'''
+import asyncio
+import bisect
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from shared import capture
+
+METRICS_TEXTFILE = os.environ.get('METRICS_TEXTFILE')
+METRICS_FLUSH_SECONDS = float(os.environ.get('METRICS_FLUSH_SECONDS', '5'))
+# Значения action приходят от клиента: сверх лимита на функцию они считаются как other
+MAX_ACTIONS = int(os.environ.get('METRICS_MAX_ACTIONS', '50'))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+Labels = Tuple[str, ...]
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: Labels = (), amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def samples(self) -> List[list]:
+        with self._lock:
+            return [[list(labels), value] for labels, value in self._values.items()]
+
+
+class Histogram:
+    '''Гистограмма с фиксированными верхними границами корзин; значение — [счётчики корзин и +Inf, сумма]'''
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values: Dict[Labels, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, labels: Labels = ()) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def samples(self) -> List[list]:
+        with self._lock:
+            return [[list(labels), [list(counts), total]] for labels, (counts, total) in self._values.items()]
+
+
+class Callback:
+    '''Метрика, значения которой вычисляются при снятии снимка: fn() -> {метки: значение}'''
+
+    def __init__(self, name: str, help: str, kind: str, labelnames: Sequence[str],
+                 fn: Callable[[], Dict[Labels, float]]):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.fn = fn
+
+    def samples(self) -> List[list]:
+        try:
+            return [[list(labels), float(value)] for labels, value in self.fn().items()]
+        except Exception:
+            return []
+
+
+_registry: Dict[str, Any] = {}
+_registry_lock = threading.Lock()
+
+
+def _register(metric: Any) -> Any:
+    with _registry_lock:
+        existing = _registry.get(metric.name)
+        if existing is not None and not isinstance(metric, Callback):
+            # Повторный импорт модуля (перезагрузка handler) продолжает те же ряды
+            return existing
+        _registry[metric.name] = metric
+    return metric
+
+
+def counter(name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+    return _register(Counter(name, help, labelnames))
+
+
+def histogram(name: str, help: str, labelnames: Sequence[str] = (),
+              buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+    return _register(Histogram(name, help, labelnames, buckets))
+
+
+def register_callback(name: str, help: str, kind: str, labelnames: Sequence[str],
+                      fn: Callable[[], Dict[Labels, float]]) -> None:
+    '''Значения gauge или counter, которые хранит сам источник (пул соединений, lru_cache)'''
+    _register(Callback(name, help, kind, labelnames, fn))
+
+
+REQUESTS = counter('fd_requests_total', 'Запросы к функциям', ('function', 'method', 'action', 'status'))
+ERRORS = counter('fd_request_errors_total', 'Запросы с ответом 5xx или необработанным исключением',
+                 ('function', 'method', 'action'))
+LATENCY = histogram('fd_request_duration_seconds', 'Длительность запроса', ('function', 'method', 'action'))
+DB_QUERIES = histogram('fd_db_queries_per_request', 'Запросов к БД на один запрос к функции',
+                       ('function', 'method', 'action'), QUERY_BUCKETS)
+CACHE = counter('fd_cache_requests_total', 'Обращения к кэшам: hit или miss', ('cache', 'result'))
+
+_queries: contextvars.ContextVar = contextvars.ContextVar('fd_metrics_queries', default=None)
+_actions: Dict[str, set] = {}
+
+
+def record_query() -> None:
+    '''Учитывает запрос к БД в текущем запросе к функции (вне instrumented ничего не делает)'''
+    queries = _queries.get()
+    if queries is not None:
+        queries[0] += 1
+
+
+def cache_result(cache: str, hit: bool) -> None:
+    CACHE.inc((cache, 'hit' if hit else 'miss'))
+
+
+def request_action(event: Dict[str, Any]) -> str:
+    '''Действие запроса для меток: action из тела JSON, иначе type или action из параметров, иначе item/list'''
+    body = event.get('body')
+    if body and '"action"' in body:
+        try:
+            action = json.loads(body).get('action')
+        except (ValueError, AttributeError):
+            action = None
+        if isinstance(action, str) and action:
+            return action
+    query = event.get('queryStringParameters') or {}
+    action = query.get('type') or query.get('action')
+    if action:
+        return action
+    return 'item' if query.get('id') else 'list'
+
+
+def _action_label(function_name: str, action: str) -> str:
+    seen = _actions.setdefault(function_name, set())
+    if action in seen:
+        return action
+    if len(seen) >= MAX_ACTIONS:
+        return 'other'
+    seen.add(action)
+    return action
+
+
+def _observe(function_name: str, event: Dict[str, Any], status: int, elapsed: float, queries: int) -> None:
+    method = event.get('httpMethod', 'GET')
+    action = _action_label(function_name, request_action(event))
+    labels = (function_name, method, action)
+    REQUESTS.inc(labels + (str(status),))
+    if status >= 500:
+        ERRORS.inc(labels)
+    LATENCY.observe(elapsed, labels)
+    DB_QUERIES.observe(queries, labels)
+    capture.record(function_name, event, status, elapsed, queries)
+    maybe_flush_textfile()
+
+
+def instrumented(function_name: str) -> Callable:
+    '''Декоратор handler или handler_async функции function_name: метрики запроса и числа запросов к БД'''
+    def decorator(handler: Callable) -> Callable:
+        if asyncio.iscoroutinefunction(handler):
+            @functools.wraps(handler)
+            async def async_wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+                if _queries.get() is not None:
+                    return await handler(event, context)
+                queries = [0]
+                token = _queries.set(queries)
+                started = time.perf_counter()
+                status = 500
+                try:
+                    response = await handler(event, context)
+                    status = int(response.get('statusCode', 200))
+                    return response
+                finally:
+                    _queries.reset(token)
+                    _observe(function_name, event, status, time.perf_counter() - started, queries[0])
+            return async_wrapper
+
+        @functools.wraps(handler)
+        def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+            # handler, вызванный из уже учитываемого handler_async (adb.run_sync переносит контекст), не учитывается повторно
+            if _queries.get() is not None:
+                return handler(event, context)
+            queries = [0]
+            token = _queries.set(queries)
+            started = time.perf_counter()
+            status = 500
+            try:
+                response = handler(event, context)
+                status = int(response.get('statusCode', 200))
+                return response
+            finally:
+                _queries.reset(token)
+                _observe(function_name, event, status, time.perf_counter() - started, queries[0])
+        return wrapper
+    return decorator
+
+
+def snapshot() -> Dict[str, Any]:
+    '''Текущие значения всех метрик процесса в виде JSON-совместимого словаря'''
+    with _registry_lock:
+        metrics = list(_registry.values())
+    result = {}
+    for metric in metrics:
+        item = {'kind': metric.kind, 'help': metric.help, 'labels': list(metric.labelnames),
+                'samples': metric.samples()}
+        if isinstance(metric, Histogram):
+            item['buckets'] = list(metric.buckets)
+        result[metric.name] = item
+    return result
+
+
+def merge(snapshots: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    '''Сумма снимков нескольких процессов: счётчики, gauge и корзины гистограмм складываются'''
+    merged: Dict[str, Any] = {}
+    for process_snapshot in snapshots:
+        for name, item in process_snapshot.items():
+            target = merged.setdefault(name, dict(item, samples={}))
+            if item.get('buckets') != target.get('buckets'):
+                continue
+            samples = target['samples']
+            for labels, value in item['samples']:
+                key = tuple(labels)
+                if item['kind'] == 'histogram':
+                    current = samples.get(key)
+                    if current is None:
+                        samples[key] = [list(value[0]), value[1]]
+                    else:
+                        current[0] = [a + b for a, b in zip(current[0], value[0])]
+                        current[1] += value[1]
+                else:
+                    samples[key] = samples.get(key, 0.0) + value
+    for item in merged.values():
+        item['samples'] = [[list(labels), value] for labels, value in item['samples'].items()]
+    return merged
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def render(metrics_snapshot: Optional[Dict[str, Any]] = None) -> str:
+    '''Снимок (по умолчанию текущего процесса) в текстовом формате Prometheus 0.0.4'''
+    if metrics_snapshot is None:
+        metrics_snapshot = snapshot()
+    lines: List[str] = []
+    for name in sorted(metrics_snapshot):
+        item = metrics_snapshot[name]
+        lines.append(f'# HELP {name} {item["help"]}')
+        lines.append(f'# TYPE {name} {item["kind"]}')
+        names = item['labels']
+        for labels, value in sorted(item['samples'], key=lambda sample: sample[0]):
+            if item['kind'] != 'histogram':
+                lines.append(f'{name}{_labels(names, labels)} {_number(value)}')
+                continue
+            counts, total = value
+            cumulative = 0
+            for bound, count in zip(item['buckets'] + ['+Inf'], counts):
+                cumulative += count
+                le = 'le="' + (bound if bound == '+Inf' else _number(bound)) + '"'
+                lines.append(f'{name}_bucket{_labels(names, labels, le)} {cumulative}')
+            lines.append(f'{name}_sum{_labels(names, labels)} {_number(total)}')
+            lines.append(f'{name}_count{_labels(names, labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+def _write_atomic(path: str, data: str) -> None:
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'w', encoding='utf-8') as f:
+        f.write(data)
+    os.replace(temporary, path)
+
+
+_last_flush = [0.0]
+
+
+def maybe_flush_textfile() -> None:
+    '''Облачный режим: снимок процесса в METRICS_TEXTFILE не чаще METRICS_FLUSH_SECONDS'''
+    if not METRICS_TEXTFILE:
+        return
+    now = time.monotonic()
+    if now - _last_flush[0] < METRICS_FLUSH_SECONDS:
+        return
+    _last_flush[0] = now
+    try:
+        _write_atomic(METRICS_TEXTFILE, render())
+    except OSError:
+        pass
+
+
+def worker_snapshot_path(directory: str, pid: int) -> str:
+    return os.path.join(directory, f'worker-{pid}.json')
+
+
+def flush_worker(directory: str) -> None:
+    try:
+        _write_atomic(worker_snapshot_path(directory, os.getpid()), json.dumps(snapshot()))
+    except OSError:
+        pass
+
+
+def start_worker_sink(directory: str) -> threading.Event:
+    '''Рабочий процесс serve.py: снимок в directory раз в METRICS_FLUSH_SECONDS; set() события — остановка'''
+    stopped = threading.Event()
+
+    def run() -> None:
+        while not stopped.wait(METRICS_FLUSH_SECONDS):
+            flush_worker(directory)
+        flush_worker(directory)
+
+    threading.Thread(target=run, name='metrics-sink', daemon=True).start()
+    return stopped
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def collect_workers(directory: str) -> str:
+    '''Текст /metrics: свежий снимок текущего процесса и последние снимки остальных живых рабочих процессов'''
+    snapshots = [snapshot()]
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        names = []
+    for name in names:
+        if not (name.startswith('worker-') and name.endswith('.json')):
+            continue
+        try:
+            pid = int(name[len('worker-'):-len('.json')])
+        except ValueError:
+            continue
+        if pid == os.getpid() or not _alive(pid):
+            continue
+        try:
+            with open(os.path.join(directory, name), encoding='utf-8') as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return render(merge(snapshots))
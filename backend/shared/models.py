@@ -0,0 +1,134 @@
+'''
+Записи строк БД для ответов API: классы со __slots__ и сгенерированным сериализатором на каждый тип.
+
+Тип объявляется через record(): столбцы в порядке SELECT (COLUMNS — готовый список для запроса)
+и выражения для полей JSON, отличающихся от значения столбца. По ним один раз при импорте
+генерируется код сериализатора serialize() — строка обычного курсора psycopg2 или asyncpg.Record сразу
+в словарь для json.dumps, без промежуточного dict(row), циклов по полям и проверок типов на каждую строку;
+лишние столбцы в конце строки игнорируются. from_row() и to_dict() делают то же через запись со __slots__,
+когда строке нужны поля по именам.
+'''
+import json
+import re
+from typing import Any, Dict, List, Optional, Sequence
+
+# Шаблоны выражений; {0} — имя столбца
+ISO = '{0}.isoformat() if {0} else None'
+FLOAT = 'float({0}) if {0} else None'
+STR = 'str({0}) if {0} is not None else None'
+
+
+def record(name: str, columns: Sequence[str], expressions: Optional[Dict[str, str]] = None,
+           output: Optional[Sequence[str]] = None, namespace: Optional[Dict[str, Any]] = None) -> type:
+    '''
+    Класс записи name со столбцами columns. expressions — выражения полей JSON через имена столбцов
+    (шаблон с {0} подставляет имя поля); output — поля JSON по порядку, по умолчанию все столбцы.
+    namespace — функции, на которые ссылаются выражения.
+    '''
+    expressions = {key: expression.replace('{0}', key) for key, expression in (expressions or {}).items()}
+    output = tuple(output or columns)
+    # Столбцы из выражений читаются в локальные переменные один раз, остальные подставляются по месту
+    referenced = [c for c in columns if any(re.search(rf'\b{c}\b', e) for e in expressions.values())]
+
+    def body(source: str) -> List[str]:
+        access = {column: source.format(index=index, column=column) for index, column in enumerate(columns)}
+        items = ', '.join(f'{key!r}: {expressions[key] if key in expressions else access[key]}' for key in output)
+        return [f'    {column} = {access[column]}' for column in referenced] + [f'    return {{{items}}}']
+
+    lines = ['def from_row(row):',
+             '    self = new(cls)']
+    lines += [f'    self.{column} = row[{index}]' for index, column in enumerate(columns)]
+    lines += ['    return self', '', 'def serialize(row):'] + body('row[{index}]')
+    lines += ['', 'def to_dict(self):'] + body('self.{column}')
+
+    cls = type(name, (), {
+        '__slots__': tuple(columns),
+        '__doc__': f'Строка {name}: {", ".join(columns)}',
+        'COLUMNS': ', '.join(columns),
+        'FIELDS': output,
+        '__repr__': lambda self: f'{name}({", ".join(f"{c}={getattr(self, c)!r}" for c in columns)})',
+    })
+    scope = dict(namespace or {}, cls=cls, new=object.__new__)
+    exec(compile('\n'.join(lines), f'<record {name}>', 'exec'), scope)
+    cls.from_row = staticmethod(scope['from_row'])
+    cls.serialize = staticmethod(scope['serialize'])
+    cls.to_dict = scope['to_dict']
+    return cls
+
+
+def serialize_rows(model: type, rows: Sequence[Any]) -> List[Dict[str, Any]]:
+    '''Строки курсора -> словари JSON типа model'''
+    return list(map(model.serialize, rows))
+
+
+def serialize_row(model: type, row: Optional[Any]) -> Optional[Dict[str, Any]]:
+    return model.serialize(row) if row is not None else None
+
+
+def _legacy_age(legacy: Any) -> Any:
+    '''Возраст из старого текстового поля patient_age (JSON или строка как есть)'''
+    if legacy:
+        try:
+            return json.loads(legacy)
+        except (json.JSONDecodeError, TypeError):
+            pass
+    return legacy
+
+
+Doctor = record(
+    'Doctor',
+    ('id', 'email', 'full_name', 'specialization', 'signature_url', 'created_at'),
+    {'created_at': ISO},
+)
+
+Protocol = record(
+    'Protocol',
+    ('id', 'doctor_id', 'study_type', 'patient_name', 'patient_gender',
+     'patient_birth_date', 'patient_age', 'patient_weight', 'patient_height',
+     'patient_bsa', 'ultrasound_device', 'study_date', 'results', 'results_min_max',
+     'conclusion', 'signed', 'created_at',
+     'patient_age_years', 'patient_age_months', 'patient_age_days', 'patient_id'),
+    {
+        'patient_birth_date': ISO,
+        'patient_age': "{'years': patient_age_years, 'months': patient_age_months, 'days': patient_age_days} "
+                       "if patient_age_years is not None else legacy_age(patient_age)",
+        'patient_weight': FLOAT,
+        'patient_height': FLOAT,
+        'patient_bsa': FLOAT,
+        'study_date': ISO,
+        'created_at': ISO,
+    },
+    output=('id', 'doctor_id', 'study_type', 'patient_name', 'patient_gender', 'patient_birth_date',
+            'patient_age', 'patient_weight', 'patient_height', 'patient_bsa', 'ultrasound_device',
+            'study_date', 'results', 'results_min_max', 'conclusion', 'signed', 'created_at', 'patient_id'),
+    namespace={'legacy_age': _legacy_age},
+)
+
+# Строка объединённого набора норм врача (doctor-settings/norm_library.py); source — own, override или base
+NormTable = record(
+    'NormTable',
+    ('id', 'doctor_id', 'study_type', 'category', 'parameter', 'norm_type', 'rows',
+     'show_in_report', 'conclusion_below', 'conclusion_above',
+     'conclusion_borderline_low', 'conclusion_borderline_high',
+     'created_at', 'updated_at', 'base_key', 'source'),
+    {'id': STR, 'created_at': ISO, 'updated_at': ISO},
+)
+
+ConclusionTemplate = record(
+    'ConclusionTemplate',
+    ('id', 'doctor_id', 'study_type', 'template_name', 'priority', 'conditions', 'conclusion_text',
+     'created_at', 'updated_at'),
+    {'created_at': ISO, 'updated_at': ISO},
+)
+
+InputSettings = record(
+    'InputSettings',
+    ('id', 'doctor_id', 'study_type', 'field_order', 'enabled_fields', 'created_at', 'updated_at'),
+    {'created_at': ISO, 'updated_at': ISO},
+)
+
+ClinicSettings = record(
+    'ClinicSettings',
+    ('id', 'clinic_name', 'address', 'phone', 'logo_url', 'created_at', 'updated_at', 'doctor_id'),
+    {'created_at': ISO, 'updated_at': ISO},
+)
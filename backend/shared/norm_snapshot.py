@@ -0,0 +1,395 @@
+'''
+Скомпилированный бинарный снимок норм врача, общий для всех процессов на хосте.
+
+Объединённый набор таблиц норм (см. doctor-settings/norm_library.py) компилируется в файл
+NORM_SNAPSHOT_DIR/doctor-<id>.norms: массивы float64 границ интервалов и норм, отсортированные
+по началу интервала, целочисленные метаданные таблиц и таблица строк (ключи и заключения).
+Файл записывается атомарно (временный файл + os.replace), процессы открывают его через mmap
+и читают как представления NumPy без копирования: страницы файла общие для всех процессов
+в кэше ОС, запуск нового процесса не требует ни запроса к БД, ни разбора JSON.
+
+Снимок помечен версией библиотеки и doctors.norms_revision; load() возвращает снимок, только
+если пометка совпадает с переданным состоянием, иначе вызывающий строит новый через write().
+check() повторяет логику checkParameterNorms из src/utils/normsChecker.ts.
+'''
+import mmap
+import os
+import re
+import struct
+import tempfile
+import threading
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from shared import metrics
+
+NORM_SNAPSHOT_DIR = os.environ.get('NORM_SNAPSHOT_DIR', os.path.join(tempfile.gettempdir(), 'fd-norm-snapshots'))
+
+MAGIC = b'FDNS'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sHHiiiIIII')
+
+ADULT_AGE_YEARS = 18
+
+# Измерения пациента, с которыми сравнивается интервал строки (возраст — в единицах строки)
+DIMENSIONS = ('age_years', 'age_months', 'age_days', 'weight', 'height', 'bsa')
+AGE_UNIT_DIMENSIONS = {'years': 0, 'months': 1, 'days': 2}
+NORM_TYPE_DIMENSIONS = {'weight': 3, 'height': 4, 'bsa': 5}
+
+# Столбцы массивов снимка
+ROW_RANGE_FROM, ROW_RANGE_TO, ROW_NORM_FROM, ROW_NORM_TO, ROW_BORDERLINE_LOW, ROW_BORDERLINE_HIGH = range(6)
+ROW_FLOAT_COLUMNS = 6
+(TABLE_KEY, TABLE_ID, TABLE_GROUP_START, TABLE_GROUP_END, TABLE_BELOW, TABLE_ABOVE,
+ TABLE_BORDERLINE_LOW, TABLE_BORDERLINE_HIGH, TABLE_SHOW_IN_REPORT) = range(9)
+TABLE_COLUMNS = 9
+GROUP_DIMENSION, GROUP_ROW_START, GROUP_ROW_END = range(3)
+GROUP_COLUMNS = 3
+
+KEY_SEPARATOR = '\x1f'
+
+_NUMBER_PREFIX = re.compile(r'\s*([+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)')
+
+_snapshots: Dict[int, 'NormSnapshot'] = {}
+_snapshots_lock = threading.Lock()
+
+
+class NormCheck(NamedTuple):
+    status: str
+    norm_min: Optional[float] = None
+    norm_max: Optional[float] = None
+    borderline_low: Optional[float] = None
+    borderline_high: Optional[float] = None
+    conclusion: Optional[str] = None
+    table_id: Optional[str] = None
+
+
+NORMAL = NormCheck('normal')
+
+
+def parse_float(value: Any) -> float:
+    '''Число как parseFloat в JS: ведущая числовая часть строки, иначе NaN'''
+    if value is None or isinstance(value, bool):
+        return float('nan')
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = _NUMBER_PREFIX.match(str(value))
+    return float(match.group(1)) if match else float('nan')
+
+
+def patient_category(gender: Optional[str], age_years: int) -> Optional[str]:
+    if gender == 'male':
+        return 'child_male' if age_years < ADULT_AGE_YEARS else 'adult_male'
+    if gender == 'female':
+        return 'child_female' if age_years < ADULT_AGE_YEARS else 'adult_female'
+    return None
+
+
+def patient_dimensions(years: float, months: float, days: float,
+                       weight: Any = None, height: Any = None, bsa: Any = None) -> np.ndarray:
+    '''Значения измерений пациента в порядке DIMENSIONS; NaN — измерение неизвестно'''
+    bsa_value = parse_float(bsa)
+    return np.array([
+        years + months / 12 + days / 365.25,
+        years * 12 + months + days / 30.44,
+        years * 365.25 + months * 30.44 + days,
+        parse_float(weight),
+        parse_float(height),
+        bsa_value if bsa_value else float('nan'),
+    ], dtype=np.float64)
+
+
+def snapshot_path(doctor_id: int, directory: Optional[str] = None) -> str:
+    return os.path.join(directory or NORM_SNAPSHOT_DIR, f'doctor-{doctor_id}.norms')
+
+
+def _aligned(offset: int) -> int:
+    return (offset + 7) & ~7
+
+
+def _layout(n_tables: int, n_groups: int, n_rows: int, n_strings: int) -> Dict[str, int]:
+    '''Смещения секций файла; каждая секция выровнена на 8 байт'''
+    offsets: Dict[str, int] = {}
+    offset = _aligned(HEADER.size)
+    for name, size in (('rows', n_rows * ROW_FLOAT_COLUMNS * 8),
+                       ('row_order', n_rows * 4),
+                       ('tables', n_tables * TABLE_COLUMNS * 4),
+                       ('groups', n_groups * GROUP_COLUMNS * 4),
+                       ('string_offsets', (n_strings + 1) * 4)):
+        offsets[name] = offset
+        offset = _aligned(offset + size)
+    offsets['strings'] = offset
+    return offsets
+
+
+def compile_tables(tables: Sequence[Dict[str, Any]]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, List[str]]:
+    '''
+    Таблицы норм (поля norm_tables) -> массивы снимка.
+    Таблицы одного ключа (вид исследования, параметр, категория) идут подряд в исходном порядке;
+    строки таблицы разбиты на группы по измерению и отсортированы по началу интервала,
+    row_order хранит исходный номер строки (при пересечении интервалов побеждает первая строка).
+    Строки без числовых границ интервала и строки возрастных таблиц без единицы пропускаются,
+    как и в normsChecker.ts.
+    '''
+    strings: List[str] = []
+    string_index: Dict[str, int] = {}
+
+    def intern(text: Optional[str]) -> int:
+        if not text:
+            return -1
+        if text not in string_index:
+            string_index[text] = len(strings)
+            strings.append(text)
+        return string_index[text]
+
+    by_key: Dict[str, List[Dict[str, Any]]] = {}
+    for table in tables:
+        key = KEY_SEPARATOR.join((table['study_type'], table['parameter'], table['category']))
+        by_key.setdefault(key, []).append(table)
+
+    row_values: List[Tuple[float, ...]] = []
+    row_order: List[int] = []
+    table_meta: List[Tuple[int, ...]] = []
+    group_meta: List[Tuple[int, int, int]] = []
+
+    for key, key_tables in by_key.items():
+        key_code = intern(key)
+        for table in key_tables:
+            groups: Dict[int, List[Tuple[int, Tuple[float, ...]]]] = {}
+            for order, row in enumerate(table.get('rows') or []):
+                values = (parse_float(row.get('rangeFrom')), parse_float(row.get('rangeTo')),
+                          parse_float(row.get('parameterFrom')), parse_float(row.get('parameterTo')),
+                          parse_float(row.get('borderlineLow')) if row.get('borderlineLow') else float('nan'),
+                          parse_float(row.get('borderlineHigh')) if row.get('borderlineHigh') else float('nan'))
+                if np.isnan(values[ROW_RANGE_FROM]) or np.isnan(values[ROW_RANGE_TO]):
+                    continue
+                if table['norm_type'] == 'age':
+                    dimension = AGE_UNIT_DIMENSIONS.get(row.get('rangeUnit'))
+                else:
+                    dimension = NORM_TYPE_DIMENSIONS.get(table['norm_type'])
+                if dimension is None:
+                    continue
+                groups.setdefault(dimension, []).append((order, values))
+
+            group_start = len(group_meta)
+            for dimension, rows in sorted(groups.items()):
+                rows.sort(key=lambda item: (item[1][ROW_RANGE_FROM], item[0]))
+                row_start = len(row_values)
+                for order, values in rows:
+                    row_values.append(values)
+                    row_order.append(order)
+                group_meta.append((dimension, row_start, len(row_values)))
+
+            table_meta.append((
+                key_code, intern(str(table['id'])), group_start, len(group_meta),
+                intern(table.get('conclusion_below')), intern(table.get('conclusion_above')),
+                intern(table.get('conclusion_borderline_low')), intern(table.get('conclusion_borderline_high')),
+                int(table.get('show_in_report', True) is not False),
+            ))
+
+    return (np.array(row_values, dtype=np.float64).reshape(-1, ROW_FLOAT_COLUMNS),
+            np.array(row_order, dtype=np.int32),
+            np.array(table_meta, dtype=np.int32).reshape(-1, TABLE_COLUMNS),
+            np.array(group_meta, dtype=np.int32).reshape(-1, GROUP_COLUMNS),
+            strings)
+
+
+def _read_header(path: str) -> Optional[Tuple[Any, ...]]:
+    try:
+        with open(path, 'rb') as f:
+            header = HEADER.unpack(f.read(HEADER.size))
+    except (OSError, struct.error):
+        return None
+    if header[0] != MAGIC or header[1] != FORMAT_VERSION:
+        return None
+    return header
+
+
+def write(doctor_id: int, tables: Sequence[Dict[str, Any]], library_version: Optional[int],
+          norms_revision: int, directory: Optional[str] = None) -> 'NormSnapshot':
+    '''Компилирует и атомарно записывает снимок; более новый снимок другого процесса не перезаписывается'''
+    path = snapshot_path(doctor_id, directory)
+    state = (library_version if library_version is not None else -1, norms_revision)
+    existing = _read_header(path)
+    if existing is not None and existing[3] == doctor_id and (existing[4], existing[5]) >= state:
+        return NormSnapshot.open(path)
+
+    rows, row_order, table_meta, group_meta, strings = compile_tables(tables)
+    encoded = [text.encode('utf-8') for text in strings]
+    string_offsets = np.zeros(len(encoded) + 1, dtype=np.uint32)
+    if encoded:
+        string_offsets[1:] = np.cumsum([len(item) for item in encoded])
+    layout = _layout(len(table_meta), len(group_meta), len(rows), len(encoded))
+
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f'.doctor-{doctor_id}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, FORMAT_VERSION, 0, doctor_id, state[0], state[1],
+                                len(table_meta), len(group_meta), len(rows), len(encoded)))
+            for name, array in (('rows', rows), ('row_order', row_order), ('tables', table_meta),
+                                ('groups', group_meta), ('string_offsets', string_offsets)):
+                f.seek(layout[name])
+                f.write(array.tobytes())
+            f.seek(layout['strings'])
+            f.write(b''.join(encoded))
+            f.truncate(layout['strings'] + int(string_offsets[-1]))
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+    snapshot = NormSnapshot.open(path)
+    with _snapshots_lock:
+        _snapshots[doctor_id] = snapshot
+    return snapshot
+
+
+def load(doctor_id: int, library_version: Optional[int], norms_revision: int,
+         directory: Optional[str] = None) -> Optional['NormSnapshot']:
+    '''
+    Снимок врача для состояния (версия библиотеки, ревизия норм) или None, если его нет или он устарел.
+    Открытый снимок переиспользуется, пока файл не заменён (сравнение inode и mtime).
+    '''
+    path = snapshot_path(doctor_id, directory)
+    state = (library_version if library_version is not None else -1, norms_revision)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        metrics.cache_result('norm_snapshot', False)
+        return None
+    identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    with _snapshots_lock:
+        snapshot = _snapshots.get(doctor_id)
+    if snapshot is None or snapshot.path != path or snapshot.identity != identity:
+        try:
+            snapshot = NormSnapshot.open(path)
+        except (OSError, ValueError):
+            metrics.cache_result('norm_snapshot', False)
+            return None
+        with _snapshots_lock:
+            _snapshots[doctor_id] = snapshot
+    metrics.cache_result('norm_snapshot', snapshot.state == state)
+    return snapshot if snapshot.state == state else None
+
+
+class NormSnapshot:
+    '''Снимок норм врача поверх mmap; массивы — представления NumPy без копирования'''
+    __slots__ = ('path', 'identity', 'doctor_id', 'state', 'rows', 'row_order', 'tables', 'groups',
+                 '_mmap', '_string_offsets', '_strings_start', '_keys')
+
+    def __init__(self, path: str, identity: Tuple[int, int, int], buffer: mmap.mmap):
+        header = HEADER.unpack_from(buffer, 0)
+        magic, version, _, doctor_id, library_version, norms_revision, n_tables, n_groups, n_rows, n_strings = header
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f'Неизвестный формат снимка норм: {path}')
+        layout = _layout(n_tables, n_groups, n_rows, n_strings)
+
+        self.path = path
+        self.identity = identity
+        self.doctor_id = doctor_id
+        self.state = (library_version, norms_revision)
+        self._mmap = buffer
+        self.rows = np.frombuffer(buffer, np.float64, n_rows * ROW_FLOAT_COLUMNS,
+                                  layout['rows']).reshape(n_rows, ROW_FLOAT_COLUMNS)
+        self.row_order = np.frombuffer(buffer, np.int32, n_rows, layout['row_order'])
+        self.tables = np.frombuffer(buffer, np.int32, n_tables * TABLE_COLUMNS,
+                                    layout['tables']).reshape(n_tables, TABLE_COLUMNS)
+        self.groups = np.frombuffer(buffer, np.int32, n_groups * GROUP_COLUMNS,
+                                    layout['groups']).reshape(n_groups, GROUP_COLUMNS)
+        self._string_offsets = np.frombuffer(buffer, np.uint32, n_strings + 1, layout['string_offsets'])
+        self._strings_start = layout['strings']
+
+        # Индекс ключей — единственная структура, которая строится в памяти процесса
+        self._keys: Dict[str, Tuple[int, int]] = {}
+        for index, key_code in enumerate(self.tables[:, TABLE_KEY].tolist()):
+            key = self.string(key_code)
+            start, _ = self._keys.get(key, (index, index))
+            self._keys[key] = (start, index + 1)
+
+    @classmethod
+    def open(cls, path: str) -> 'NormSnapshot':
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(path, (stat.st_ino, stat.st_mtime_ns, stat.st_size), buffer)
+
+    def string(self, index: int) -> Optional[str]:
+        if index < 0:
+            return None
+        start = self._strings_start + int(self._string_offsets[index])
+        end = self._strings_start + int(self._string_offsets[index + 1])
+        return self._mmap[start:end].decode('utf-8')
+
+    def __len__(self) -> int:
+        return len(self.tables)
+
+    def find_row(self, study_type: str, parameter: str, category: str,
+                 dimensions: np.ndarray) -> Optional[Tuple[int, int]]:
+        '''(таблица, строка) первой таблицы ключа, в интервал которой попадает пациент'''
+        span = self._keys.get(KEY_SEPARATOR.join((study_type, parameter, category)))
+        if span is None:
+            return None
+        for table in range(*span):
+            best_row = -1
+            best_order = 0
+            group_start, group_end = self.tables[table, TABLE_GROUP_START:TABLE_GROUP_END + 1]
+            for dimension, row_start, row_end in self.groups[group_start:group_end].tolist():
+                x = dimensions[dimension]
+                if np.isnan(x):
+                    continue
+                count = int(np.searchsorted(self.rows[row_start:row_end, ROW_RANGE_FROM], x, side='right'))
+                if not count:
+                    continue
+                matches = np.flatnonzero(self.rows[row_start:row_start + count, ROW_RANGE_TO] >= x)
+                if not len(matches):
+                    continue
+                orders = self.row_order[row_start + matches]
+                first = int(orders.argmin())
+                if best_row < 0 or orders[first] < best_order:
+                    best_row = row_start + int(matches[first])
+                    best_order = orders[first]
+            if best_row >= 0:
+                return table, best_row
+        return None
+
+    def check(self, study_type: str, parameter: str, value: float, category: Optional[str],
+              dimensions: np.ndarray) -> NormCheck:
+        '''Статус значения показателя относительно норм (normal, below, above, borderline_low, borderline_high)'''
+        if category is None or np.isnan(value):
+            return NORMAL
+        found = self.find_row(study_type, parameter, category, dimensions)
+        if found is None:
+            return NORMAL
+        table, row = found
+        norm_min, norm_max, borderline_low, borderline_high = self.rows[row, ROW_NORM_FROM:].tolist()
+        if np.isnan(norm_min) or np.isnan(norm_max):
+            return NORMAL
+
+        meta = self.tables[table]
+        status = 'normal'
+        conclusion_codes: Tuple[int, ...] = ()
+        if value < norm_min:
+            if not np.isnan(borderline_low) and value >= borderline_low:
+                status, conclusion_codes = 'borderline_low', (meta[TABLE_BORDERLINE_LOW], meta[TABLE_BELOW])
+            else:
+                status, conclusion_codes = 'below', (meta[TABLE_BELOW],)
+        elif value > norm_max:
+            if not np.isnan(borderline_high) and value <= borderline_high:
+                status, conclusion_codes = 'borderline_high', (meta[TABLE_BORDERLINE_HIGH], meta[TABLE_ABOVE])
+            else:
+                status, conclusion_codes = 'above', (meta[TABLE_ABOVE],)
+        conclusion = next((self.string(int(code)) for code in conclusion_codes if code >= 0), None)
+
+        return NormCheck(
+            status, norm_min, norm_max,
+            None if np.isnan(borderline_low) else borderline_low,
+            None if np.isnan(borderline_high) else borderline_high,
+            conclusion, self.string(int(meta[TABLE_ID]))
+        )
@@ -0,0 +1,190 @@
+'''
+Защита backend от медленной или недоступной БД.
+
+- Политики маршрутов (READ, WRITE, SCAN): приоритет и statement_timeout для соединения запроса.
+- Ограничитель параллельности: дешёвые чтения и сохранения (high) занимают любой слот,
+  выгрузки и сканирование списков (low) — не больше DB_LOW_PRIORITY_SLOTS; сверх лимита запрос
+  сразу получает 503 вместо ожидания в очереди.
+- Автомат-предохранитель: после DB_BREAKER_FAILURES ошибок БД подряд запросы к БД отклоняются
+  на DB_BREAKER_RESET_SECONDS, затем пропускается один пробный запрос. Таймауты запросов SCAN
+  предохранителю не засчитываются.
+Все отказы поднимают ServiceUnavailable, которую handler превращает в 503 с Retry-After.
+'''
+import json
+import math
+import os
+import threading
+import time
+from typing import Any, Dict, NamedTuple, Optional
+
+import psycopg2
+import psycopg2.extensions
+
+
+class ServiceUnavailable(Exception):
+    '''Запрос отклонён без обращения к БД; клиенту стоит повторить через retry_after секунд'''
+
+    def __init__(self, message: str, retry_after: float = 1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Policy(NamedTuple):
+    priority: str
+    statement_timeout_ms: int
+
+
+READ = Policy('high', int(os.environ.get('DB_TIMEOUT_READ_MS', '2000')))
+WRITE = Policy('high', int(os.environ.get('DB_TIMEOUT_WRITE_MS', '5000')))
+SCAN = Policy('low', int(os.environ.get('DB_TIMEOUT_SCAN_MS', '10000')))
+
+
+class CircuitBreaker:
+    '''
+    Размыкается после failure_threshold ошибок подряд, через reset_timeout пропускает пробный запрос.
+    Пробный запрос всегда разрешается: record_success/record_failure по исходу, release_probe — если он
+    не дошёл до БД; не разрешённый за probe_timeout (потерянный) пробный запрос заменяется следующим.
+    '''
+
+    def __init__(self, failure_threshold: int, reset_timeout: float, probe_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.probe_timeout = probe_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probe_started: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return 'half-open'
+            return 'open'
+
+    def before_call(self) -> bool:
+        '''Пропускает вызов или поднимает ServiceUnavailable; True — вызов пробный'''
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            now = time.monotonic()
+            remaining = self.reset_timeout - (now - self._opened_at)
+            if remaining > 0:
+                raise ServiceUnavailable('База данных временно недоступна', retry_after=remaining)
+            if self._probe_started is not None and now - self._probe_started < self.probe_timeout:
+                raise ServiceUnavailable('База данных временно недоступна', retry_after=1.0)
+            self._probe_started = now
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probe_started = None
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._probe_started is not None or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._probe_started = None
+
+    def release_probe(self) -> None:
+        '''Пробный вызов не дошёл до БД (пул занят): следующий вызов станет пробным'''
+        with self._lock:
+            self._probe_started = None
+
+    def settle_probe(self, answered: bool) -> None:
+        '''Разрешает ещё не разрешённый пробный вызов: успех, если БД ответила, иначе ошибка'''
+        with self._lock:
+            if self._probe_started is None:
+                return
+        if answered:
+            self.record_success()
+        else:
+            self.record_failure()
+
+
+class PriorityLimiter:
+    '''Ограничение одновременных запросов процесса с резервом слотов для приоритета high'''
+
+    def __init__(self, capacity: int, low_slots: int):
+        self.capacity = capacity
+        self.low_slots = low_slots
+        self._lock = threading.Lock()
+        self._active = 0
+        self._active_low = 0
+
+    def acquire(self, priority: str) -> 'Slot':
+        with self._lock:
+            if self._active >= self.capacity:
+                raise ServiceUnavailable('Сервер перегружен, повторите запрос позже')
+            if priority == 'low' and self._active_low >= self.low_slots:
+                raise ServiceUnavailable('Слишком много тяжёлых запросов, повторите позже', retry_after=2.0)
+            self._active += 1
+            if priority == 'low':
+                self._active_low += 1
+        return Slot(self, priority)
+
+    def release(self, priority: str) -> None:
+        with self._lock:
+            self._active -= 1
+            if priority == 'low':
+                self._active_low -= 1
+
+
+class Slot:
+    __slots__ = ('_limiter', '_priority')
+
+    def __init__(self, limiter: PriorityLimiter, priority: str):
+        self._limiter = limiter
+        self._priority = priority
+
+    def release(self) -> None:
+        if self._limiter is not None:
+            self._limiter.release(self._priority)
+            self._limiter = None
+
+
+# Ошибки, означающие недоступность или перегрузку БД, а не ошибку в самом запросе
+UNAVAILABLE_ERRORS = (ServiceUnavailable, psycopg2.OperationalError)
+
+db_breaker = CircuitBreaker(
+    failure_threshold=int(os.environ.get('DB_BREAKER_FAILURES', '5')),
+    reset_timeout=float(os.environ.get('DB_BREAKER_RESET_SECONDS', '5')),
+    probe_timeout=float(os.environ.get('DB_BREAKER_PROBE_TIMEOUT_SECONDS', '30'))
+)
+
+limiter = PriorityLimiter(
+    capacity=int(os.environ.get('DB_MAX_CONCURRENT_REQUESTS', '64')),
+    low_slots=int(os.environ.get('DB_LOW_PRIORITY_SLOTS', '4'))
+)
+
+
+def admit(policy: Policy) -> Slot:
+    '''Занимает слот ограничителя под запрос; освобождается через slot.release()'''
+    return limiter.acquire(policy.priority)
+
+
+def unavailable_response(headers: Dict[str, str], error: Exception, policy: Optional[Policy] = None) -> Dict[str, Any]:
+    '''
+    Ответ 503 на отказ БД; ошибка соединения или таймаут запроса засчитываются предохранителю.
+    Таймаут запроса с политикой SCAN не засчитывается: тяжёлая выборка не признак недоступности БД.
+    '''
+    if isinstance(error, ServiceUnavailable):
+        message, retry_after = str(error), error.retry_after
+    elif isinstance(error, psycopg2.extensions.QueryCanceledError):
+        if policy is not SCAN:
+            db_breaker.record_failure()
+        message, retry_after = 'Превышено время выполнения запроса', 1.0
+    else:
+        db_breaker.record_failure()
+        message, retry_after = 'База данных недоступна', 1.0
+    return {
+        'statusCode': 503,
+        'headers': dict(headers, **{'Retry-After': str(max(1, math.ceil(retry_after)))}),
+        'body': json.dumps({'error': message}),
+        'isBase64Encoded': False
+    }
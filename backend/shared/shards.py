@@ -0,0 +1,261 @@
+'''
+Распределение данных врачей по нескольким базам PostgreSQL (узлам).
+
+Узлы задаёт DATABASE_SHARDS: «имя=DSN» через точку с запятой или JSON-объект {имя: DSN}; без неё
+вся работа идёт с одной базой DATABASE_URL, как раньше. DATABASE_URL остаётся каталогом: в нём все врачи
+(авторизация, профиль), ключи идемпотентности и таблица doctor_shards — какой узел хранит данные врача.
+Узел с тем же DSN, что у каталога, обслуживается пулом каталога. Схема на всех узлах одинаковая
+(миграции применяются к каждому), на узле есть копия строки врача — её поддерживает copy_doctor().
+
+Новый врач получает узел по консистентному хешированию doctor_id (SHARD_VNODES виртуальных точек
+на узел), назначение сразу записывается в doctor_shards и дальше не зависит от кольца: добавление узла
+не перемещает существующих врачей, их переносит backend/move_doctor.py. Врачи без записи в doctor_shards
+(зарегистрированные до включения шардирования) остаются в каталоге. Все запросы handler'ов
+ограничены врачом, поэтому соединение выбирается по токену один раз на запрос (db.connect(doctor_token=...)).
+Маршруты кэшируются в процессе на SHARD_MAP_TTL_SECONDS; пока врач переносится (state = 'moving'),
+запись отклоняется с 503, чтение идёт с прежнего узла.
+
+Последовательности id на узлах чередуются (init_sequences: шаг SHARD_ID_STRIDE, свой остаток на узел),
+поэтому id протоколов и пациентов уникальны во всех узлах и переносятся без перенумерации.
+'''
+import bisect
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+SHARD_VNODES = int(os.environ.get('SHARD_VNODES', '64'))
+SHARD_MAP_TTL_SECONDS = float(os.environ.get('SHARD_MAP_TTL_SECONDS', '5'))
+SHARD_ID_STRIDE = int(os.environ.get('SHARD_ID_STRIDE', '64'))
+SHARD_CACHE_SIZE = int(os.environ.get('SHARD_CACHE_SIZE', '100000'))
+
+ACTIVE = 'active'
+MOVING = 'moving'
+
+
+class Route(NamedTuple):
+    doctor_id: int
+    shard: Optional[str]  # None — данные в каталоге
+    state: str
+
+
+class HashRing:
+    '''Консистентное хеширование: SHARD_VNODES точек на узел, ключ уходит к ближайшей точке по часовой стрелке'''
+
+    def __init__(self, names: List[str], vnodes: int = SHARD_VNODES):
+        points = sorted((_hash(f'{name}#{i}'), name) for name in names for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._names = [name for _, name in points]
+
+    def lookup(self, key: Any) -> str:
+        index = bisect.bisect(self._hashes, _hash(str(key))) % len(self._hashes)
+        return self._names[index]
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def parse_shards(value: Optional[str]) -> Dict[str, str]:
+    '''DATABASE_SHARDS -> {имя узла: DSN} в порядке объявления'''
+    value = (value or '').strip()
+    if not value:
+        return {}
+    if value.startswith('{'):
+        return {str(name): str(dsn) for name, dsn in json.loads(value).items()}
+    shards: Dict[str, str] = {}
+    for item in value.split(';'):
+        name, sep, dsn = item.strip().partition('=')
+        if not sep or not name.strip() or not dsn.strip():
+            raise ValueError(f'Некорректный узел в DATABASE_SHARDS: {item!r} (ожидается имя=DSN)')
+        shards[name.strip()] = dsn.strip()
+    return shards
+
+
+_config_lock = threading.Lock()
+_config: Dict[str, Any] = {'raw': None, 'shards': {}, 'ring': None}
+
+# token -> (Route или None, истекает); doctor_id -> (Route, истекает)
+_token_routes: Dict[str, Tuple[Optional[Route], float]] = {}
+_doctor_routes: Dict[int, Tuple[Route, float]] = {}
+_routes_lock = threading.Lock()
+
+
+def _load() -> Dict[str, Any]:
+    raw = os.environ.get('DATABASE_SHARDS')
+    if _config['raw'] != raw:
+        with _config_lock:
+            if _config['raw'] != raw:
+                shards = parse_shards(raw)
+                _config.update(raw=raw, shards=shards, ring=HashRing(list(shards)) if shards else None)
+    return _config
+
+
+def enabled() -> bool:
+    return bool(_load()['shards'])
+
+
+def names() -> List[str]:
+    return list(_load()['shards'])
+
+
+def dsn(shard: str) -> str:
+    shards = _load()['shards']
+    if shard not in shards:
+        raise KeyError(f'Узел БД {shard!r} не описан в DATABASE_SHARDS')
+    return shards[shard]
+
+
+def is_directory(shard: Optional[str]) -> bool:
+    '''True, если узел — сама база каталога DATABASE_URL (или шардирование выключено)'''
+    return shard is None or not enabled() or dsn(shard) == os.environ.get('DATABASE_URL')
+
+
+def directory_shard() -> Optional[str]:
+    '''Имя узла, совпадающего с каталогом, или None'''
+    for name, shard_dsn in _load()['shards'].items():
+        if shard_dsn == os.environ.get('DATABASE_URL'):
+            return name
+    return None
+
+
+def ring_shard(doctor_id: int) -> str:
+    '''Узел по кольцу консистентного хеширования (для врачей без назначения)'''
+    return _load()['ring'].lookup(doctor_id)
+
+
+def cached_route(token: str) -> Tuple[bool, Optional[Route]]:
+    '''(найден ли в кэше, маршрут врача с токеном token или None — такого врача нет)'''
+    now = time.monotonic()
+    with _routes_lock:
+        cached = _token_routes.get(token)
+        if cached is None or cached[1] <= now:
+            return False, None
+        route = cached[0]
+        if route is not None:
+            by_doctor = _doctor_routes.get(route.doctor_id)
+            if by_doctor is not None and by_doctor[1] > now:
+                route = by_doctor[0]
+        return True, route
+
+
+def _remember(token: Optional[str], route: Optional[Route]) -> None:
+    expires = time.monotonic() + SHARD_MAP_TTL_SECONDS
+    with _routes_lock:
+        if len(_token_routes) >= SHARD_CACHE_SIZE or len(_doctor_routes) >= SHARD_CACHE_SIZE:
+            _token_routes.clear()
+            _doctor_routes.clear()
+        if token is not None:
+            _token_routes[token] = (route, expires)
+        if route is not None:
+            _doctor_routes[route.doctor_id] = (route, expires)
+
+
+def invalidate(doctor_id: Optional[int] = None) -> None:
+    '''Сбрасывает кэш маршрутов (одного врача или все)'''
+    with _routes_lock:
+        if doctor_id is None:
+            _token_routes.clear()
+            _doctor_routes.clear()
+            return
+        _doctor_routes.pop(doctor_id, None)
+        for token in [t for t, (route, _) in _token_routes.items() if route and route.doctor_id == doctor_id]:
+            del _token_routes[token]
+
+
+def place_doctor(cur, doctor_id: int) -> Route:
+    '''Маршрут врача по doctor_shards каталога; без назначения — узел по кольцу, записывается сразу'''
+    cur.execute("""
+        INSERT INTO t_p13795046_functional_diagnosti.doctor_shards (doctor_id, shard)
+        VALUES (%s, %s)
+        ON CONFLICT (doctor_id) DO NOTHING
+    """, (doctor_id, ring_shard(doctor_id)))
+    cur.execute(
+        "SELECT shard, state FROM t_p13795046_functional_diagnosti.doctor_shards WHERE doctor_id = %s",
+        (doctor_id,)
+    )
+    row = cur.fetchone()
+    if isinstance(row, dict):
+        row = tuple(row.values())
+    route = Route(doctor_id, row[0], row[1])
+    _remember(None, route)
+    return route
+
+
+def lookup_route(cur, token: str) -> Optional[Route]:
+    '''
+    Маршрут врача по токену (email) из каталога; None — врача нет. Курсор — соединение с каталогом.
+    Врач без записи в doctor_shards хранится в каталоге.
+    '''
+    cur.execute("""
+        SELECT d.id, s.shard, s.state
+        FROM t_p13795046_functional_diagnosti.doctors d
+        LEFT JOIN t_p13795046_functional_diagnosti.doctor_shards s ON s.doctor_id = d.id
+        WHERE d.email = %s
+    """, (token,))
+    row = cur.fetchone()
+    if isinstance(row, dict):
+        row = tuple(row.values())
+    if row is None:
+        route = None
+    elif row[1] is None:
+        route = Route(row[0], directory_shard(), ACTIVE)
+    else:
+        route = Route(row[0], row[1], row[2])
+    _remember(token, route)
+    return route
+
+
+DOCTOR_COPY_COLUMNS = ('id', 'email', 'password_hash', 'full_name', 'specialization', 'signature_url',
+                       'created_at', 'updated_at')
+
+
+def copy_doctor(directory_cur, shard_cur, doctor_id: int) -> None:
+    '''Создаёт или обновляет копию строки врача на узле (norms_revision узла не трогается)'''
+    columns = ', '.join(DOCTOR_COPY_COLUMNS)
+    directory_cur.execute(f"SELECT {columns} FROM t_p13795046_functional_diagnosti.doctors WHERE id = %s",
+                          (doctor_id,))
+    row = directory_cur.fetchone()
+    if row is None:
+        return
+    if isinstance(row, dict):
+        row = tuple(row.values())
+    updates = ', '.join(f'{column} = EXCLUDED.{column}' for column in DOCTOR_COPY_COLUMNS[1:])
+    shard_cur.execute(f"""
+        INSERT INTO t_p13795046_functional_diagnosti.doctors ({columns})
+        VALUES ({', '.join(['%s'] * len(DOCTOR_COPY_COLUMNS))})
+        ON CONFLICT (id) DO UPDATE SET {updates}
+    """, row)
+
+
+def init_sequences(cur, shard: str, floors: Optional[Dict[str, int]] = None) -> List[str]:
+    '''
+    Чередует последовательности id схемы на узле: шаг SHARD_ID_STRIDE, остаток — номер узла
+    в DATABASE_SHARDS. Следующее значение — первое подходящее больше текущего и больше floors[имя]
+    (максимум по всем узлам, чтобы не повторить id, выданные до чередования). Последовательность
+    doctors не меняется: врачей создаёт только каталог.
+    '''
+    index = names().index(shard)
+    if index >= SHARD_ID_STRIDE:
+        raise ValueError(f'Узлов больше, чем SHARD_ID_STRIDE ({SHARD_ID_STRIDE})')
+    changed = []
+    for name, last_value in sequence_values(cur).items():
+        next_value = max(last_value, (floors or {}).get(name, 0)) + 1
+        next_value += (index - next_value) % SHARD_ID_STRIDE
+        cur.execute(f"ALTER SEQUENCE t_p13795046_functional_diagnosti.{name} INCREMENT BY {SHARD_ID_STRIDE}")
+        cur.execute("SELECT setval(%s, %s, false)", (f't_p13795046_functional_diagnosti.{name}', next_value))
+        changed.append(name)
+    return changed
+
+
+def sequence_values(cur) -> Dict[str, int]:
+    '''Последнее выданное значение каждой последовательности схемы, кроме doctors_id_seq'''
+    cur.execute("""
+        SELECT s.sequencename, COALESCE(s.last_value, s.start_value - 1)
+        FROM pg_sequences s
+        WHERE s.schemaname = 't_p13795046_functional_diagnosti' AND s.sequencename <> 'doctors_id_seq'
+        ORDER BY s.sequencename
+    """)
+    return {name: value for name, value in cur.fetchall()}
@@ -0,0 +1,172 @@
+'''
+Обработчики фоновых задач из таблицы jobs (см. shared/jobs.py).
+
+Виды задач регистрируются в backend/<имя функции>/index.py через @jobs.register, поэтому
+обработчик загружает те же модули, что и serve.py. Главный процесс запускает --workers процессов,
+каждый выполняет задачи по одной; в простое процесс ждёт LISTEN jobs не дольше --poll-interval.
+Заодно с возвратом зависших задач удаляются просроченные ключи идемпотентности (shared/idempotency.py).
+При DATABASE_SHARDS процесс с номером i обслуживает очередь i по модулю числа очередей: узлы и каталог,
+если он не один из узлов (задачи врачей без doctor_shards, фоновые задачи миграций каталога).
+
+Сигналы главному процессу:
+    SIGTERM/SIGINT  — плавная остановка: процессы дорабатывают текущую задачу
+
+Запуск: DATABASE_URL=... python backend/worker.py --workers 4
+        python backend/worker.py --burst   — выполнить готовые задачи и выйти (cron)
+'''
+import argparse
+import os
+import select
+import signal
+import socket
+import sys
+import time
+from typing import List, Optional
+
+import psycopg2
+import psycopg2.extensions
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BACKEND_DIR)
+
+from shared import db, idempotency, jobs, resilience, shards  # noqa: E402
+from serve import load_handlers  # noqa: E402
+
+STALE_CHECK_INTERVAL = 30.0
+JOB_STATEMENT_TIMEOUT_MS = int(os.environ.get('JOB_STATEMENT_TIMEOUT_MS', '600000'))
+
+
+def work(worker_id: str, kinds: Optional[List[str]], poll_interval: float, burst: bool,
+         should_stop=lambda: False, shard: Optional[str] = None) -> int:
+    '''
+    Цикл одного процесса: выполняет задачи очереди каталога или узла shard, пока не попросят остановиться;
+    возвращает число задач
+    '''
+    processed = 0
+    conn = None
+    listener = None
+    next_stale_check = 0.0
+    try:
+        while not should_stop():
+            try:
+                if conn is None:
+                    conn = db.connect(statement_timeout_ms=JOB_STATEMENT_TIMEOUT_MS, shard=shard)
+                if jobs.run_next(conn, worker_id, kinds):
+                    processed += 1
+                    continue
+                if time.monotonic() >= next_stale_check:
+                    jobs.requeue_stale(conn)
+                    if shards.is_directory(shard):
+                        idempotency.purge_expired(conn)
+                    next_stale_check = time.monotonic() + STALE_CHECK_INTERVAL
+            except resilience.UNAVAILABLE_ERRORS as e:
+                print(f'[{worker_id}] БД недоступна: {e}', file=sys.stderr)
+                if conn is not None:
+                    conn.close()
+                    conn = None
+                time.sleep(poll_interval)
+                continue
+
+            if burst:
+                break
+            if listener is None:
+                listener = psycopg2.connect(os.environ['DATABASE_URL'] if shard is None else shards.dsn(shard))
+                listener.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                listener.cursor().execute(f'LISTEN {jobs.NOTIFY_CHANNEL}')
+            if select.select([listener], [], [], poll_interval)[0]:
+                listener.poll()
+                listener.notifies.clear()
+    finally:
+        if conn is not None:
+            conn.close()
+        if listener is not None:
+            listener.close()
+    return processed
+
+
+def queues() -> List[Optional[str]]:
+    '''Очереди задач: узлы DATABASE_SHARDS и каталог (None), если он не совпадает ни с одним узлом'''
+    shard_names: List[Optional[str]] = list(shards.names())
+    if not shard_names or shards.directory_shard() is None:
+        shard_names.append(None)
+    return shard_names
+
+
+def run_worker(index: int, args: argparse.Namespace) -> None:
+    '''Тело процесса-обработчика'''
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda s, f: stopping.append(True))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    db.init_pool(1, 2)
+    load_handlers(BACKEND_DIR)
+    worker_id = f'{socket.gethostname()}:{os.getpid()}:{index}'
+    shard_names = queues()
+    shard = shard_names[index % len(shard_names)]
+    try:
+        work(worker_id, args.kinds, args.poll_interval, args.burst, lambda: bool(stopping), shard)
+    finally:
+        db.close_pool()
+
+
+def main(args: argparse.Namespace) -> None:
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda s, f: stopping.append(True))
+    signal.signal(signal.SIGINT, lambda s, f: stopping.append(True))
+
+    workers = {}
+    terminated = False
+
+    def spawn(index: int) -> None:
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(index, args)
+            except Exception as e:
+                print(f'[worker {os.getpid()}] ошибка: {e!r}', file=sys.stderr)
+                code = 1
+            finally:
+                os._exit(code)
+        workers[pid] = index
+
+    # при шардировании у каждого узла (и у каталога вне узлов) своя очередь: процессов не меньше, чем очередей
+    count = max(args.workers, len(queues()))
+    for index in range(count):
+        spawn(index)
+    print(f'Обработчиков задач: {count}', file=sys.stderr)
+
+    while workers:
+        if stopping and not terminated:
+            terminated = True
+            for pid in list(workers):
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid == 0:
+            time.sleep(0.2)
+            continue
+        index = workers.pop(pid)
+        if not stopping and not args.burst and status != 0:
+            print(f'[master] обработчик {pid} завершился ({status}), перезапуск', file=sys.stderr)
+            spawn(index)
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Обработчики фоновых задач backend')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('JOB_WORKERS', '2')),
+                        help='число параллельных процессов-обработчиков')
+    parser.add_argument('--kinds', nargs='*', help='обрабатывать только задачи этих видов')
+    parser.add_argument('--poll-interval', type=float, default=5.0,
+                        help='максимальное ожидание новых задач в простое, секунд')
+    parser.add_argument('--burst', action='store_true', help='выполнить готовые задачи и завершиться')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,107 @@
+-- Перевод таблицы протоколов на помесячное секционирование по study_date.
+-- Старая таблица сохраняется как protocols_legacy до проверки, затем её можно удалить.
+
+-- Создание (при необходимости) секции на месяц, содержащий p_date.
+-- Строки этого месяца, ранее попавшие в default-секцию, переносятся в новую секцию.
+CREATE OR REPLACE FUNCTION t_p13795046_functional_diagnosti.ensure_protocol_partition(p_date DATE)
+RETURNS TEXT
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_from DATE := date_trunc('month', p_date)::date;
+    v_to DATE := (date_trunc('month', p_date) + INTERVAL '1 month')::date;
+    v_name TEXT := 'protocols_' || to_char(date_trunc('month', p_date), 'YYYY_MM');
+BEGIN
+    IF to_regclass('t_p13795046_functional_diagnosti.' || v_name) IS NOT NULL THEN
+        RETURN v_name;
+    END IF;
+
+    PERFORM pg_advisory_xact_lock(hashtext('t_p13795046_functional_diagnosti.protocols_partitions'));
+
+    IF to_regclass('t_p13795046_functional_diagnosti.' || v_name) IS NOT NULL THEN
+        RETURN v_name;
+    END IF;
+
+    EXECUTE format(
+        'CREATE TABLE t_p13795046_functional_diagnosti.%I (LIKE t_p13795046_functional_diagnosti.protocols INCLUDING DEFAULTS)',
+        v_name
+    );
+
+    IF to_regclass('t_p13795046_functional_diagnosti.protocols_default') IS NOT NULL THEN
+        EXECUTE format(
+            'WITH moved AS (
+                 DELETE FROM t_p13795046_functional_diagnosti.protocols_default
+                 WHERE study_date >= %L AND study_date < %L
+                 RETURNING *
+             )
+             INSERT INTO t_p13795046_functional_diagnosti.%I SELECT * FROM moved',
+            v_from, v_to, v_name
+        );
+    END IF;
+
+    EXECUTE format(
+        'ALTER TABLE t_p13795046_functional_diagnosti.protocols ATTACH PARTITION t_p13795046_functional_diagnosti.%I FOR VALUES FROM (%L) TO (%L)',
+        v_name, v_from, v_to
+    );
+
+    RETURN v_name;
+END;
+$$;
+
+-- Создание секций от текущего месяца на p_months_ahead месяцев вперёд (для планировщика)
+CREATE OR REPLACE FUNCTION t_p13795046_functional_diagnosti.ensure_protocol_partitions(p_months_ahead INTEGER DEFAULT 3)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_month DATE := date_trunc('month', CURRENT_DATE)::date;
+    v_count INTEGER := 0;
+BEGIN
+    FOR i IN 0..p_months_ahead LOOP
+        PERFORM t_p13795046_functional_diagnosti.ensure_protocol_partition((v_month + make_interval(months => i))::date);
+        v_count := v_count + 1;
+    END LOOP;
+    RETURN v_count;
+END;
+$$;
+
+LOCK TABLE t_p13795046_functional_diagnosti.protocols IN EXCLUSIVE MODE;
+
+CREATE TABLE t_p13795046_functional_diagnosti.protocols_partitioned (
+    LIKE t_p13795046_functional_diagnosti.protocols INCLUDING DEFAULTS,
+    PRIMARY KEY (id, study_date)
+) PARTITION BY RANGE (study_date);
+
+CREATE TABLE t_p13795046_functional_diagnosti.protocols_default
+PARTITION OF t_p13795046_functional_diagnosti.protocols_partitioned DEFAULT;
+
+-- Индексы создаются на родительской таблице и автоматически наследуются каждой секцией
+CREATE INDEX idx_protocols_part_doctor_study_date
+ON t_p13795046_functional_diagnosti.protocols_partitioned(doctor_id, study_date);
+CREATE INDEX idx_protocols_part_doctor_created_at
+ON t_p13795046_functional_diagnosti.protocols_partitioned(doctor_id, created_at);
+CREATE INDEX idx_protocols_part_study_date
+ON t_p13795046_functional_diagnosti.protocols_partitioned(study_date);
+CREATE INDEX idx_protocols_part_id
+ON t_p13795046_functional_diagnosti.protocols_partitioned(id);
+
+ALTER TABLE t_p13795046_functional_diagnosti.protocols RENAME TO protocols_legacy;
+ALTER TABLE t_p13795046_functional_diagnosti.protocols_partitioned RENAME TO protocols;
+ALTER SEQUENCE t_p13795046_functional_diagnosti.protocols_id_seq OWNED BY t_p13795046_functional_diagnosti.protocols.id;
+
+-- Секции для всех месяцев, в которых уже есть исследования, и на три месяца вперёд
+SELECT t_p13795046_functional_diagnosti.ensure_protocol_partition(month::date)
+FROM (
+    SELECT DISTINCT date_trunc('month', study_date) AS month
+    FROM t_p13795046_functional_diagnosti.protocols_legacy
+) months;
+
+SELECT t_p13795046_functional_diagnosti.ensure_protocol_partitions(3);
+
+INSERT INTO t_p13795046_functional_diagnosti.protocols
+SELECT * FROM t_p13795046_functional_diagnosti.protocols_legacy;
+
+ANALYZE t_p13795046_functional_diagnosti.protocols;
+
+COMMENT ON TABLE t_p13795046_functional_diagnosti.protocols IS 'Протоколы исследований пациентов (помесячные секции по study_date)';
+COMMENT ON TABLE t_p13795046_functional_diagnosti.protocols_legacy IS 'Несекционированная копия протоколов до V0007, удалить после проверки';
@@ -0,0 +1,63 @@
+-- Нормализованные числовые значения показателей протоколов для индексных запросов вида "EF < 50"
+CREATE TABLE IF NOT EXISTS t_p13795046_functional_diagnosti.protocol_results (
+    protocol_id INTEGER NOT NULL,
+    doctor_id INTEGER NOT NULL,
+    study_type VARCHAR(50) NOT NULL,
+    study_date DATE NOT NULL,
+    param VARCHAR(100) NOT NULL,
+    value DOUBLE PRECISION NOT NULL,
+    PRIMARY KEY (protocol_id, param)
+);
+
+-- Диапазонный поиск по значению параметра в пределах врача, study_type/study_date доступны без обращения к таблице
+CREATE INDEX IF NOT EXISTS idx_protocol_results_doctor_param_value
+ON t_p13795046_functional_diagnosti.protocol_results(doctor_id, param, value)
+INCLUDE (study_type, study_date);
+
+COMMENT ON TABLE t_p13795046_functional_diagnosti.protocol_results IS 'Числовые значения показателей из protocols.results, синхронизируются триггером';
+
+-- Синхронизация protocol_results при записи протокола
+CREATE OR REPLACE FUNCTION t_p13795046_functional_diagnosti.sync_protocol_results()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        DELETE FROM t_p13795046_functional_diagnosti.protocol_results WHERE protocol_id = OLD.id;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') AND jsonb_typeof(NEW.results) = 'object' THEN
+        INSERT INTO t_p13795046_functional_diagnosti.protocol_results
+            (protocol_id, doctor_id, study_type, study_date, param, value)
+        SELECT NEW.id, NEW.doctor_id, NEW.study_type, NEW.study_date, r.key,
+               replace(btrim(r.value #>> '{}'), ',', '.')::double precision
+        FROM jsonb_each(NEW.results) r
+        WHERE jsonb_typeof(r.value) = 'number'
+           OR (jsonb_typeof(r.value) = 'string'
+               AND btrim(r.value #>> '{}') ~ '^-?[0-9]+([.,][0-9]+)?$');
+    END IF;
+
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trg_protocols_sync_results ON t_p13795046_functional_diagnosti.protocols;
+CREATE TRIGGER trg_protocols_sync_results
+AFTER INSERT OR DELETE OR UPDATE OF results, study_type, study_date, doctor_id
+ON t_p13795046_functional_diagnosti.protocols
+FOR EACH ROW EXECUTE FUNCTION t_p13795046_functional_diagnosti.sync_protocol_results();
+
+-- Заполнение по уже сохранённым протоколам
+INSERT INTO t_p13795046_functional_diagnosti.protocol_results
+    (protocol_id, doctor_id, study_type, study_date, param, value)
+SELECT p.id, p.doctor_id, p.study_type, p.study_date, r.key,
+       replace(btrim(r.value #>> '{}'), ',', '.')::double precision
+FROM t_p13795046_functional_diagnosti.protocols p
+CROSS JOIN LATERAL jsonb_each(p.results) r
+WHERE jsonb_typeof(p.results) = 'object'
+  AND (jsonb_typeof(r.value) = 'number'
+       OR (jsonb_typeof(r.value) = 'string'
+           AND btrim(r.value #>> '{}') ~ '^-?[0-9]+([.,][0-9]+)?$'))
+ON CONFLICT (protocol_id, param) DO NOTHING;
+
+ANALYZE t_p13795046_functional_diagnosti.protocol_results;
@@ -0,0 +1,71 @@
+-- Возраст пациента в числовых столбцах вместо JSON в TEXT (patient_age остаётся для нестандартных значений)
+ALTER TABLE t_p13795046_functional_diagnosti.protocols
+    ADD COLUMN IF NOT EXISTS patient_age_years SMALLINT,
+    ADD COLUMN IF NOT EXISTS patient_age_months SMALLINT,
+    ADD COLUMN IF NOT EXISTS patient_age_days SMALLINT,
+    ADD COLUMN IF NOT EXISTS patient_age_total_days INTEGER;
+
+COMMENT ON COLUMN t_p13795046_functional_diagnosti.protocols.patient_age_total_days IS
+    'Возраст в днях: years * 365.25 + months * 30.44 + days (как ageToTotalDays на клиенте)';
+
+CREATE INDEX IF NOT EXISTS idx_protocols_doctor_age_total_days
+ON t_p13795046_functional_diagnosti.protocols(doctor_id, patient_age_total_days);
+
+-- Безопасный разбор старого значения patient_age: JSON {"years", "months", "days"} или целое число лет
+CREATE OR REPLACE FUNCTION t_p13795046_functional_diagnosti.parse_patient_age(p_value TEXT)
+RETURNS JSONB
+LANGUAGE plpgsql
+IMMUTABLE
+AS $$
+BEGIN
+    IF p_value IS NULL THEN
+        RETURN NULL;
+    END IF;
+    IF btrim(p_value) ~ '^[0-9]+$' THEN
+        RETURN jsonb_build_object('years', btrim(p_value)::int, 'months', 0, 'days', 0);
+    END IF;
+    IF btrim(p_value) LIKE '{%' THEN
+        RETURN p_value::jsonb;
+    END IF;
+    RETURN NULL;
+EXCEPTION WHEN others THEN
+    RETURN NULL;
+END;
+$$;
+
+-- Пакетное заполнение новых столбцов с фиксацией после каждого пакета.
+-- Вызывается отдельно, вне транзакции миграции: CALL t_p13795046_functional_diagnosti.backfill_patient_age(5000);
+CREATE OR REPLACE PROCEDURE t_p13795046_functional_diagnosti.backfill_patient_age(p_batch_size INTEGER DEFAULT 5000)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_last_id INTEGER := 0;
+    v_max_id INTEGER;
+BEGIN
+    SELECT COALESCE(max(id), 0) INTO v_max_id FROM t_p13795046_functional_diagnosti.protocols;
+
+    WHILE v_last_id < v_max_id LOOP
+        UPDATE t_p13795046_functional_diagnosti.protocols p
+        SET patient_age_years = (a.age ->> 'years')::smallint,
+            patient_age_months = COALESCE((a.age ->> 'months')::smallint, 0),
+            patient_age_days = COALESCE((a.age ->> 'days')::smallint, 0),
+            patient_age_total_days = round(
+                (a.age ->> 'years')::numeric * 365.25
+                + COALESCE((a.age ->> 'months')::numeric, 0) * 30.44
+                + COALESCE((a.age ->> 'days')::numeric, 0)
+            )::integer,
+            patient_age = NULL
+        FROM (
+            SELECT id, study_date, t_p13795046_functional_diagnosti.parse_patient_age(patient_age) AS age
+            FROM t_p13795046_functional_diagnosti.protocols
+            WHERE id > v_last_id AND id <= v_last_id + p_batch_size
+              AND patient_age IS NOT NULL AND patient_age_total_days IS NULL
+        ) a
+        WHERE p.id = a.id AND p.study_date = a.study_date
+          AND jsonb_typeof(a.age -> 'years') = 'number';
+
+        v_last_id := v_last_id + p_batch_size;
+        COMMIT;
+    END LOOP;
+END;
+$$;
@@ -0,0 +1,65 @@
+-- Пациенты врача: одна запись на нормализованное ФИО и дату рождения
+CREATE OR REPLACE FUNCTION t_p13795046_functional_diagnosti.normalize_patient_name(p_name TEXT)
+RETURNS TEXT
+LANGUAGE sql
+IMMUTABLE
+AS $$
+    SELECT btrim(regexp_replace(replace(lower(p_name), 'ё', 'е'), '\s+', ' ', 'g'))
+$$;
+
+CREATE TABLE IF NOT EXISTS t_p13795046_functional_diagnosti.patients (
+    id SERIAL PRIMARY KEY,
+    doctor_id INTEGER NOT NULL REFERENCES t_p13795046_functional_diagnosti.doctors(id),
+    full_name VARCHAR(255) NOT NULL,
+    normalized_name VARCHAR(255) NOT NULL,
+    birth_date DATE NOT NULL,
+    gender VARCHAR(10),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (doctor_id, normalized_name, birth_date)
+);
+
+COMMENT ON TABLE t_p13795046_functional_diagnosti.patients IS 'Пациенты врача (дедупликация по нормализованному ФИО и дате рождения)';
+
+ALTER TABLE t_p13795046_functional_diagnosti.protocols
+    ADD COLUMN IF NOT EXISTS patient_id INTEGER REFERENCES t_p13795046_functional_diagnosti.patients(id);
+
+-- История пациента: все исследования по patient_id в порядке дат
+CREATE INDEX IF NOT EXISTS idx_protocols_patient_study_date
+ON t_p13795046_functional_diagnosti.protocols(patient_id, study_date);
+
+-- Пакетная привязка существующих протоколов к пациентам с фиксацией после каждого пакета.
+-- Вызывается отдельно, вне транзакции миграции: CALL t_p13795046_functional_diagnosti.backfill_protocol_patients(5000);
+CREATE OR REPLACE PROCEDURE t_p13795046_functional_diagnosti.backfill_protocol_patients(p_batch_size INTEGER DEFAULT 5000)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_last_id INTEGER := 0;
+    v_max_id INTEGER;
+BEGIN
+    SELECT COALESCE(max(id), 0) INTO v_max_id FROM t_p13795046_functional_diagnosti.protocols;
+
+    WHILE v_last_id < v_max_id LOOP
+        INSERT INTO t_p13795046_functional_diagnosti.patients (doctor_id, full_name, normalized_name, birth_date, gender)
+        SELECT DISTINCT ON (doctor_id, t_p13795046_functional_diagnosti.normalize_patient_name(patient_name), patient_birth_date)
+               doctor_id, patient_name, t_p13795046_functional_diagnosti.normalize_patient_name(patient_name),
+               patient_birth_date, patient_gender
+        FROM t_p13795046_functional_diagnosti.protocols
+        WHERE id > v_last_id AND id <= v_last_id + p_batch_size AND patient_id IS NULL
+        ORDER BY doctor_id, t_p13795046_functional_diagnosti.normalize_patient_name(patient_name),
+                 patient_birth_date, created_at DESC
+        ON CONFLICT (doctor_id, normalized_name, birth_date) DO NOTHING;
+
+        UPDATE t_p13795046_functional_diagnosti.protocols p
+        SET patient_id = pt.id
+        FROM t_p13795046_functional_diagnosti.patients pt
+        WHERE p.id > v_last_id AND p.id <= v_last_id + p_batch_size AND p.patient_id IS NULL
+          AND pt.doctor_id = p.doctor_id
+          AND pt.normalized_name = t_p13795046_functional_diagnosti.normalize_patient_name(p.patient_name)
+          AND pt.birth_date = p.patient_birth_date;
+
+        v_last_id := v_last_id + p_batch_size;
+        COMMIT;
+    END LOOP;
+END;
+$$;
@@ -0,0 +1,37 @@
+-- Очередь фоновых задач (экспорт, пересчёт норм, импорт), разбирается обработчиками backend/worker.py
+CREATE TABLE IF NOT EXISTS t_p13795046_functional_diagnosti.jobs (
+    id BIGSERIAL PRIMARY KEY,
+    doctor_id INTEGER REFERENCES t_p13795046_functional_diagnosti.doctors(id),
+    kind VARCHAR(64) NOT NULL,
+    payload JSONB NOT NULL DEFAULT '{}'::jsonb,
+    status VARCHAR(16) NOT NULL DEFAULT 'queued',
+    priority SMALLINT NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 5,
+    run_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    locked_by VARCHAR(100),
+    locked_at TIMESTAMP,
+    progress REAL NOT NULL DEFAULT 0,
+    progress_message TEXT,
+    result JSONB,
+    error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP,
+    CHECK (status IN ('queued', 'running', 'done', 'failed'))
+);
+
+COMMENT ON TABLE t_p13795046_functional_diagnosti.jobs IS 'Фоновые задачи: выборка через FOR UPDATE SKIP LOCKED, повторы с экспоненциальной задержкой';
+
+-- Выборка следующей задачи: только ожидающие, в порядке приоритета и времени запуска
+CREATE INDEX IF NOT EXISTS idx_jobs_queued
+ON t_p13795046_functional_diagnosti.jobs(priority DESC, run_at, id)
+WHERE status = 'queued';
+
+-- Возврат в очередь задач упавших обработчиков
+CREATE INDEX IF NOT EXISTS idx_jobs_running_locked_at
+ON t_p13795046_functional_diagnosti.jobs(locked_at)
+WHERE status = 'running';
+
+CREATE INDEX IF NOT EXISTS idx_jobs_doctor_created_at
+ON t_p13795046_functional_diagnosti.jobs(doctor_id, created_at);
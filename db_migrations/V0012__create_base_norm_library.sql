@@ -0,0 +1,75 @@
+-- Общая версионируемая библиотека норм: врач хранит только свои переопределения базовых таблиц
+CREATE TABLE IF NOT EXISTS t_p13795046_functional_diagnosti.norm_library_versions (
+    id SERIAL PRIMARY KEY,
+    note TEXT,
+    published_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+COMMENT ON TABLE t_p13795046_functional_diagnosti.norm_library_versions IS 'Версии базовой библиотеки норм; действующая — с наибольшим id';
+
+CREATE TABLE IF NOT EXISTS t_p13795046_functional_diagnosti.base_norm_tables (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    version INTEGER NOT NULL REFERENCES t_p13795046_functional_diagnosti.norm_library_versions(id),
+    base_key VARCHAR(255) NOT NULL,
+    study_type VARCHAR(50) NOT NULL,
+    category VARCHAR(50) NOT NULL,
+    parameter VARCHAR(100) NOT NULL,
+    norm_type VARCHAR(20) NOT NULL,
+    rows JSONB NOT NULL DEFAULT '[]'::jsonb,
+    show_in_report BOOLEAN DEFAULT true,
+    conclusion_below TEXT,
+    conclusion_above TEXT,
+    conclusion_borderline_low TEXT,
+    conclusion_borderline_high TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (version, base_key)
+);
+
+CREATE INDEX IF NOT EXISTS idx_base_norm_tables_version_study_type
+ON t_p13795046_functional_diagnosti.base_norm_tables(version, study_type, parameter);
+
+-- Переопределение базовой таблицы (base_key) и скрытие базовой таблицы врачом (deleted)
+ALTER TABLE t_p13795046_functional_diagnosti.norm_tables
+    ADD COLUMN IF NOT EXISTS base_key VARCHAR(255),
+    ADD COLUMN IF NOT EXISTS deleted BOOLEAN NOT NULL DEFAULT false;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_norm_tables_doctor_base_key
+ON t_p13795046_functional_diagnosti.norm_tables(doctor_id, base_key)
+WHERE base_key IS NOT NULL;
+
+-- Ревизия норм врача: ключ кэша объединённого набора норм
+ALTER TABLE t_p13795046_functional_diagnosti.doctors
+    ADD COLUMN IF NOT EXISTS norms_revision INTEGER NOT NULL DEFAULT 0;
+
+CREATE OR REPLACE FUNCTION t_p13795046_functional_diagnosti.bump_norms_revision()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    UPDATE t_p13795046_functional_diagnosti.doctors
+    SET norms_revision = norms_revision + 1
+    WHERE id = COALESCE(NEW.doctor_id, OLD.doctor_id);
+    IF TG_OP = 'UPDATE' AND NEW.doctor_id <> OLD.doctor_id THEN
+        UPDATE t_p13795046_functional_diagnosti.doctors
+        SET norms_revision = norms_revision + 1
+        WHERE id = OLD.doctor_id;
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trg_norm_tables_bump_revision ON t_p13795046_functional_diagnosti.norm_tables;
+CREATE TRIGGER trg_norm_tables_bump_revision
+AFTER INSERT OR UPDATE OR DELETE ON t_p13795046_functional_diagnosti.norm_tables
+FOR EACH ROW EXECUTE FUNCTION t_p13795046_functional_diagnosti.bump_norms_revision();
+
+-- Содержимое строк таблицы норм без идентификаторов строк (для сравнения копий с базовой таблицей)
+CREATE OR REPLACE FUNCTION t_p13795046_functional_diagnosti.norm_rows_content(p_rows JSONB)
+RETURNS JSONB
+LANGUAGE sql
+IMMUTABLE
+AS $$
+    SELECT COALESCE(jsonb_agg(r.value - 'id' ORDER BY r.ordinality), '[]'::jsonb)
+    FROM jsonb_array_elements(p_rows) WITH ORDINALITY r
+$$;
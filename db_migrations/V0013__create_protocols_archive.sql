@@ -0,0 +1,72 @@
+-- Словари zstd, обученные на выборке архивируемых протоколов: короткие JSON-записи
+-- с повторяющимися ключами показателей сжимаются общим словарём в разы лучше, чем по отдельности
+CREATE TABLE IF NOT EXISTS t_p13795046_functional_diagnosti.protocols_archive_dictionaries (
+    id SERIAL PRIMARY KEY,
+    dictionary BYTEA NOT NULL,
+    samples INTEGER NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Холодный архив старых протоколов: сводные столбцы для фильтров и сортировки списка,
+-- остальные поля протокола — сжатым JSON в payload (кодек в codec: zstd или zlib)
+CREATE TABLE IF NOT EXISTS t_p13795046_functional_diagnosti.protocols_archive (
+    id INTEGER PRIMARY KEY,
+    doctor_id INTEGER NOT NULL,
+    patient_id INTEGER,
+    study_type VARCHAR(50) NOT NULL,
+    patient_name VARCHAR(255) NOT NULL,
+    patient_gender VARCHAR(10) NOT NULL,
+    patient_birth_date DATE,
+    patient_age_total_days INTEGER,
+    study_date DATE NOT NULL,
+    signed BOOLEAN,
+    created_at TIMESTAMP,
+    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    codec VARCHAR(10) NOT NULL,
+    dictionary_id INTEGER REFERENCES t_p13795046_functional_diagnosti.protocols_archive_dictionaries(id),
+    payload BYTEA NOT NULL
+);
+
+COMMENT ON TABLE t_p13795046_functional_diagnosti.protocols_archive IS 'Архив протоколов старше ARCHIVE_AFTER_DAYS; читается прозрачно через handler protocols';
+
+-- payload уже сжат, повторное сжатие TOAST не нужно
+ALTER TABLE t_p13795046_functional_diagnosti.protocols_archive ALTER COLUMN payload SET STORAGE EXTERNAL;
+
+CREATE INDEX IF NOT EXISTS idx_protocols_archive_doctor_study_date
+ON t_p13795046_functional_diagnosti.protocols_archive(doctor_id, study_date);
+
+CREATE INDEX IF NOT EXISTS idx_protocols_archive_doctor_created_at
+ON t_p13795046_functional_diagnosti.protocols_archive(doctor_id, created_at);
+
+CREATE INDEX IF NOT EXISTS idx_protocols_archive_patient_study_date
+ON t_p13795046_functional_diagnosti.protocols_archive(patient_id, study_date);
+
+-- При переносе в архив (fd.archiving = on) показатели протокола остаются в protocol_results,
+-- чтобы фильтры по значениям и история пациента продолжали работать для архивных протоколов
+CREATE OR REPLACE FUNCTION t_p13795046_functional_diagnosti.sync_protocol_results()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF TG_OP = 'DELETE' AND current_setting('fd.archiving', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        DELETE FROM t_p13795046_functional_diagnosti.protocol_results WHERE protocol_id = OLD.id;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') AND jsonb_typeof(NEW.results) = 'object' THEN
+        INSERT INTO t_p13795046_functional_diagnosti.protocol_results
+            (protocol_id, doctor_id, study_type, study_date, param, value)
+        SELECT NEW.id, NEW.doctor_id, NEW.study_type, NEW.study_date, r.key,
+               replace(btrim(r.value #>> '{}'), ',', '.')::double precision
+        FROM jsonb_each(NEW.results) r
+        WHERE jsonb_typeof(r.value) = 'number'
+           OR (jsonb_typeof(r.value) = 'string'
+               AND btrim(r.value #>> '{}') ~ '^-?[0-9]+([.,][0-9]+)?$');
+    END IF;
+
+    RETURN NULL;
+END;
+$$;
@@ -0,0 +1,83 @@
+-- Полнотекстовый поиск по протоколам (конфигурация russian): заключение — вес A,
+-- вид исследования и аппарат — вес B, текстовые значения показателей — вес C
+CREATE OR REPLACE FUNCTION t_p13795046_functional_diagnosti.protocol_search_vector(
+    p_conclusion TEXT, p_study_type TEXT, p_ultrasound_device TEXT, p_results JSONB
+)
+RETURNS TSVECTOR
+LANGUAGE sql
+IMMUTABLE
+AS $$
+    SELECT setweight(to_tsvector('russian'::regconfig, COALESCE(p_conclusion, '')), 'A')
+        || setweight(to_tsvector('russian'::regconfig,
+                                 COALESCE(p_study_type, '') || ' ' || COALESCE(p_ultrasound_device, '')), 'B')
+        || setweight(jsonb_to_tsvector('russian'::regconfig, COALESCE(p_results, '{}'::jsonb), '["string"]'), 'C')
+$$;
+
+ALTER TABLE t_p13795046_functional_diagnosti.protocols
+    ADD COLUMN IF NOT EXISTS search_vector TSVECTOR GENERATED ALWAYS AS (
+        t_p13795046_functional_diagnosti.protocol_search_vector(conclusion, study_type, ultrasound_device, results)
+    ) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_protocols_search_vector
+ON t_p13795046_functional_diagnosti.protocols USING GIN (search_vector);
+
+-- В архиве вектор хранится готовым: заключение там сжато и недоступно SQL.
+-- Для уже заархивированных протоколов его заполняет archiver.py при следующем запуске
+ALTER TABLE t_p13795046_functional_diagnosti.protocols_archive
+    ADD COLUMN IF NOT EXISTS search_vector TSVECTOR;
+
+CREATE INDEX IF NOT EXISTS idx_protocols_archive_search_vector
+ON t_p13795046_functional_diagnosti.protocols_archive USING GIN (search_vector);
+
+-- Новые секции наследуют вычисляемый столбец search_vector; строки из default-секции
+-- переносятся без него (значение вычисляется заново при вставке)
+CREATE OR REPLACE FUNCTION t_p13795046_functional_diagnosti.ensure_protocol_partition(p_date DATE)
+RETURNS TEXT
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_from DATE := date_trunc('month', p_date)::date;
+    v_to DATE := (date_trunc('month', p_date) + INTERVAL '1 month')::date;
+    v_name TEXT := 'protocols_' || to_char(date_trunc('month', p_date), 'YYYY_MM');
+    v_columns TEXT;
+BEGIN
+    IF to_regclass('t_p13795046_functional_diagnosti.' || v_name) IS NOT NULL THEN
+        RETURN v_name;
+    END IF;
+
+    PERFORM pg_advisory_xact_lock(hashtext('t_p13795046_functional_diagnosti.protocols_partitions'));
+
+    IF to_regclass('t_p13795046_functional_diagnosti.' || v_name) IS NOT NULL THEN
+        RETURN v_name;
+    END IF;
+
+    EXECUTE format(
+        'CREATE TABLE t_p13795046_functional_diagnosti.%I (LIKE t_p13795046_functional_diagnosti.protocols INCLUDING DEFAULTS INCLUDING GENERATED)',
+        v_name
+    );
+
+    IF to_regclass('t_p13795046_functional_diagnosti.protocols_default') IS NOT NULL THEN
+        SELECT string_agg(quote_ident(attname), ', ' ORDER BY attnum) INTO v_columns
+        FROM pg_attribute
+        WHERE attrelid = 't_p13795046_functional_diagnosti.protocols'::regclass
+          AND attnum > 0 AND NOT attisdropped AND attgenerated = '';
+
+        EXECUTE format(
+            'WITH moved AS (
+                 DELETE FROM t_p13795046_functional_diagnosti.protocols_default
+                 WHERE study_date >= %L AND study_date < %L
+                 RETURNING %s
+             )
+             INSERT INTO t_p13795046_functional_diagnosti.%I (%s) SELECT * FROM moved',
+            v_from, v_to, v_columns, v_name, v_columns
+        );
+    END IF;
+
+    EXECUTE format(
+        'ALTER TABLE t_p13795046_functional_diagnosti.protocols ATTACH PARTITION t_p13795046_functional_diagnosti.%I FOR VALUES FROM (%L) TO (%L)',
+        v_name, v_from, v_to
+    );
+
+    RETURN v_name;
+END;
+$$;
@@ -0,0 +1,135 @@
+-- Сохранённый статус каждого числового показателя протокола относительно норм врача
+-- (normal, below, above, borderline_low, borderline_high — как checkParameterNorms на клиенте).
+-- Строка хранит всё, что нужно для проверки: категорию и измерения пациента, значение показателя,
+-- поэтому пересчёт после изменения норм не читает протоколы (в том числе архивные).
+-- pending = true — статус ещё не вычислен или устарел; пересчитывает задача evaluate_norm_status
+CREATE TABLE IF NOT EXISTS t_p13795046_functional_diagnosti.protocol_norm_status (
+    protocol_id INTEGER NOT NULL,
+    param VARCHAR(100) NOT NULL,
+    doctor_id INTEGER NOT NULL,
+    study_type VARCHAR(50) NOT NULL,
+    study_date DATE NOT NULL,
+    category VARCHAR(20),
+    age_years SMALLINT,
+    age_months SMALLINT,
+    age_days SMALLINT,
+    age_total_days INTEGER,
+    weight DOUBLE PRECISION,
+    height DOUBLE PRECISION,
+    bsa DOUBLE PRECISION,
+    value DOUBLE PRECISION NOT NULL,
+    status VARCHAR(16),
+    norm_min DOUBLE PRECISION,
+    norm_max DOUBLE PRECISION,
+    norm_table_id UUID,
+    pending BOOLEAN NOT NULL DEFAULT true,
+    evaluated_at TIMESTAMP,
+    PRIMARY KEY (protocol_id, param)
+);
+
+COMMENT ON TABLE t_p13795046_functional_diagnosti.protocol_norm_status IS 'Статус показателей протоколов по нормам; строки создаёт триггер, статус вычисляет задача evaluate_norm_status';
+
+-- Очередь пересчёта врача
+CREATE INDEX IF NOT EXISTS idx_protocol_norm_status_pending
+ON t_p13795046_functional_diagnosti.protocol_norm_status(doctor_id)
+WHERE pending;
+
+-- Поиск строк, затронутых изменением таблицы норм (вид исследования, параметр, категория, возраст)
+CREATE INDEX IF NOT EXISTS idx_protocol_norm_status_norm_key
+ON t_p13795046_functional_diagnosti.protocol_norm_status(doctor_id, study_type, param, category, age_total_days);
+
+-- Фильтр списка протоколов по отклонениям от нормы
+CREATE INDEX IF NOT EXISTS idx_protocol_norm_status_abnormal
+ON t_p13795046_functional_diagnosti.protocol_norm_status(doctor_id, status, study_date)
+INCLUDE (protocol_id, param)
+WHERE status <> 'normal';
+
+-- Проверка, стоит ли уже в очереди задача врача данного вида
+CREATE INDEX IF NOT EXISTS idx_jobs_queued_doctor_kind
+ON t_p13795046_functional_diagnosti.jobs(doctor_id, kind)
+WHERE status = 'queued';
+
+-- Ставит задачу пересчёта статусов врача, если такая ещё не ждёт в очереди
+CREATE OR REPLACE FUNCTION t_p13795046_functional_diagnosti.enqueue_norm_status(p_doctor_id INTEGER)
+RETURNS VOID
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM t_p13795046_functional_diagnosti.jobs
+        WHERE doctor_id = p_doctor_id AND kind = 'evaluate_norm_status' AND status = 'queued'
+    ) THEN
+        INSERT INTO t_p13795046_functional_diagnosti.jobs (doctor_id, kind)
+        VALUES (p_doctor_id, 'evaluate_norm_status');
+        PERFORM pg_notify('jobs', 'evaluate_norm_status');
+    END IF;
+END;
+$$;
+
+-- Строки статусов при записи протокола; при переносе в архив (fd.archiving = on) статусы сохраняются
+CREATE OR REPLACE FUNCTION t_p13795046_functional_diagnosti.sync_protocol_norm_status()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF TG_OP = 'DELETE' AND current_setting('fd.archiving', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+
+    -- При возврате протокола из архива (INSERT) заменяются сохранённые при архивации строки
+    DELETE FROM t_p13795046_functional_diagnosti.protocol_norm_status
+    WHERE protocol_id = CASE WHEN TG_OP = 'INSERT' THEN NEW.id ELSE OLD.id END;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') AND jsonb_typeof(NEW.results) = 'object' THEN
+        INSERT INTO t_p13795046_functional_diagnosti.protocol_norm_status
+            (protocol_id, param, doctor_id, study_type, study_date, category,
+             age_years, age_months, age_days, age_total_days, weight, height, bsa, value)
+        SELECT NEW.id, r.key, NEW.doctor_id, NEW.study_type, NEW.study_date,
+               CASE WHEN NEW.patient_age_years IS NULL OR NEW.patient_gender NOT IN ('male', 'female') THEN NULL
+                    WHEN NEW.patient_age_years < 18 THEN 'child_' || NEW.patient_gender
+                    ELSE 'adult_' || NEW.patient_gender END,
+               NEW.patient_age_years, NEW.patient_age_months, NEW.patient_age_days, NEW.patient_age_total_days,
+               NEW.patient_weight, NEW.patient_height, NEW.patient_bsa,
+               replace(btrim(r.value #>> '{}'), ',', '.')::double precision
+        FROM jsonb_each(NEW.results) r
+        WHERE jsonb_typeof(r.value) = 'number'
+           OR (jsonb_typeof(r.value) = 'string'
+               AND btrim(r.value #>> '{}') ~ '^-?[0-9]+([.,][0-9]+)?$');
+
+        IF FOUND THEN
+            PERFORM t_p13795046_functional_diagnosti.enqueue_norm_status(NEW.doctor_id);
+        END IF;
+    END IF;
+
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trg_protocols_sync_norm_status ON t_p13795046_functional_diagnosti.protocols;
+CREATE TRIGGER trg_protocols_sync_norm_status
+AFTER INSERT OR DELETE OR UPDATE OF results, study_type, study_date, doctor_id, patient_gender,
+    patient_age_years, patient_age_months, patient_age_days, patient_age_total_days,
+    patient_weight, patient_height, patient_bsa
+ON t_p13795046_functional_diagnosti.protocols
+FOR EACH ROW EXECUTE FUNCTION t_p13795046_functional_diagnosti.sync_protocol_norm_status();
+
+-- Строки для уже сохранённых протоколов оперативной таблицы; архивные заполняет archiver.py
+INSERT INTO t_p13795046_functional_diagnosti.protocol_norm_status
+    (protocol_id, param, doctor_id, study_type, study_date, category,
+     age_years, age_months, age_days, age_total_days, weight, height, bsa, value)
+SELECT p.id, r.param, p.doctor_id, p.study_type, p.study_date,
+       CASE WHEN p.patient_age_years IS NULL OR p.patient_gender NOT IN ('male', 'female') THEN NULL
+            WHEN p.patient_age_years < 18 THEN 'child_' || p.patient_gender
+            ELSE 'adult_' || p.patient_gender END,
+       p.patient_age_years, p.patient_age_months, p.patient_age_days, p.patient_age_total_days,
+       p.patient_weight, p.patient_height, p.patient_bsa, r.value
+FROM t_p13795046_functional_diagnosti.protocols p
+JOIN t_p13795046_functional_diagnosti.protocol_results r
+  ON r.protocol_id = p.id AND r.study_date = p.study_date
+ON CONFLICT (protocol_id, param) DO NOTHING;
+
+INSERT INTO t_p13795046_functional_diagnosti.jobs (doctor_id, kind)
+SELECT DISTINCT doctor_id, 'evaluate_norm_status'
+FROM t_p13795046_functional_diagnosti.protocol_norm_status;
+
+ANALYZE t_p13795046_functional_diagnosti.protocol_norm_status;
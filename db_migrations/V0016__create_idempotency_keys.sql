@@ -0,0 +1,15 @@
+-- Ключи идемпотентности запросов на запись (заголовок Idempotency-Key), см. backend/shared/idempotency.py.
+-- Строка занимается до выполнения запроса (status_code IS NULL, expires_at — срок захвата),
+-- после выполнения хранит сжатый ответ до expires_at. Ключ и отпечаток запроса — 16-байтные хэши
+CREATE TABLE IF NOT EXISTS t_p13795046_functional_diagnosti.idempotency_keys (
+    key_hash BYTEA PRIMARY KEY,
+    request_hash BYTEA NOT NULL,
+    status_code SMALLINT,
+    response BYTEA,
+    expires_at TIMESTAMP NOT NULL
+);
+
+COMMENT ON TABLE t_p13795046_functional_diagnosti.idempotency_keys IS 'Ответы на запросы с Idempotency-Key; просроченные строки удаляет backend/worker.py';
+
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires_at
+ON t_p13795046_functional_diagnosti.idempotency_keys(expires_at);
@@ -0,0 +1,20 @@
+-- Версия протокола для ETag: время последнего изменения строки.
+-- Существующие протоколы получают время применения миграции (значение по умолчанию без перезаписи таблицы)
+ALTER TABLE t_p13795046_functional_diagnosti.protocols
+    ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
+
+-- updated_at обновляется при любом изменении протокола, кем бы оно ни выполнялось
+CREATE OR REPLACE FUNCTION t_p13795046_functional_diagnosti.touch_protocol_updated_at()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    NEW.updated_at := clock_timestamp();
+    RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trg_protocols_touch_updated_at ON t_p13795046_functional_diagnosti.protocols;
+CREATE TRIGGER trg_protocols_touch_updated_at
+BEFORE UPDATE ON t_p13795046_functional_diagnosti.protocols
+FOR EACH ROW EXECUTE FUNCTION t_p13795046_functional_diagnosti.touch_protocol_updated_at();
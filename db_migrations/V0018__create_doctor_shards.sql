@@ -0,0 +1,17 @@
+-- Размещение врачей по узлам БД (backend/shared/shards.py). Таблица ведётся в каталоге — базе DATABASE_URL,
+-- где хранятся все врачи; на узлах схема та же, но используются только данные размещённых на них врачей.
+-- Строка создаётся при первом обращении врача по консистентному хешированию и дальше не меняется,
+-- кроме переноса врача (backend/move_doctor.py): на время переноса state = 'moving', запись отклоняется
+CREATE TABLE IF NOT EXISTS t_p13795046_functional_diagnosti.doctor_shards (
+    doctor_id INTEGER PRIMARY KEY REFERENCES t_p13795046_functional_diagnosti.doctors(id) ON DELETE CASCADE,
+    shard VARCHAR(64) NOT NULL,
+    state VARCHAR(16) NOT NULL DEFAULT 'active',
+    target_shard VARCHAR(64),
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    CHECK (state IN ('active', 'moving'))
+);
+
+COMMENT ON TABLE t_p13795046_functional_diagnosti.doctor_shards IS 'Узел БД с данными врача; отсутствие строки — узел ещё не назначен';
+
+CREATE INDEX IF NOT EXISTS idx_doctor_shards_shard
+ON t_p13795046_functional_diagnosti.doctor_shards(shard);
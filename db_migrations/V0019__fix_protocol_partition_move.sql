@@ -0,0 +1,74 @@
+-- Перенос строк из default-секции в новую секцию не должен терять показатели и статусы норм:
+-- DELETE из protocols_default запускает триггеры protocols, которые удаляют строки protocol_results
+-- и protocol_norm_status, а вставка в ещё не присоединённую секцию их не создаёт. Перенос выполняется
+-- с fd.archiving = on (как перенос в архив): триггеры при этом сохраняют строки показателей и статусов
+CREATE OR REPLACE FUNCTION t_p13795046_functional_diagnosti.ensure_protocol_partition(p_date DATE)
+RETURNS TEXT
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_from DATE := date_trunc('month', p_date)::date;
+    v_to DATE := (date_trunc('month', p_date) + INTERVAL '1 month')::date;
+    v_name TEXT := 'protocols_' || to_char(date_trunc('month', p_date), 'YYYY_MM');
+    v_columns TEXT;
+    v_archiving TEXT;
+BEGIN
+    IF to_regclass('t_p13795046_functional_diagnosti.' || v_name) IS NOT NULL THEN
+        RETURN v_name;
+    END IF;
+
+    PERFORM pg_advisory_xact_lock(hashtext('t_p13795046_functional_diagnosti.protocols_partitions'));
+
+    IF to_regclass('t_p13795046_functional_diagnosti.' || v_name) IS NOT NULL THEN
+        RETURN v_name;
+    END IF;
+
+    EXECUTE format(
+        'CREATE TABLE t_p13795046_functional_diagnosti.%I (LIKE t_p13795046_functional_diagnosti.protocols INCLUDING DEFAULTS INCLUDING GENERATED)',
+        v_name
+    );
+
+    IF to_regclass('t_p13795046_functional_diagnosti.protocols_default') IS NOT NULL THEN
+        SELECT string_agg(quote_ident(attname), ', ' ORDER BY attnum) INTO v_columns
+        FROM pg_attribute
+        WHERE attrelid = 't_p13795046_functional_diagnosti.protocols'::regclass
+          AND attnum > 0 AND NOT attisdropped AND attgenerated = '';
+
+        v_archiving := current_setting('fd.archiving', true);
+        PERFORM set_config('fd.archiving', 'on', true);
+        EXECUTE format(
+            'WITH moved AS (
+                 DELETE FROM t_p13795046_functional_diagnosti.protocols_default
+                 WHERE study_date >= %L AND study_date < %L
+                 RETURNING %s
+             )
+             INSERT INTO t_p13795046_functional_diagnosti.%I (%s) SELECT * FROM moved',
+            v_from, v_to, v_columns, v_name, v_columns
+        );
+        PERFORM set_config('fd.archiving', COALESCE(v_archiving, ''), true);
+    END IF;
+
+    EXECUTE format(
+        'ALTER TABLE t_p13795046_functional_diagnosti.protocols ATTACH PARTITION t_p13795046_functional_diagnosti.%I FOR VALUES FROM (%L) TO (%L)',
+        v_name, v_from, v_to
+    );
+
+    RETURN v_name;
+END;
+$$;
+
+-- V0007 создал секционированную таблицу через LIKE ... INCLUDING DEFAULTS, который не копирует
+-- внешние ключи: ссылка протокола на врача восстанавливается
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_constraint
+        WHERE conrelid = 't_p13795046_functional_diagnosti.protocols'::regclass
+          AND contype = 'f' AND confrelid = 't_p13795046_functional_diagnosti.doctors'::regclass
+    ) THEN
+        ALTER TABLE t_p13795046_functional_diagnosti.protocols
+            ADD CONSTRAINT protocols_doctor_id_fkey
+            FOREIGN KEY (doctor_id) REFERENCES t_p13795046_functional_diagnosti.doctors(id);
+    END IF;
+END;
+$$;
@@ -0,0 +1,58 @@
+-- Заполнение числовых столбцов возраста больше не стирает исходный текст patient_age:
+-- старое значение остаётся для сверки и отката, чтение по-прежнему берёт числовые столбцы, если они заданы.
+-- Один пакет по диапазону id; возвращает число обновлённых строк
+CREATE OR REPLACE FUNCTION t_p13795046_functional_diagnosti.backfill_patient_age_batch(p_after_id INTEGER, p_batch_size INTEGER)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_updated INTEGER;
+BEGIN
+    UPDATE t_p13795046_functional_diagnosti.protocols p
+    SET patient_age_years = (a.age ->> 'years')::smallint,
+        patient_age_months = COALESCE((a.age ->> 'months')::smallint, 0),
+        patient_age_days = COALESCE((a.age ->> 'days')::smallint, 0),
+        patient_age_total_days = round(
+            (a.age ->> 'years')::numeric * 365.25
+            + COALESCE((a.age ->> 'months')::numeric, 0) * 30.44
+            + COALESCE((a.age ->> 'days')::numeric, 0)
+        )::integer
+    FROM (
+        SELECT id, study_date, t_p13795046_functional_diagnosti.parse_patient_age(patient_age) AS age
+        FROM t_p13795046_functional_diagnosti.protocols
+        WHERE id > p_after_id AND id <= p_after_id + p_batch_size
+          AND patient_age IS NOT NULL AND patient_age_total_days IS NULL
+    ) a
+    WHERE p.id = a.id AND p.study_date = a.study_date
+      AND jsonb_typeof(a.age -> 'years') = 'number';
+    GET DIAGNOSTICS v_updated = ROW_COUNT;
+    RETURN v_updated;
+END;
+$$;
+
+-- Ручной запуск вне транзакции: CALL t_p13795046_functional_diagnosti.backfill_patient_age(5000);
+CREATE OR REPLACE PROCEDURE t_p13795046_functional_diagnosti.backfill_patient_age(p_batch_size INTEGER DEFAULT 5000)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_last_id INTEGER := 0;
+    v_max_id INTEGER;
+BEGIN
+    SELECT COALESCE(max(id), 0) INTO v_max_id FROM t_p13795046_functional_diagnosti.protocols;
+
+    WHILE v_last_id < v_max_id LOOP
+        PERFORM t_p13795046_functional_diagnosti.backfill_patient_age_batch(v_last_id, p_batch_size);
+        v_last_id := v_last_id + p_batch_size;
+        COMMIT;
+    END LOOP;
+END;
+$$;
+
+-- Миграция выполняется в одной транзакции, поэтому пакетное заполнение ставится фоновой задачей:
+-- её выполняет backend/worker.py (вид backfill_patient_age) после применения миграции
+INSERT INTO t_p13795046_functional_diagnosti.jobs (kind)
+SELECT 'backfill_patient_age'
+WHERE EXISTS (
+    SELECT 1 FROM t_p13795046_functional_diagnosti.protocols
+    WHERE patient_age IS NOT NULL AND patient_age_total_days IS NULL
+);
@@ -0,0 +1,15 @@
+-- Результат фоновой задачи частями: выгрузка протоколов пишет сюда пакеты по EXPORT_CHUNK_SIZE,
+-- а jobs.result хранит только число строк и частей; клиент читает части через GET ?job_id=...&offset=...
+CREATE TABLE IF NOT EXISTS t_p13795046_functional_diagnosti.job_result_chunks (
+    job_id BIGINT NOT NULL REFERENCES t_p13795046_functional_diagnosti.jobs(id) ON DELETE CASCADE,
+    chunk INTEGER NOT NULL,
+    doctor_id INTEGER REFERENCES t_p13795046_functional_diagnosti.doctors(id),
+    items JSONB NOT NULL,
+    PRIMARY KEY (job_id, chunk)
+);
+
+COMMENT ON TABLE t_p13795046_functional_diagnosti.job_result_chunks IS 'Части результата фоновых задач (выгрузка протоколов)';
+
+-- Перенос врача между узлами (backend/move_doctor.py) выбирает строки по doctor_id
+CREATE INDEX IF NOT EXISTS idx_job_result_chunks_doctor_id
+ON t_p13795046_functional_diagnosti.job_result_chunks(doctor_id);
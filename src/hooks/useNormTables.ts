@@ -22,6 +22,8 @@ type ApiNormTable = {
   conclusion_borderline_high?: string;
   created_at: string;
   updated_at: string;
+  base_key?: string | null;
+  source?: 'base' | 'override' | 'own';
 };
 
 function convertFromApi(apiTable: ApiNormTable): NormTable {
@@ -1,17 +1,30 @@
 import { useState, useEffect } from 'react';
 import { toast } from 'sonner';
 import { Protocol } from '@/types/medical';
+import { ImportedProtocol } from '@/utils/excelImport';
 import func2url from '../../backend/func2url.json';
 
 const API_URL = func2url.protocols;
+const IMPORT_BATCH_SIZE = 1000;
 
 type ProtocolFilters = {
+  // Полнотекстовый поиск по заключению и показателям, результаты по релевантности
+  q?: string;
+  limit?: string;
+  offset?: string;
   search_name?: string;
   search_study_type?: string;
   date_from?: string;
   date_to?: string;
-  sort_by?: 'created_at' | 'study_date' | 'patient_name' | 'study_type';
+  sort_by?: 'created_at' | 'study_date' | 'patient_name' | 'study_type' | 'rank';
   sort_order?: 'asc' | 'desc';
+  age_from?: string;
+  age_to?: string;
+  age_unit?: 'years' | 'months' | 'days';
+  // Фильтры по значениям показателей, несколько через запятую: param=ef&op=lt&value=50
+  param?: string;
+  op?: string;
+  value?: string;
 };
 
 export const useProtocolsAPI = (authToken: string | null) => {
@@ -195,22 +208,101 @@ export const useProtocolsAPI = (authToken: string | null) => {
     }
   };
 
-  const importProtocols = async (importedProtocols: any[]) => {
+  // Групповые операции: по списку id или по фильтрам списка; за запрос не больше BULK_MAX_BATCH протоколов,
+  // при has_more запрос повторяется для оставшихся
+  const bulkUpdateProtocols = async (
+    action: 'bulk_sign' | 'bulk_delete' | 'bulk_set_study_type',
+    target: { ids?: string[]; filters?: ProtocolFilters },
+    studyType?: string
+  ) => {
+    if (!authToken) {
+      toast.error('Требуется авторизация');
+      return [];
+    }
+
+    const affectedIds: number[] = [];
+    try {
+      let hasMore = true;
+      while (hasMore) {
+        const response = await fetch(API_URL, {
+          method: 'POST',
+          headers: {
+            'Content-Type': 'application/json',
+            'X-Auth-Token': authToken,
+          },
+          body: JSON.stringify({
+            action,
+            ids: target.ids?.map((id) => parseInt(id)),
+            filters: target.filters,
+            study_type: studyType,
+          }),
+        });
+
+        const data = await response.json();
+        if (!response.ok) {
+          throw new Error(data.error || 'Ошибка групповой операции');
+        }
+        affectedIds.push(...data.ids);
+        hasMore = data.has_more && !target.ids && data.count > 0;
+      }
+
+      toast.success(`Обработано протоколов: ${affectedIds.length}`);
+    } catch (error: any) {
+      toast.error(error.message || 'Не удалось выполнить групповую операцию');
+      console.error(error);
+    }
+    fetchProtocols();
+    return affectedIds;
+  };
+
+  const importProtocols = async (importedProtocols: ImportedProtocol[]) => {
     if (!authToken) {
       toast.error('Требуется авторизация');
       return;
     }
 
+    // Возраст и BSA вычисляет сервер по датам, массе и росту
+    const payload = importedProtocols.map((protocol) => ({
+      study_type: protocol.studyType,
+      patient_name: protocol.patientName,
+      patient_gender: protocol.gender,
+      patient_birth_date: protocol.birthDate,
+      patient_weight: protocol.weight || null,
+      patient_height: protocol.height || null,
+      ultrasound_device: protocol.ultrasoundDevice || null,
+      study_date: protocol.studyDate,
+      results: protocol.results,
+      conclusion: protocol.conclusion,
+    }));
+
     let successCount = 0;
     let failCount = 0;
 
-    for (const protocol of importedProtocols) {
-      const created = await createProtocol(protocol);
-      if (created) {
-        successCount++;
-      } else {
-        failCount++;
+    try {
+      for (let start = 0; start < payload.length; start += IMPORT_BATCH_SIZE) {
+        const response = await fetch(API_URL, {
+          method: 'POST',
+          headers: {
+            'Content-Type': 'application/json',
+            'X-Auth-Token': authToken,
+          },
+          body: JSON.stringify({
+            action: 'import_protocols',
+            protocols: payload.slice(start, start + IMPORT_BATCH_SIZE),
+            skip_invalid: true,
+          }),
+        });
+
+        const data = await response.json();
+        if (!response.ok) {
+          throw new Error(data.error || 'Ошибка импорта протоколов');
+        }
+        successCount += data.count;
+        failCount += data.errors.length;
       }
+    } catch (error: any) {
+      toast.error(error.message || 'Не удалось импортировать протоколы');
+      console.error(error);
     }
 
     if (successCount > 0) {
@@ -236,6 +328,7 @@ export const useProtocolsAPI = (authToken: string | null) => {
     createProtocol,
     updateProtocol,
     deleteProtocol,
+    bulkUpdateProtocols,
     importProtocols,
   };
 };
\ No newline at end of file
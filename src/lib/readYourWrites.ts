@@ -0,0 +1,38 @@
+import func2url from '../../backend/func2url.json';
+
+// Время последней записи в БД (заголовок X-Last-Write ответа функций). Возвращается функциям
+// в каждом запросе, чтобы следующие чтения шли на основную БД, а не на отстающую реплику
+const WRITE_MARK_HEADER = 'X-Last-Write';
+const STORAGE_KEY = 'fd_last_write';
+
+const API_URLS = Object.values(func2url) as string[];
+
+const isApiRequest = (input: RequestInfo | URL) => {
+  const url = typeof input === 'string' ? input : input instanceof URL ? input.href : input.url;
+  return API_URLS.some((apiUrl) => url.startsWith(apiUrl));
+};
+
+export const installReadYourWrites = () => {
+  const originalFetch = window.fetch.bind(window);
+
+  window.fetch = async (input: RequestInfo | URL, init?: RequestInit) => {
+    if (!isApiRequest(input)) {
+      return originalFetch(input, init);
+    }
+
+    const lastWrite = localStorage.getItem(STORAGE_KEY);
+    let request = init;
+    if (lastWrite) {
+      const headers = new Headers(init?.headers ?? (input instanceof Request ? input.headers : undefined));
+      headers.set(WRITE_MARK_HEADER, lastWrite);
+      request = { ...init, headers };
+    }
+
+    const response = await originalFetch(input, request);
+    const written = response.headers.get(WRITE_MARK_HEADER);
+    if (written && Number(written) > Number(localStorage.getItem(STORAGE_KEY) || 0)) {
+      localStorage.setItem(STORAGE_KEY, written);
+    }
+    return response;
+  };
+};